@@ -2,7 +2,9 @@ import argparse
 import subprocess
 
 from .platform import SensorPlatform, SwitchPlatform
-from .top import SensorTop, SwitchTop
+from .top import SensorTop, SwitchTop, SWITCH_CSRS, SWITCH_UDP_LEN
+from .csr import generate_bindings
+from .user import CMD_CSR
 
 
 def main():
@@ -12,7 +14,15 @@ def main():
     parser.add_argument("--verilog", action="store_true")
     parser.add_argument("--program", action="store_true")
     parser.add_argument("--flash", action="store_true")
+    parser.add_argument("--csr-bindings", metavar="FILE",
+                        help="write host CSR bindings to FILE and exit")
     args = parser.parse_args()
+    if args.csr_bindings:
+        if args.device != "switch":
+            parser.error("only the switch has CSRs")
+        with open(args.csr_bindings, "w") as f:
+            f.write(generate_bindings(SWITCH_CSRS, CMD_CSR, SWITCH_UDP_LEN))
+        return
     if args.device == "switch":
         plat = SwitchPlatform()
         top = SwitchTop(plat, args)
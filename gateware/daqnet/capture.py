@@ -0,0 +1,623 @@
+"""
+Triggered sample capture.
+
+Copyright 2018-2019 Adam Greig
+Released under the MIT license; see LICENSE for details.
+"""
+
+from nmigen import Elaboratable, Module, Signal, Memory, Array, Cat, Repl
+from nmigen.lib.fifo import SyncFIFO
+
+
+# Trigger modes
+TRIGGER_OFF = 0
+TRIGGER_ABOVE = 1
+TRIGGER_BELOW = 2
+TRIGGER_RISING = 3
+TRIGGER_FALLING = 4
+
+
+class Trigger(Elaboratable):
+    """
+    Sample trigger engine.
+
+    Compares each sample against a threshold. In `TRIGGER_ABOVE` and
+    `TRIGGER_BELOW` modes it triggers on every sample above or at-or-below
+    the threshold, and in `TRIGGER_RISING` and `TRIGGER_FALLING` modes only
+    on the first sample after crossing it.
+
+    Parameters:
+        * `width`: Width of samples
+
+    Inputs:
+        * `in_data`: `width`-bit two's complement sample
+        * `in_valid`: High when a new sample is at `in_data`
+        * `mode`: One of the `TRIGGER_` modes
+        * `level`: `width`-bit two's complement threshold
+
+    Outputs:
+        * `trigger`: High with `in_valid` when the sample triggers
+    """
+    def __init__(self, width):
+        self.in_data = Signal(width)
+        self.in_valid = Signal()
+        self.mode = Signal(3)
+        self.level = Signal(width)
+        self.trigger = Signal()
+
+        self.width = width
+
+    def elaborate(self, platform):
+        m = Module()
+
+        # Offset both values so an unsigned comparison orders them as signed
+        offset = 1 << (self.width - 1)
+        above = Signal()
+        was_above = Signal()
+        m.d.comb += above.eq((self.in_data ^ offset) > (self.level ^ offset))
+        with m.If(self.in_valid):
+            m.d.sync += was_above.eq(above)
+
+        with m.Switch(self.mode):
+            with m.Case(TRIGGER_ABOVE):
+                m.d.comb += self.trigger.eq(self.in_valid & above)
+            with m.Case(TRIGGER_BELOW):
+                m.d.comb += self.trigger.eq(self.in_valid & ~above)
+            with m.Case(TRIGGER_RISING):
+                m.d.comb += self.trigger.eq(
+                    self.in_valid & above & ~was_above)
+            with m.Case(TRIGGER_FALLING):
+                m.d.comb += self.trigger.eq(
+                    self.in_valid & ~above & was_above)
+
+        return m
+
+
+class TriggeredCapture(Elaboratable):
+    """
+    Triggered capture with a pre-trigger ring buffer.
+
+    Once armed, samples are continuously written into a BRAM ring buffer.
+    A trigger is accepted once at least `pre_len` samples are held, after
+    which `post_len` samples starting with the triggering one are written.
+    The `pre_len + post_len` captured samples are then read out in order,
+    one per clock while `out_ready` is high, for transmission. Samples
+    arriving during readout are discarded.
+
+    Parameters:
+        * `width`: Width of samples
+        * `depth`: Ring buffer depth in samples, a power of two
+
+    Inputs:
+        * `in_data`: `width`-bit sample
+        * `in_valid`: High when a new sample is at `in_data`
+        * `trigger`: High with `in_valid` when the sample triggers, for
+                     example from a `Trigger`
+        * `arm`: Pulse high to start capturing
+        * `rearm`: If high, arm again automatically after each readout
+        * `pre_len`: Number of samples before the trigger to capture
+        * `post_len`: Number of samples from the trigger to capture, at
+                      least 1. `pre_len + post_len` must not exceed `depth`.
+        * `out_ready`: High when the sample at `out_data` may be taken
+
+    Outputs:
+        * `armed`: High while waiting for a trigger
+        * `busy`: High from the trigger until readout is complete
+        * `out_data`: Captured sample being read out
+        * `out_valid`: High while a sample is at `out_data`
+        * `out_last`: High with the final sample of a capture
+    """
+    def __init__(self, width, depth):
+        if depth & (depth - 1):
+            raise ValueError(f"depth={depth} must be a power of two")
+
+        self.in_data = Signal(width)
+        self.in_valid = Signal()
+        self.trigger = Signal()
+        self.arm = Signal()
+        self.rearm = Signal()
+        self.pre_len = Signal(max=depth+1)
+        self.post_len = Signal(max=depth+1)
+        self.out_ready = Signal()
+
+        self.armed = Signal()
+        self.busy = Signal()
+        self.out_data = Signal(width)
+        self.out_valid = Signal()
+        self.out_last = Signal()
+
+        self.mem = Memory(width, depth)
+        self.depth = depth
+
+    def elaborate(self, platform):
+        m = Module()
+        m.submodules.wport = wport = self.mem.write_port()
+        m.submodules.rport = rport = self.mem.read_port(transparent=False)
+
+        addr_bits = (self.depth - 1).bit_length()
+        waddr = Signal(addr_bits)
+        raddr = Signal(addr_bits)
+        filled = Signal(max=self.depth+1)
+        remaining = Signal(max=self.depth+1)
+
+        m.d.comb += [
+            wport.addr.eq(waddr),
+            wport.data.eq(self.in_data),
+            rport.addr.eq(raddr),
+            rport.en.eq(1),
+            self.out_data.eq(rport.data),
+        ]
+
+        with m.FSM() as fsm:
+            m.d.comb += [
+                self.armed.eq(fsm.ongoing("ARMED")),
+                self.busy.eq(fsm.ongoing("POST") | fsm.ongoing("PRIME") |
+                             fsm.ongoing("READOUT")),
+            ]
+
+            with m.State("IDLE"):
+                m.d.sync += filled.eq(0)
+                with m.If(self.arm):
+                    m.next = "ARMED"
+
+            with m.State("ARMED"):
+                with m.If(self.in_valid):
+                    m.d.comb += wport.en.eq(1)
+                    m.d.sync += waddr.eq(waddr + 1)
+                    with m.If(filled != self.depth):
+                        m.d.sync += filled.eq(filled + 1)
+                    with m.If(self.trigger & (filled >= self.pre_len)):
+                        m.d.sync += [
+                            raddr.eq(waddr - self.pre_len),
+                            remaining.eq(self.post_len - 1),
+                        ]
+                        with m.If(self.post_len == 1):
+                            m.next = "PRIME"
+                        with m.Else():
+                            m.next = "POST"
+
+            with m.State("POST"):
+                with m.If(self.in_valid):
+                    m.d.comb += wport.en.eq(1)
+                    m.d.sync += [
+                        waddr.eq(waddr + 1),
+                        remaining.eq(remaining - 1),
+                    ]
+                    with m.If(remaining == 1):
+                        m.next = "PRIME"
+
+            # Wait for the first sample to be read from memory
+            with m.State("PRIME"):
+                m.d.sync += remaining.eq(self.pre_len + self.post_len)
+                m.next = "READOUT"
+
+            # Present each sample in turn, reading the next one from
+            # memory as soon as the current one is taken
+            with m.State("READOUT"):
+                m.d.comb += [
+                    self.out_valid.eq(1),
+                    self.out_last.eq(remaining == 1),
+                ]
+                with m.If(self.out_ready):
+                    m.d.comb += rport.addr.eq(raddr + 1)
+                    m.d.sync += [
+                        raddr.eq(raddr + 1),
+                        remaining.eq(remaining - 1),
+                    ]
+                    with m.If(remaining == 1):
+                        m.d.sync += filled.eq(0)
+                        with m.If(self.rearm):
+                            m.next = "ARMED"
+                        with m.Else():
+                            m.next = "IDLE"
+
+        return m
+
+
+class SawtoothSource(Elaboratable):
+    """
+    Synthetic sample source, for exercising the capture path without an ADC.
+
+    Produces a sawtooth, adding `step` to the sample every `period + 1`
+    clocks and wrapping around at the sample width.
+
+    Parameters:
+        * `width`: Width of samples
+
+    Inputs:
+        * `period`: 16-bit number of clocks between samples, less one
+        * `step`: `width`-bit increment between samples
+
+    Outputs:
+        * `out_data`: `width`-bit sample
+        * `out_valid`: Pulsed high when a new sample is at `out_data`
+    """
+    def __init__(self, width):
+        self.period = Signal(16)
+        self.step = Signal(width)
+        self.out_data = Signal(width)
+        self.out_valid = Signal()
+
+    def elaborate(self, platform):
+        m = Module()
+
+        ctr = Signal(16)
+        with m.If(ctr >= self.period):
+            m.d.sync += [
+                ctr.eq(0),
+                self.out_data.eq(self.out_data + self.step),
+                self.out_valid.eq(1),
+            ]
+        with m.Else():
+            m.d.sync += [
+                ctr.eq(ctr + 1),
+                self.out_valid.eq(0),
+            ]
+
+        return m
+
+
+class SampleSerialiser(Elaboratable):
+    """
+    Serialise samples into a byte stream.
+
+    Each sample is sign extended to a whole number of bytes and sent most
+    significant byte first, one byte per clock while `out_ready` is high.
+    A new sample is taken as the final byte of the previous one is sent.
+
+    Parameters:
+        * `width`: Width of samples
+
+    Inputs:
+        * `in_data`: `width`-bit two's complement sample
+        * `in_valid`: High while a sample is at `in_data`
+        * `in_last`: High with the final sample of a capture
+        * `out_ready`: High when the byte at `out_data` may be taken
+
+    Outputs:
+        * `in_ready`: High when the sample at `in_data` is taken
+        * `out_data`: 8-bit byte being sent
+        * `out_valid`: High while a byte is at `out_data`
+        * `out_last`: High with the final byte of a capture
+    """
+    def __init__(self, width):
+        self.in_data = Signal(width)
+        self.in_valid = Signal()
+        self.in_last = Signal()
+        self.out_ready = Signal()
+
+        self.in_ready = Signal()
+        self.out_data = Signal(8)
+        self.out_valid = Signal()
+        self.out_last = Signal()
+
+        self.width = width
+        self.nbytes = (width + 7) // 8
+
+    def elaborate(self, platform):
+        m = Module()
+
+        pad = 8 * self.nbytes - self.width
+        data = Signal(8 * self.nbytes)
+        last = Signal()
+        full = Signal()
+        idx = Signal(max=self.nbytes)
+        final = Signal()
+
+        data_bytes = Array(data[8*(self.nbytes-i-1):8*(self.nbytes-i)]
+                           for i in range(self.nbytes))
+        m.d.comb += [
+            final.eq(idx == self.nbytes - 1),
+            self.out_data.eq(data_bytes[idx]),
+            self.out_valid.eq(full),
+            self.out_last.eq(full & last & final),
+            self.in_ready.eq(~full | (self.out_ready & final)),
+        ]
+
+        with m.If(full & self.out_ready):
+            m.d.sync += idx.eq(idx + 1)
+            with m.If(final):
+                m.d.sync += [
+                    full.eq(0),
+                    idx.eq(0),
+                ]
+        with m.If(self.in_valid & self.in_ready):
+            m.d.sync += [
+                data.eq(Cat(self.in_data, Repl(self.in_data[-1], pad))),
+                last.eq(self.in_last),
+                full.eq(1),
+                idx.eq(0),
+            ]
+
+        return m
+
+
+class BurstBuffer(Elaboratable):
+    """
+    Byte FIFO which gathers a slow stream into bursts.
+
+    Bytes from a producer without back pressure, such as a `RiceEncoder`,
+    are held until `burst_len` bytes are buffered, the byte marked with
+    `in_last` is buffered, or the FIFO is nearly full, so a consumer which
+    blocks while waiting for bytes, such as `IPStack`, is not held up by
+    the slow stream. While `out_ready` is high, `out_valid` is raised for
+    any buffered byte, so a consumer which has started a burst and is
+    waiting for more bytes is not stalled.
+
+    Parameters:
+        * `depth`: FIFO depth in bytes
+        * `reserve`: Bytes kept free for the producer, which must not
+                     start producing more than this many bytes while
+                     `in_room` is low
+
+    Inputs:
+        * `in_data`: 8-bit byte to buffer
+        * `in_valid`: Pulsed high when a new byte is at `in_data`
+        * `in_last`: High with the final byte of a capture
+        * `burst_len`: 11-bit number of bytes to buffer before a burst
+        * `out_ready`: High when the byte at `out_data` may be taken
+
+    Outputs:
+        * `in_room`: High while at least `reserve` bytes are free
+        * `out_data`: 8-bit byte being sent
+        * `out_valid`: High while a byte is at `out_data`
+        * `out_last`: High with the final byte of a capture
+    """
+    def __init__(self, depth, reserve):
+        self.in_data = Signal(8)
+        self.in_valid = Signal()
+        self.in_last = Signal()
+        self.burst_len = Signal(11)
+        self.out_ready = Signal()
+
+        self.in_room = Signal()
+        self.out_data = Signal(8)
+        self.out_valid = Signal()
+        self.out_last = Signal()
+
+        self.depth = depth
+        self.reserve = reserve
+
+    def elaborate(self, platform):
+        m = Module()
+        m.submodules.fifo = fifo = SyncFIFO(width=9, depth=self.depth)
+
+        # Count the final bytes of captures in the FIFO
+        lasts = Signal(max=self.depth+1)
+        write_last = Signal()
+        read_last = Signal()
+        burst = Signal()
+        m.d.comb += [
+            fifo.din.eq(Cat(self.in_data, self.in_last)),
+            fifo.we.eq(self.in_valid),
+            fifo.re.eq(self.out_valid & self.out_ready),
+            write_last.eq(fifo.we & self.in_last),
+            read_last.eq(fifo.re & self.out_last),
+            self.in_room.eq(fifo.level <= self.depth - self.reserve),
+            burst.eq((fifo.level >= self.burst_len) | ~self.in_room |
+                     (lasts != 0)),
+            self.out_data.eq(fifo.dout[:8]),
+            self.out_last.eq(fifo.dout[8]),
+            self.out_valid.eq(fifo.readable & (burst | self.out_ready)),
+        ]
+        m.d.sync += lasts.eq(lasts + write_last - read_last)
+
+        return m
+
+
+def test_trigger():
+    from nmigen.back import pysim
+
+    trigger = Trigger(8)
+    samples = [0, 10, 20, -5, -30, 25, 40, -128, 127]
+    level = 15
+    expected = {
+        TRIGGER_OFF: [0] * len(samples),
+        TRIGGER_ABOVE: [int(x > level) for x in samples],
+        TRIGGER_BELOW: [int(x <= level) for x in samples],
+        TRIGGER_RISING: [0, 0, 1, 0, 0, 1, 0, 0, 1],
+        TRIGGER_FALLING: [0, 0, 0, 1, 0, 0, 0, 1, 0],
+    }
+
+    def testbench():
+        yield trigger.level.eq(level)
+        for mode, triggers in expected.items():
+            yield trigger.mode.eq(mode)
+            for sample, triggered in zip(samples, triggers):
+                yield trigger.in_data.eq(sample & 0xFF)
+                yield trigger.in_valid.eq(1)
+                yield
+                assert (yield trigger.trigger) == triggered
+            # Start each mode below the threshold
+            yield trigger.in_data.eq(0)
+            yield
+
+    vcdf = open("trigger.vcd", "w")
+    with pysim.Simulator(trigger, vcd_file=vcdf) as sim:
+        sim.add_clock(1e-6)
+        sim.add_sync_process(testbench())
+        sim.run()
+
+
+def test_triggered_capture():
+    import random
+    from nmigen.back import pysim
+
+    depth = 64
+    capture = TriggeredCapture(8, depth)
+
+    def testbench():
+        rng = random.Random(0)
+        sample = 0
+        for pre_len, post_len, trig_at in ((10, 20, 40), (0, 1, 3),
+                                           (30, 34, 100), (5, 5, 2)):
+            yield capture.pre_len.eq(pre_len)
+            yield capture.post_len.eq(post_len)
+            yield capture.arm.eq(1)
+            yield
+            yield capture.arm.eq(0)
+            yield
+
+            # Stream samples, requesting a trigger on sample `trig_at`.
+            # Triggers before `pre_len` samples are held are ignored.
+            sent = []
+            first = max(trig_at, pre_len)
+            while len(sent) < first + post_len:
+                if rng.random() < 0.7:
+                    trig = len(sent) in (trig_at, first)
+                    yield capture.in_data.eq(sample)
+                    yield capture.in_valid.eq(1)
+                    yield capture.trigger.eq(trig)
+                    sent.append(sample)
+                    sample = (sample + 1) % 256
+                yield
+                yield capture.in_valid.eq(0)
+                yield capture.trigger.eq(0)
+            expected = sent[first - pre_len:first + post_len]
+
+            # Read out with random back pressure
+            received = []
+            for _ in range(4 * depth):
+                ready = rng.random() < 0.6
+                yield capture.out_ready.eq(ready)
+                yield
+                if ready and (yield capture.out_valid):
+                    received.append((yield capture.out_data))
+                    if (yield capture.out_last):
+                        break
+            yield capture.out_ready.eq(0)
+            yield
+            assert received == expected
+            assert not (yield capture.busy)
+
+    vcdf = open("triggered_capture.vcd", "w")
+    with pysim.Simulator(capture, vcd_file=vcdf) as sim:
+        sim.add_clock(1e-6)
+        sim.add_sync_process(testbench())
+        sim.run()
+
+
+def test_sample_serialiser():
+    import random
+    from nmigen.back import pysim
+
+    serialiser = SampleSerialiser(12)
+    samples = [0x123, 0x7FF, 0x800, 0xFFF, 0x001, 0xA5A]
+    expected = []
+    for sample in samples:
+        value = sample | (0xF000 if sample & 0x800 else 0)
+        expected += [value >> 8, value & 0xFF]
+
+    def testbench():
+        rng = random.Random(0)
+        to_send = list(samples)
+        received = []
+        last_at = None
+        for _ in range(100):
+            if to_send:
+                yield serialiser.in_data.eq(to_send[0])
+                yield serialiser.in_last.eq(len(to_send) == 1)
+            yield serialiser.in_valid.eq(len(to_send) != 0 and
+                                         rng.random() < 0.7)
+            yield serialiser.out_ready.eq(rng.random() < 0.7)
+            yield
+            if (yield serialiser.in_valid) and (yield serialiser.in_ready):
+                to_send.pop(0)
+            if (yield serialiser.out_valid) and (yield serialiser.out_ready):
+                received.append((yield serialiser.out_data))
+                if (yield serialiser.out_last):
+                    last_at = len(received)
+        assert received == expected
+        assert last_at == len(expected)
+
+    vcdf = open("sample_serialiser.vcd", "w")
+    with pysim.Simulator(serialiser, vcd_file=vcdf) as sim:
+        sim.add_clock(1e-6)
+        sim.add_sync_process(testbench())
+        sim.run()
+
+
+def test_burst_buffer():
+    from nmigen.back import pysim
+
+    buffer = BurstBuffer(16, 4)
+
+    def testbench():
+        received = []
+
+        def push(byte, last=0):
+            yield buffer.in_data.eq(byte)
+            yield buffer.in_last.eq(last)
+            yield buffer.in_valid.eq(1)
+            yield
+            yield buffer.in_valid.eq(0)
+            yield
+            yield
+
+        def pull():
+            yield buffer.out_ready.eq(1)
+            for _ in range(20):
+                yield
+                if (yield buffer.out_valid):
+                    received.append(((yield buffer.out_data),
+                                     (yield buffer.out_last)))
+                else:
+                    break
+            yield buffer.out_ready.eq(0)
+            yield
+
+        # Bytes are only offered once a burst is buffered
+        yield buffer.burst_len.eq(8)
+        for byte in range(8):
+            assert not (yield buffer.out_valid)
+            yield from push(byte)
+        assert (yield buffer.out_valid)
+        yield from pull()
+        assert received == [(x, 0) for x in range(8)]
+
+        # The final byte of a capture ends a burst early
+        received.clear()
+        yield from push(10)
+        yield from push(11)
+        assert not (yield buffer.out_valid)
+        yield from push(12, last=1)
+        assert (yield buffer.out_valid)
+        yield from pull()
+        assert received == [(10, 0), (11, 0), (12, 1)]
+
+        # Bytes are offered as they arrive while the consumer is waiting
+        received.clear()
+        yield buffer.out_ready.eq(1)
+        for byte in (20, 21):
+            yield buffer.in_data.eq(byte)
+            yield buffer.in_last.eq(0)
+            yield buffer.in_valid.eq(1)
+            yield
+            yield buffer.in_valid.eq(0)
+            for _ in range(3):
+                yield
+                if (yield buffer.out_valid):
+                    received.append(((yield buffer.out_data),
+                                     (yield buffer.out_last)))
+        yield buffer.out_ready.eq(0)
+        yield
+        assert received == [(20, 0), (21, 0)]
+        assert not (yield buffer.out_valid)
+
+        # A nearly full FIFO is sent even if the burst is longer
+        received.clear()
+        yield buffer.burst_len.eq(100)
+        for byte in range(13):
+            assert (yield buffer.in_room)
+            assert not (yield buffer.out_valid)
+            yield from push(30 + byte)
+        assert not (yield buffer.in_room)
+        assert (yield buffer.out_valid)
+        yield from pull()
+        assert received == [(30 + x, 0) for x in range(13)]
+
+    vcdf = open("burst_buffer.vcd", "w")
+    with pysim.Simulator(buffer, vcd_file=vcdf) as sim:
+        sim.add_clock(1e-6)
+        sim.add_sync_process(testbench())
+        sim.run()
@@ -0,0 +1,495 @@
+"""
+Control and status registers.
+
+Copyright 2018-2019 Adam Greig
+Released under the MIT license; see LICENSE for details.
+"""
+
+import textwrap
+from nmigen import Elaboratable, Module, Signal, Array, Cat, Mux
+
+
+# Set in the op byte of a CSR packet to write the register
+CSR_WRITE = 0x80
+
+# Length of the CSR packet header, and of each op in the packet
+CSR_HEADER_LEN = 2
+CSR_OP_LEN = 5
+
+
+class CSR:
+    """
+    Description of a control or status register.
+
+    Parameters:
+        * `name`: Register name, a valid Python identifier
+        * `width`: Width in bits, at most 32
+        * `access`: "rw" for registers written by the host, or "ro" for
+                    registers driven by the gateware
+        * `reset`: Reset value of "rw" registers
+        * `desc`: Description for the host bindings
+        * `max`: Largest value of "rw" registers, with larger writes
+                 clamped to it, or None to allow any value
+    """
+    def __init__(self, name, width=32, access="rw", reset=0, desc="",
+                 max=None):
+        if not 1 <= width <= 32:
+            raise ValueError(f"width={width} invalid for CSR {name}")
+        if access not in ("rw", "ro"):
+            raise ValueError(f"access={access} invalid for CSR {name}")
+        if max is not None and not reset <= max < 2**width:
+            raise ValueError(f"max={max} invalid for CSR {name}")
+
+        self.name = name
+        self.width = width
+        self.access = access
+        self.reset = reset
+        self.desc = desc
+        self.max = max
+
+
+class CSRBank(Elaboratable):
+    """
+    Bank of control and status registers on a simple bus.
+
+    Registers are given consecutive addresses in the order of `csrs`.
+    "rw" registers are held in the bank and are updated by bus writes,
+    while "ro" registers are inputs to the bank and ignore writes. Writes
+    above a register's `max` store `max` instead. Each register's Signal
+    is `bank[name]`.
+
+    Parameters:
+        * `csrs`: List of up to 128 `CSR` descriptions
+
+    Bus inputs:
+        * `addr`: 7-bit register address
+        * `wdata`: 32-bit data to write
+        * `we`: Pulse high to write `wdata` to `addr`
+
+    Bus outputs:
+        * `rdata`: 32-bit value of the register at `addr` one clock before,
+                   or 0 for addresses without a register
+
+    Outputs:
+        * `strobe(name)`: Pulsed high when a register is written
+    """
+    def __init__(self, csrs):
+        if len(csrs) > 128:
+            raise ValueError("Too many CSRs for bank")
+        names = [csr.name for csr in csrs]
+        if len(set(names)) != len(names):
+            raise ValueError("Duplicate CSR names in bank")
+
+        self.addr = Signal(7)
+        self.wdata = Signal(32)
+        self.we = Signal()
+        self.rdata = Signal(32)
+
+        self.csrs = csrs
+        self.regs = {csr.name: Signal(csr.width, reset=csr.reset,
+                                      name=f"csr_{csr.name}")
+                     for csr in csrs}
+        self.strobes = {csr.name: Signal(name=f"csr_{csr.name}_we")
+                        for csr in csrs}
+
+    def __getitem__(self, name):
+        return self.regs[name]
+
+    def strobe(self, name):
+        return self.strobes[name]
+
+    def elaborate(self, platform):
+        m = Module()
+
+        with m.Switch(self.addr):
+            for addr, csr in enumerate(self.csrs):
+                with m.Case(addr):
+                    reg = self.regs[csr.name]
+                    m.d.sync += self.rdata.eq(reg)
+                    m.d.comb += self.strobes[csr.name].eq(self.we)
+                    if csr.access == "rw" and csr.max is not None:
+                        with m.If(self.we):
+                            m.d.sync += reg.eq(Mux(self.wdata > csr.max,
+                                                   csr.max, self.wdata))
+                    elif csr.access == "rw":
+                        with m.If(self.we):
+                            m.d.sync += reg.eq(self.wdata)
+            with m.Case():
+                m.d.sync += self.rdata.eq(0)
+
+        return m
+
+
+class CSRHandler(Elaboratable):
+    """
+    Carries out a batch of CSR operations from a packet in memory.
+
+    Packets start with a command byte and a count of ops, followed by
+    that many ops of `CSR_OP_LEN` bytes:
+        * 0: Register address, ORed with `CSR_WRITE` to write it
+        * 1-4: Data to write, big-endian
+
+    Ops are carried out in order, and the reply is the packet with the
+    data of each op replaced by the register's value after the op. Counts
+    above `max_ops` are treated as `max_ops`.
+
+    Parameters:
+        * `bank`: `CSRBank` to access
+        * `max_ops`: Most ops which fit in a packet
+
+    Inputs:
+        * `start`: Pulse high to process the packet in memory
+        * `rx_data`: Packet byte read from `rx_addr` on the previous clock
+
+    Outputs:
+        * `rx_addr`: Address of packet byte to read
+        * `tx_addr`, `tx_data`, `tx_en`: Reply byte to write
+        * `done`: Pulsed high when the reply has been written
+    """
+    def __init__(self, bank, max_ops):
+        pkt_len = CSR_HEADER_LEN + CSR_OP_LEN * max_ops
+
+        self.start = Signal()
+        self.rx_data = Signal(8)
+        self.rx_addr = Signal(max=pkt_len)
+        self.tx_addr = Signal(max=pkt_len)
+        self.tx_data = Signal(8)
+        self.tx_en = Signal()
+        self.done = Signal()
+
+        self.bank = bank
+        self.max_ops = max_ops
+        self.pkt_len = pkt_len
+
+    def elaborate(self, platform):
+        m = Module()
+        bank = self.bank
+
+        # Start of the current op in the packet, and byte within it
+        ptr = Signal(max=self.pkt_len)
+        idx = Signal(3)
+        ops_left = Signal(max=self.max_ops+1)
+
+        # Current op, in packet order, with the data replaced after access
+        op = [Signal(8, name=f"op_{i}") for i in range(CSR_OP_LEN)]
+        op_array = Array(op)
+        m.d.comb += [
+            self.rx_addr.eq(ptr + idx),
+            self.tx_addr.eq(ptr + idx),
+            self.tx_data.eq(op_array[idx]),
+            bank.addr.eq(op[0][:7]),
+            bank.wdata.eq(Cat(op[4], op[3], op[2], op[1])),
+        ]
+
+        with m.FSM():
+            with m.State("IDLE"):
+                m.d.sync += [
+                    ptr.eq(0),
+                    idx.eq(0),
+                ]
+                with m.If(self.start):
+                    m.next = "HEADER"
+
+            # Read the header into the first two op bytes
+            with m.State("HEADER"):
+                m.d.sync += idx.eq(idx + 1)
+                with m.If(idx == 1):
+                    m.d.sync += op[0].eq(self.rx_data)
+                with m.If(idx == CSR_HEADER_LEN):
+                    with m.If(self.rx_data > self.max_ops):
+                        m.d.sync += [
+                            op[1].eq(self.max_ops),
+                            ops_left.eq(self.max_ops),
+                        ]
+                    with m.Else():
+                        m.d.sync += [
+                            op[1].eq(self.rx_data),
+                            ops_left.eq(self.rx_data),
+                        ]
+                    m.d.sync += idx.eq(0)
+                    m.next = "HEADER_REPLY"
+
+            with m.State("HEADER_REPLY"):
+                m.d.comb += self.tx_en.eq(1)
+                m.d.sync += idx.eq(idx + 1)
+                with m.If(idx == CSR_HEADER_LEN - 1):
+                    m.d.sync += [
+                        idx.eq(0),
+                        ptr.eq(CSR_HEADER_LEN),
+                    ]
+                    with m.If(ops_left == 0):
+                        m.next = "DONE"
+                    with m.Else():
+                        m.next = "FETCH"
+
+            # Read one op, shifting in one byte per clock
+            with m.State("FETCH"):
+                m.d.sync += idx.eq(idx + 1)
+                with m.If(idx != 0):
+                    m.d.sync += [dst.eq(src) for dst, src
+                                 in zip(op, op[1:] + [self.rx_data])]
+                with m.If(idx == CSR_OP_LEN):
+                    m.d.sync += idx.eq(0)
+                    m.next = "ACCESS"
+
+            with m.State("ACCESS"):
+                m.d.comb += bank.we.eq((op[0] & CSR_WRITE) != 0)
+                m.next = "WAIT"
+
+            # Wait for any write to be read back
+            with m.State("WAIT"):
+                m.next = "READBACK"
+
+            with m.State("READBACK"):
+                m.d.sync += [
+                    op[1].eq(bank.rdata[24:32]),
+                    op[2].eq(bank.rdata[16:24]),
+                    op[3].eq(bank.rdata[8:16]),
+                    op[4].eq(bank.rdata[0:8]),
+                ]
+                m.next = "REPLY"
+
+            with m.State("REPLY"):
+                m.d.comb += self.tx_en.eq(1)
+                m.d.sync += idx.eq(idx + 1)
+                with m.If(idx == CSR_OP_LEN - 1):
+                    m.d.sync += [
+                        idx.eq(0),
+                        ptr.eq(ptr + CSR_OP_LEN),
+                        ops_left.eq(ops_left - 1),
+                    ]
+                    with m.If(ops_left == 1):
+                        m.next = "DONE"
+                    with m.Else():
+                        m.next = "FETCH"
+
+            with m.State("DONE"):
+                m.d.comb += self.done.eq(1)
+                m.next = "IDLE"
+
+        return m
+
+
+def generate_bindings(csrs, command, packet_len):
+    """
+    Returns the source of a Python module for the host to access `csrs`
+    through a `CSRHandler` behind the user UDP port.
+
+    `command` is the command byte which selects the `CSRHandler`, and
+    `packet_len` is the fixed length of user UDP packets.
+    """
+    max_ops = (packet_len - CSR_HEADER_LEN) // CSR_OP_LEN
+    lines = [
+        '"""',
+        "DAQnet CSR host bindings.",
+        "",
+        "Generated by daqnet.csr.generate_bindings, do not edit.",
+        '"""',
+        "",
+        "import socket",
+        "import struct",
+        "",
+        "",
+        f"COMMAND = {command:#04x}",
+        f"WRITE = {CSR_WRITE:#04x}",
+        f"PACKET_LEN = {packet_len}",
+        f"MAX_OPS = {max_ops}",
+        "",
+        "# Register name: (address, width, access)",
+        "REGISTERS = {",
+    ]
+    for addr, csr in enumerate(csrs):
+        lines += textwrap.wrap(csr.desc, 72, initial_indent="    # ",
+                               subsequent_indent="    # ")
+        lines.append(f'    "{csr.name}": ({addr}, {csr.width}, '
+                     f'"{csr.access}"),')
+    lines += [
+        "}",
+        "",
+        "",
+        "def encode_request(ops):",
+        '    """',
+        "    Returns a request packet for a list of (name, value) ops, which",
+        "    read the register if value is None and write it otherwise.",
+        '    """',
+        "    if len(ops) > MAX_OPS:",
+        '        raise ValueError(f"At most {MAX_OPS} ops per packet")',
+        "    packet = struct.pack(\"BB\", COMMAND, len(ops))",
+        "    for name, value in ops:",
+        "        addr, width, access = REGISTERS[name]",
+        "        if value is None:",
+        "            packet += struct.pack(\">BI\", addr, 0)",
+        "        elif access != \"rw\":",
+        '            raise ValueError(f"{name} is read-only")',
+        "        else:",
+        "            packet += struct.pack(\">BI\", addr | WRITE,",
+        "                                  value & (2**width - 1))",
+        "    return packet + bytes(PACKET_LEN - len(packet))",
+        "",
+        "",
+        "def decode_reply(packet, ops):",
+        '    """',
+        "    Returns the register values after each op in a reply packet.",
+        '    """',
+        "    if packet[0] != COMMAND or packet[1] != len(ops):",
+        '        raise ValueError("Reply does not match request")',
+        "    values = []",
+        "    for idx in range(len(ops)):",
+        "        offset = 2 + 5 * idx",
+        "        values.append(struct.unpack(\">I\",",
+        "                                    packet[offset+1:offset+5])[0])",
+        "    return values",
+        "",
+        "",
+        "class CSRClient:",
+        '    """',
+        "    Accesses the registers over UDP, with a property per register.",
+        '    """',
+        "    def __init__(self, address, port, timeout=1.0):",
+        "        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)",
+        "        self.sock.settimeout(timeout)",
+        "        self.sock.connect((address, port))",
+        "",
+        "    def batch(self, ops):",
+        '        """',
+        "        Carries out a list of (name, value) ops in one round trip,",
+        "        returning the register values after each op.",
+        '        """',
+        "        values = []",
+        "        for idx in range(0, len(ops), MAX_OPS):",
+        "            chunk = ops[idx:idx+MAX_OPS]",
+        "            self.sock.send(encode_request(chunk))",
+        "            reply = self.sock.recv(PACKET_LEN)",
+        "            values += decode_reply(reply, chunk)",
+        "        return values",
+        "",
+        "    def read(self, name):",
+        "        return self.batch([(name, None)])[0]",
+        "",
+        "    def write(self, name, value):",
+        "        return self.batch([(name, value)])[0]",
+    ]
+    for csr in csrs:
+        lines += ["", "    @property", f"    def {csr.name}(self):"]
+        if csr.desc:
+            lines += ['        """']
+            lines += textwrap.wrap(csr.desc, 72, initial_indent=" " * 8,
+                                   subsequent_indent=" " * 8)
+            lines += ['        """']
+        lines += [f'        return self.read("{csr.name}")']
+        if csr.access == "rw":
+            lines += [
+                "",
+                f"    @{csr.name}.setter",
+                f"    def {csr.name}(self, value):",
+                f'        self.write("{csr.name}", value)',
+            ]
+    return "\n".join(lines) + "\n"
+
+
+def test_csr_bank():
+    from nmigen.back import pysim
+
+    csrs = [CSR("ctrl", 8, reset=0x12), CSR("status", 32, "ro"),
+            CSR("wide", 32), CSR("limit", 8, max=100)]
+    bank = CSRBank(csrs)
+
+    def testbench():
+        yield bank["status"].eq(0xDEADBEEF)
+
+        def access(addr, wdata=None):
+            yield bank.addr.eq(addr)
+            if wdata is not None:
+                yield bank.wdata.eq(wdata)
+                yield bank.we.eq(1)
+            yield
+            yield bank.we.eq(0)
+            yield
+            yield
+            return (yield bank.rdata)
+
+        assert (yield from access(0)) == 0x12
+        assert (yield from access(1)) == 0xDEADBEEF
+        assert (yield from access(0, 0x1234)) == 0x34
+        assert (yield from access(1, 0x1234)) == 0xDEADBEEF
+        assert (yield from access(2, 0x89ABCDEF)) == 0x89ABCDEF
+        assert (yield from access(3, 100)) == 100
+        assert (yield from access(3, 42)) == 42
+        assert (yield from access(3, 0x165)) == 100
+        assert (yield from access(4)) == 0
+
+    vcdf = open("csr_bank.vcd", "w")
+    with pysim.Simulator(bank, vcd_file=vcdf) as sim:
+        sim.add_clock(1e-6)
+        sim.add_sync_process(testbench())
+        sim.run()
+
+
+def test_csr_handler():
+    from nmigen import Memory
+    from nmigen.back import pysim
+
+    csrs = [CSR("ctrl", 8), CSR("status", 16, "ro", desc="Status"),
+            CSR("count", 32, reset=7)]
+    packet_len = 32
+    max_ops = (packet_len - CSR_HEADER_LEN) // CSR_OP_LEN
+    command = ord("R")
+    bank = CSRBank(csrs)
+    handler = CSRHandler(bank, max_ops)
+
+    # Exercise the generated host bindings against the handler
+    bindings = {}
+    exec(generate_bindings(csrs, command, packet_len), bindings)
+
+    rx_mem = Memory(8, packet_len)
+    tx_mem = Memory(8, packet_len)
+    rx_port = rx_mem.read_port()
+    rx_write_port = rx_mem.write_port()
+    tx_port = tx_mem.write_port()
+
+    m = Module()
+    m.submodules += bank, handler, rx_port, rx_write_port, tx_port
+    m.d.comb += [
+        rx_port.addr.eq(handler.rx_addr),
+        handler.rx_data.eq(rx_port.data),
+        tx_port.addr.eq(handler.tx_addr),
+        tx_port.data.eq(handler.tx_data),
+        tx_port.en.eq(handler.tx_en),
+        bank["status"].eq(0xBEEF),
+    ]
+
+    def testbench():
+        for ops, expected in (
+            ([("ctrl", None), ("count", None)], [0, 7]),
+            ([("ctrl", 0x1A5), ("status", None), ("ctrl", None),
+              ("count", 0x12345678)], [0xA5, 0xBEEF, 0xA5, 0x12345678]),
+            ([("count", None)] * max_ops, [0x12345678] * max_ops),
+            ([], []),
+        ):
+            request = bindings["encode_request"](ops)
+            yield rx_write_port.en.eq(1)
+            for addr, byte in enumerate(request):
+                yield rx_write_port.addr.eq(addr)
+                yield rx_write_port.data.eq(byte)
+                yield
+            yield rx_write_port.en.eq(0)
+            yield handler.start.eq(1)
+            yield
+            yield handler.start.eq(0)
+            for _ in range(20 * (len(ops) + 1)):
+                yield
+                if (yield handler.done):
+                    break
+            else:
+                assert False, "handler did not finish"
+            yield
+            reply = []
+            for addr in range(packet_len):
+                reply.append((yield tx_mem[addr]))
+            assert bindings["decode_reply"](bytes(reply), ops) == expected
+
+    vcdf = open("csr_handler.vcd", "w")
+    with pysim.Simulator(m, vcd_file=vcdf) as sim:
+        sim.add_clock(1e-6)
+        sim.add_sync_process(testbench())
+        sim.run()
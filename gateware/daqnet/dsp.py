@@ -0,0 +1,707 @@
+"""
+Sample decimation and filtering.
+
+Copyright 2018-2019 Adam Greig
+Released under the MIT license; see LICENSE for details.
+"""
+
+from nmigen import Elaboratable, Module, Signal, Const, Array, Cat
+from .utils import PipelinedAccumulator, PipelinedAdder, _delay
+
+
+class CICDecimator(Elaboratable):
+    """
+    Cascaded integrator-comb decimator.
+
+    Decimates by a power of two selected at run time, with the gain of the
+    filter removed so the output has the same scale as the input. Samples
+    are two's complement, and the integrators rely on wrapping modulo the
+    internal width, so no overflow handling is needed.
+
+    After `log2_ratio` changes, the output settles after `n` decimated
+    samples.
+
+    Parameters:
+        * `width`: Width of input and output samples
+        * `n`: Number of integrator and comb stages
+        * `max_log2_ratio`: Largest supported log2 of the decimation ratio
+        * `pipeline`: Number of pipeline stages in each integrator and
+                      comb, to meet timing with the wide internal adders
+
+    Inputs:
+        * `in_data`: `width`-bit two's complement input sample
+        * `in_valid`: Pulsed high when a new sample is at `in_data`
+        * `log2_ratio`: log2 of the decimation ratio, at most
+                        `max_log2_ratio`
+
+    Outputs:
+        * `out_data`: `width`-bit two's complement output sample
+        * `out_valid`: Pulsed high when a new sample is at `out_data`
+    """
+    def __init__(self, width, n, max_log2_ratio, pipeline=1):
+        self.in_data = Signal(width)
+        self.in_valid = Signal()
+        self.log2_ratio = Signal(max=max_log2_ratio+1)
+        self.out_data = Signal(width)
+        self.out_valid = Signal()
+
+        self.width = width
+        self.n = n
+        self.max_log2_ratio = max_log2_ratio
+        self.pipeline = pipeline
+
+        # Each stage can grow the sample by log2 of the ratio
+        self.internal_width = width + n * max_log2_ratio
+
+    def elaborate(self, platform):
+        m = Module()
+        iw = self.internal_width
+
+        # Integrators at the input rate, with their enables delayed to
+        # match each integrator's latency
+        x = Signal(iw)
+        m.d.comb += x.eq(Cat(self.in_data,
+                             *([self.in_data[-1]] * (iw - self.width))))
+        valid = self.in_valid
+        for idx in range(self.n):
+            integrator = PipelinedAccumulator(iw, self.pipeline)
+            m.submodules[f"integrator{idx}"] = integrator
+            m.d.comb += [
+                integrator.x.eq(x),
+                integrator.en.eq(valid),
+            ]
+            x = integrator.acc
+            valid = _delay(m, valid, integrator.latency, f"int{idx}_valid")
+
+        # Keep one in every 2**log2_ratio integrated samples
+        phase = Signal(self.max_log2_ratio)
+        mask = Signal(self.max_log2_ratio)
+        decimate = Signal()
+        m.d.comb += [
+            mask.eq((1 << self.log2_ratio) - 1),
+            decimate.eq(valid & ((phase & mask) == mask)),
+        ]
+        with m.If(valid):
+            m.d.sync += phase.eq(phase + 1)
+        valid = decimate
+
+        # Combs at the output rate, each subtracting its previous input
+        for idx in range(self.n):
+            comb = PipelinedAdder(iw, self.pipeline, subtract=True)
+            m.submodules[f"comb{idx}"] = comb
+            prev = Signal(iw, name=f"comb{idx}_prev")
+            m.d.comb += [
+                comb.a.eq(x),
+                comb.b.eq(prev),
+            ]
+            with m.If(valid):
+                m.d.sync += prev.eq(x)
+            x = comb.c
+            valid = _delay(m, valid, comb.latency, f"comb{idx}_valid")
+
+        # Remove the gain of 2**(n*log2_ratio)
+        scaled = Array(x[self.n*k:self.n*k+self.width]
+                       for k in range(self.max_log2_ratio+1))
+        m.d.sync += self.out_valid.eq(valid)
+        with m.If(valid):
+            m.d.sync += self.out_data.eq(scaled[self.log2_ratio])
+
+        return m
+
+
+class FIRFilter(Elaboratable):
+    """
+    Finite impulse response filter.
+
+    Computes one tap per clock with a single multiplier, suiting the low
+    sample rates after decimation. Each output needs `len(taps) + 2`
+    clocks, and input samples arriving sooner than that are dropped.
+
+    Parameters:
+        * `width`: Width of input and output samples
+        * `taps`: List of integer coefficients, scaled by 2**`shift`
+        * `shift`: Number of fractional bits in `taps`
+
+    Inputs:
+        * `in_data`: `width`-bit two's complement input sample
+        * `in_valid`: Pulsed high when a new sample is at `in_data`
+
+    Outputs:
+        * `out_data`: `width`-bit two's complement output sample, wrapping
+                      if the filtered value does not fit
+        * `out_valid`: Pulsed high when a new sample is at `out_data`
+    """
+    def __init__(self, width, taps, shift):
+        self.in_data = Signal(width)
+        self.in_valid = Signal()
+        self.out_data = Signal(width)
+        self.out_valid = Signal()
+
+        self.width = width
+        self.taps = taps
+        self.shift = shift
+
+    def elaborate(self, platform):
+        m = Module()
+        ntaps = len(self.taps)
+        coeff_width = max(abs(tap) for tap in self.taps).bit_length() + 1
+        acc_width = self.width + coeff_width + ntaps.bit_length()
+
+        # Most recent input samples, newest first
+        samples = [Signal((self.width, True), name=f"sample{idx}")
+                   for idx in range(ntaps)]
+        sample = Array(samples)
+        coeff = Array(Const(tap, (coeff_width, True)) for tap in self.taps)
+        tap = Signal(max=ntaps)
+        acc = Signal((acc_width, True))
+
+        m.d.sync += self.out_valid.eq(0)
+
+        with m.FSM():
+            with m.State("IDLE"):
+                m.d.sync += [
+                    tap.eq(0),
+                    acc.eq(0),
+                ]
+                with m.If(self.in_valid):
+                    m.d.sync += [
+                        samples[0].eq(self.in_data),
+                        *(dst.eq(src)
+                          for dst, src in zip(samples[1:], samples[:-1])),
+                    ]
+                    m.next = "MAC"
+
+            with m.State("MAC"):
+                m.d.sync += [
+                    acc.eq(acc + sample[tap] * coeff[tap]),
+                    tap.eq(tap + 1),
+                ]
+                with m.If(tap == ntaps - 1):
+                    m.next = "OUTPUT"
+
+            with m.State("OUTPUT"):
+                m.d.sync += [
+                    self.out_data.eq(acc[self.shift:]),
+                    self.out_valid.eq(1),
+                ]
+                m.next = "IDLE"
+
+        return m
+
+
+class Decimator(Elaboratable):
+    """
+    Sample decimator for reducing the data rate before transmission.
+
+    A `CICDecimator`, optionally followed by a `FIRFilter` which may be
+    bypassed at run time, for example to compensate the droop of the CIC
+    passband.
+
+    Parameters:
+        * `width`, `n`, `max_log2_ratio`, `pipeline`: As for `CICDecimator`
+        * `fir_taps`: List of FIR coefficients, or None for no FIR
+        * `fir_shift`: Number of fractional bits in `fir_taps`
+
+    Inputs:
+        * `in_data`, `in_valid`, `log2_ratio`: As for `CICDecimator`
+        * `fir_en`: Apply the FIR filter while high, if present
+
+    Outputs:
+        * `out_data`, `out_valid`: As for `CICDecimator`
+    """
+    def __init__(self, width, n, max_log2_ratio, pipeline=1,
+                 fir_taps=None, fir_shift=0):
+        self.in_data = Signal(width)
+        self.in_valid = Signal()
+        self.log2_ratio = Signal(max=max_log2_ratio+1)
+        self.fir_en = Signal()
+        self.out_data = Signal(width)
+        self.out_valid = Signal()
+
+        self.cic = CICDecimator(width, n, max_log2_ratio, pipeline)
+        if fir_taps is not None:
+            self.fir = FIRFilter(width, fir_taps, fir_shift)
+        else:
+            self.fir = None
+
+    def elaborate(self, platform):
+        m = Module()
+        m.submodules.cic = cic = self.cic
+
+        m.d.comb += [
+            cic.in_data.eq(self.in_data),
+            cic.in_valid.eq(self.in_valid),
+            cic.log2_ratio.eq(self.log2_ratio),
+            self.out_data.eq(cic.out_data),
+            self.out_valid.eq(cic.out_valid),
+        ]
+
+        if self.fir is not None:
+            m.submodules.fir = fir = self.fir
+            m.d.comb += [
+                fir.in_data.eq(cic.out_data),
+                fir.in_valid.eq(cic.out_valid & self.fir_en),
+            ]
+            with m.If(self.fir_en):
+                m.d.comb += [
+                    self.out_data.eq(fir.out_data),
+                    self.out_valid.eq(fir.out_valid),
+                ]
+
+        return m
+
+
+class RiceEncoder(Elaboratable):
+    """
+    Lossless delta and Rice encoder for sample streams.
+
+    Each sample is predicted by the previous one, and the difference,
+    wrapped to `width` bits, is zigzag mapped to an unsigned value `u` so
+    small differences of either sign give small values. `u` is then coded
+    as `u >> k` one bits, a zero bit, and the low `k` bits of `u`. If
+    `u >> k` is at least `width`, `width` one bits are sent followed by all
+    `width` bits of `u` instead, so no code exceeds `2*width` bits.
+
+    Codes are packed into bytes with the first bit in the most significant
+    bit. One bit is sent per clock, so each sample takes a few clocks more
+    than its code length.
+
+    Flushing pads the final byte with zeros and resets the predictor, so
+    each flushed block may be decoded on its own given its sample count.
+    A block is flushed either by `flush`, or automatically after a sample
+    marked with `in_last`, in which case its final byte is marked with
+    `out_last`.
+
+    Parameters:
+        * `width`: Width of input samples
+
+    Inputs:
+        * `in_data`: `width`-bit input sample
+        * `in_valid`: High when a new sample is at `in_data`, which is
+                      taken when `in_ready` is also high
+        * `k`: Rice parameter, less than `width`, sampled with each sample
+        * `in_last`: High with the final sample of a block
+        * `flush`: Pulse high while `in_ready` is high to end a block
+
+    Outputs:
+        * `in_ready`: High when the encoder can take a sample or flush
+        * `out_data`: Encoded byte
+        * `out_valid`: Pulsed high when a new byte is at `out_data`
+        * `out_last`: High with `out_valid` for the final byte of a block
+                      ended by `in_last`
+        * `samples_in`: 32-bit count of samples encoded
+        * `bytes_out`: 32-bit count of bytes produced, which with
+                       `samples_in` gives the compression ratio
+    """
+    def __init__(self, width):
+        self.in_data = Signal(width)
+        self.in_valid = Signal()
+        self.k = Signal(max=width)
+        self.in_last = Signal()
+        self.flush = Signal()
+        self.in_ready = Signal()
+        self.out_data = Signal(8)
+        self.out_valid = Signal()
+        self.out_last = Signal()
+        self.samples_in = Signal(32)
+        self.bytes_out = Signal(32)
+
+        self.width = width
+
+    def elaborate(self, platform):
+        m = Module()
+        width = self.width
+
+        # Zigzag map the difference from the previous sample
+        prev = Signal(width)
+        delta = Signal(width)
+        u = Signal(width)
+        m.d.comb += [
+            delta.eq(self.in_data - prev),
+            u.eq(Cat(0, delta[:-1]) ^ Cat(*([delta[-1]] * width))),
+        ]
+
+        # Remaining one bits to send, and bits to send after them, MSB first
+        ones = Signal(width)
+        escape = Signal()
+        bits = Signal(width)
+        nbits = Signal(max=width+1)
+        k = Signal(max=width)
+        last = Signal()
+
+        # Pack bits into bytes, MSB first. The byte completed as the final
+        # code of a block ends, or by its padding, ends the block.
+        bit = Signal()
+        emit = Signal()
+        end = Signal()
+        shift = Signal(7)
+        nshift = Signal(3)
+        m.d.sync += [
+            self.out_valid.eq(0),
+            self.out_last.eq(0),
+        ]
+        with m.If(emit):
+            m.d.sync += [
+                shift.eq(Cat(bit, shift[:6])),
+                nshift.eq(nshift + 1),
+            ]
+            with m.If(nshift == 7):
+                m.d.sync += [
+                    self.out_data.eq(Cat(bit, shift)),
+                    self.out_valid.eq(1),
+                    self.out_last.eq(last & end),
+                    self.bytes_out.eq(self.bytes_out + 1),
+                ]
+
+        with m.FSM() as fsm:
+            m.d.comb += self.in_ready.eq(fsm.ongoing("IDLE"))
+
+            with m.State("IDLE"):
+                with m.If(self.flush):
+                    m.d.sync += prev.eq(0)
+                    with m.If(nshift != 0):
+                        m.next = "PAD"
+                with m.Elif(self.in_valid):
+                    m.d.sync += [
+                        prev.eq(self.in_data),
+                        self.samples_in.eq(self.samples_in + 1),
+                        k.eq(self.k),
+                        last.eq(self.in_last),
+                    ]
+                    with m.If(self.in_last):
+                        m.d.sync += prev.eq(0)
+                    with m.If((u >> self.k) >= width):
+                        m.d.sync += [
+                            ones.eq(width),
+                            escape.eq(1),
+                            bits.eq(u),
+                            nbits.eq(width),
+                        ]
+                    with m.Else():
+                        m.d.sync += [
+                            ones.eq(u >> self.k),
+                            escape.eq(0),
+                            bits.eq(u << (width - self.k)),
+                            nbits.eq(self.k),
+                        ]
+                    m.next = "UNARY"
+
+            with m.State("UNARY"):
+                m.d.comb += emit.eq(1)
+                with m.If(ones != 0):
+                    m.d.comb += bit.eq(1)
+                    m.d.sync += ones.eq(ones - 1)
+                with m.Elif(escape):
+                    # Escaped codes have no terminating zero
+                    m.d.comb += bit.eq(bits[-1])
+                    m.d.sync += [
+                        bits.eq(bits << 1),
+                        nbits.eq(nbits - 1),
+                    ]
+                    m.next = "BITS"
+                with m.Else():
+                    m.d.comb += bit.eq(0)
+                    with m.If(nbits != 0):
+                        m.next = "BITS"
+                    with m.Else():
+                        m.d.comb += end.eq(1)
+                        with m.If(last & (nshift != 7)):
+                            m.next = "PAD"
+                        with m.Else():
+                            m.next = "IDLE"
+
+            with m.State("BITS"):
+                with m.If(nbits != 0):
+                    m.d.comb += [
+                        emit.eq(1),
+                        bit.eq(bits[-1]),
+                    ]
+                    m.d.sync += [
+                        bits.eq(bits << 1),
+                        nbits.eq(nbits - 1),
+                    ]
+                with m.If(nbits <= 1):
+                    m.d.comb += end.eq(1)
+                    with m.If(last & (nshift != 7)):
+                        m.next = "PAD"
+                    with m.Else():
+                        m.next = "IDLE"
+
+            with m.State("PAD"):
+                m.d.comb += [
+                    emit.eq(1),
+                    bit.eq(0),
+                    end.eq(1),
+                ]
+                with m.If(nshift == 7):
+                    m.next = "IDLE"
+
+        return m
+
+
+def _signed(value, width):
+    """Returns the two's complement `width`-bit `value` as an integer."""
+    value &= 2**width - 1
+    return value - 2**width if value >> (width - 1) else value
+
+
+def test_cic_decimator():
+    import random
+    from nmigen.back import pysim
+
+    width = 12
+    n = 3
+
+    def model(samples, log2_ratio):
+        ratio = 2**log2_ratio
+        for _ in range(n):
+            total = 0
+            integrated = []
+            for sample in samples:
+                total += sample
+                integrated.append(total)
+            samples = integrated
+        samples = samples[ratio-1::ratio]
+        for _ in range(n):
+            samples = [x - y for x, y in zip(samples, [0] + samples[:-1])]
+        return [_signed(x >> (n * log2_ratio), width) for x in samples]
+
+    # Each ratio is tested from the reset state
+    for log2_ratio in (0, 2, 4):
+        cic = CICDecimator(width, n, 4, pipeline=2)
+        rng = random.Random(log2_ratio)
+        samples = [rng.randrange(-2**(width-1), 2**(width-1))
+                   for _ in range(32 * 2**log2_ratio)]
+        # Include a run of full scale samples to check for overflow
+        samples[:40] = [-2**(width-1)] * 40
+
+        def testbench():
+            yield cic.log2_ratio.eq(log2_ratio)
+            outputs = []
+            # Leave gaps between input samples at random
+            pending = list(samples)
+            for _ in range(4 * len(samples) + 20):
+                if pending and rng.random() < 0.5:
+                    yield cic.in_data.eq(pending.pop(0) & (2**width - 1))
+                    yield cic.in_valid.eq(1)
+                else:
+                    yield cic.in_valid.eq(0)
+                yield
+                if (yield cic.out_valid):
+                    outputs.append(_signed((yield cic.out_data), width))
+            assert not pending
+            assert outputs == model(samples, log2_ratio)
+
+        vcdf = open(f"cic_decimator_{log2_ratio}.vcd", "w")
+        with pysim.Simulator(cic, vcd_file=vcdf) as sim:
+            sim.add_clock(1e-6)
+            sim.add_sync_process(testbench())
+            sim.run()
+
+
+def test_fir_filter():
+    import random
+    from nmigen.back import pysim
+
+    width = 12
+    taps = [-3, 0, 19, 32, 19, 0, -3]
+    shift = 6
+    fir = FIRFilter(width, taps, shift)
+
+    def model(samples):
+        history = [0] * len(taps)
+        outputs = []
+        for sample in samples:
+            history = [sample] + history[:-1]
+            total = sum(x * c for x, c in zip(history, taps))
+            outputs.append(_signed(total >> shift, width))
+        return outputs
+
+    def testbench():
+        rng = random.Random(0)
+        samples = [rng.randrange(-2**(width-1), 2**(width-1))
+                   for _ in range(50)]
+        samples[:10] = [2**(width-1) - 1] * 10
+        outputs = []
+        # Send samples as fast as the filter allows, or slower at random
+        pending = list(samples)
+        gap = 0
+        for _ in range(20 * len(samples)):
+            if pending and gap >= len(taps) + 2 and rng.random() < 0.5:
+                yield fir.in_data.eq(pending.pop(0) & (2**width - 1))
+                yield fir.in_valid.eq(1)
+                gap = 1
+            else:
+                yield fir.in_valid.eq(0)
+                gap += 1
+            yield
+            if (yield fir.out_valid):
+                outputs.append(_signed((yield fir.out_data), width))
+        assert not pending
+        assert outputs == model(samples)
+
+    vcdf = open("fir_filter.vcd", "w")
+    with pysim.Simulator(fir, vcd_file=vcdf) as sim:
+        sim.add_clock(1e-6)
+        sim.add_sync_process(testbench())
+        sim.run()
+
+
+def rice_decode(data, count, width, k):
+    """
+    Reference decoder for a block from `RiceEncoder`, for use in tests.
+    """
+    bits = []
+    for byte in data:
+        bits += [(byte >> (7 - idx)) & 1 for idx in range(8)]
+    pos = 0
+    prev = 0
+    samples = []
+    for _ in range(count):
+        q = 0
+        while q < width and bits[pos]:
+            q += 1
+            pos += 1
+        if q == width:
+            n, q = width, 0
+        else:
+            n = k
+            pos += 1
+        r = 0
+        for _ in range(n):
+            r = (r << 1) | bits[pos]
+            pos += 1
+        u = (q << k) | r
+        delta = (u >> 1) ^ -(u & 1)
+        prev = (prev + delta) % 2**width
+        samples.append(prev)
+    return samples
+
+
+def test_rice_encoder():
+    import math
+    import random
+    from nmigen.back import pysim
+
+    width = 12
+    enc = RiceEncoder(width)
+
+    def testbench():
+        rng = random.Random(0)
+        # A slowly varying signal and a step, which should compress, and
+        # full scale noise which needs escape codes
+        blocks = [
+            (2, True, [int(1000 * math.sin(x / 200)) % 2**width
+                       for x in range(200)]),
+            (0, True, [100] * 20 + [3000] * 20),
+            (5, False, [rng.randrange(2**width) for _ in range(50)]),
+        ]
+        for k, compresses, samples in blocks:
+            data = []
+            yield enc.k.eq(k)
+            pending = list(samples) + [None]
+            while pending:
+                # Wait an extra clock after each sample for in_ready to fall
+                if (yield enc.in_ready):
+                    sample = pending.pop(0)
+                    if sample is None:
+                        yield enc.flush.eq(1)
+                    else:
+                        yield enc.in_data.eq(sample)
+                        yield enc.in_valid.eq(1)
+                    yield
+                    yield enc.in_valid.eq(0)
+                    yield enc.flush.eq(0)
+                    if (yield enc.out_valid):
+                        data.append((yield enc.out_data))
+                yield
+                if (yield enc.out_valid):
+                    data.append((yield enc.out_data))
+            for _ in range(10):
+                yield
+                if (yield enc.out_valid):
+                    data.append((yield enc.out_data))
+            assert rice_decode(data, len(samples), width, k) == samples
+            if compresses:
+                assert len(data) < len(samples) * width // 16
+
+        total = sum(len(samples) for _, _, samples in blocks)
+        assert (yield enc.samples_in) == total
+
+    vcdf = open("rice_encoder.vcd", "w")
+    with pysim.Simulator(enc, vcd_file=vcdf) as sim:
+        sim.add_clock(1e-6)
+        sim.add_sync_process(testbench())
+        sim.run()
+
+
+def test_rice_encoder_last():
+    import math
+    import os
+    import random
+    import importlib.util
+    from nmigen.back import pysim
+
+    width = 12
+    enc = RiceEncoder(width)
+    rng = random.Random(1)
+
+    # Blocks which end with and without padding, including escaped codes
+    # and a block of codes which each fill exactly one byte
+    blocks = [
+        (2, [int(1000 * math.sin(x / 50)) % 2**width for x in range(60)]),
+        (5, [rng.randrange(2**width) for _ in range(20)]),
+        (7, [0] * 4),
+        (0, [5]),
+    ]
+
+    def testbench():
+        received = []
+        data = []
+
+        def step():
+            yield
+            if (yield enc.out_valid):
+                data.append((yield enc.out_data))
+                if (yield enc.out_last):
+                    received.append(list(data))
+                    data.clear()
+
+        for k, samples in blocks:
+            yield enc.k.eq(k)
+            for idx, sample in enumerate(samples):
+                yield enc.in_data.eq(sample)
+                yield enc.in_last.eq(idx == len(samples) - 1)
+                yield enc.in_valid.eq(1)
+                yield from step()
+                yield enc.in_valid.eq(0)
+                # Wait an extra clock after each sample for in_ready to fall
+                yield from step()
+                while not (yield enc.in_ready):
+                    yield from step()
+        for _ in range(10):
+            yield from step()
+
+        assert data == []
+        assert len(received) == len(blocks)
+        assert len(received[2]) == 4
+        for (k, samples), block in zip(blocks, received):
+            assert rice_decode(block, len(samples), width, k) == samples
+
+        # Check the host decoder against the same blocks, if it can run
+        if importlib.util.find_spec("numpy") is None:
+            return
+        path = os.path.join(os.path.dirname(__file__), "..", "..",
+                            "software", "scripts", "rice_decode.py")
+        spec = importlib.util.spec_from_file_location("rice_decode", path)
+        script = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(script)
+        for (k, samples), block in zip(blocks, received):
+            decoded = script.decode(bytes(block), len(samples), width, k)
+            assert [x % 2**width for x in decoded] == samples
+
+    vcdf = open("rice_encoder_last.vcd", "w")
+    with pysim.Simulator(enc, vcd_file=vcdf) as sim:
+        sim.add_clock(1e-6)
+        sim.add_sync_process(testbench())
+        sim.run()
@@ -5,20 +5,29 @@ Copyright 2018-2019 Adam Greig
 Released under the MIT license; see LICENSE for details.
 """
 
-from nmigen import Elaboratable, Module, Signal, Memory
+import operator
+from functools import reduce
+
+from nmigen import Elaboratable, Module, Signal, Memory, Cat
 
 
 class CRC32(Elaboratable):
     """
     Ethernet CRC32
 
-    Processes one byte of data every two clock cycles.
+    By default uses a lookup table in block RAM and processes one byte of
+    data every two clock cycles. Otherwise uses XOR logic and processes one
+    byte of data every clock cycle.
+
+    Parameters:
+        * `table`: If True, use a lookup table
 
     Inputs:
         * `reset`: Re-initialises CRC to start state while high
         * `data`: 8-bit input data
         * `data_valid`: Pulsed high when new data is ready at `data`.
-                        Requires one clock to process between new data.
+                        With a lookup table, requires one clock to process
+                        between new data.
 
     Outputs:
         * `crc_out`: complement of current 32-bit CRC value
@@ -27,7 +36,7 @@ class CRC32(Elaboratable):
     When using for transmission, note that `crc_out` must be sent in little
     endian (i.e. if `crc_out` is 0xAABBCCDD then transmit 0xDD 0xCC 0xBB 0xAA).
     """
-    def __init__(self):
+    def __init__(self, table=True):
         # Inputs
         self.reset = Signal()
         self.data = Signal(8)
@@ -37,21 +46,44 @@ class CRC32(Elaboratable):
         self.crc_out = Signal(32)
         self.crc_match = Signal()
 
+        # Parameters
+        self.table = table
+
+        # Number of clocks after `data_valid` before `crc_out` is updated
+        self.latency = 2 if table else 1
+
     def elaborate(self, platform):
 
         m = Module()
         crc = Signal(32)
 
-        self.crctable = Memory(32, 256, make_crc32_table())
-        table_port = self.crctable.read_port()
-        m.submodules += table_port
-
         m.d.comb += [
             self.crc_out.eq(crc ^ 0xFFFFFFFF),
             self.crc_match.eq(crc == 0xDEBB20E3),
-            table_port.addr.eq(crc ^ self.data),
         ]
 
+        if not self.table:
+            # Each bit of the next CRC is the XOR of the current CRC and data
+            # bits which set that bit when processed alone.
+            bits = Cat(crc, self.data)
+            steps = [_crc32_step(1 << idx) for idx in range(40)]
+            next_crc = []
+            for out_bit in range(32):
+                taps = [bits[idx] for idx in range(40)
+                        if steps[idx] & (1 << out_bit)]
+                next_crc.append(reduce(operator.xor, taps))
+            with m.If(self.reset):
+                m.d.sync += crc.eq(0xFFFFFFFF)
+            with m.Elif(self.data_valid):
+                m.d.sync += crc.eq(Cat(*next_crc))
+            return m
+
+        self.crctable = Memory(32, 256, make_crc32_table())
+        table_port = self.crctable.read_port()
+        m.submodules += table_port
+
+        m.d.comb += table_port.addr.eq(crc ^ self.data)
+
         with m.FSM():
             with m.State("RESET"):
                 m.d.sync += crc.eq(0xFFFFFFFF)
@@ -72,6 +104,15 @@ class CRC32(Elaboratable):
         return m
 
 
+def _crc32_step(bits):
+    """
+    Returns the next CRC after processing one byte, where `bits` holds the
+    current CRC in the low 32 bits and the new byte in the top 8 bits.
+    """
+    crc, data = bits & 0xFFFFFFFF, bits >> 32
+    return make_crc32_table()[(crc & 0xFF) ^ data] ^ (crc >> 8)
+
+
 def make_crc32_table():
     poly = 0x04C11DB7
     table = []
@@ -150,6 +191,30 @@ def test_crc32_match():
         sim.run()
 
 
+def test_crc32_xor():
+    from nmigen.back import pysim
+    crc = CRC32(table=False)
+
+    def testbench():
+        yield (crc.reset.eq(1))
+        yield
+        yield (crc.reset.eq(0))
+        for byte in [ord(x) for x in "123456789"]:
+            yield (crc.data.eq(byte))
+            yield (crc.data_valid.eq(1))
+            yield
+        yield (crc.data_valid.eq(0))
+        yield
+        out = yield (crc.crc_out)
+        assert out == 0xCBF43926
+
+    vcdf = open("crc32_xor.vcd", "w")
+    with pysim.Simulator(crc, vcd_file=vcdf) as sim:
+        sim.add_clock(1e-6)
+        sim.add_sync_process(testbench())
+        sim.run()
+
+
 def test_crc32_py():
     check = 0xCBF43926
 
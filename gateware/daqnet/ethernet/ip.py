@@ -5,10 +5,11 @@ Copyright 2018-2019 Adam Greig
 Released under the MIT license; see LICENSE for details.
 """
 
-import operator
-import functools
 from contextlib import contextmanager
 from nmigen import Elaboratable, Module, Signal, Memory, Const
+from nmigen import Array, Mux, Cat
+from .rmii import TX_PATCH_LEN
+from ..utils import LFSR, PipelinedOnesComplementAdder
 
 
 class IPStack(Elaboratable):
@@ -26,6 +27,31 @@ class IPStack(Elaboratable):
         * `ip4_addr`: IPv4 address in standard xxx.xxx.xxx.xxx format
         * `user_udp_len`: Length of user data in UDP packets, to tx/rx
         * `user_udp_port`: UDP port to transmit/receive on
+        * `reasm_contexts`: Number of fragmented UDP datagrams which may be
+                            reassembled at once, or 0 to drop all fragments
+        * `reasm_size`: Maximum size of a reassembled datagram in bytes,
+                        must be a power of two
+        * `reasm_timeout`: Clock cycles after the most recent fragment at
+                           which an incomplete datagram is discarded
+        * `shared_buffer`: If True, replies to received packets are
+                           transmitted in place from RX memory. Layers only
+                           write the bytes which differ from the received
+                           packet to TX memory, and the mask of written
+                           bytes is stored after them for the MAC to patch
+                           the received packet with. The received packet
+                           must not be overwritten until its reply has been
+                           transmitted, so it is only acknowledged once
+                           `tx_done` reports the reply done, and the MAC
+                           must keep packets until they are acknowledged,
+                           as `MAC` does. Packets are still transmitted
+                           while the acknowledgement waits, but no further
+                           packets are received.
+        * `prbs_port`: UDP port for PRBS link test packets, or None to
+                       disable the link test. See `PRBS link test` below.
+        * `prbs_k`: Length of the PRBS LFSR, one of the lengths supported
+                    by `utils.LFSR` from 9 to 31
+        * `capture_port`: UDP port to transmit captured data from and to, or
+                          None to disable. See `Capture stream` below.
 
     Memory ports:
         * `rx_port`: Read port into RX packet memory
@@ -40,17 +66,105 @@ class IPStack(Elaboratable):
         * `rx_offset`: Start address of received packet
         * `rx_valid`: High when new packet data is ready in `rx_len`
         * `user_tx`: Start transmission of user data from `user_w_port`
+        * `tx_done`: Pulsed high as each packet started with `tx_start`
+                     has been transmitted or discarded, in the order they
+                     were started, for example from the MAC's `tx_done`.
+                     Only used if `shared_buffer` is set.
+        * `udp_echo`: While high, UDP packets received on `user_udp_port`
+                      are sent back to their source instead of being
+                      written to `user_w_port`, whatever their length,
+                      unless their UDP length runs past the end of the
+                      received frame or they were reassembled from
+                      fragments
+        * `tx_free`: Number of bytes free in TX packet memory after
+                     `tx_offset`. Received packets are not processed and user
+                     data is not transmitted until there is enough space
+                     for any reply. Defaults to the whole memory if not
+                     connected.
 
     Outputs:
-        * `rx_ack`: Pulsed high when current packet has been processed
+        * `rx_ack`: Pulsed high when current packet has been processed.
+                    With `shared_buffer`, this is once processing is done,
+                    and once `tx_done` reports its reply done if one is
+                    being sent in place from it.
         * `tx_len`: Length of packet to transmit
         * `tx_offset`: Start address of packet to transmit
         * `tx_start`: Pulsed high when a packet is ready to begin transmission
+        * `tx_split`: Length of the patch region at the start of the packet,
+                      followed in TX memory by its patch mask, with the
+                      rest of the packet transmitted from RX memory at
+                      `tx_rx_offset`, or 0 to transmit the whole packet from
+                      TX memory
+        * `tx_rx_offset`: Start address of the received packet to transmit
+                          from when `tx_split` is not 0
         * `user_ready`: High while ready to transmit user packets
         * `user_rx`: Pulsed high when new user data has been written
+        * `user_rx_len`: Number of bytes of user data written for the most
+                         recent `user_rx`. This is `user_udp_len`, except
+                         for datagrams reassembled from fragments, which
+                         are received with any shorter non-empty payload,
+                         leaving the rest of `user_w_port` unchanged.
+        * `tx_full_events`: 32-bit count of times processing stalled waiting
+                            for free space in TX packet memory
+
+    PRBS link test:
+        While `prbs_tx_enable` is high, UDP packets are transmitted from and
+        to `prbs_port` whenever there is space in TX packet memory, which is
+        enough to saturate the link. Their payload is a 32-bit big-endian
+        sequence number followed by a PRBS from an LFSR seeded by the
+        sequence number. Received packets on `prbs_port` are checked against
+        the same sequence, counting bit errors in the PRBS, and frames lost
+        from gaps in the sequence numbers. Received packets and replies are
+        still processed while transmitting.
+
+        * `prbs_tx_enable`: Input, transmit PRBS packets while high
+        * `prbs_tx_len`: Input, 11-bit UDP payload length of PRBS packets,
+                         including the sequence number, from 5 to 1472
+        * `prbs_dst_mac`: Input, 48-bit destination MAC address
+        * `prbs_dst_ip4`: Input, 32-bit destination IPv4 address
+        * `prbs_rx_clear`: Input, pulse high to clear the receive counters
+        * `prbs_tx_frames`: Output, 32-bit count of PRBS packets sent
+        * `prbs_rx_frames`: Output, 32-bit count of PRBS packets received
+        * `prbs_rx_lost`: Output, 32-bit count of PRBS packets lost
+        * `prbs_rx_bit_errors`: Output, 32-bit count of PRBS bit errors
+
+    Capture stream:
+        Bytes from a stream, such as serialised samples from a
+        `capture.TriggeredCapture`, are packetised into UDP packets from and
+        to `capture_port`. Each payload is a 32-bit big-endian sequence
+        number, incremented for each packet, with its top bit set on the
+        final packet of a capture, followed by up to `capture_tx_len` bytes
+        from the stream. A packet is started once a byte is available and
+        there is space in TX packet memory for a full packet, and ends early
+        at the byte marked with `capture_last`. Received packets are not
+        processed while a packet waits for bytes, so the stream should not
+        stall for long once a byte has been offered.
+
+        * `capture_data`: Input, 8-bit stream data
+        * `capture_valid`: Input, high while a byte is at `capture_data`
+        * `capture_last`: Input, high with the final byte of a capture
+        * `capture_ready`: Output, high when the byte at `capture_data`
+                           is taken
+        * `capture_tx_len`: Input, 11-bit maximum number of stream bytes in
+                            each packet, from 1 to 1468
+        * `capture_dst_mac`: Input, 48-bit destination MAC address
+        * `capture_dst_ip4`: Input, 32-bit destination IPv4 address
+        * `capture_tx_frames`: Output, 32-bit count of capture packets sent
     """
     def __init__(self, mac_addr, ip4_addr, user_udp_len, user_udp_port,
-                 rx_port, tx_port, user_r_port, user_w_port):
+                 rx_port, tx_port, user_r_port, user_w_port,
+                 reasm_contexts=0, reasm_size=2048, reasm_timeout=2**27,
+                 shared_buffer=False, prbs_port=None, prbs_k=31,
+                 capture_port=None):
+        if prbs_port is not None and prbs_port == user_udp_port:
+            raise ValueError("prbs_port must differ from user_udp_port")
+        if capture_port is not None and capture_port in (user_udp_port,
+                                                         prbs_port):
+            raise ValueError("capture_port must differ from user_udp_port "
+                             "and prbs_port")
+        if not 9 <= prbs_k <= 31:
+            raise ValueError(f"prbs_k={prbs_k} invalid for PRBS")
+
         # RX port
         self.rx_port = rx_port
         self.rx_len = Signal(11)
@@ -63,21 +177,59 @@ class IPStack(Elaboratable):
         self.tx_len = Signal(11)
         self.tx_offset = Signal(tx_port.addr.nbits)
         self.tx_start = Signal()
+        self.tx_split = Signal(11)
+        self.tx_rx_offset = Signal(rx_port.addr.nbits)
+        self.tx_free = Signal(max=2**tx_port.addr.nbits + 1,
+                              reset=2**tx_port.addr.nbits)
+        self.tx_done = Signal()
+        self.tx_full_events = Signal(32)
+        self.shared_buffer = shared_buffer
 
         # User port
         self.user_r_port = user_r_port
         self.user_w_port = user_w_port
         self.user_tx = Signal()
         self.user_rx = Signal()
+        self.user_rx_len = Signal(max=user_udp_len+1)
         self.user_ready = Signal()
         self.user_udp_len = user_udp_len
         self.user_udp_port = user_udp_port
+        self.udp_echo = Signal()
+
+        # IPv4 reassembly
+        self.reasm_contexts = reasm_contexts
+        self.reasm_size = reasm_size
+        self.reasm_timeout = reasm_timeout
 
         # Store the last-seen MAC, IP, and port for UDP transmission
         self.user_last_mac = Signal(48)
         self.user_last_ip4 = Signal(32)
         self.user_last_port = Signal(16)
 
+        # PRBS link test
+        self.prbs_port = prbs_port
+        self.prbs_k = prbs_k
+        self.prbs_tx_enable = Signal()
+        self.prbs_tx_len = Signal(11)
+        self.prbs_dst_mac = Signal(48)
+        self.prbs_dst_ip4 = Signal(32)
+        self.prbs_rx_clear = Signal()
+        self.prbs_tx_frames = Signal(32)
+        self.prbs_rx_frames = Signal(32)
+        self.prbs_rx_lost = Signal(32)
+        self.prbs_rx_bit_errors = Signal(32)
+
+        # Capture stream
+        self.capture_port = capture_port
+        self.capture_data = Signal(8)
+        self.capture_valid = Signal()
+        self.capture_last = Signal()
+        self.capture_ready = Signal()
+        self.capture_tx_len = Signal(11)
+        self.capture_dst_mac = Signal(48)
+        self.capture_dst_ip4 = Signal(32)
+        self.capture_tx_frames = Signal(32)
+
         mac_addr_parts = [int(x, 16) for x in mac_addr.split(":")]
         ip4_addr_parts = [int(x, 10) for x in ip4_addr.split(".")]
         self.mac_addr = sum(mac_addr_parts[5-x] << (8*x) for x in range(6))
@@ -94,9 +246,23 @@ class IPStack(Elaboratable):
         # It handles all layers of the stack directly.
         m.submodules.udp_tx = udp_tx = _UDPTxLayer(self)
 
+        # PRBS Tx submodule likewise transmits PRBS link test packets.
+        if self.prbs_port is not None:
+            m.submodules.prbs_tx = prbs_tx = _PRBSTxLayer(self)
+            m.d.comb += prbs_tx.rx_data.eq(0)
+
+        # Capture Tx submodule likewise packetises the capture stream.
+        if self.capture_port is not None:
+            m.submodules.capture_tx = capture_tx = _CaptureTxLayer(self)
+            m.d.comb += capture_tx.rx_data.eq(0)
+
         # Register for RX packet memory read address, controlled by this module
         self.rx_addr = Signal(self.rx_port.addr.nbits)
 
+        # Length of the packet being processed, latched as it is started,
+        # as `rx_len` may change once the packet is acknowledged
+        self.rx_pkt_len = Signal(11)
+
         m.d.comb += [
             self.rx_port.addr.eq(self.rx_addr),
             udp_tx.rx_data.eq(0),
@@ -105,17 +271,90 @@ class IPStack(Elaboratable):
             eth.rx_data.eq(self.rx_port.data),
         ]
 
+        # A packet with a reply sent in place from it is released once
+        # `release_ctr` packets have completed, counting those queued
+        # before the reply and the reply itself.
+        release_pending = Signal()
+        release_ready = Signal()
+        if self.shared_buffer:
+            tx_queued = Signal(max=2**self.tx_port.addr.nbits + 1)
+            release_ctr = Signal(max=2**self.tx_port.addr.nbits + 2)
+            m.d.sync += tx_queued.eq(tx_queued + self.tx_start - self.tx_done)
+            with m.If(release_pending & self.tx_done):
+                m.d.sync += release_ctr.eq(release_ctr - 1)
+            m.d.comb += release_ready.eq(release_pending & (release_ctr == 0))
+
+        # Mask of bytes written to TX memory in the patch region, and the
+        # length and patch region size of the reply being written.
+        if self.shared_buffer:
+            patch_mask = Signal(TX_PATCH_LEN)
+            patch_ctr = Signal(max=TX_PATCH_LEN//8)
+            reply_len = Signal(11)
+            reply_split = Signal(11)
+            with m.If(eth.tx_en & (eth.tx_addr < TX_PATCH_LEN)):
+                m.d.sync += patch_mask.eq(
+                    patch_mask | (Const(1, TX_PATCH_LEN) << eth.tx_addr))
+
+        # Replies are never longer than the received packet, plus the patch
+        # mask if sent in place. User packets have a fixed length.
+        rx_space = Signal()
+        user_space = Signal()
+        if self.shared_buffer:
+            m.d.comb += rx_space.eq(
+                self.tx_free >= self.rx_len + TX_PATCH_LEN//8)
+        else:
+            m.d.comb += rx_space.eq(self.tx_free >= self.rx_len)
+        m.d.comb += user_space.eq(self.tx_free >= self.user_udp_len + 42)
+        prbs_ready = Signal()
+        if self.prbs_port is not None:
+            m.d.comb += prbs_ready.eq(
+                self.prbs_tx_enable & (self.prbs_tx_len >= 5) &
+                (self.tx_free >= self.prbs_tx_len + 42))
+        capture_ready = Signal()
+        if self.capture_port is not None:
+            m.d.comb += capture_ready.eq(
+                self.capture_valid & (self.capture_tx_len != 0) &
+                (self.tx_free >= self.capture_tx_len + 46))
+
+        # Count each time a packet starts waiting for free space
+        tx_full = Signal()
+        tx_full_last = Signal()
+        m.d.sync += tx_full_last.eq(tx_full)
+        with m.If(tx_full & ~tx_full_last):
+            m.d.sync += self.tx_full_events.eq(self.tx_full_events + 1)
+
         with m.FSM() as fsm:
-            m.d.comb += self.user_ready.eq(fsm.ongoing("IDLE"))
+            m.d.comb += [
+                self.user_ready.eq(fsm.ongoing("IDLE") & user_space),
+                tx_full.eq(fsm.ongoing("IDLE") & (
+                    (self.user_tx & ~user_space) |
+                    (self.rx_valid & ~release_pending & ~rx_space))),
+            ]
 
             with m.State("IDLE"):
                 m.d.sync += self.rx_addr.eq(self.rx_offset)
+                m.d.sync += self.rx_pkt_len.eq(self.rx_len)
+                m.d.sync += self.tx_rx_offset.eq(self.rx_offset)
                 m.d.sync += eth.run.eq(0), udp_tx.run.eq(0)
-                with m.If(self.user_tx):
+                if self.shared_buffer:
+                    m.d.sync += patch_mask.eq(0)
+                with m.If(self.user_tx & user_space):
                     m.next = "SEND_USER"
-                with m.Elif(self.rx_valid):
-                    m.d.sync += self.rx_ack.eq(1)
+                with m.Elif(release_ready):
+                    if self.shared_buffer:
+                        m.d.sync += [
+                            self.rx_ack.eq(1),
+                            release_pending.eq(0),
+                        ]
+                        m.next = "RELEASE_RX"
+                with m.Elif(self.rx_valid & ~release_pending & rx_space):
+                    if not self.shared_buffer:
+                        m.d.sync += self.rx_ack.eq(1)
                     m.next = "PROCESS_RX"
+                with m.Elif(prbs_ready):
+                    m.next = "SEND_PRBS"
+                with m.Elif(capture_ready):
+                    m.next = "SEND_CAPTURE"
 
             # Handle a newly received packet. Streams the entire packet
             # into the Ethernet layer byte-by-byte, and waits until the
@@ -132,12 +371,72 @@ class IPStack(Elaboratable):
                     self.tx_port.en.eq(eth.tx_en),
                     self.tx_start.eq(eth.send),
                     self.tx_len.eq(eth.tx_len),
+                    self.tx_split.eq(eth.tx_split),
                 ]
 
-                with m.If(eth.done):
-                    with m.If(eth.send):
-                        m.d.sync += self.tx_offset.eq(
-                            self.tx_offset + self.tx_len)
+                if self.shared_buffer:
+                    # Replies sent in place first need their patch mask
+                    # written to TX memory.
+                    with m.If(eth.tx_split != 0):
+                        m.d.comb += self.tx_start.eq(0)
+                    with m.If(eth.done):
+                        m.d.sync += [
+                            reply_len.eq(eth.tx_len),
+                            reply_split.eq(eth.tx_split),
+                            patch_ctr.eq(0),
+                        ]
+                        with m.If(eth.send & (eth.tx_split != 0)):
+                            m.next = "WRITE_PATCH_MASK"
+                        with m.Else():
+                            with m.If(eth.send):
+                                m.d.sync += self.tx_offset.eq(
+                                    self.tx_offset + self.tx_len)
+                            m.d.sync += self.rx_ack.eq(1)
+                            m.next = "RELEASE_RX"
+                else:
+                    with m.If(eth.done):
+                        with m.If(eth.send):
+                            m.d.sync += self.tx_offset.eq(
+                                self.tx_offset + self.tx_len)
+                        m.next = "IDLE"
+
+            # Write the patch mask after the patch region, one byte per
+            # clock, and then start transmission.
+            if self.shared_buffer:
+                with m.State("WRITE_PATCH_MASK"):
+                    mask_bytes = Array(patch_mask[8*i:8*(i+1)]
+                                       for i in range(TX_PATCH_LEN//8))
+                    m.d.sync += patch_ctr.eq(patch_ctr + 1)
+                    m.d.comb += [
+                        self.tx_port.addr.eq(
+                            self.tx_offset + reply_split + patch_ctr),
+                        self.tx_port.data.eq(mask_bytes[patch_ctr]),
+                        self.tx_port.en.eq(1),
+                    ]
+                    with m.If(patch_ctr == TX_PATCH_LEN//8 - 1):
+                        m.d.comb += [
+                            self.tx_start.eq(1),
+                            self.tx_len.eq(reply_len),
+                            self.tx_split.eq(reply_split),
+                        ]
+                        # Replies sent in place are transmitted from the
+                        # received packet, so it is only acknowledged,
+                        # allowing the MAC to overwrite it, once the
+                        # packets queued before the reply and the reply
+                        # itself are done. Other packets may be sent while
+                        # waiting.
+                        m.d.sync += [
+                            self.tx_offset.eq(
+                                self.tx_offset + reply_split
+                                + TX_PATCH_LEN//8),
+                            release_ctr.eq(tx_queued + 1 - self.tx_done),
+                            release_pending.eq(1),
+                        ]
+                        m.next = "IDLE"
+
+                # Wait for the acknowledgement to reach the RX FIFO.
+                with m.State("RELEASE_RX"):
+                    m.d.sync += self.rx_ack.eq(0)
                     m.next = "IDLE"
 
             # Handle sending a new packet with user data. Runs the UDP Tx
@@ -158,6 +457,43 @@ class IPStack(Elaboratable):
                             self.tx_offset + self.tx_len)
                     m.next = "IDLE"
 
+            # Handle sending a PRBS link test packet, as for user data.
+            if self.prbs_port is not None:
+                with m.State("SEND_PRBS"):
+                    m.d.sync += prbs_tx.run.eq(~prbs_tx.done)
+                    m.d.comb += [
+                        self.tx_port.addr.eq(prbs_tx.tx_addr + self.tx_offset),
+                        self.tx_port.data.eq(prbs_tx.tx_data),
+                        self.tx_port.en.eq(prbs_tx.tx_en),
+                        self.tx_start.eq(prbs_tx.send),
+                        self.tx_len.eq(prbs_tx.tx_len),
+                    ]
+
+                    with m.If(prbs_tx.done):
+                        with m.If(prbs_tx.send):
+                            m.d.sync += self.tx_offset.eq(
+                                self.tx_offset + self.tx_len)
+                        m.next = "IDLE"
+
+            # Handle sending a capture stream packet, as for user data.
+            if self.capture_port is not None:
+                with m.State("SEND_CAPTURE"):
+                    m.d.sync += capture_tx.run.eq(~capture_tx.done)
+                    m.d.comb += [
+                        self.tx_port.addr.eq(
+                            capture_tx.tx_addr + self.tx_offset),
+                        self.tx_port.data.eq(capture_tx.tx_data),
+                        self.tx_port.en.eq(capture_tx.tx_en),
+                        self.tx_start.eq(capture_tx.send),
+                        self.tx_len.eq(capture_tx.tx_len),
+                    ]
+
+                    with m.If(capture_tx.done):
+                        with m.If(capture_tx.send):
+                            m.d.sync += self.tx_offset.eq(
+                                self.tx_offset + self.tx_len)
+                        m.next = "IDLE"
+
         return m
 
 
@@ -193,6 +529,12 @@ class _StackLayer(Elaboratable):
         * `tx_data`: Output 8-bit data to store at `tx_addr`
         * `tx_len`: Output 11-bit number of bytes to transmit from this layer,
           valid when `send` is high.
+        * `tx_split`: Output 11-bit length of the patch region of this layer
+          and its children if the reply is to be transmitted in place from
+          the received packet, or 0 if all bytes were written. Within the
+          patch region only written bytes replace the received packet, and
+          all later bytes are transmitted unchanged. Valid when `send` is
+          high.
     """
     def __init__(self, ip_stack, parent=None):
         self.run = Signal()
@@ -203,10 +545,12 @@ class _StackLayer(Elaboratable):
         self.tx_addr = Signal(ip_stack.tx_port.addr.nbits)
         self.tx_data = Signal(8)
         self.tx_len = Signal(11)
+        self.tx_split = Signal(11)
 
         # Internal signals
         self.send_at_end = Signal()
         self.child_tx_len = Signal(11)
+        self.child_tx_split = Signal(11)
         self.ip_stack = ip_stack
         self.parent = parent
 
@@ -219,6 +563,7 @@ class _StackLayer(Elaboratable):
             self.m.d.sync += self.send_at_end.eq(0)
             self.m.d.sync += self.tx_en.eq(0)
             self.m.d.sync += self.child_tx_len.eq(0)
+            self.m.d.sync += self.child_tx_split.eq(0)
             with self.m.If(self.run):
                 self.m.next = self._fsm_ctr
 
@@ -410,31 +755,42 @@ class _StackLayer(Elaboratable):
         ]
         with self.m.State(self._fsm_ctr):
             self._fsm_ctr += 1
-            self.m.d.sync += [
-                self.tx_en.eq(1),
-                self.tx_data.eq(read_port.data),
-            ]
+            self.m.d.sync += self.tx_data.eq(read_port.data)
+            # The first cycle only presents the read address, so its output
+            # data is not yet valid and must not be written.
             with self.m.If(ctr == 0):
-                self.m.d.sync += self.tx_addr.eq(dst)
+                self.m.d.sync += [
+                    self.tx_en.eq(0),
+                    self.tx_addr.eq(dst),
+                ]
             with self.m.Else():
-                self.m.d.sync += self.tx_addr.eq(dst + ctr - 1)
+                self.m.d.sync += [
+                    self.tx_en.eq(1),
+                    self.tx_addr.eq(dst + ctr - 1),
+                ]
             with self.m.If(ctr == n):
                 self.m.next = self._fsm_ctr
                 self.m.d.sync += ctr.eq(0)
             with self.m.Else():
                 self.m.d.sync += ctr.eq(ctr + 1)
 
-    def switch(self, key, cases):
+    def switch(self, key, cases, rx_data=None):
         """
         Depending on the value in register `key`, delegate further
         processing to the relevant case from `cases` (a dictionary
         of integers mapping submodules).
+
+        Submodules are streamed this layer's `rx_data`, or `rx_data` if
+        given instead.
         """
+        if rx_data is None:
+            rx_data = self.rx_data
+
         # Wire up submodules' rx_data
         for case in cases:
             submod = cases[case]
             self.m.d.sync += [
-                submod.rx_data.eq(self.rx_data),
+                submod.rx_data.eq(rx_data),
             ]
 
         # Generate switch state
@@ -458,6 +814,7 @@ class _StackLayer(Elaboratable):
                                 self.m.d.sync += [
                                     self.send_at_end.eq(1),
                                     self.child_tx_len.eq(submod.tx_len),
+                                    self.child_tx_split.eq(submod.tx_split),
                                 ]
                             with self.m.Else():
                                 # If the submodule does _not_ need to send a
@@ -487,15 +844,23 @@ class _StackLayer(Elaboratable):
             else:
                 self.m.next = self._fsm_ctr
 
-    def end_fsm(self, tx_len=0, send=False):
+    def end_fsm(self, tx_len=0, send=False, tx_split=None):
         """
         Call to generate final FSM state.
 
         * `tx_len`: Number of bytes sent by this layer, excluding submodules
         * `send`: Whether to send a reply packet. Automatically set from child
                   if a `switch` statement was used.
+        * `tx_split`: Length of this layer's patch region if its `tx_len`
+                      bytes are to be sent in place from the received
+                      packet. By default, set from child if a `switch`
+                      statement was used.
         """
         self.m.d.sync += self.tx_len.eq(tx_len + self.child_tx_len)
+        if tx_split is None:
+            tx_split = Mux(self.child_tx_split != 0,
+                           tx_len + self.child_tx_split, 0)
+        self.m.d.sync += self.tx_split.eq(tx_split)
         with self.m.State("DONE_NO_TX"):
             self.m.d.comb += [
                 self.done.eq(1),
@@ -547,7 +912,9 @@ class _EthernetLayer(_StackLayer):
     levels depending on ethertype.
 
     Writes our own MAC address to outgoing `src` and sets ethertype if sending
-    a response packet.
+    a response packet. If IPStack's `shared_buffer` is set, all responses are
+    sent in place and so the ethertype is left unchanged, and IPStack holds
+    the received packet until the response has been transmitted.
     """
     def elaborate(self, platform):
         self.m = Module()
@@ -570,7 +937,10 @@ class _EthernetLayer(_StackLayer):
             # Extract and switch on the ethertype field.
             # If there's no handler or the handler doesn't need to transmit,
             # we'll return to idle after this.
-            self.copy_extract("ETYPE", reg=self.ethertype, dst=12, n=2)
+            if self.ip_stack.shared_buffer:
+                self.extract("ETYPE", reg=self.ethertype, n=2)
+            else:
+                self.copy_extract("ETYPE", reg=self.ethertype, dst=12, n=2)
             self.switch(self.ethertype, {
                 0x0806: arp,
                 0x0800: ipv4,
@@ -588,18 +958,28 @@ class _ARPLayer(_StackLayer):
     Implements Ethernet ARP handling.
 
     Replies to requests for its own MAC address only.
+
+    If IPStack's `shared_buffer` is set, the reply is sent in place and the
+    unchanged type and length fields are not written, with the request held
+    in RX memory until the reply has been transmitted.
     """
     def elaborate(self, platform):
         self.m = Module()
+        shared = self.ip_stack.shared_buffer
 
         with self.m.FSM():
             self.start_fsm()
 
             # Read incoming packet, checking/copying relevant fields as we go.
             # If any checks do not pass, we abort immediately.
-            self.copy("HTYPE", dst=0, n=2)
-            self.copy_check("PTYPE", val=0x0800, dst=2, n=2)
-            self.copy("LEN", dst=4, n=2)
+            if shared:
+                self.skip("HTYPE", n=2)
+                self.check("PTYPE", val=0x0800, n=2)
+                self.skip("LEN", n=2)
+            else:
+                self.copy("HTYPE", dst=0, n=2)
+                self.copy_check("PTYPE", val=0x0800, dst=2, n=2)
+                self.copy("LEN", dst=4, n=2)
             self.check("OPER", val=1, n=2)
             self.copy("SHA", dst=18, n=6)
             self.copy("SPA", dst=24, n=4)
@@ -611,7 +991,7 @@ class _ARPLayer(_StackLayer):
             self.write("SHA", val=self.ip_stack.mac_addr, dst=8, n=6)
 
             # Send response
-            self.end_fsm(tx_len=28, send=True)
+            self.end_fsm(tx_len=28, send=True, tx_split=28 if shared else 0)
 
         return self.m
 
@@ -624,33 +1004,79 @@ class _IPv4Layer(_StackLayer):
     depending on the protocol field. Fills in outgoing packet IPv4 header if
     a response needs to be sent, with the original source as the destination.
 
+    Fragmented UDP datagrams are passed to `_IPv4Reassembly` if IPStack has
+    any reassembly contexts, and once complete are streamed from its buffer
+    into the UDP layer. Other fragmented packets are dropped.
+
     Does not verify incoming header checksums.
     """
     def __init__(self, ip_stack, parent=None):
         super().__init__(ip_stack, parent)
         self.total_length = Signal(16)
+        self.ident = Signal(16)
+        self.flags_frag = Signal(16)
         self.source_ip = Signal(32)
 
+        self.more_fragments = self.flags_frag[13]
+        self.frag_offset = self.flags_frag[0:13]
+
+        # High while a reassembled datagram is streamed to the UDP layer
+        self.delivering = Signal()
+
     def elaborate(self, platform):
         self.m = Module()
 
         # Sublayers handle ICMPv4 and UDP protocols
         self.m.submodules.icmpv4 = icmpv4 = _ICMPv4Layer(self.ip_stack, self)
         self.m.submodules.udp = udp = _UDPLayer(self.ip_stack, self)
+        cases = {0x01: icmpv4, 0x11: udp}
+
+        # Fragments are dispatched on a key which is not a valid protocol,
+        # either to the reassembly layer or to nothing. While delivering a
+        # reassembled datagram, the UDP layer is fed from its buffer instead.
+        protocol = Signal(8)
+        dispatch = Signal(9)
+        fragmented = self.more_fragments | (self.frag_offset != 0)
+        rx_data = Signal(8)
+        if self.ip_stack.reasm_contexts:
+            self.m.submodules.reasm = reasm = _IPv4Reassembly(
+                self.ip_stack, self)
+            cases[0x100] = reasm
+            read_ctr = Signal(max=self.ip_stack.reasm_size)
+            self.m.d.comb += reasm.read_port.addr.eq(
+                reasm.read_base + read_ctr)
+            self.m.d.sync += read_ctr.eq(read_ctr + 1)
+            with self.m.If(self.done):
+                self.m.d.sync += self.delivering.eq(0)
+            with self.m.If(self.delivering):
+                self.m.d.comb += rx_data.eq(reasm.read_port.data)
+            with self.m.Else():
+                self.m.d.comb += rx_data.eq(self.rx_data)
+        else:
+            self.m.d.comb += rx_data.eq(self.rx_data)
+        with self.m.If(self.delivering):
+            self.m.d.comb += dispatch.eq(0x11)
+        with self.m.Elif(fragmented):
+            with self.m.If(protocol == 0x11):
+                self.m.d.comb += dispatch.eq(0x100)
+            with self.m.Else():
+                self.m.d.comb += dispatch.eq(0x1FF)
+        with self.m.Else():
+            self.m.d.comb += dispatch.eq(protocol)
 
         # Wire the IPChecksum submodule to see our outgoing write data.
         # The IP Checksum algorithm is not sensitive to data order, but
         # bytes must retain their correct high/low byte order per word.
+        # Only the 20-byte header is included, as child layers may not
+        # write their entire reply.
         self.m.submodules.ipchecksum = ipchecksum = _InternetChecksum()
         self.m.d.comb += [
             ipchecksum.data.eq(self.tx_data),
             ipchecksum.lowbyte.eq(self.tx_addr[0]),
-            ipchecksum.en.eq(self.tx_en),
+            ipchecksum.en.eq(self.tx_en & (self.tx_addr < 20)),
             ipchecksum.reset.eq(self.done),
         ]
 
-        protocol = Signal(8)
-
         with self.m.FSM():
             self.start_fsm()
 
@@ -658,15 +1084,33 @@ class _IPv4Layer(_StackLayer):
             self.copy_check("VER_IHL", val=0x45, dst=0, n=1)
             self.skip("DSCP_ECN", n=1)
             self.extract("TOTAL_LENGTH", reg=self.total_length, n=2)
-            self.skip("ID_FRAG_TTL", n=5)
+            self.extract("IDENT", reg=self.ident, n=2)
+            self.extract("FLAGS_FRAG", reg=self.flags_frag, n=2)
+            self.skip("TTL", n=1)
             self.copy_extract("PROTO", reg=protocol, dst=9, n=1)
             self.skip("CHECKSUM", n=2)
             self.copy_extract("SOURCE", reg=self.source_ip, dst=16, n=4)
             self.copy_check("DEST", val=self.ip_stack.ip4_addr, dst=12, n=4)
-            self.switch(protocol, {
-                0x01: icmpv4,
-                0x11: udp,
-            })
+            switch_state = self._fsm_ctr
+            self.switch(dispatch, cases, rx_data=rx_data)
+
+            # If the reassembly layer has completed a datagram, go back to
+            # the switch state to stream it into the UDP layer. The first
+            # byte is addressed in this state so it is ready in time.
+            if self.ip_stack.reasm_contexts:
+                with self.m.State(self._fsm_ctr):
+                    self.m.d.sync += self.tx_en.eq(0)
+                    with self.m.If(dispatch == 0x100):
+                        self.m.d.comb += reasm.read_port.addr.eq(
+                            reasm.read_base)
+                        self.m.d.sync += [
+                            read_ctr.eq(1),
+                            self.delivering.eq(1),
+                        ]
+                        self.m.next = switch_state
+                    with self.m.Else():
+                        self.m.next = self._fsm_ctr + 1
+                self._fsm_ctr += 1
 
             # If the child layer requested transmission, fill in the
             # outbound IPv4 header.
@@ -680,11 +1124,174 @@ class _IPv4Layer(_StackLayer):
         return self.m
 
 
+class _IPv4Reassembly(_StackLayer):
+    """
+    Reassembles fragmented IPv4 datagrams.
+
+    The payload of each fragment is written into one of IPStack's
+    `reasm_contexts` buffers, each `reasm_size` bytes long and held together
+    in one BRAM, at the fragment's offset. Buffers are matched to fragments
+    by source address and identification field, and a free buffer is
+    allocated for the first fragment of a new datagram.
+
+    Once every byte of a datagram has been received, `send` is asserted with
+    `done` and the buffer is freed; the parent should then stream the
+    datagram from `read_port`, starting at `read_base`, before processing
+    any further packets. Buffers which receive no fragments for
+    `reasm_timeout` clocks are freed. Fragments which do not fit in a buffer
+    or for which no buffer is free are dropped. Duplicate or overlapping
+    fragments are not detected, and will cause the datagram to time out.
+    """
+    def __init__(self, ip_stack, parent=None):
+        super().__init__(ip_stack, parent)
+        n = ip_stack.reasm_contexts
+        size = ip_stack.reasm_size
+        self.mem = Memory(8, n*size)
+        self.read_port = self.mem.read_port()
+        self.read_base = Signal(max=n*size)
+
+    def elaborate(self, platform):
+        n = self.ip_stack.reasm_contexts
+        size = self.ip_stack.reasm_size
+        timeout = self.ip_stack.reasm_timeout
+
+        self.m = Module()
+        write_port = self.mem.write_port()
+        self.m.submodules += [self.read_port, write_port]
+
+        # We never transmit, so manually set these to 0.
+        self.m.d.comb += self.tx_addr.eq(0), self.tx_data.eq(0)
+
+        # Per-buffer state
+        valid = Array(Signal(name=f"valid{i}") for i in range(n))
+        source = Array(Signal(32, name=f"source{i}") for i in range(n))
+        ident = Array(Signal(16, name=f"ident{i}") for i in range(n))
+        received = Array(Signal(17, name=f"received{i}") for i in range(n))
+        total = Array(Signal(17, name=f"total{i}") for i in range(n))
+        total_known = Array(Signal(name=f"total_known{i}") for i in range(n))
+        age = [Signal(max=timeout+1, name=f"age{i}") for i in range(n)]
+
+        # Evict buffers which have not been written to recently.
+        for i in range(n):
+            with self.m.If(valid[i]):
+                with self.m.If(age[i] == timeout):
+                    self.m.d.sync += valid[i].eq(0)
+                with self.m.Else():
+                    self.m.d.sync += age[i].eq(age[i] + 1)
+
+        # Position of this fragment in the datagram
+        frag_start = Signal(16)
+        frag_len = Signal(16)
+        frag_end = Signal(17)
+        self.m.d.comb += [
+            frag_start.eq(self.parent.frag_offset << 3),
+            frag_len.eq(self.parent.total_length - 20),
+            frag_end.eq(frag_start + frag_len),
+        ]
+
+        # Find a matching buffer, or else a free one, with the lowest index
+        # taking priority.
+        match = Signal()
+        match_idx = Signal(max=n)
+        free = Signal()
+        free_idx = Signal(max=n)
+        for i in reversed(range(n)):
+            with self.m.If(valid[i] & (source[i] == self.parent.source_ip) &
+                           (ident[i] == self.parent.ident)):
+                self.m.d.comb += match.eq(1), match_idx.eq(i)
+            with self.m.If(~valid[i]):
+                self.m.d.comb += free.eq(1), free_idx.eq(i)
+
+        # Selected buffer, latched while idle (see below) as the parent
+        # header fields are already valid when we are started.
+        ctx = Signal(max=n)
+        new = Signal()
+        accept = Signal()
+        ctr = Signal(16)
+        base = Signal(max=n*size)
+        self.m.d.comb += base.eq(ctx * size)
+
+        with self.m.FSM() as fsm:
+            self.start_fsm()
+
+            # Write the fragment payload into the buffer.
+            with self.m.State(self._fsm_ctr):
+                self._fsm_ctr += 1
+                self.m.d.sync += self.tx_en.eq(0)
+                self.m.d.comb += [
+                    write_port.addr.eq(base + frag_start + ctr),
+                    write_port.data.eq(self.rx_data),
+                    write_port.en.eq(1),
+                ]
+                self.m.d.sync += ctr.eq(ctr + 1)
+                with self.m.If(~accept):
+                    self.m.d.comb += write_port.en.eq(0)
+                    self.m.next = "DONE_NO_TX"
+                with self.m.Elif(ctr == frag_len - 1):
+                    self.m.next = self._fsm_ctr
+
+            # Record the fragment against its buffer.
+            with self.custom_state():
+                self.m.d.sync += [
+                    self.tx_en.eq(0),
+                    valid[ctx].eq(1),
+                    source[ctx].eq(self.parent.source_ip),
+                    ident[ctx].eq(self.parent.ident),
+                ]
+                for i in range(n):
+                    with self.m.If(ctx == i):
+                        self.m.d.sync += age[i].eq(0)
+                with self.m.If(new):
+                    self.m.d.sync += [
+                        received[ctx].eq(frag_len),
+                        total[ctx].eq(frag_end),
+                        total_known[ctx].eq(~self.parent.more_fragments),
+                    ]
+                with self.m.Else():
+                    self.m.d.sync += received[ctx].eq(received[ctx] + frag_len)
+                    with self.m.If(~self.parent.more_fragments):
+                        self.m.d.sync += [
+                            total[ctx].eq(frag_end),
+                            total_known[ctx].eq(1),
+                        ]
+
+            # If the datagram is complete, free its buffer and request the
+            # parent delivers it.
+            with self.custom_state():
+                self.m.d.sync += self.tx_en.eq(0)
+                with self.m.If(total_known[ctx] &
+                               (received[ctx] == total[ctx])):
+                    self.m.d.sync += [
+                        valid[ctx].eq(0),
+                        self.read_base.eq(base),
+                        self.send_at_end.eq(1),
+                    ]
+
+            self.end_fsm(tx_len=0)
+
+        with self.m.If(fsm.ongoing("IDLE")):
+            self.m.d.sync += [
+                ctx.eq(Mux(match, match_idx, free_idx)),
+                new.eq(~match),
+                accept.eq((match | free) & (frag_len != 0) &
+                          (frag_end <= size)),
+                ctr.eq(0),
+            ]
+
+        return self.m
+
+
 class _ICMPv4Layer(_StackLayer):
     """
     Implements a simple ICMPv4 layer.
 
     Replies to echo requests only. Does not validate incoming checksums.
+
+    If IPStack's `shared_buffer` is set, only the changed type and checksum
+    fields are written and the rest of the reply is transmitted in place
+    from the received packet. The reply checksum is then updated
+    incrementally from the request checksum, as described in RFC 1624, to
+    account for the changed type field.
     """
     def elaborate(self, platform):
         self.m = Module()
@@ -704,37 +1311,133 @@ class _ICMPv4Layer(_StackLayer):
         payload_n = Signal(11)
         self.m.d.sync += payload_n.eq(self.parent.total_length - 28)
 
+        # Reply checksum with the type changed from 8 to 0, computed as
+        # ~(~HC + ~m + m') with m=0x0800 and m'=0x0000.
+        rx_checksum = Signal(16)
+        in_place_sum = Signal(17)
+        in_place_checksum = Signal(16)
+        self.m.d.comb += [
+            in_place_sum.eq((~rx_checksum)[:16] + 0xF7FF),
+            in_place_checksum.eq(~(in_place_sum[:16] + in_place_sum[16])),
+        ]
+
         with self.m.FSM():
             self.start_fsm()
             self.check("TYPE", val=8, n=1)
             self.check("CODE", val=0, n=1)
-            self.skip("CHECKSUM", n=2)
-            self.copy("IDENTIFIER", dst=4, n=2)
-            self.copy("SEQUENCE", dst=6, n=2)
-            self.copy_sig_n("PAYLOAD", dst=8, n=payload_n)
-            self.write("TYPE", val=0, dst=0, n=1)
-            self.write("CODE", val=0, dst=1, n=1)
-            self.write("CHECKSUM", val=ipchecksum.checksum, dst=2, n=2)
-            self.end_fsm(tx_len=self.parent.total_length - 20, send=True)
+            if self.ip_stack.shared_buffer:
+                self.extract("CHECKSUM", reg=rx_checksum, n=2)
+                self.write("TYPE", val=0, dst=0, n=1)
+                self.write("CHECKSUM", val=in_place_checksum, dst=2, n=2)
+                self.end_fsm(tx_len=self.parent.total_length - 20, send=True,
+                             tx_split=8)
+            else:
+                self.skip("CHECKSUM", n=2)
+                self.copy("IDENTIFIER", dst=4, n=2)
+                self.copy("SEQUENCE", dst=6, n=2)
+                self.copy_sig_n("PAYLOAD", dst=8, n=payload_n)
+                self.write("TYPE", val=0, dst=0, n=1)
+                self.write("CODE", val=0, dst=1, n=1)
+                self.write("CHECKSUM", val=ipchecksum.checksum, dst=2, n=2)
+                self.end_fsm(tx_len=self.parent.total_length - 20, send=True)
 
         return self.m
 
 
 class _UDPLayer(_StackLayer):
     """
-    Receive UDP packets and copy the payload into a BRAM.
-
-    Writes to the top-level IPStack `user_w_port`. Receives on UDP port
-    specified by IPStack's `user_udp_port` with receive data length always
-    set by IPStack `user_udp_len` (which must match received packet length).
+    Receive UDP packets, delegating to submodules depending on port.
+
+    Packets to IPStack's `user_udp_port` with a payload of IPStack's
+    `user_udp_len` bytes, or reassembled datagrams with a non-empty payload
+    of at most that many bytes, are passed to `_UDPUserLayer`, or to
+    `_UDPEchoLayer`
+    with any payload while IPStack's `udp_echo` is set. Packets are only
+    echoed if their payload lies within the received frame, and reassembled
+    datagrams are never echoed, as the reply would not be fragmented and
+    could exceed the MTU. If IPStack has a
+    `prbs_port`, packets to it are passed to `_PRBSRxLayer`. Other packets
+    are dropped.
+
+    If the packet is echoed, fills in the outgoing UDP header with the
+    ports swapped and no checksum.
 
     Does not validate incoming checksums.
+    """
+    def __init__(self, ip_stack, parent=None):
+        super().__init__(ip_stack, parent)
+        self.src_port = Signal(16)
+        self.dst_port = Signal(16)
+        self.length = Signal(16)
+
+    def elaborate(self, platform):
+        udp_port = self.ip_stack.user_udp_port
+        udp_len = self.ip_stack.user_udp_len
+        prbs_port = self.ip_stack.prbs_port
+
+        self.m = Module()
+
+        self.m.submodules.user = user = _UDPUserLayer(self.ip_stack, self)
+        self.m.submodules.echo = echo = _UDPEchoLayer(self.ip_stack, self)
+        cases = {udp_port: user, 0x10001: echo}
+
+        # Packets are dispatched on their destination port once their length
+        # has been checked, or on keys which are not valid ports to echo or
+        # drop them.
+        dispatch = Signal(17)
+        echo_ok = Signal()
+        self.m.d.comb += echo_ok.eq(
+            self.ip_stack.udp_echo & (self.length > 8) &
+            (self.length + 34 <= self.ip_stack.rx_pkt_len) &
+            ~self.parent.delivering)
+        with self.m.If(echo_ok & (self.dst_port == udp_port)):
+            self.m.d.comb += dispatch.eq(0x10001)
+        with self.m.Elif((self.dst_port == udp_port) & (
+                (self.length == udp_len + 8) |
+                (self.parent.delivering & (self.length > 8) &
+                 (self.length <= udp_len + 8)))):
+            self.m.d.comb += dispatch.eq(udp_port)
+        if prbs_port is not None:
+            self.m.submodules.prbs = prbs = _PRBSRxLayer(self.ip_stack, self)
+            cases[prbs_port] = prbs
+            with self.m.Elif((self.dst_port == prbs_port) &
+                             (self.length >= 13)):
+                self.m.d.comb += dispatch.eq(prbs_port)
+        with self.m.Else():
+            self.m.d.comb += dispatch.eq(0x10000)
+
+        with self.m.FSM():
+            self.start_fsm()
+            self.extract("SRC_PORT", reg=self.src_port, n=2)
+            self.extract("DST_PORT", reg=self.dst_port, n=2)
+            self.extract("LENGTH", reg=self.length, n=2)
+            self.skip("CHECKSUM", n=2)
+            self.switch(dispatch, cases)
+
+            # If echoing, reply from the port the packet was sent to.
+            self.write("SRC_PORT", val=self.dst_port, dst=0, n=2)
+            self.write("DST_PORT", val=self.src_port, dst=2, n=2)
+            self.write("LENGTH", val=self.length, dst=4, n=2)
+            self.write("CHECKSUM", val=0, dst=6, n=2)
+            if self.ip_stack.shared_buffer:
+                self.end_fsm(tx_len=8, tx_split=8)
+            else:
+                self.end_fsm(tx_len=8)
+
+        return self.m
+
+
+class _UDPUserLayer(_StackLayer):
+    """
+    Receive user UDP packets and copy the payload into a BRAM.
+
+    Writes the payload, whose length the parent has checked is at most
+    IPStack's `user_udp_len`, to the top-level IPStack `user_w_port`.
 
     Pulses IPStack's `user_rx` signal high when a packet is received.
     """
     def elaborate(self, platform):
         write_port = self.ip_stack.user_w_port
-        udp_port = self.ip_stack.user_udp_port
         udp_len = self.ip_stack.user_udp_len
 
         self.m = Module()
@@ -743,26 +1446,25 @@ class _UDPLayer(_StackLayer):
         # manually set these to 0.
         self.m.d.comb += self.tx_addr.eq(0), self.tx_data.eq(0)
 
-        src_port = Signal(16)
+        payload_len = Signal(max=udp_len+1)
+        self.m.d.comb += payload_len.eq(self.parent.length - 8)
 
         with self.m.FSM() as fsm:
             self.start_fsm()
-            self.extract("SRC_PORT", reg=src_port, n=2)
-            self.check("DST_PORT", val=udp_port, n=2)
-            self.check("LENGTH", val=udp_len+8, n=2)
-            self.skip("CHECKSUM", n=2)
 
             if write_port is not None:
-                self.extract_to_mem("DATA", write_port, 0, udp_len)
+                self.extract_to_mem("DATA", write_port, 0, payload_len)
 
             # If we've received a valid packet, save the current source details
             # to the IPStack registers for later transmission use.
+            udp = self.parent
             with self.custom_state():
                 self.m.d.sync += [
                     self.tx_en.eq(0),
-                    self.ip_stack.user_last_mac.eq(self.parent.parent.src_mac),
-                    self.ip_stack.user_last_ip4.eq(self.parent.source_ip),
-                    self.ip_stack.user_last_port.eq(src_port),
+                    self.ip_stack.user_last_mac.eq(udp.parent.parent.src_mac),
+                    self.ip_stack.user_last_ip4.eq(udp.parent.source_ip),
+                    self.ip_stack.user_last_port.eq(udp.src_port),
+                    self.ip_stack.user_rx_len.eq(payload_len),
                 ]
             self.m.d.sync += self.ip_stack.user_rx.eq(
                 fsm.ongoing(self._fsm_ctr - 1))
@@ -772,6 +1474,117 @@ class _UDPLayer(_StackLayer):
         return self.m
 
 
+class _UDPEchoLayer(_StackLayer):
+    """
+    Echo the payload of received UDP packets.
+
+    If IPStack's `shared_buffer` is set, the payload is transmitted in place
+    from the received packet, so nothing is written.
+    """
+    def elaborate(self, platform):
+        self.m = Module()
+
+        payload_len = Signal(16)
+        self.m.d.comb += payload_len.eq(self.parent.length - 8)
+
+        with self.m.FSM():
+            self.start_fsm()
+            if self.ip_stack.shared_buffer:
+                self.m.d.comb += self.tx_addr.eq(0), self.tx_data.eq(0)
+            else:
+                self.copy_sig_n("PAYLOAD", dst=0, n=payload_len)
+            self.end_fsm(tx_len=payload_len, send=True)
+
+        return self.m
+
+
+class _PRBSRxLayer(_StackLayer):
+    """
+    Check received PRBS link test packets.
+
+    Compares the payload after the sequence number against the PRBS seeded
+    by the sequence number, counting bit errors in IPStack's
+    `prbs_rx_bit_errors`. Gaps in the sequence numbers of received packets
+    are counted in `prbs_rx_lost`, while packets received out of order
+    only resynchronise the expected sequence number.
+    """
+    def elaborate(self, platform):
+        k = self.ip_stack.prbs_k
+
+        self.m = Module()
+
+        # We never transmit, so manually set these to 0.
+        self.m.d.comb += self.tx_addr.eq(0), self.tx_data.eq(0)
+
+        self.m.submodules.lfsr = lfsr = LFSR(k, n=8)
+
+        seq = Signal(32)
+        next_seq = Signal(32)
+        gap = Signal(32)
+        synced = Signal()
+        n = Signal(16)
+        ctr = Signal(16)
+        diff = Signal(8)
+        self.m.d.comb += [
+            gap.eq(seq - next_seq),
+            n.eq(self.parent.length - 12),
+            diff.eq(self.rx_data ^ lfsr.next[:8]),
+            lfsr.en.eq(0),
+        ]
+
+        with self.m.FSM() as fsm:
+            self.start_fsm()
+
+            # Seed the LFSR as the final sequence number byte arrives.
+            self.extract("SEQ", reg=seq, n=4)
+            self.m.d.comb += [
+                lfsr.seed.eq(_prbs_seed(Cat(self.rx_data, seq[8:32]), k)),
+                lfsr.reset.eq(fsm.ongoing(self._fsm_ctr - 1)),
+            ]
+
+            # Compare each payload byte with the next PRBS byte.
+            with self.m.State(self._fsm_ctr):
+                self._fsm_ctr += 1
+                self.m.d.comb += lfsr.en.eq(1)
+                self.m.d.sync += [
+                    self.tx_en.eq(0),
+                    ctr.eq(ctr + 1),
+                    self.ip_stack.prbs_rx_bit_errors.eq(
+                        self.ip_stack.prbs_rx_bit_errors +
+                        sum(diff[i] for i in range(8))),
+                ]
+                with self.m.If(ctr == n - 1):
+                    self.m.next = self._fsm_ctr
+
+            # Count the packet and any lost since the last one.
+            with self.custom_state():
+                self.m.d.sync += [
+                    self.tx_en.eq(0),
+                    self.ip_stack.prbs_rx_frames.eq(
+                        self.ip_stack.prbs_rx_frames + 1),
+                    next_seq.eq(seq + 1),
+                    synced.eq(1),
+                ]
+                with self.m.If(synced & ~gap[31]):
+                    self.m.d.sync += self.ip_stack.prbs_rx_lost.eq(
+                        self.ip_stack.prbs_rx_lost + gap)
+
+            self.end_fsm(send=False)
+
+        with self.m.If(fsm.ongoing("IDLE")):
+            self.m.d.sync += ctr.eq(0)
+
+        with self.m.If(self.ip_stack.prbs_rx_clear):
+            self.m.d.sync += [
+                self.ip_stack.prbs_rx_frames.eq(0),
+                self.ip_stack.prbs_rx_lost.eq(0),
+                self.ip_stack.prbs_rx_bit_errors.eq(0),
+                synced.eq(0),
+            ]
+
+        return self.m
+
+
 class _UDPTxLayer(_StackLayer):
     """
     Transmit new UDP packets with payload from a BRAM.
@@ -784,30 +1597,54 @@ class _UDPTxLayer(_StackLayer):
 
     Reads payload data from IPStack's `user_r_port`.
 
-    Does not set the UDP checksum field.
+    The IPv4 header checksum and the header part of the UDP checksum are
+    precomputed by `_HeaderChecksum`, so only the destination fields are
+    added at run time. The UDP checksum is completed over the payload as it
+    is written out, and is filled in after the payload so that no additional
+    cycles are required per packet.
     """
     def elaborate(self, platform):
         mem_port = self.ip_stack.user_r_port
         udp_port = self.ip_stack.user_udp_port
         udp_len = self.ip_stack.user_udp_len
+        src_ip4 = self.ip_stack.ip4_addr
         dst_mac = self.ip_stack.user_last_mac
         dst_ip4 = self.ip_stack.user_last_ip4
         dst_udp_port = self.ip_stack.user_last_port
 
         self.m = Module()
-        self.m.submodules.ipchecksum = ipchecksum = _InternetChecksum()
+
+        # The IPv4 header is constant apart from the destination address.
+        self.m.submodules.ipchecksum = ipchecksum = _HeaderChecksum(
+            constants=[0x4500, udp_len+28, 0x0000, 0x0000, 0x4011,
+                       src_ip4 >> 16, src_ip4 & 0xFFFF],
+            variables=[dst_ip4[16:32], dst_ip4[0:16]])
+
+        # The UDP checksum covers a pseudo-header containing the source and
+        # destination IP addresses, protocol and UDP length, followed by the
+        # UDP header and payload. Only the destination address and port are
+        # not known at elaboration time.
+        self.m.submodules.udphdrchecksum = udphdrchecksum = _HeaderChecksum(
+            constants=[src_ip4 >> 16, src_ip4 & 0xFFFF, 0x0011, udp_len+8,
+                       udp_port, udp_len+8],
+            variables=[dst_ip4[16:32], dst_ip4[0:16], dst_udp_port])
+
+        # The payload is added to the UDP header sum as it is written out.
+        self.m.submodules.udpchecksum = udpchecksum = _InternetChecksum(
+            init=udphdrchecksum.sum)
+        udp_chk = Signal(16)
+        with self.m.If(udpchecksum.checksum == 0):
+            self.m.d.comb += udp_chk.eq(0xFFFF)
+        with self.m.Else():
+            self.m.d.comb += udp_chk.eq(udpchecksum.checksum)
 
         with self.m.FSM() as fsm:
-            # Wire the IPChecksum to update when we are in the IPv4 header
-            # states. Note that the first byte is state 1, so state 15 is
-            # the first byte after the 14-byte Ethernet header.
+            # Hold the payload checksum at the header sum until we start.
             self.m.d.comb += [
-                ipchecksum.data.eq(self.tx_data),
-                ipchecksum.lowbyte.eq(self.tx_addr[0]),
-                ipchecksum.reset.eq(self.done),
-                ipchecksum.en.eq(functools.reduce(
-                    operator.or_, [fsm.ongoing(x) for x in range(15, 33)])
-                ),
+                udpchecksum.data.eq(self.tx_data),
+                udpchecksum.lowbyte.eq(self.tx_addr[0]),
+                udpchecksum.reset.eq(fsm.ongoing("IDLE")),
+                udpchecksum.en.eq(self.tx_en & (self.tx_addr >= 42)),
             ]
 
             self.start_fsm()
@@ -823,84 +1660,461 @@ class _UDPTxLayer(_StackLayer):
             self.write("PROTO", val=0x11, n=1, dst=23)
             self.write("SRC_IP", val=self.ip_stack.ip4_addr, n=4, dst=26)
             self.write("DST_IP", val=dst_ip4, n=4, dst=30)
-            self.write("CHECKSUM", val=ipchecksum.checksum, n=2, dst=24)
             self.write("SRC_PORT", val=udp_port, n=2, dst=34)
             self.write("DST_PORT", val=dst_udp_port, n=2, dst=36)
             self.write("UDP_LEN", val=udp_len+8, n=2, dst=38)
-            self.write("UDP_CHK", val=0x0000, n=2, dst=40)
             if mem_port is not None:
                 self.write_from_mem("DATA", mem_port, src=0, dst=42, n=udp_len)
+
+            # Write the IPv4 checksum after the payload, which gives the UDP
+            # checksum time to absorb the final payload byte before we write
+            # it out. A computed UDP checksum of 0 is transmitted as 0xFFFF,
+            # as 0 indicates no checksum.
+            self.write("CHECKSUM", val=ipchecksum.checksum, n=2, dst=24)
+            self.write("UDP_CHK", val=udp_chk, n=2, dst=40)
             self.end_fsm(send=True, tx_len=udp_len+42)
 
         return self.m
 
 
-class _InternetChecksum(Elaboratable):
+class _PRBSTxLayer(_StackLayer):
     """
-    Implements the Internet Checksum algorithm from RFC 1071.
+    Transmit new PRBS link test packets.
 
-    Inputs:
-        * `data`: 8-bit data to add to checksum.
-        * `lowbyte`: Assert if `data` contains the lower byte of a 16-bit word
-                     in network byte order
-        * `en`: Checksum updated with `data` when `en` is high
-        * `reset`: Pulse high to reset checksum to zero
+    Writes complete Ethernet packets (all protocol layers) from and to
+    IPStack's `prbs_port`, addressed to `prbs_dst_mac` and `prbs_dst_ip4`,
+    with `prbs_tx_len` bytes of UDP payload: a 32-bit sequence number,
+    incremented for each packet, followed by a PRBS generated eight bits
+    per clock by an LFSR seeded from the sequence number.
 
-    Outputs:
-        * `checksum`: 16-bit current value of checksum
+    The UDP checksum is not used, so the PRBS is never read back, and the
+    IPv4 header checksum is written after the payload as in `_UDPTxLayer`.
     """
-    def __init__(self):
-        self.data = Signal(8)
-        self.lowbyte = Signal()
-        self.en = Signal()
-        self.reset = Signal()
-        self.checksum = Signal(16)
-
     def elaborate(self, platform):
-        m = Module()
-        state = Signal(17)
-        data_shift = Signal(16)
+        k = self.ip_stack.prbs_k
+        prbs_port = self.ip_stack.prbs_port
+        src_ip4 = self.ip_stack.ip4_addr
+        dst_mac = self.ip_stack.prbs_dst_mac
+        dst_ip4 = self.ip_stack.prbs_dst_ip4
 
-        m.d.comb += self.checksum.eq(~state[:-1])
+        self.m = Module()
 
-        with m.If(self.lowbyte):
-            m.d.comb += data_shift.eq(self.data)
-        with m.Else():
-            m.d.comb += data_shift.eq(self.data << 8)
+        self.m.submodules.lfsr = lfsr = LFSR(k, n=8)
 
-        with m.If(self.reset):
-            m.d.sync += state.eq(0)
-        with m.Else():
-            with m.If(self.en):
-                m.d.sync += state.eq(state[:-1] + data_shift + state[-1])
-        return m
+        # Payload length is held for the whole packet.
+        payload_len = Signal(11)
+        seq = Signal(32)
+        ctr = Signal(11)
 
+        # The IPv4 header is constant apart from the total length, split
+        # here into a variable payload length and the constant header
+        # length, and the destination address.
+        self.m.submodules.ipchecksum = ipchecksum = _HeaderChecksum(
+            constants=[0x4500, 28, 0x0000, 0x0000, 0x4011,
+                       src_ip4 >> 16, src_ip4 & 0xFFFF],
+            variables=[payload_len, dst_ip4[16:32], dst_ip4[0:16]])
 
-def test_ipv4_checksum():
-    from nmigen.back import pysim
+        with self.m.FSM() as fsm:
+            self.m.d.comb += [
+                lfsr.seed.eq(_prbs_seed(seq, k)),
+                lfsr.reset.eq(fsm.ongoing("IDLE")),
+                lfsr.en.eq(0),
+            ]
 
-    checksum = _InternetChecksum()
+            self.start_fsm()
+            self.write("DST_MAC", val=dst_mac, n=6, dst=0)
+            self.write("SRC_MAC", val=self.ip_stack.mac_addr, n=6, dst=6)
+            self.write("ETYPE", val=0x0800, n=2, dst=12)
+            self.write("VER_IHL", val=0x45, n=1, dst=14)
+            self.write("DSCP_ECN", val=0, n=1, dst=15)
+            self.write("TOTAL_LENGTH", val=payload_len+28, n=2, dst=16)
+            self.write("IDENT", val=0, n=2, dst=18)
+            self.write("FRAG", val=0, n=2, dst=20)
+            self.write("TTL", val=64, n=1, dst=22)
+            self.write("PROTO", val=0x11, n=1, dst=23)
+            self.write("SRC_IP", val=src_ip4, n=4, dst=26)
+            self.write("DST_IP", val=dst_ip4, n=4, dst=30)
+            self.write("SRC_PORT", val=prbs_port, n=2, dst=34)
+            self.write("DST_PORT", val=prbs_port, n=2, dst=36)
+            self.write("UDP_LEN", val=payload_len+8, n=2, dst=38)
+            self.write("UDP_CHK", val=0, n=2, dst=40)
+            self.write("SEQ", val=seq, n=4, dst=42)
 
-    data = [0x45, 0x00, 0x00, 0x73, 0x00, 0x00, 0x40, 0x00, 0x40, 0x11, 0x00,
-            0x00, 0xc0, 0xa8, 0x00, 0x01, 0xc0, 0xa8, 0x00, 0xc7]
-    expected_checksum = 0xb861
+            # Write the PRBS, one byte per clock.
+            with self.m.State(self._fsm_ctr):
+                self._fsm_ctr += 1
+                self.m.d.comb += lfsr.en.eq(1)
+                self.m.d.sync += [
+                    self.tx_en.eq(1),
+                    self.tx_addr.eq(46 + ctr),
+                    self.tx_data.eq(lfsr.next[:8]),
+                    ctr.eq(ctr + 1),
+                ]
+                with self.m.If(ctr == payload_len - 5):
+                    self.m.next = self._fsm_ctr
 
-    def testbench():
-        yield
-        yield
+            self.write("CHECKSUM", val=ipchecksum.checksum, n=2, dst=24)
 
-        for i in range(2):
+            with self.custom_state():
+                self.m.d.sync += [
+                    self.tx_en.eq(0),
+                    seq.eq(seq + 1),
+                    self.ip_stack.prbs_tx_frames.eq(
+                        self.ip_stack.prbs_tx_frames + 1),
+                ]
 
-            for idx, byte in enumerate(data):
-                yield checksum.data.eq(byte)
-                yield checksum.lowbyte.eq(idx & 1)
-                yield checksum.en.eq(1)
-                yield
+            self.end_fsm(send=True, tx_len=payload_len+42)
 
-            yield checksum.en.eq(0)
-            yield
+        with self.m.If(fsm.ongoing("IDLE")):
+            self.m.d.sync += [
+                payload_len.eq(self.ip_stack.prbs_tx_len),
+                ctr.eq(0),
+            ]
 
-            assert (yield checksum.checksum) == expected_checksum
+        return self.m
+
+
+class _CaptureTxLayer(_StackLayer):
+    """
+    Transmit capture stream packets.
+
+    Writes complete Ethernet packets (all protocol layers) from and to
+    IPStack's `capture_port`, addressed to `capture_dst_mac` and
+    `capture_dst_ip4`. The stream bytes are written first, one per clock
+    as they are available, until `capture_tx_len` bytes or the byte marked
+    with `capture_last`, so the payload length is known before the headers
+    and the sequence number are written.
+    """
+    def elaborate(self, platform):
+        capture_port = self.ip_stack.capture_port
+        src_ip4 = self.ip_stack.ip4_addr
+        dst_mac = self.ip_stack.capture_dst_mac
+        dst_ip4 = self.ip_stack.capture_dst_ip4
+
+        self.m = Module()
+
+        # Maximum data length is held for the whole packet, and the
+        # payload length follows the number of data bytes written.
+        max_len = Signal(11)
+        payload_len = Signal(11)
+        seq = Signal(31)
+        last = Signal()
+        ctr = Signal(11)
+        self.m.d.comb += payload_len.eq(ctr + 4)
+
+        self.m.submodules.ipchecksum = ipchecksum = _HeaderChecksum(
+            constants=[0x4500, 28, 0x0000, 0x0000, 0x4011,
+                       src_ip4 >> 16, src_ip4 & 0xFFFF],
+            variables=[payload_len, dst_ip4[16:32], dst_ip4[0:16]])
+
+        with self.m.FSM() as fsm:
+            self.start_fsm()
+
+            # Write stream bytes as they arrive.
+            with self.m.State(self._fsm_ctr):
+                self._fsm_ctr += 1
+                self.m.d.comb += self.ip_stack.capture_ready.eq(1)
+                self.m.d.sync += self.tx_en.eq(0)
+                with self.m.If(self.ip_stack.capture_valid):
+                    self.m.d.sync += [
+                        self.tx_en.eq(1),
+                        self.tx_addr.eq(46 + ctr),
+                        self.tx_data.eq(self.ip_stack.capture_data),
+                        ctr.eq(ctr + 1),
+                        last.eq(self.ip_stack.capture_last),
+                    ]
+                    with self.m.If(self.ip_stack.capture_last |
+                                   (ctr == max_len - 1)):
+                        self.m.next = self._fsm_ctr
+
+            self.write("SEQ", val=Cat(seq, last), n=4, dst=42)
+            self.write("DST_MAC", val=dst_mac, n=6, dst=0)
+            self.write("SRC_MAC", val=self.ip_stack.mac_addr, n=6, dst=6)
+            self.write("ETYPE", val=0x0800, n=2, dst=12)
+            self.write("VER_IHL", val=0x45, n=1, dst=14)
+            self.write("DSCP_ECN", val=0, n=1, dst=15)
+            self.write("TOTAL_LENGTH", val=payload_len+28, n=2, dst=16)
+            self.write("IDENT", val=0, n=2, dst=18)
+            self.write("FRAG", val=0, n=2, dst=20)
+            self.write("TTL", val=64, n=1, dst=22)
+            self.write("PROTO", val=0x11, n=1, dst=23)
+            self.write("SRC_IP", val=src_ip4, n=4, dst=26)
+            self.write("DST_IP", val=dst_ip4, n=4, dst=30)
+            self.write("SRC_PORT", val=capture_port, n=2, dst=34)
+            self.write("DST_PORT", val=capture_port, n=2, dst=36)
+            self.write("UDP_LEN", val=payload_len+8, n=2, dst=38)
+            self.write("UDP_CHK", val=0, n=2, dst=40)
+            self.write("CHECKSUM", val=ipchecksum.checksum, n=2, dst=24)
+
+            with self.custom_state():
+                self.m.d.sync += [
+                    self.tx_en.eq(0),
+                    seq.eq(seq + 1),
+                    self.ip_stack.capture_tx_frames.eq(
+                        self.ip_stack.capture_tx_frames + 1),
+                ]
+
+            self.end_fsm(send=True, tx_len=payload_len+42)
+
+        with self.m.If(fsm.ongoing("IDLE")):
+            self.m.d.sync += [
+                max_len.eq(self.ip_stack.capture_tx_len),
+                ctr.eq(0),
+            ]
+
+        return self.m
+
+
+def _prbs_seed(seq, k):
+    """
+    Returns the non-zero k-bit PRBS LFSR seed for sequence number `seq`.
+
+    Alternate bits of `seq` are inverted so that the start of the PRBS is
+    not mostly zeros for small sequence numbers.
+    """
+    return Cat(Const(1, 1), seq ^ 0x55555555)[:k]
+
+
+class _InternetChecksum(Elaboratable):
+    """
+    Implements the Internet Checksum algorithm from RFC 1071.
+
+    Parameters:
+        * `init`: 16-bit value or Signal to initialise the checksum to on
+                  reset, used to fold in header fields such as the UDP
+                  pseudo-header
+
+    Inputs:
+        * `data`: 8-bit data to add to checksum.
+        * `lowbyte`: Assert if `data` contains the lower byte of a 16-bit word
+                     in network byte order
+        * `en`: Checksum updated with `data` when `en` is high
+        * `reset`: Pulse high to reset checksum to zero
+
+    Outputs:
+        * `checksum`: 16-bit current value of checksum
+    """
+    def __init__(self, init=0):
+        self.data = Signal(8)
+        self.lowbyte = Signal()
+        self.en = Signal()
+        self.reset = Signal()
+        self.checksum = Signal(16)
+
+        self.init = init
+
+    def elaborate(self, platform):
+        m = Module()
+        state_reset = self.init if isinstance(self.init, int) else 0
+        state = Signal(17, reset=state_reset)
+        data_shift = Signal(16)
+        folded = Signal(16)
+
+        # Fold in any carry still pending from the most recent update.
+        m.d.comb += [
+            folded.eq(state[:-1] + state[-1]),
+            self.checksum.eq(~folded),
+        ]
+
+        with m.If(self.lowbyte):
+            m.d.comb += data_shift.eq(self.data)
+        with m.Else():
+            m.d.comb += data_shift.eq(self.data << 8)
+
+        with m.If(self.reset):
+            m.d.sync += state.eq(self.init)
+        with m.Else():
+            with m.If(self.en):
+                m.d.sync += state.eq(state[:-1] + data_shift + state[-1])
+        return m
+
+
+class _HeaderChecksum(Elaboratable):
+    """
+    Computes the Internet Checksum of a header with mostly constant fields.
+
+    The constant 16-bit words are summed at elaboration time, so only the
+    variable words are added at run time. The result is registered in two
+    pipeline stages and is valid two clocks after `variables` change.
+
+    Parameters:
+        * `constants`: list of constant 16-bit words in the header
+        * `variables`: list of 16-bit Signals or slices in the header
+
+    Outputs:
+        * `sum`: 16-bit one's complement sum of all words
+        * `checksum`: 16-bit checksum, the complement of `sum`
+    """
+    def __init__(self, constants, variables):
+        self.sum = Signal(16)
+        self.checksum = Signal(16)
+
+        self.constant = _ones_complement_sum(constants)
+        self.variables = variables
+
+    def elaborate(self, platform):
+        m = Module()
+
+        total = Signal(16 + len(self.variables).bit_length())
+        partial = Signal(17)
+        m.d.sync += [
+            total.eq(sum(self.variables, Const(self.constant, 16))),
+            partial.eq(total[:16] + total[16:]),
+        ]
+        m.d.comb += [
+            self.sum.eq(partial[:16] + partial[16]),
+            self.checksum.eq(~self.sum),
+        ]
+
+        return m
+
+
+class _PipelinedChecksum(Elaboratable):
+    """
+    Implements the Internet Checksum algorithm from RFC 1071 over several
+    bytes per clock, for datapaths wider than `_InternetChecksum` keeps up
+    with.
+
+    All additions use `utils.PipelinedOnesComplementAdder`. With four bytes
+    per clock, the two 16-bit words in each input are first added together.
+    The accumulator adder's output is fed back to its input, so two partial
+    sums circulate through its pipeline, each taking every other word, and
+    a final adder combines them. A reset restarts both partial sums as they
+    next enter the accumulator.
+
+    Parameters:
+        * `nbytes`: Bytes per clock, 2 or 4
+        * `init`: 16-bit value or Signal to initialise the checksum to on
+                  reset, as for `_InternetChecksum`
+
+    Inputs:
+        * `data`: `nbytes` bytes to add to the checksum, in network byte
+                  order with the first byte most significant. The first
+                  byte must be the upper byte of a 16-bit word.
+        * `mask`: One bit per byte of `data`, the first byte most
+                  significant. Bytes whose bit is clear are treated as zero,
+                  for example to end an odd-length packet.
+        * `en`: Checksum updated with `data` when `en` is high
+        * `reset`: Pulse high to reset checksum to `init`
+
+    Outputs:
+        * `checksum`: 16-bit checksum, including data given at least
+                      `latency` clocks before
+    """
+    def __init__(self, nbytes, init=0):
+        if nbytes not in (2, 4):
+            raise ValueError(f"nbytes={nbytes} invalid for checksum")
+
+        self.data = Signal(8*nbytes)
+        self.mask = Signal(nbytes, reset=2**nbytes - 1)
+        self.en = Signal()
+        self.reset = Signal()
+        self.checksum = Signal(16)
+
+        self.pair = None
+        if nbytes == 4:
+            self.pair = PipelinedOnesComplementAdder(16, 1)
+        self.acc = PipelinedOnesComplementAdder(16, 1)
+        self.final = PipelinedOnesComplementAdder(16, 1)
+
+        self.nbytes = nbytes
+        self.init = init
+        self.latency = self.acc.latency + self.final.latency
+        if self.pair is not None:
+            self.latency += self.pair.latency
+
+    def elaborate(self, platform):
+        m = Module()
+        m.submodules.acc = acc = self.acc
+        m.submodules.final = final = self.final
+
+        masked = Signal(8*self.nbytes)
+        m.d.comb += masked.eq(Cat(*(
+            Mux(self.mask[idx], self.data[8*idx:8*(idx+1)], 0)
+            for idx in range(self.nbytes))))
+
+        # Add the two words in each input, tracking which words in flight
+        # are enabled so a reset discards them
+        word_en = Signal()
+        m.d.comb += word_en.eq(self.en & ~self.reset)
+        if self.pair is not None:
+            m.submodules.pair = pair = self.pair
+            m.d.comb += [
+                pair.a.eq(masked[16:32]),
+                pair.b.eq(masked[0:16]),
+            ]
+            word = pair.c
+            for idx in range(pair.latency):
+                word_en_d = Signal(name=f"word_en_d{idx}")
+                m.d.sync += word_en_d.eq(word_en & ~self.reset)
+                word_en = word_en_d
+        else:
+            word = masked
+
+        # After a reset, start one partial sum from `init` and the other
+        # from zero in place of the sums leaving the accumulator
+        restart = Signal(max=acc.latency+1)
+        with m.If(self.reset):
+            m.d.sync += restart.eq(acc.latency)
+        with m.Elif(restart != 0):
+            m.d.sync += restart.eq(restart - 1)
+        with m.If(restart == acc.latency):
+            m.d.comb += acc.a.eq(self.init)
+        with m.Elif(restart != 0):
+            m.d.comb += acc.a.eq(0)
+        with m.Else():
+            m.d.comb += acc.a.eq(acc.c)
+        m.d.comb += acc.b.eq(Mux(word_en, word, 0))
+
+        # Combine the two partial sums, which leave the accumulator on
+        # alternate clocks, ignoring those being restarted
+        acc_c_d = Signal(16)
+        m.d.sync += acc_c_d.eq(Mux(restart != 0, 0, acc.c))
+        m.d.comb += [
+            final.a.eq(acc.c),
+            final.b.eq(acc_c_d),
+            self.checksum.eq(~final.c),
+        ]
+
+        return m
+
+
+def _ones_complement_sum(words):
+    """
+    Returns the 16-bit one's complement sum of a list of 16-bit integers.
+    """
+    total = 0
+    for word in words:
+        total += word
+        total = (total & 0xFFFF) + (total >> 16)
+    return total
+
+
+def test_ipv4_checksum():
+    from nmigen.back import pysim
+
+    checksum = _InternetChecksum()
+
+    data = [0x45, 0x00, 0x00, 0x73, 0x00, 0x00, 0x40, 0x00, 0x40, 0x11, 0x00,
+            0x00, 0xc0, 0xa8, 0x00, 0x01, 0xc0, 0xa8, 0x00, 0xc7]
+    expected_checksum = 0xb861
+
+    def testbench():
+        yield
+        yield
+
+        for i in range(2):
+
+            for idx, byte in enumerate(data):
+                yield checksum.data.eq(byte)
+                yield checksum.lowbyte.eq(idx & 1)
+                yield checksum.en.eq(1)
+                yield
+
+            yield checksum.en.eq(0)
+            yield
+
+            assert (yield checksum.checksum) == expected_checksum
 
             yield checksum.reset.eq(1)
             yield
@@ -914,6 +2128,91 @@ def test_ipv4_checksum():
         sim.run()
 
 
+def test_header_checksum():
+    import random
+    from nmigen.back import pysim
+
+    constants = [0x4500, 0x002C, 0x0000, 0x0000, 0x4011, 0x0A00, 0x0005]
+    variables = [Signal(16), Signal(16)]
+    hdrchecksum = _HeaderChecksum(constants, variables)
+
+    def testbench():
+        rng = random.Random(0)
+        for _ in range(50):
+            words = [rng.randrange(2**16) for _ in variables]
+            for variable, word in zip(variables, words):
+                yield variable.eq(word)
+            yield
+            yield
+            yield
+            data = []
+            for word in constants + words:
+                data += [word >> 8, word & 0xFF]
+            assert (yield hdrchecksum.checksum) == internet_checksum(data)
+
+    vcdf = open("ipstack_header_checksum.vcd", "w")
+    with pysim.Simulator(hdrchecksum, vcd_file=vcdf) as sim:
+        sim.add_clock(1/100e6)
+        sim.add_sync_process(testbench())
+        sim.run()
+
+
+def test_pipelined_checksum():
+    import random
+    from nmigen.back import pysim
+
+    for nbytes in (2, 4):
+        checksum = _PipelinedChecksum(nbytes, init=0x1234)
+
+        def testbench():
+            rng = random.Random(nbytes)
+            lengths = [rng.randrange(1, 1500) for _ in range(10)]
+            for length in [20, 21, 1, 2, 3] + lengths:
+                data = [rng.randrange(256) for _ in range(length)]
+                # All-ones data exercises many carries
+                if length == 20:
+                    data = [0xFF] * length
+
+                yield checksum.reset.eq(1)
+                yield
+                yield checksum.reset.eq(0)
+                for idx in range(0, length, nbytes):
+                    # Pad the final chunk with junk to be masked out
+                    chunk = data[idx:idx+nbytes]
+                    pad = nbytes - len(chunk)
+                    word = 0
+                    for byte in chunk + [rng.randrange(256)] * pad:
+                        word = (word << 8) | byte
+                    yield checksum.data.eq(word)
+                    yield checksum.mask.eq((2**len(chunk) - 1) << pad)
+                    yield checksum.en.eq(1)
+                    yield
+                yield checksum.en.eq(0)
+                for _ in range(checksum.latency + 1):
+                    yield
+                expected = internet_checksum([0x12, 0x34] + data)
+                assert (yield checksum.checksum) == expected
+
+        vcdf = open(f"ipstack_pipelined_checksum_{nbytes}.vcd", "w")
+        with pysim.Simulator(checksum, vcd_file=vcdf) as sim:
+            sim.add_clock(1/100e6)
+            sim.add_sync_process(testbench())
+            sim.run()
+
+
+def internet_checksum(data):
+    """
+    Reference RFC 1071 checksum over a list of bytes, for use in tests.
+    """
+    if len(data) % 2:
+        data = data + [0]
+    state = 0
+    for idx in range(0, len(data), 2):
+        state += (data[idx] << 8) | data[idx+1]
+        state = (state & 0xFFFF) + (state >> 16)
+    return (~state) & 0xFFFF
+
+
 def compare_packet(tx_bytes, expected_bytes):
     if tx_bytes != expected_bytes:
         print("Received:", " ".join(f"{x:02X}" for x in tx_bytes),
@@ -925,56 +2224,90 @@ def compare_packet(tx_bytes, expected_bytes):
                        for (x, y) in zip(tx_bytes, expected_bytes)))
 
 
-def run_rx_test(name, rx_bytes, expected_bytes, mac_addr, ip4_addr):
+def run_rx_test(name, rx_bytes, expected_bytes, mac_addr, ip4_addr,
+                shared_buffer=False, udp_port=0, udp_echo=False):
     from nmigen.back import pysim
 
-    mem_n = 64
-    rx_mem = Memory(8, mem_n, [0]*4 + rx_bytes)
+    mem_n = 128
+    rx_mem_init = [0]*4 + rx_bytes
+    rx_mem = Memory(8, mem_n, rx_mem_init)
     rx_mem_port = rx_mem.read_port()
     tx_mem = Memory(8, mem_n)
     tx_mem_port = tx_mem.write_port()
 
-    ipstack = IPStack(mac_addr, ip4_addr, 0, 0, rx_mem_port, tx_mem_port,
-                      None, None)
+    ipstack = IPStack(mac_addr, ip4_addr, 0, udp_port, rx_mem_port,
+                      tx_mem_port, None, None, shared_buffer=shared_buffer)
 
     def testbench():
+        yield ipstack.udp_echo.eq(udp_echo)
         for repeat in range(3):
             yield
             yield
 
             yield ipstack.rx_offset.eq(4)
+            yield ipstack.rx_len.eq(len(rx_bytes))
             yield ipstack.rx_valid.eq(1)
             yield
             yield ipstack.rx_valid.eq(0)
             yield ipstack.rx_offset.eq(0)
+            yield ipstack.rx_len.eq(0)
 
             tx_start = False
             tx_offset = 0
             tx_len = 0
+            tx_split = 0
+            rx_acked = False
             for _ in range(128):
+                rx_acked |= bool((yield ipstack.rx_ack))
                 if (yield ipstack.tx_start):
                     tx_start = True
                     tx_offset = (yield ipstack.tx_offset)
                     tx_len = (yield ipstack.tx_len)
+                    tx_split = (yield ipstack.tx_split)
+                    tx_rx_offset = (yield ipstack.tx_rx_offset)
                     break
                 yield
 
+            # Packets replied to in place must not be acknowledged until
+            # the reply has been transmitted
+            if tx_split:
+                assert not rx_acked
+                for _ in range(20):
+                    yield
+                    assert not (yield ipstack.rx_ack)
+                yield ipstack.tx_done.eq(1)
+                yield
+                yield ipstack.tx_done.eq(0)
+
             for _ in range(5):
                 yield
+                rx_acked |= bool((yield ipstack.rx_ack))
+            assert rx_acked
 
-            tx_bytes = []
-            for idx in range(len(expected_bytes)):
-                tx_bytes.append((yield tx_mem[(tx_offset + idx) % mem_n]))
-
-            if expected_bytes is not None:
-                # Check transmit got asserted with valid tx_len, tx_offset
-                assert tx_start
-                assert tx_len == len(expected_bytes)
-                compare_packet(tx_bytes, expected_bytes)
-                assert tx_bytes == expected_bytes
-            else:
+            if expected_bytes is None:
                 # Check transmit did not get asserted
                 assert not tx_start
+                continue
+
+            # Bytes not patched from TX memory are transmitted from the
+            # received packet.
+            mask = 0
+            if tx_split:
+                for idx in range(TX_PATCH_LEN//8):
+                    addr = (tx_offset + tx_split + idx) % mem_n
+                    mask |= (yield tx_mem[addr]) << (8*idx)
+            tx_bytes = []
+            for idx in range(len(expected_bytes)):
+                if tx_split and (idx >= tx_split or not (mask >> idx) & 1):
+                    tx_bytes.append(rx_mem_init[(tx_rx_offset + idx) % mem_n])
+                else:
+                    tx_bytes.append((yield tx_mem[(tx_offset + idx) % mem_n]))
+
+            # Check transmit got asserted with valid tx_len, tx_offset
+            assert tx_start
+            assert tx_len == len(expected_bytes)
+            compare_packet(tx_bytes, expected_bytes)
+            assert tx_bytes == expected_bytes
 
     mod = Module()
     mod.submodules += ipstack, rx_mem_port, tx_mem_port
@@ -1046,6 +2379,12 @@ def test_rx_arp():
     ]
 
     run_rx_test("arp", rx_bytes, expected_bytes, mac_addr, ip4_addr)
+    run_rx_test("arp_in_place", rx_bytes, expected_bytes, mac_addr, ip4_addr,
+                shared_buffer=True)
+
+    # Requests for other addresses are acknowledged without a reply
+    run_rx_test("arp_other_in_place", rx_bytes[:-1] + [0x06], None,
+                mac_addr, ip4_addr, shared_buffer=True)
 
 
 def test_rx_icmp():
@@ -1082,8 +2421,8 @@ def test_rx_icmp():
         0x08,
         # ICMP code 0
         0x00,
-        # ICMP checksum 0x023E (not checked)
-        0x02, 0x3e,
+        # ICMP checksum 0x01BE (not checked)
+        0x01, 0xBE,
         # ICMP identifier 0x1234
         0x12, 0x34,
         # ICMP sequence 0xABCD
@@ -1134,6 +2473,153 @@ def test_rx_icmp():
     ]
 
     run_rx_test("icmp", rx_bytes, expected_bytes, mac_addr, ip4_addr)
+    run_rx_test("icmp_in_place", rx_bytes, expected_bytes, mac_addr, ip4_addr,
+                shared_buffer=True)
+
+
+def test_rx_udp_echo():
+    mac_addr = "01:23:45:67:89:AB"
+    ip4_addr = "10.0.0.5"
+
+    rx_bytes = [
+        # Sent to 01:23:45:67:89:AB from 00:01:02:03:04:05
+        0x01, 0x23, 0x45, 0x67, 0x89, 0xAB, 0x00, 0x01, 0x02, 0x03, 0x04, 0x05,
+        # Ethertype is IPv4
+        0x08, 0x00,
+        # IP version 4, IHL 5
+        0x45,
+        # DSCP class selector 0, no ECN
+        0x00,
+        # Total length 44
+        0, 44,
+        # Identification 0x0000
+        0x00, 0x00,
+        # Flags, fragment 0x0000
+        0x00, 0x00,
+        # TTL 64
+        0x40,
+        # Protocol UDP (17)
+        0x11,
+        # Checksum (not checked at present)
+        0x01, 0x0c,
+        # Source IP 10.0.0.1
+        10, 0, 0, 1,
+        # Destination IP 10.0.0.5
+        10, 0, 0, 5,
+        # Source port 10000
+        0x27, 0x10,
+        # Destination port 1735
+        0x06, 0xC7,
+        # Length 24
+        0, 24,
+        # Checksum 0x1234 (not checked)
+        0x12, 0x34,
+        # Some payload bytes
+        0x00, 0x01, 0x02, 0x03, 0x04, 0x05, 0x06, 0x07,
+        0x08, 0x09, 0x0A, 0x0B, 0x0C, 0x0D, 0x0E, 0x0F,
+    ]
+
+    expected_bytes = [
+        # Sent to 00:01:02:03:04:05 from 01:23:45:67:89:AB
+        0x00, 0x01, 0x02, 0x03, 0x04, 0x05, 0x01, 0x23, 0x45, 0x67, 0x89, 0xAB,
+        # Ethertype is IPv4
+        0x08, 0x00,
+        # IP version 4, IHL 5
+        0x45,
+        # DSCP class selector 0, no ECN
+        0x00,
+        # Total length 44
+        0, 44,
+        # Identification 0x0000
+        0x00, 0x00,
+        # Flags, fragment 0x0000
+        0x00, 0x00,
+        # TTL 64
+        0x40,
+        # Protocol UDP (17)
+        0x11,
+        # Checksum, filled in below
+        0x00, 0x00,
+        # Source IP 10.0.0.5
+        10, 0, 0, 5,
+        # Destination IP 10.0.0.1
+        10, 0, 0, 1,
+        # Source port 1735
+        0x06, 0xC7,
+        # Destination port 10000
+        0x27, 0x10,
+        # Length 24
+        0, 24,
+        # No checksum
+        0x00, 0x00,
+        # Some payload bytes
+        0x00, 0x01, 0x02, 0x03, 0x04, 0x05, 0x06, 0x07,
+        0x08, 0x09, 0x0A, 0x0B, 0x0C, 0x0D, 0x0E, 0x0F,
+    ]
+    checksum = internet_checksum(expected_bytes[14:34])
+    expected_bytes[24:26] = [checksum >> 8, checksum & 0xFF]
+
+    run_rx_test("udp_echo", rx_bytes, expected_bytes, mac_addr, ip4_addr,
+                udp_port=1735, udp_echo=True)
+    run_rx_test("udp_echo_in_place", rx_bytes, expected_bytes, mac_addr,
+                ip4_addr, shared_buffer=True, udp_port=1735, udp_echo=True)
+
+    # Packets are not echoed while echo is disabled, or to other ports
+    run_rx_test("udp_no_echo", rx_bytes, None, mac_addr, ip4_addr,
+                udp_port=1735)
+    run_rx_test("udp_echo_other_port", rx_bytes, None, mac_addr, ip4_addr,
+                udp_port=1736, udp_echo=True)
+
+    # Packets whose UDP length runs past the end of the frame are not
+    # echoed, in either mode
+    oversized = rx_bytes[:38] + [0, 25] + rx_bytes[40:]
+    run_rx_test("udp_echo_oversized", oversized, None, mac_addr, ip4_addr,
+                udp_port=1735, udp_echo=True)
+    run_rx_test("udp_echo_oversized_in_place", oversized, None, mac_addr,
+                ip4_addr, shared_buffer=True, udp_port=1735, udp_echo=True)
+
+
+def test_tx_backpressure():
+    from nmigen.back import pysim
+
+    rx_mem = Memory(8, 128, [0]*128)
+    rx_mem_port = rx_mem.read_port()
+    tx_mem = Memory(8, 128)
+    tx_mem_port = tx_mem.write_port()
+
+    ipstack = IPStack("01:23:45:67:89:AB", "10.0.0.5", 16, 1735,
+                      rx_mem_port, tx_mem_port, None, None)
+
+    def testbench():
+        # With too little free space, the packet must wait.
+        yield ipstack.tx_free.eq(40)
+        yield ipstack.rx_len.eq(60)
+        yield ipstack.rx_valid.eq(1)
+        for _ in range(20):
+            yield
+            assert not (yield ipstack.rx_ack)
+            assert not (yield ipstack.user_ready)
+        assert (yield ipstack.tx_full_events) == 1
+
+        # Once space is freed, it is processed.
+        yield ipstack.tx_free.eq(128)
+        yield
+        yield
+        assert (yield ipstack.rx_ack)
+        yield ipstack.rx_valid.eq(0)
+        for _ in range(100):
+            yield
+        assert (yield ipstack.user_ready)
+        assert (yield ipstack.tx_full_events) == 1
+
+    mod = Module()
+    mod.submodules += ipstack, rx_mem_port, tx_mem_port
+
+    vcdf = open("ipstack_tx_backpressure.vcd", "w")
+    with pysim.Simulator(mod, vcd_file=vcdf) as sim:
+        sim.add_clock(1/100e6)
+        sim.add_sync_process(testbench())
+        sim.run()
 
 
 def test_udp_tx():
@@ -1185,12 +2671,19 @@ def test_udp_tx():
         top_byte(dst_udp_port), bot_byte(dst_udp_port),
         # Length (+8 for UDP header)
         top_byte(udp_len + 8), bot_byte(udp_len + 8),
-        # Checksum 0
+        # Checksum, filled in below
         0, 0,
     ]
     # Data payload
     expected_bytes += udp_payload
 
+    # UDP checksum over pseudo-header, UDP header, and payload
+    udp_checksum = internet_checksum(
+        expected_bytes[26:34] + [0x00, 0x11] +
+        [top_byte(udp_len + 8), bot_byte(udp_len + 8)] + expected_bytes[34:])
+    expected_bytes[40] = top_byte(udp_checksum)
+    expected_bytes[41] = bot_byte(udp_checksum)
+
     mem_n = 64
     rx_mem = Memory(8, 64)
     rx_mem_port = rx_mem.read_port()
@@ -1374,3 +2867,433 @@ def test_udp_rx():
         sim.add_clock(1/100e6)
         sim.add_sync_process(testbench())
         sim.run()
+
+
+def test_udp_rx_fragmented():
+    from nmigen.back import pysim
+
+    mac_addr = "01:23:45:67:89:AB"
+    ip4_addr = "10.0.0.5"
+    udp_port = 1735
+    udp_len = 32
+    src_udp_port = 10000
+    udp_payload = [ord('A') + x for x in range(udp_len)]
+    short_payload = [ord('a') + x for x in range(16)]
+
+    def top_byte(x):
+        return (x >> 8) & 0xFF
+
+    def bot_byte(x):
+        return x & 0xFF
+
+    # UDP datagrams to be split into fragments
+    def make_datagram(payload):
+        return [
+            # Source port
+            top_byte(src_udp_port), bot_byte(src_udp_port),
+            # Destination port
+            top_byte(udp_port), bot_byte(udp_port),
+            # Length (+8 for UDP header)
+            top_byte(len(payload) + 8), bot_byte(len(payload) + 8),
+            # Checksum 0
+            0, 0,
+        ] + payload
+    datagram = make_datagram(udp_payload)
+    short_datagram = make_datagram(short_payload)
+
+    def fragment(ident, offset, length, more, datagram=datagram):
+        flags_frag = (more << 13) | (offset // 8)
+        return [
+            # Sent to 01:23:45:67:89:AB from 00:01:02:03:04:05
+            0x01, 0x23, 0x45, 0x67, 0x89, 0xAB,
+            0x00, 0x01, 0x02, 0x03, 0x04, 0x05,
+            # Ethertype is IPv4
+            0x08, 0x00,
+            # IP version 4, IHL 5
+            0x45,
+            # DSCP class selector 0, no ECN
+            0x00,
+            # Total length
+            top_byte(20 + length), bot_byte(20 + length),
+            # Identification
+            top_byte(ident), bot_byte(ident),
+            # Flags, fragment offset
+            top_byte(flags_frag), bot_byte(flags_frag),
+            # TTL
+            0x40,
+            # Protocol UDP
+            0x11,
+            # Checksum (not checked at present)
+            0x00, 0x00,
+            # Source IP
+            10, 0, 0, 1,
+            # Destination IP
+            10, 0, 0, 5,
+        ] + datagram[offset:offset+length]
+
+    # Send the final fragment first, and interleave an unrelated fragment
+    # which is never completed.
+    packets = [
+        (fragment(0x1234, 32, 8, 0), False),
+        (fragment(0x1234, 0, 16, 1), False),
+        (fragment(0x9999, 0, 16, 1), False),
+        (fragment(0x1234, 16, 16, 1), True),
+    ]
+
+    # A datagram with a shorter payload than the user buffer is received
+    # once reassembled
+    short_packets = [
+        (fragment(0x5678, 0, 16, 1, short_datagram), False),
+        (fragment(0x5678, 16, 8, 0, short_datagram), True),
+    ]
+
+    mem_n = 512
+    rx_mem = Memory(8, mem_n, sum((p for (p, _) in packets + short_packets),
+                                  []))
+    rx_mem_port = rx_mem.read_port()
+    tx_mem = Memory(8, mem_n)
+    tx_mem_port = tx_mem.write_port()
+    user_rx_mem = Memory(8, 64)
+    user_rx_mem_port = user_rx_mem.write_port()
+
+    ipstack = IPStack(mac_addr, ip4_addr, udp_len, udp_port,
+                      rx_mem_port, tx_mem_port, None, user_rx_mem_port,
+                      reasm_contexts=2, reasm_size=64)
+
+    def testbench():
+        rx_offset = 0
+        for packet, expect_rx in packets:
+            yield
+            yield
+
+            yield ipstack.rx_offset.eq(rx_offset)
+            yield ipstack.rx_valid.eq(1)
+            yield
+            yield ipstack.rx_valid.eq(0)
+            rx_offset += len(packet)
+
+            # Watch for IP stack reporting received UDP packet
+            user_rx = False
+            for _ in range(256):
+                yield
+                if (yield ipstack.user_rx):
+                    user_rx = True
+                if (yield ipstack.user_ready):
+                    break
+            assert user_rx == expect_rx
+
+        # Reassembled datagrams are never echoed, however long the frames
+        # they arrived in, so with echo enabled the datagram is received
+        # again as user data without any reply
+        yield ipstack.udp_echo.eq(1)
+        yield ipstack.rx_len.eq(200)
+        rx_offset = 0
+        for packet, expect_rx in packets:
+            if packet is not packets[2][0]:
+                yield ipstack.rx_offset.eq(rx_offset)
+                yield ipstack.rx_valid.eq(1)
+                yield
+                yield ipstack.rx_valid.eq(0)
+
+                user_rx = False
+                for _ in range(256):
+                    yield
+                    assert not (yield ipstack.tx_start)
+                    if (yield ipstack.user_rx):
+                        user_rx = True
+                    if (yield ipstack.user_ready):
+                        break
+                assert user_rx == expect_rx
+            rx_offset += len(packet)
+        yield ipstack.udp_echo.eq(0)
+
+        # Check received payload, compensating for the simulation offset
+        # described in test_udp_rx.
+        user_bytes = []
+        for idx in range(udp_len):
+            user_bytes.append((yield user_rx_mem[idx + 1]))
+        compare_packet(user_bytes, udp_payload)
+        assert user_bytes[:-1] == udp_payload[:-1]
+        assert (yield ipstack.user_rx_len) == udp_len
+
+        # The short datagram is written over the start of the user data,
+        # leaving the rest unchanged
+        for packet, expect_rx in short_packets:
+            yield ipstack.rx_offset.eq(rx_offset)
+            yield ipstack.rx_valid.eq(1)
+            yield
+            yield ipstack.rx_valid.eq(0)
+            rx_offset += len(packet)
+
+            user_rx = False
+            for _ in range(256):
+                yield
+                if (yield ipstack.user_rx):
+                    user_rx = True
+                if (yield ipstack.user_ready):
+                    break
+            assert user_rx == expect_rx
+        assert (yield ipstack.user_rx_len) == len(short_payload)
+        user_bytes = []
+        for idx in range(udp_len):
+            user_bytes.append((yield user_rx_mem[idx + 1]))
+        expected = short_payload + udp_payload[len(short_payload):]
+        compare_packet(user_bytes, expected)
+        assert user_bytes[:len(short_payload)-1] == short_payload[:-1]
+        assert user_bytes[len(short_payload):-1] == (
+            expected[len(short_payload):-1])
+
+    mod = Module()
+    mod.submodules += ipstack, rx_mem_port, tx_mem_port, user_rx_mem_port
+
+    vcdf = open("ipstack_udp_rx_fragmented.vcd", "w")
+    with pysim.Simulator(mod, vcd_file=vcdf) as sim:
+        sim.add_clock(1/100e6)
+        sim.add_sync_process(testbench())
+        sim.run()
+
+
+def test_prbs():
+    from nmigen.back import pysim
+
+    prbs_port = 1736
+    prbs_len = 24
+    k = 31
+
+    # Packets are transmitted by one stack into memory which is received
+    # from by a second stack.
+    mem_n = 256
+    link_mem = Memory(8, mem_n)
+    link_w_port = link_mem.write_port()
+    link_r_port = link_mem.read_port()
+    tx_mem = Memory(8, mem_n)
+    tx_mem_port = tx_mem.write_port()
+    rx_mem = Memory(8, mem_n)
+    rx_mem_port = rx_mem.read_port()
+
+    ipstack_a = IPStack("01:23:45:67:89:AB", "10.0.0.5", 16, 1735,
+                        rx_mem_port, link_w_port, None, None,
+                        prbs_port=prbs_port, prbs_k=k)
+    ipstack_b = IPStack("01:23:45:67:89:AC", "10.0.0.6", 16, 1735,
+                        link_r_port, tx_mem_port, None, None,
+                        prbs_port=prbs_port, prbs_k=k)
+
+    def prbs(seq, n):
+        state = (((seq ^ 0x55555555) << 1) | 1) & (2**k - 1)
+        data = []
+        for _ in range(n):
+            for _ in range(8):
+                x = ((state >> (k-1)) ^ (state >> (LFSR.TAPS[k]-1))) & 1
+                state = ((state << 1) | x) & (2**k - 1)
+            data.append(state & 0xFF)
+        return data
+
+    def testbench():
+        yield ipstack_a.prbs_tx_len.eq(prbs_len)
+        yield ipstack_a.prbs_dst_mac.eq(0x0123456789AC)
+        yield ipstack_a.prbs_dst_ip4.eq(0x0A000006)
+
+        for seq in range(5):
+            # Transmit one packet
+            yield ipstack_a.prbs_tx_enable.eq(1)
+            for _ in range(128):
+                yield
+                if (yield ipstack_a.tx_start):
+                    break
+            yield ipstack_a.prbs_tx_enable.eq(0)
+            tx_offset = (yield ipstack_a.tx_offset)
+            tx_len = (yield ipstack_a.tx_len)
+            for _ in range(5):
+                yield
+
+            # Check the packet has a valid header and the expected payload
+            assert tx_len == prbs_len + 42
+            packet = []
+            for idx in range(tx_len):
+                packet.append((yield link_mem[(tx_offset + idx) % mem_n]))
+            assert packet[12:14] == [0x08, 0x00]
+            assert internet_checksum(packet[14:34]) == 0
+            assert packet[36:38] == [prbs_port >> 8, prbs_port & 0xFF]
+            assert packet[42:46] == [0, 0, 0, seq]
+            assert packet[46:] == prbs(seq, prbs_len - 4)
+
+            # Drop the third packet, and flip three bits in the fourth
+            if seq == 2:
+                continue
+            if seq == 3:
+                addr = (tx_offset + 50) % mem_n
+                yield link_mem[addr].eq(packet[50] ^ 0x85)
+                yield
+
+            # Receive it on the second stack
+            yield ipstack_b.rx_offset.eq(tx_offset)
+            yield ipstack_b.rx_len.eq(tx_len)
+            yield ipstack_b.rx_valid.eq(1)
+            yield
+            yield ipstack_b.rx_valid.eq(0)
+            for _ in range(128):
+                yield
+
+        assert (yield ipstack_a.prbs_tx_frames) == 5
+        assert (yield ipstack_b.prbs_rx_frames) == 4
+        assert (yield ipstack_b.prbs_rx_lost) == 1
+        assert (yield ipstack_b.prbs_rx_bit_errors) == 3
+
+        # Clearing the counters
+        yield ipstack_b.prbs_rx_clear.eq(1)
+        yield
+        yield ipstack_b.prbs_rx_clear.eq(0)
+        yield
+        yield
+        assert (yield ipstack_b.prbs_rx_frames) == 0
+        assert (yield ipstack_b.prbs_rx_lost) == 0
+        assert (yield ipstack_b.prbs_rx_bit_errors) == 0
+
+    mod = Module()
+    mod.submodules += [ipstack_a, ipstack_b, link_w_port, link_r_port,
+                       tx_mem_port, rx_mem_port]
+
+    vcdf = open("ipstack_prbs.vcd", "w")
+    with pysim.Simulator(mod, vcd_file=vcdf) as sim:
+        sim.add_clock(1/100e6)
+        sim.add_sync_process(testbench())
+        sim.run()
+
+
+def test_capture_stream():
+    from nmigen.back import pysim
+    from ..capture import (SawtoothSource, Trigger, TriggeredCapture,
+                           SampleSerialiser, BurstBuffer, TRIGGER_RISING)
+    from ..dsp import RiceEncoder, rice_decode
+
+    capture_port = 1737
+    pre_len = 20
+    post_len = 60
+    step = 3
+    level = 1000
+    k = 2
+
+    # Captures are sent as raw samples, and Rice encoded
+    for rice, capture_tx_len in ((False, 64), (True, 16)):
+        mem_n = 256
+        tx_mem = Memory(8, mem_n)
+        tx_mem_port = tx_mem.write_port()
+        rx_mem = Memory(8, mem_n)
+        rx_mem_port = rx_mem.read_port()
+
+        source = SawtoothSource(16)
+        trigger = Trigger(16)
+        capture = TriggeredCapture(16, 128)
+        ipstack = IPStack("01:23:45:67:89:AB", "10.0.0.5", 16, 1735,
+                          rx_mem_port, tx_mem_port, None, None,
+                          capture_port=capture_port)
+
+        def testbench():
+            yield source.step.eq(step)
+            yield trigger.mode.eq(TRIGGER_RISING)
+            yield trigger.level.eq(level)
+            yield capture.pre_len.eq(pre_len)
+            yield capture.post_len.eq(post_len)
+            yield ipstack.capture_tx_len.eq(capture_tx_len)
+            yield ipstack.capture_dst_mac.eq(0x0123456789AC)
+            yield ipstack.capture_dst_ip4.eq(0x0A000006)
+            yield capture.arm.eq(1)
+            yield
+            yield capture.arm.eq(0)
+
+            # Collect each packet as it is sent
+            packets = []
+            for _ in range(3000):
+                yield
+                if (yield ipstack.tx_start):
+                    tx_offset = (yield ipstack.tx_offset)
+                    tx_len = (yield ipstack.tx_len)
+                    packet = []
+                    for idx in range(tx_len):
+                        addr = (tx_offset + idx) % mem_n
+                        packet.append((yield tx_mem[addr]))
+                    packets.append(packet)
+                    if packet[42] & 0x80:
+                        break
+
+            # Check each packet has valid headers, and the sequence numbers
+            # mark only the last packet
+            data = []
+            for seq, packet in enumerate(packets):
+                payload = packet[42:]
+                assert packet[0:6] == [0x01, 0x23, 0x45, 0x67, 0x89, 0xAC]
+                assert packet[12:14] == [0x08, 0x00]
+                assert packet[16:18] == [0, len(payload) + 28]
+                assert internet_checksum(packet[14:34]) == 0
+                assert packet[30:34] == [10, 0, 0, 6]
+                assert packet[34:38] == [capture_port >> 8,
+                                         capture_port & 0xFF,
+                                         capture_port >> 8,
+                                         capture_port & 0xFF]
+                assert packet[38:40] == [0, len(payload) + 8]
+                last = 0x80 if seq == len(packets) - 1 else 0
+                assert payload[:4] == [last, 0, 0, seq]
+                data += payload[4:]
+            assert len(packets) > 1
+            assert all(len(p) == capture_tx_len + 46 for p in packets[:-1])
+            assert (yield ipstack.capture_tx_frames) == len(packets)
+
+            # The captured samples follow the sawtooth, with the trigger on
+            # the first sample above the level
+            if rice:
+                samples = rice_decode(data, pre_len + post_len, 16, k)
+            else:
+                samples = [(data[i] << 8) | data[i+1]
+                           for i in range(0, len(data), 2)]
+            assert len(samples) == pre_len + post_len
+            assert all(y - x == step for (x, y) in zip(samples, samples[1:]))
+            assert samples[pre_len - 1] <= level < samples[pre_len]
+
+        mod = Module()
+        mod.submodules += [source, trigger, capture, ipstack,
+                           tx_mem_port, rx_mem_port]
+        mod.d.comb += [
+            trigger.in_data.eq(source.out_data),
+            trigger.in_valid.eq(source.out_valid),
+            capture.in_data.eq(source.out_data),
+            capture.in_valid.eq(source.out_valid),
+            capture.trigger.eq(trigger.trigger),
+        ]
+        if rice:
+            encoder = RiceEncoder(16)
+            buffer = BurstBuffer(64, 8)
+            mod.submodules += [encoder, buffer]
+            mod.d.comb += [
+                encoder.in_data.eq(capture.out_data),
+                encoder.in_valid.eq(capture.out_valid & buffer.in_room),
+                encoder.in_last.eq(capture.out_last),
+                encoder.k.eq(k),
+                capture.out_ready.eq(encoder.in_ready & buffer.in_room),
+                buffer.in_data.eq(encoder.out_data),
+                buffer.in_valid.eq(encoder.out_valid),
+                buffer.in_last.eq(encoder.out_last),
+                buffer.burst_len.eq(capture_tx_len),
+                ipstack.capture_data.eq(buffer.out_data),
+                ipstack.capture_valid.eq(buffer.out_valid),
+                ipstack.capture_last.eq(buffer.out_last),
+                buffer.out_ready.eq(ipstack.capture_ready),
+            ]
+        else:
+            serialiser = SampleSerialiser(16)
+            mod.submodules += serialiser
+            mod.d.comb += [
+                serialiser.in_data.eq(capture.out_data),
+                serialiser.in_valid.eq(capture.out_valid),
+                serialiser.in_last.eq(capture.out_last),
+                capture.out_ready.eq(serialiser.in_ready),
+                ipstack.capture_data.eq(serialiser.out_data),
+                ipstack.capture_valid.eq(serialiser.out_valid),
+                ipstack.capture_last.eq(serialiser.out_last),
+                serialiser.out_ready.eq(ipstack.capture_ready),
+            ]
+
+        vcdf = open(f"ipstack_capture_{'rice' if rice else 'raw'}.vcd", "w")
+        with pysim.Simulator(mod, vcd_file=vcdf) as sim:
+            sim.add_clock(1/100e6)
+            sim.add_sync_process(testbench())
+            sim.run()
@@ -1,65 +1,234 @@
 """
-Ethernet RMII MAC
+Ethernet MAC
 
 Copyright 2018-2019 Adam Greig
 Released under the MIT license; see LICENSE for details.
 """
 
-from nmigen import Elaboratable, Module, Signal, Const, Memory, ClockDomain
-from nmigen import Cat
+from nmigen import Elaboratable, Module, Signal, Memory, ClockDomain
+from nmigen import Cat, Mux, Array
 from nmigen.lib.fifo import AsyncFIFO
+from nmigen.lib.cdc import MultiReg
+from nmigen.lib.coding import GrayEncoder, GrayDecoder
 from nmigen.hdl.xfrm import DomainRenamer
-from .mdio import MDIO
-from .rmii import RMIIRx, RMIITx
+from .mdio import MDIO, MDIOQueue, OP_READ, OP_WRITE
+from .rmii import RMIIRx, RMIITx, TX_PATCH_LEN
+from .mii import MIIRx, MIITx
 from ..utils import PulseStretch
 
 
+# Loopback modes, selected by the MAC's `loopback_mode` input
+LOOPBACK_OFF = 0
+LOOPBACK_PHY = 1
+LOOPBACK_DESC = 2
+
+
 class MAC(Elaboratable):
     """
-    Ethernet RMII MAC.
+    Ethernet MAC, connecting to an RMII, MII, or GMII PHY.
 
     Clock domain:
-        This module is clocked at the system clock frequency and generates an
-        RMII clock domain internally. All its inputs and outputs are in the
-        system clock domain.
+        This module is clocked at the system clock frequency and generates
+        PHY receive and transmit clock domains internally. All its inputs
+        and outputs are in the system clock domain.
 
     Parameters:
         * `clk_freq`: MAC's clock frequency
         * `phy_addr`: 5-bit address of the PHY
         * `mac_addr`: MAC address in standard XX:XX:XX:XX:XX:XX format
+        * `interface`: PHY interface, one of "rmii", "mii", or "gmii". GMII
+                       is only supported at 1000Mbps.
+        * `shared_buffer`: If True, packets may be transmitted in place from
+                           the RX packet memory with a patch list of bytes
+                           from TX memory, see `tx_split`. The received
+                           packet is kept in RX memory until acknowledged,
+                           so must not be acknowledged with `rx_ack` until
+                           the packet sent from it has been transmitted.
+        * `rx_fifo_depth`: Number of received packets which may be queued,
+                           by default enough to fill `rx_buf_size` with
+                           minimum-size packets
+        * `tx_fifo_depth`: Number of packets which may be queued for
+                           transmission, by default enough to fill
+                           `tx_buf_size` with minimum-size packets
+        * `rx_min_len`: Received frames shorter than this many bytes,
+                        including the FCS, are discarded as runts
+        * `rx_max_len`: Received frames longer than this many bytes,
+                        including the FCS, are discarded as oversize
+        * `ethertypes`: List of ethertypes to receive, or None to receive all
+        * `ip_protocols`: List of IPv4 protocols to receive, or None to
+                          receive all
+        * `mac_table_size`: Number of additional MAC addresses which may be
+                            received, set by `mac_table`
+        * `flow_control`: If True, use 802.3x PAUSE frames to pause
+                          transmission when requested by the link partner,
+                          and to request the link partner pauses while the
+                          RX FIFO is filling up
+        * `pause_threshold`: `rx_fifo_level` at which PAUSE frames are sent
+                             requesting the link partner stops transmitting,
+                             by default three quarters of `rx_fifo_depth`.
+                             A PAUSE frame resuming transmission is sent
+                             once the level falls to half the threshold.
+        * `pause_quanta`: Pause time requested from the link partner, in
+                          units of 512 bit times. PAUSE frames are resent
+                          every half pause time while the threshold is
+                          still exceeded.
+        * `link_down_flush`: If True, packets queued for transmission while
+                             the link is down are discarded, otherwise
+                             they are held until the link returns
+        * `tx_burst`: Number of bytes which may be transmitted back-to-back
+                      at the full line rate while `tx_rate` is limiting the
+                      transmit rate
+        * `phy_poll_registers`: List of (address, period) of additional PHY
+                                registers to poll, see `PHYManager`
+        * `phy_init_writes`: List of (address, value) of PHY registers to
+                             write after each PHY reset
+        * `phy_mdc_freq`: Maximum MDC frequency, up to the PHY's limit
+        * `phy_suppress_preamble`: If True, suppress MDIO preambles if the
+                                   PHY accepts them
+        * `phy_fast_link_poll`: If True, read the PHY's link status whenever
+                                MDIO is otherwise idle
+        * `phy_int_status_reg`: Address of the PHY's interrupt status
+                                register, read to clear `phy_int`
+        * `loopback`: If True, include the loopback modes selected by
+                      `loopback_mode`. Only supported with RMII, and not
+                      with `shared_buffer`.
 
     Memory Ports:
         * `rx_port`: Read port into RX packet memory, 8 bytes by 2048 cells.
         * `tx_port`: Write port into TX packet memory, 8 bytes by 2048 cells.
 
     Pins:
-        * `rmii`: signal group containing:
-            txd0, txd1, txen, rxd0, rxd1, crs_dv, ref_clk
+        * `phy_pins`: signal group for the PHY interface, containing:
+            for RMII: txd0, txd1, txen, rxd0, rxd1, crs_dv, ref_clk
+            for MII: txd[4], tx_en, tx_clk, rxd[4], rx_dv, rx_clk
+            for GMII: txd[8], tx_en, gtx_clk, rxd[8], rx_dv, rx_clk,
+                      where gtx_clk must be driven with a 125MHz clock
         * `mdio`: signal group containing: mdc, mdio
         * `phy_rst`: PHY RST pin (output, active low)
         * `eth_led`: Ethernet LED, active high, pulsed on packet traffic
+        * `phy_int`: Optional PHY interrupt pin (input, active low), which
+                     should be configured to signal link changes
+
+    PHY management:
+        * `phy_manager`: `PHYManager` instance, whose host MDIO request,
+                         register shadow, and poll period ports may be used
+                         to access the PHY while it is being managed
 
     TX port:
         * `tx_start`: Pulse high to begin transmission of a packet from memory
         * `tx_len`: 11-bit length of packet to transmit
         * `tx_offset`: n-bit address offset of packet to transmit, with
                        n=log2(tx_buf_size)
+        * `tx_split`: 11-bit length of the patch region at the start of the
+                      packet, or 0 to transmit the whole packet from TX
+                      memory. Only used if `shared_buffer` is set. The
+                      packet is transmitted from the same offset in the
+                      received packet at `tx_rx_offset`, except for bytes in
+                      the patch region whose bit is set in the patch mask,
+                      which are transmitted from TX memory. The patch mask
+                      is stored LSb first in the 8 bytes of TX memory
+                      following the patch region.
+        * `tx_rx_offset`: n-bit address offset of received packet, with
+                          n=log2(rx_buf_size). The received packet must
+                          not be acknowledged until `tx_done` shows this
+                          packet has been transmitted or discarded, or it
+                          may be overwritten by later frames.
+        * `tx_free`: Number of bytes of TX memory not used by packets still
+                     waiting to be transmitted. Packets must be written
+                     contiguously after the previous packet, and only once
+                     enough space is free. Each packet uses `tx_len` bytes,
+                     or `tx_split` bytes plus its patch mask if `tx_split`
+                     is not 0.
 
     RX port:
         * `rx_valid`: Held high while `rx_len` and `rx_offset` are valid
         * `rx_len`: 11-bit length of received packet
         * `rx_offset`: n-bit address offset of received packet, with
                        n=log2(rx_buf_size)
-        * `rx_ack`: Pulse high to acknowledge packet receipt
+        * `rx_ack`: Pulse high to acknowledge packet receipt. Packets are
+                    kept in RX memory until acknowledged, and frames which
+                    would overwrite them are dropped.
 
     Inputs:
         * `phy_reset`: Assert to reset the PHY, de-assert for normal operation
+        * `multicast_hash`: 64-bit mask of multicast address hashes to
+                            receive, where the hash of an address is given
+                            by `mac_address_match.multicast_hash()`
+        * `mac_table`: List of `mac_table_size` 48-bit MAC addresses to
+                       receive, with the first byte in the top bits
+        * `mac_table_valid`: `mac_table_size`-bit mask of valid `mac_table`
+                             entries
+        * `tx_ipg`: 8-bit interpacket gap in byte times, at least 12
+        * `tx_rate`: 16-bit maximum transmit rate as a fraction of the line
+                     rate in units of 1/65536, or 0 for no limit. Each
+                     packet is counted from its preamble to the end of its
+                     interpacket gap.
+        * `loopback_mode`: 2-bit loopback mode, if `loopback` is set:
+            * `LOOPBACK_OFF`: Normal operation
+            * `LOOPBACK_PHY`: Transmitted RMII dibits are received in place
+                              of those from the PHY, and are not sent to
+                              the PHY
+            * `LOOPBACK_DESC`: Packets taken from the TX FIFO are copied
+                               from TX memory to RX memory and placed in
+                               the RX FIFO, bypassing the PHY modules.
+                               Received packets do not include an FCS.
+                               Packets may be overwritten if the mode
+                               changes while they are waiting in the RX
+                               FIFO.
+            Transmission is not held while the link is down in either
+            loopback mode, and runs at 100Mbps.
 
     Outputs:
         * `link_up`: High while link is established
+        * `speed_10`: High while the link is running at 10Mbps
+        * `rx_fifo_level`: Number of received packets waiting for `rx_ack`
+        * `rx_fifo_hwm`: Highest `rx_fifo_level` seen since reset
+        * `rx_dropped`: 32-bit count of received packets dropped because
+                        the RX FIFO was full, or because they would have
+                        overwritten a packet not yet acknowledged
+        * `tx_fifo_level`: Number of packets waiting to be transmitted,
+                           including any being transmitted
+        * `tx_fifo_hwm`: Highest `tx_fifo_level` seen since reset
+        * `tx_done`: Pulsed high as each packet leaves `tx_fifo_level`,
+                     once it has been transmitted or discarded, in the order
+                     the packets were started. Packets dropped because the
+                     TX FIFO was full are not reported.
+        * `tx_dropped`: 32-bit count of packets dropped because `tx_start`
+                        was pulsed while the TX FIFO was full. `tx_free` is
+                        held at 0 while the TX FIFO is full.
+        * `rx_runt_errors`: 32-bit count of runt frames received
+        * `rx_oversize_errors`: 32-bit count of oversize frames received
+        * `rx_align_errors`: 32-bit count of frames received which did not
+                             end on a byte boundary
+        * `rx_crc_errors`: 32-bit count of frames received with an invalid
+                           FCS
+        * `rx_filtered_frames`: 32-bit count of frames discarded because of
+                                their destination, ethertype, or protocol
+        * `tx_paused`: High while transmission is paused by the link partner
+        * `rx_pause_frames`: 32-bit count of PAUSE frames received
+        * `tx_pause_frames`: 32-bit count of PAUSE frames transmitted
+        * `link_down_events`: 32-bit count of times the link has gone down
+        * `tx_flushed_frames`: 32-bit count of packets discarded because
+                               the link was down
     """
-    def __init__(self, clk_freq, phy_addr, mac_addr, rmii, mdio,
-                 phy_rst, eth_led, tx_buf_size=2048, rx_buf_size=2048):
+    def __init__(self, clk_freq, phy_addr, mac_addr, phy_pins, mdio,
+                 phy_rst, eth_led, tx_buf_size=2048, rx_buf_size=2048,
+                 shared_buffer=False, rx_fifo_depth=None, tx_fifo_depth=None,
+                 rx_min_len=64, rx_max_len=1522, ethertypes=None,
+                 ip_protocols=None, mac_table_size=0, interface="rmii",
+                 flow_control=False, pause_threshold=None,
+                 pause_quanta=0xFFFF, link_down_flush=True, tx_burst=4096,
+                 phy_poll_registers=(),
+                 phy_init_writes=(), phy_mdc_freq=2.5e6,
+                 phy_suppress_preamble=False, phy_fast_link_poll=False,
+                 phy_int=None, phy_int_status_reg=None, loopback=False):
+        if interface not in ("rmii", "mii", "gmii"):
+            raise ValueError(f"Unknown PHY interface {interface}")
+        if loopback and interface != "rmii":
+            raise ValueError("Loopback is only supported with RMII")
+        if loopback and shared_buffer:
+            raise ValueError("Loopback is not supported with shared_buffer")
+
         # Memory Ports
         self.rx_port = None  # Assigned below
         self.tx_port = None  # Assigned below
@@ -68,6 +237,9 @@ class MAC(Elaboratable):
         self.tx_start = Signal()
         self.tx_len = Signal(11)
         self.tx_offset = Signal(max=tx_buf_size-1)
+        self.tx_split = Signal(11)
+        self.tx_rx_offset = Signal(max=rx_buf_size-1)
+        self.tx_free = Signal(max=tx_buf_size+1)
 
         # RX port
         self.rx_ack = Signal()
@@ -77,17 +249,82 @@ class MAC(Elaboratable):
 
         # Inputs
         self.phy_reset = Signal()
+        self.multicast_hash = Signal(64)
+        self.mac_table = [Signal(48, name=f"mac_table{idx}")
+                          for idx in range(mac_table_size)]
+        self.mac_table_valid = Signal(mac_table_size)
+        self.tx_ipg = Signal(8, reset=12)
+        self.tx_rate = Signal(16)
+        self.loopback_mode = Signal(2)
 
         # Outputs
         self.link_up = Signal()
+        self.speed_10 = Signal()
+
+        # FIFO depths default to one entry per minimum-size packet
+        if rx_fifo_depth is None:
+            rx_fifo_depth = _fifo_depth(rx_buf_size)
+        if tx_fifo_depth is None:
+            tx_fifo_depth = _fifo_depth(tx_buf_size)
+        self.rx_fifo_depth = rx_fifo_depth
+        self.tx_fifo_depth = tx_fifo_depth
+
+        # FIFO statistics
+        self.rx_fifo_level = Signal(max=rx_fifo_depth+1)
+        self.rx_fifo_hwm = Signal(max=rx_fifo_depth+1)
+        self.rx_dropped = Signal(32)
+        self.tx_fifo_level = Signal(max=tx_fifo_depth+2)
+        self.tx_fifo_hwm = Signal(max=tx_fifo_depth+2)
+        self.tx_done = Signal()
+        self.tx_dropped = Signal(32)
+
+        # Receive error counters
+        self.rx_runt_errors = Signal(32)
+        self.rx_oversize_errors = Signal(32)
+        self.rx_align_errors = Signal(32)
+        self.rx_crc_errors = Signal(32)
+        self.rx_filtered_frames = Signal(32)
+
+        # Flow control
+        self.tx_paused = Signal()
+        self.rx_pause_frames = Signal(32)
+        self.tx_pause_frames = Signal(32)
+
+        # Link state
+        self.link_down_events = Signal(32)
+        self.tx_flushed_frames = Signal(32)
 
         self.clk_freq = clk_freq
         self.phy_addr = phy_addr
         self.mac_addr = [int(x, 16) for x in mac_addr.split(":")]
-        self.rmii = rmii
+        self.phy_pins = phy_pins
+        self.interface = interface
         self.mdio = mdio
         self.phy_rst = phy_rst
         self.eth_led = eth_led
+        self.shared_buffer = shared_buffer
+        self.tx_buf_size = tx_buf_size
+        self.rx_min_len = rx_min_len
+        self.rx_max_len = rx_max_len
+        self.ethertypes = ethertypes
+        self.ip_protocols = ip_protocols
+        self.mac_table_size = mac_table_size
+        self.flow_control = flow_control
+        if pause_threshold is None:
+            pause_threshold = (3 * rx_fifo_depth) // 4
+        self.pause_threshold = pause_threshold
+        self.pause_quanta = pause_quanta
+        self.link_down_flush = link_down_flush
+        self.tx_burst = tx_burst
+        self.loopback = loopback
+
+        # Create PHY manager, which may also be used to access the PHY
+        self.phy_manager = PHYManager(
+            clk_freq, phy_addr, phy_rst, mdio.mdio, mdio.mdc,
+            interface == "gmii", phy_poll_registers, phy_init_writes,
+            mdc_freq=phy_mdc_freq, suppress_preamble=phy_suppress_preamble,
+            fast_link_poll=phy_fast_link_poll, phy_int=phy_int,
+            int_status_reg=phy_int_status_reg)
 
         # Create packet memories and interface ports
         self.tx_mem = Memory(8, tx_buf_size)
@@ -98,62 +335,525 @@ class MAC(Elaboratable):
     def elaborate(self, platform):
         m = Module()
 
-        # Create RMII clock domain from RMII clock input
-        cd = ClockDomain("rmii", reset_less=True)
-        m.d.comb += cd.clk.eq(self.rmii.ref_clk)
-        m.domains.rmii = cd
-
-        # Create RX write and TX read ports for RMII use
-        rx_port_w = self.rx_mem.write_port(domain="rmii")
-        tx_port_r = self.tx_mem.read_port(domain="rmii", transparent=False)
+        # Create PHY receive and transmit clock domains from PHY clocks,
+        # which are the same clock for RMII
+        pins = self.phy_pins
+        if self.interface == "rmii":
+            rx_clk, tx_clk = pins.ref_clk, pins.ref_clk
+        elif self.interface == "mii":
+            rx_clk, tx_clk = pins.rx_clk, pins.tx_clk
+        else:
+            rx_clk, tx_clk = pins.rx_clk, pins.gtx_clk
+        cd_rx = ClockDomain("phy_rx", reset_less=True)
+        cd_tx = ClockDomain("phy_tx", reset_less=True)
+        m.d.comb += cd_rx.clk.eq(rx_clk), cd_tx.clk.eq(tx_clk)
+        m.domains.phy_rx = cd_rx
+        m.domains.phy_tx = cd_tx
+
+        # Create RX write and TX read ports for PHY use
+        rx_port_w = self.rx_mem.write_port(domain="phy_rx")
+        tx_port_r = self.tx_mem.read_port(domain="phy_tx", transparent=False)
         m.submodules += [self.rx_port, rx_port_w, self.tx_port, tx_port_r]
         m.d.comb += [self.rx_port.en.eq(1), tx_port_r.en.eq(1)]
 
-        # Create submodules for PHY and RMII
-        m.submodules.phy_manager = phy_manager = PHYManager(
-            self.clk_freq, self.phy_addr, self.phy_rst,
-            self.mdio.mdio, self.mdio.mdc)
+        # In shared buffer mode, PHY TX can also read from RX memory
+        if self.shared_buffer:
+            rx_port_r = self.rx_mem.read_port(
+                domain="phy_tx", transparent=False)
+            m.submodules += rx_port_r
+            m.d.comb += rx_port_r.en.eq(1)
+        else:
+            rx_port_r = None
+
+        # Create submodules for PHY management and data interface
+        m.submodules.phy_manager = phy_manager = self.phy_manager
         m.submodules.stretch = stretch = PulseStretch(int(1e6))
 
-        rmii_rx = RMIIRx(
-            self.mac_addr, rx_port_w, self.rmii.crs_dv,
-            self.rmii.rxd0, self.rmii.rxd1)
-        rmii_tx = RMIITx(
-            tx_port_r, self.rmii.txen, self.rmii.txd0, self.rmii.txd1)
+        rx_args = (self.rx_min_len, self.rx_max_len, self.ethertypes,
+                   self.ip_protocols, self.mac_table_size, self.flow_control)
+        tx_args = (rx_port_r, self.mac_addr if self.flow_control else None,
+                   self.pause_quanta, self.tx_burst)
+        if self.loopback:
+            # The PHY modules are connected to the pins and memory ports
+            # through loopback multiplexers, see below.
+            phy_rx_pins = [Signal(name=f"phy_rx_{n}")
+                           for n in ("crs_dv", "rxd0", "rxd1")]
+            phy_tx_pins = [Signal(name=f"phy_tx_{n}")
+                           for n in ("txen", "txd0", "txd1")]
+            phy_rx_port = _MemoryPort(rx_port_w)
+            phy_tx_port = _MemoryPort(tx_port_r)
+            phy_rx = RMIIRx(
+                self.mac_addr, phy_rx_port, *phy_rx_pins, *rx_args)
+            phy_tx = RMIITx(phy_tx_port, *phy_tx_pins, *tx_args)
+        elif self.interface == "rmii":
+            phy_rx = RMIIRx(
+                self.mac_addr, rx_port_w, pins.crs_dv, pins.rxd0, pins.rxd1,
+                *rx_args)
+            phy_tx = RMIITx(
+                tx_port_r, pins.txen, pins.txd0, pins.txd1, *tx_args)
+        else:
+            phy_rx = MIIRx(
+                self.mac_addr, rx_port_w, pins.rx_dv, pins.rxd, *rx_args)
+            phy_tx = MIITx(tx_port_r, pins.tx_en, pins.txd, *tx_args)
+
+        # Link speed, receive address filters, and transmit shaping change
+        # rarely, so are simply synchronised into the PHY domains. Only RMII
+        # needs to know the link speed, as MII PHYs slow down their clocks
+        # instead. Loopback runs at 100Mbps while the link is down.
+        if self.interface == "rmii":
+            speed_10 = Signal()
+            m.d.comb += speed_10.eq(phy_manager.speed_10)
+            if self.loopback:
+                with m.If(self.loopback_mode != LOOPBACK_OFF):
+                    m.d.comb += speed_10.eq(
+                        phy_manager.speed_10 & phy_manager.link_up)
+            m.submodules += DomainRenamer("phy_rx")(
+                MultiReg(speed_10, phy_rx.speed_10))
+            m.submodules += DomainRenamer("phy_tx")(
+                MultiReg(speed_10, phy_tx.speed_10))
+        filters = [(self.multicast_hash, phy_rx.multicast_hash)]
+        if self.mac_table_size:
+            filters.append((self.mac_table_valid, phy_rx.mac_table_valid))
+            filters += zip(self.mac_table, phy_rx.mac_table)
+        for filt, phy_filt in filters:
+            m.submodules += DomainRenamer("phy_rx")(MultiReg(filt, phy_filt))
+        for shaping, phy_shaping in ((self.tx_ipg, phy_tx.ipg),
+                                     (self.tx_rate, phy_tx.rate)):
+            m.submodules += DomainRenamer("phy_tx")(
+                MultiReg(shaping, phy_shaping))
+
+        # Packet handshakes between the FIFOs and the PHY modules, which
+        # may be replaced by descriptor loopback
+        lb_mode = Signal(2)
+        lb_desc = Signal()
+        tx_ready = Signal()
+        tx_done = Signal()
+        rx_valid = Signal()
+        rx_desc = Signal(11 + self.rx_port.addr.nbits)
+        m.d.comb += [
+            lb_desc.eq(lb_mode == LOOPBACK_DESC),
+            tx_ready.eq(phy_tx.tx_ready),
+            tx_done.eq(phy_tx.tx_done),
+            rx_valid.eq(phy_rx.rx_valid),
+            rx_desc.eq(Cat(phy_rx.rx_offset, phy_rx.rx_len)),
+        ]
+
+        # Loopback is only supported with RMII, where PHY RX and TX share
+        # a clock, so the mode is synchronised once for both domains and
+        # the descriptor loopback copy runs across both of them.
+        if self.loopback:
+            m.submodules += DomainRenamer("phy_tx")(
+                MultiReg(self.loopback_mode, lb_mode))
+            lb_phy = Signal()
+            m.d.comb += lb_phy.eq(lb_mode == LOOPBACK_PHY)
+
+            # Transmitted dibits are received in PHY loopback instead of
+            # being sent to the PHY, and nothing is received from the PHY
+            # in descriptor loopback.
+            rx_pins = (pins.crs_dv, pins.rxd0, pins.rxd1)
+            tx_pins = (pins.txen, pins.txd0, pins.txd1)
+            for phy_rx_pin, rx_pin, phy_tx_pin, tx_pin in zip(
+                    phy_rx_pins, rx_pins, phy_tx_pins, tx_pins):
+                m.d.comb += [
+                    tx_pin.eq(phy_tx_pin & (lb_mode == LOOPBACK_OFF)),
+                    phy_rx_pin.eq(Mux(lb_phy, phy_tx_pin,
+                                      rx_pin & ~lb_desc)),
+                ]
+
+            # Descriptor loopback copies packets with its own memory ports,
+            # which are multiplexed with the PHY modules' ports.
+            lb_tx_port = _MemoryPort(tx_port_r)
+            lb_rx_port = _MemoryPort(rx_port_w)
+            loopback = _DescriptorLoopback(lb_tx_port, lb_rx_port)
+            m.submodules.loopback = DomainRenamer("phy_tx")(loopback)
+            m.d.comb += [
+                tx_port_r.addr.eq(Mux(lb_desc, lb_tx_port.addr,
+                                      phy_tx_port.addr)),
+                phy_tx_port.data.eq(tx_port_r.data),
+                lb_tx_port.data.eq(tx_port_r.data),
+                rx_port_w.addr.eq(Mux(lb_desc, lb_rx_port.addr,
+                                      phy_rx_port.addr)),
+                rx_port_w.data.eq(Mux(lb_desc, lb_rx_port.data,
+                                      phy_rx_port.data)),
+                rx_port_w.en.eq(Mux(lb_desc, lb_rx_port.en,
+                                    phy_rx_port.en)),
+                loopback.tx_offset.eq(phy_tx.tx_offset),
+                loopback.tx_len.eq(phy_tx.tx_len),
+                tx_ready.eq(Mux(lb_desc, loopback.tx_ready,
+                                phy_tx.tx_ready)),
+                tx_done.eq(phy_tx.tx_done | loopback.tx_done),
+                rx_valid.eq(phy_rx.rx_valid | loopback.rx_valid),
+                rx_desc.eq(Mux(loopback.rx_valid,
+                               Cat(loopback.rx_offset, loopback.rx_len),
+                               Cat(phy_rx.rx_offset, phy_rx.rx_len))),
+            ]
+
+        # Stop transmitting while the link is down, holding or discarding
+        # queued packets, and count link losses and discarded packets.
+        # There is no need to wait for the link in loopback.
+        link_up = Signal()
+        m.submodules += DomainRenamer("phy_tx")(
+            MultiReg(phy_manager.link_up, link_up))
+        m.d.comb += phy_tx.link_up.eq(link_up | (lb_mode != LOOPBACK_OFF))
+        m.d.comb += phy_tx.flush.eq(int(self.link_down_flush))
+        link_up_last = Signal()
+        m.d.sync += link_up_last.eq(phy_manager.link_up)
+        with m.If(link_up_last & ~phy_manager.link_up):
+            m.d.sync += self.link_down_events.eq(self.link_down_events + 1)
+        m.submodules.tx_flushes = tx_flushes = _CounterSync(32, "phy_tx")
+        m.d.comb += [
+            tx_flushes.inc.eq(phy_tx.tx_flushed),
+            self.tx_flushed_frames.eq(tx_flushes.count),
+        ]
 
-        # Create FIFOs to interface to RMII modules
-        rx_fifo = AsyncFIFO(width=11+self.rx_port.addr.nbits, depth=4)
-        tx_fifo = AsyncFIFO(width=11+self.tx_port.addr.nbits, depth=4)
+        # Create FIFOs to interface to PHY modules
+        if self.shared_buffer:
+            tx_desc = Cat(self.tx_offset, self.tx_len,
+                          self.tx_split, self.tx_rx_offset)
+            phy_tx_desc = Cat(phy_tx.tx_offset, phy_tx.tx_len,
+                              phy_tx.tx_split, phy_tx.tx_rx_offset)
+        else:
+            tx_desc = Cat(self.tx_offset, self.tx_len)
+            phy_tx_desc = Cat(phy_tx.tx_offset, phy_tx.tx_len)
+        rx_fifo = AsyncFIFO(width=11+self.rx_port.addr.nbits,
+                            depth=self.rx_fifo_depth)
+        tx_fifo = AsyncFIFO(width=len(tx_desc), depth=self.tx_fifo_depth)
+
+        # Track TX memory used by packets until they have been transmitted.
+        # The TX memory used by each packet is latched as PHY TX starts it,
+        # and returned through the completion FIFO once it is finished.
+        txc_fifo = AsyncFIFO(width=12, depth=4)
+        tx_used = Signal(max=self.tx_buf_size+1)
+        tx_alloc = Signal(12)
+        phy_tx_used = Signal(12)
+        if self.shared_buffer:
+            patch_used = TX_PATCH_LEN//8
+            m.d.comb += tx_alloc.eq(Mux(
+                self.tx_split != 0, self.tx_split + patch_used, self.tx_len))
+            with m.If(tx_ready & tx_fifo.readable):
+                m.d.phy_tx += phy_tx_used.eq(Mux(
+                    phy_tx.tx_split != 0, phy_tx.tx_split + patch_used,
+                    phy_tx.tx_len))
+        else:
+            m.d.comb += tx_alloc.eq(self.tx_len)
+            with m.If(tx_ready & tx_fifo.readable):
+                m.d.phy_tx += phy_tx_used.eq(phy_tx.tx_len)
+        tx_accept = Signal()
+        m.d.comb += tx_accept.eq(self.tx_start & tx_fifo.writable)
+        m.d.sync += tx_used.eq(
+            tx_used + Mux(tx_accept, tx_alloc, 0)
+            - Mux(txc_fifo.readable, txc_fifo.dout, 0))
+
+        # TX FIFO statistics, where packets leave the level once they
+        # have been transmitted.
+        m.d.sync += self.tx_fifo_level.eq(
+            self.tx_fifo_level + tx_accept - txc_fifo.readable)
+        with m.If(self.tx_fifo_level > self.tx_fifo_hwm):
+            m.d.sync += self.tx_fifo_hwm.eq(self.tx_fifo_level)
+        with m.If(self.tx_start & ~tx_fifo.writable):
+            m.d.sync += self.tx_dropped.eq(self.tx_dropped + 1)
+
+        # RX FIFO statistics. Packets written and dropped are counted in the
+        # PHY RX domain and synchronised for comparison with packets read.
+        rx_writes = _CounterSync(len(self.rx_fifo_level), "phy_rx")
+        rx_drops = _CounterSync(32, "phy_rx")
+        rx_reads = Signal(len(self.rx_fifo_level))
+        m.submodules.rx_writes = rx_writes
+        m.submodules.rx_drops = rx_drops
+        m.d.comb += [
+            rx_writes.inc.eq(rx_valid & rx_fifo.writable),
+            rx_drops.inc.eq((rx_valid & ~rx_fifo.writable) |
+                            phy_rx.rx_overflow),
+            self.rx_fifo_level.eq(rx_writes.count - rx_reads),
+            self.rx_dropped.eq(rx_drops.count),
+        ]
+        with m.If(self.rx_ack & rx_fifo.readable):
+            m.d.sync += rx_reads.eq(rx_reads + 1)
+        with m.If(self.rx_fifo_level > self.rx_fifo_hwm):
+            m.d.sync += self.rx_fifo_hwm.eq(self.rx_fifo_level)
+
+        # Received packets are kept in RX memory until acknowledged, so PHY
+        # RX drops frames which would overwrite the oldest packet in the RX
+        # FIFO. The offset of each packet is recorded as it enters the FIFO,
+        # and acknowledgements are counted back into the PHY RX domain to
+        # look up the oldest. The hold lags acknowledgements, which only
+        # delays releasing memory.
+        fifo_bits = (rx_fifo.depth - 1).bit_length()
+        rx_acks = _CounterSync(fifo_bits + 1, "sync", "phy_rx")
+        rx_queued = Signal(fifo_bits + 1)
+        rx_offsets = Memory(len(self.rx_offset), rx_fifo.depth)
+        rx_offsets_w = rx_offsets.write_port(domain="phy_rx")
+        rx_offsets_r = rx_offsets.read_port(domain="phy_rx",
+                                            transparent=False)
+        m.submodules.rx_acks = rx_acks
+        m.submodules += rx_offsets_w, rx_offsets_r
+        m.d.comb += [
+            rx_acks.inc.eq(self.rx_ack & rx_fifo.readable),
+            rx_offsets_w.addr.eq(rx_queued[:fifo_bits]),
+            rx_offsets_w.data.eq(rx_desc[:len(self.rx_offset)]),
+            rx_offsets_w.en.eq(rx_valid & rx_fifo.writable),
+            rx_offsets_r.addr.eq(rx_acks.count[:fifo_bits]),
+            rx_offsets_r.en.eq(1),
+            phy_rx.rx_hold_offset.eq(rx_offsets_r.data),
+        ]
+        with m.If(rx_valid & rx_fifo.writable):
+            m.d.phy_rx += rx_queued.eq(rx_queued + 1)
+        m.d.phy_rx += phy_rx.rx_hold.eq(rx_queued != rx_acks.count)
+
+        # Receive error and filter counters, from strobes in the PHY RX domain
+        rx_errors = [
+            (phy_rx.rx_runt, self.rx_runt_errors),
+            (phy_rx.rx_oversize, self.rx_oversize_errors),
+            (phy_rx.rx_align_error, self.rx_align_errors),
+            (phy_rx.rx_crc_error, self.rx_crc_errors),
+            (phy_rx.rx_filtered, self.rx_filtered_frames),
+            (phy_rx.rx_pause, self.rx_pause_frames),
+        ]
+        for strobe, count in rx_errors:
+            counter = _CounterSync(32, "phy_rx")
+            m.submodules += counter
+            m.d.comb += counter.inc.eq(strobe), count.eq(counter.count)
+
+        if self.flow_control:
+            # Request the link partner pauses while the RX FIFO is filling
+            # up, with hysteresis so PAUSE frames are not sent too often.
+            xoff = Signal()
+            with m.If(self.rx_fifo_level >= self.pause_threshold):
+                m.d.sync += xoff.eq(1)
+            with m.Elif(self.rx_fifo_level <= self.pause_threshold // 2):
+                m.d.sync += xoff.eq(0)
+            m.submodules += DomainRenamer("phy_tx")(
+                MultiReg(xoff, phy_tx.xoff))
+
+            # Received PAUSE frames toggle a signal which is synchronised
+            # to the PHY TX domain. The pause time is held in PHY RX until
+            # the next PAUSE frame, so is stable once the toggle arrives.
+            pause_toggle = Signal()
+            pause_toggle_tx = Signal()
+            pause_toggle_tx_last = Signal()
+            with m.If(phy_rx.rx_pause):
+                m.d.phy_rx += pause_toggle.eq(~pause_toggle)
+            m.submodules += DomainRenamer("phy_tx")(
+                MultiReg(pause_toggle, pause_toggle_tx))
+            m.d.phy_tx += pause_toggle_tx_last.eq(pause_toggle_tx)
+            m.d.comb += [
+                phy_tx.pause_rx.eq(pause_toggle_tx != pause_toggle_tx_last),
+                phy_tx.pause_rx_quanta.eq(phy_rx.rx_pause_quanta),
+            ]
+
+            m.submodules += MultiReg(phy_tx.paused, self.tx_paused)
+            tx_pauses = _CounterSync(32, "phy_tx")
+            m.submodules.tx_pauses = tx_pauses
+            m.d.comb += [
+                tx_pauses.inc.eq(phy_tx.tx_pause),
+                self.tx_pause_frames.eq(tx_pauses.count),
+            ]
 
         m.d.comb += [
             # RX FIFO
-            rx_fifo.din.eq(Cat(rmii_rx.rx_offset, rmii_rx.rx_len)),
-            rx_fifo.we.eq(rmii_rx.rx_valid),
+            rx_fifo.din.eq(rx_desc),
+            rx_fifo.we.eq(rx_valid),
             Cat(self.rx_offset, self.rx_len).eq(rx_fifo.dout),
             rx_fifo.re.eq(self.rx_ack),
             self.rx_valid.eq(rx_fifo.readable),
 
             # TX FIFO
-            tx_fifo.din.eq(Cat(self.tx_offset, self.tx_len)),
+            tx_fifo.din.eq(tx_desc),
             tx_fifo.we.eq(self.tx_start),
-            Cat(rmii_tx.tx_offset, rmii_tx.tx_len).eq(tx_fifo.dout),
-            tx_fifo.re.eq(rmii_tx.tx_ready),
-            rmii_tx.tx_start.eq(tx_fifo.readable),
+            phy_tx_desc.eq(tx_fifo.dout),
+            tx_fifo.re.eq(tx_ready),
+            phy_tx.tx_start.eq(tx_fifo.readable & ~lb_desc),
+
+            # TX completion FIFO
+            txc_fifo.din.eq(phy_tx_used),
+            txc_fifo.we.eq(tx_done),
+            txc_fifo.re.eq(txc_fifo.readable),
+            self.tx_done.eq(txc_fifo.readable),
+            self.tx_free.eq(Mux(tx_fifo.writable,
+                                self.tx_buf_size - tx_used, 0)),
 
             # Other submodules
             phy_manager.phy_reset.eq(self.phy_reset),
             self.link_up.eq(phy_manager.link_up),
+            self.speed_10.eq(phy_manager.speed_10),
             stretch.trigger.eq(self.rx_valid),
             self.eth_led.eq(stretch.pulse),
         ]
+        if self.loopback:
+            m.d.comb += loopback.tx_start.eq(tx_fifo.readable & lb_desc)
 
-        rdr = DomainRenamer({"read": "sync", "write": "rmii"})
-        wdr = DomainRenamer({"write": "sync", "read": "rmii"})
-        rr = DomainRenamer("rmii")
+        rdr = DomainRenamer({"read": "sync", "write": "phy_rx"})
+        wdr = DomainRenamer({"write": "sync", "read": "phy_tx"})
+        tdr = DomainRenamer({"read": "sync", "write": "phy_tx"})
         m.submodules.rx_fifo = rdr(rx_fifo)
         m.submodules.tx_fifo = wdr(tx_fifo)
-        m.submodules.rmii_rx = rr(rmii_rx)
-        m.submodules.rmii_tx = rr(rmii_tx)
+        m.submodules.txc_fifo = tdr(txc_fifo)
+        m.submodules.phy_rx = DomainRenamer("phy_rx")(phy_rx)
+        m.submodules.phy_tx = DomainRenamer("phy_tx")(phy_tx)
+
+        return m
+
+
+def _fifo_depth(buf_size, min_frame_size=64):
+    """
+    Returns the smallest power-of-two FIFO depth able to describe a buffer
+    of `buf_size` bytes filled with minimum-size frames.
+    """
+    depth = 2
+    while depth * min_frame_size < buf_size:
+        depth *= 2
+    return depth
+
+
+class _MemoryPort:
+    """
+    Stand-in for a memory port, so that several modules may be multiplexed
+    onto one port.
+    """
+    def __init__(self, port):
+        self.addr = Signal(port.addr.nbits)
+        self.data = Signal(port.data.nbits)
+        self.en = Signal()
+
+
+class _DescriptorLoopback(Elaboratable):
+    """
+    Descriptor loopback, in place of the PHY RX and TX modules.
+
+    Copies each packet taken from the TX FIFO from TX memory into RX memory,
+    one byte per clock, and then reports it as transmitted and as received.
+    Packets are written contiguously into RX memory, independently of PHY
+    RX.
+
+    As RX memory is written in the PHY RX clock domain, this must be run in
+    the PHY TX clock domain only where it is the same clock, as for RMII.
+
+    Memory Ports:
+        * `read_port`: Read port into TX packet memory
+        * `write_port`: Write port into RX packet memory
+
+    Inputs:
+        * `tx_start`: High while a packet is waiting in the TX FIFO
+        * `tx_offset`: n-bit address offset of the waiting packet
+        * `tx_len`: 11-bit length of the waiting packet
+
+    Outputs:
+        * `tx_ready`: High while ready to take a packet from the TX FIFO
+        * `tx_done`: Pulsed high when a packet has been copied
+        * `rx_valid`: Pulsed high when a packet has been copied
+        * `rx_offset`: n-bit address offset of the copied packet
+        * `rx_len`: 11-bit length of the copied packet
+    """
+    def __init__(self, read_port, write_port):
+        # Inputs
+        self.tx_start = Signal()
+        self.tx_offset = Signal(read_port.addr.nbits)
+        self.tx_len = Signal(11)
+
+        # Outputs
+        self.tx_ready = Signal()
+        self.tx_done = Signal()
+        self.rx_valid = Signal()
+        self.rx_offset = Signal(write_port.addr.nbits)
+        self.rx_len = Signal(11)
+
+        self.read_port = read_port
+        self.write_port = write_port
+
+    def elaborate(self, platform):
+        m = Module()
+
+        offset = Signal(self.read_port.addr.nbits)
+        adr = Signal(self.write_port.addr.nbits)
+        ctr = Signal(12)
+
+        m.d.sync += [
+            self.tx_done.eq(0),
+            self.rx_valid.eq(0),
+        ]
+
+        with m.FSM() as fsm:
+            m.d.comb += self.tx_ready.eq(fsm.ongoing("IDLE"))
+
+            with m.State("IDLE"):
+                m.d.sync += ctr.eq(0)
+                with m.If(self.tx_start):
+                    m.d.sync += [
+                        offset.eq(self.tx_offset),
+                        self.rx_offset.eq(adr),
+                        self.rx_len.eq(self.tx_len),
+                    ]
+                    m.next = "COPY"
+
+            # Each byte is written the clock after its address is read.
+            with m.State("COPY"):
+                m.d.comb += [
+                    self.read_port.addr.eq(offset + ctr),
+                    self.write_port.addr.eq(adr),
+                    self.write_port.data.eq(self.read_port.data),
+                    self.write_port.en.eq(ctr != 0),
+                ]
+                m.d.sync += ctr.eq(ctr + 1)
+                with m.If(ctr != 0):
+                    m.d.sync += adr.eq(adr + 1)
+                with m.If(ctr == self.rx_len):
+                    m.d.sync += [
+                        self.tx_done.eq(1),
+                        self.rx_valid.eq(1),
+                    ]
+                    m.next = "IDLE"
+
+        return m
+
+
+class _CounterSync(Elaboratable):
+    """
+    Counter which is incremented in one clock domain and read in another.
+
+    The count is Gray coded across the clock domain crossing, so `inc` must
+    not be asserted more often than once per two output clocks.
+
+    Parameters:
+        * `width`: Width of the counter in bits
+        * `idomain`: Clock domain `inc` is asserted in
+        * `odomain`: Clock domain `count` is read in
+
+    Inputs:
+        * `inc`: Assert to increment the counter
+
+    Outputs:
+        * `count`: Current value of the counter, in `odomain`
+    """
+    def __init__(self, width, idomain, odomain="sync"):
+        self.inc = Signal()
+        self.count = Signal(width)
+        self.width = width
+        self.idomain = idomain
+        self.odomain = odomain
+
+    def elaborate(self, platform):
+        m = Module()
+
+        m.submodules.enc = enc = GrayEncoder(self.width)
+        m.submodules.dec = dec = GrayDecoder(self.width)
+
+        count = Signal(self.width)
+        count_gray = Signal(self.width)
+        count_gray_sync = Signal(self.width)
+
+        # The Gray coded count is registered from the next count, so it
+        # reaches the sync domain at the same time as AsyncFIFO pointers.
+        m.d.comb += enc.i.eq(count + self.inc)
+        m.d[self.idomain] += [
+            count.eq(count + self.inc),
+            count_gray.eq(enc.o),
+        ]
+        m.submodules.multireg = DomainRenamer(self.odomain)(
+            MultiReg(count_gray, count_gray_sync))
+        m.d.comb += [
+            dec.i.eq(count_gray_sync),
+            self.count.eq(dec.o),
+        ]
 
         return m
 
@@ -164,76 +864,264 @@ class PHYManager(Elaboratable):
 
     Can trigger a PHY reset. Resets PHY at power-up.
 
-    Continually polls PHY for acceptable link status and outputs link status.
+    Polls PHY registers into a register shadow, each at its own rate, and
+    outputs link status and the negotiated link speed from the shadow. The
+    link is considered up once autonegotiation has resolved to either
+    100Mbps or 10Mbps full duplex, or to 1000Mbps full duplex if `gigabit`
+    is set.
+
+    A host may also queue its own MDIO requests, which are run in between
+    polls, and read the register shadow or change polling rates without
+    any MDIO traffic.
+
+    Link changes may be detected within a few MDIO frames instead of at the
+    next poll, either with `fast_link_poll`, which reads BSR whenever MDIO
+    is otherwise idle and relies on its link status bit latching low, or
+    with the PHY interrupt pin `phy_int`. When `phy_int` is asserted,
+    `link_up` is immediately deasserted until BSR and `int_status_reg` have
+    been read, which must clear the interrupt, so the PHY should only be
+    configured to interrupt on link changes.
+
+    The register shadow contains BSR (0x01), ANAR (0x04), and ANLPAR (0x05),
+    then GBCR (0x09) and GBSR (0x0A) if `gigabit` is set, then any
+    `poll_registers`, then `int_status_reg` if given. The addresses are
+    listed in order in `shadow_regs`.
 
     Parameters:
         * `clk_freq`: Frequency of this module's clock, used to time the 1ms
                       reset period and calculate the MDIO clock divider
         * `phy_addr`: 5-bit address of the PHY
+        * `gigabit`: If True, only consider the link up at 1000Mbps
+        * `poll_registers`: List of (address, period) of additional clause
+                            22 registers to poll into the shadow, with
+                            periods in milliseconds
+        * `init_writes`: List of (address, value) of clause 22 registers to
+                         write after each PHY reset, before polling starts
+        * `queue_depth`: Number of MDIO requests which may be queued
+        * `mdc_freq`: Maximum MDC frequency, which may be raised above the
+                      standard 2.5MHz up to the PHY's limit
+        * `suppress_preamble`: If True, suppress MDIO preambles once the
+                               PHY reports it accepts them (BSR bit 6)
+        * `fast_link_poll`: If True, read BSR whenever MDIO is idle
+        * `int_status_reg`: Clause 22 address of the PHY's interrupt status
+                            register, read to clear the interrupt
 
     Pins:
         * `phy_rst`: PHY RST pin (output, active low)
         * `mdio`: MDIO pin (data in/out)
         * `mdc`: MDC pin (clock out)
+        * `phy_int`: Optional PHY interrupt pin (input, active low)
 
     Inputs:
         * `phy_reset`: Pulse high to trigger a PHY reset
+        * `mdio_phy_addr`: 5-bit PHY address of host request
+        * `mdio_op`: 2-bit operation of host request, one of the
+                     `mdio.OP_*` constants
+        * `mdio_reg_addr`: 16-bit register address of host request
+        * `mdio_devad`: 5-bit MMD device address of clause 45 host request
+        * `mdio_write_data`: 16-bit data to write for host request
+        * `mdio_req_valid`: Assert to queue host request while
+                            `mdio_req_ready` is high
+        * `shadow_sel`: Index of the register shadow to read
+        * `poll_sel`: Index of the register shadow to set the poll period of
+        * `poll_period`: 16-bit poll period in milliseconds, or 0 to stop
+                         polling the register
+        * `poll_we`: Pulse high to set the poll period of `poll_sel`
 
     Outputs:
         * `link_up`: High while link is established
+        * `speed_10`: High while the link is running at 10Mbps
+        * `mdio_req_ready`: High while a host request may be queued
+        * `mdio_resp_valid`: Pulsed high when a host request has completed
+        * `mdio_resp_data`: 16-bit data read by a completed host request
+        * `shadow_data`: 16-bit polled value of register `shadow_sel`
     """
-    def __init__(self, clk_freq, phy_addr, phy_rst, mdio, mdc):
+    def __init__(self, clk_freq, phy_addr, phy_rst, mdio, mdc, gigabit=False,
+                 poll_registers=(), init_writes=(), queue_depth=4,
+                 mdc_freq=2.5e6, suppress_preamble=False,
+                 fast_link_poll=False, phy_int=None, int_status_reg=None):
+        # The negotiated link mode is computed from these registers, which
+        # are polled every millisecond by default
+        self.shadow_regs = [0x01, 0x04, 0x05]
+        if gigabit:
+            self.shadow_regs += [0x09, 0x0A]
+        poll_periods = [1] * len(self.shadow_regs)
+        for addr, period in poll_registers:
+            self.shadow_regs.append(addr)
+            poll_periods.append(period)
+        if int_status_reg is not None:
+            self.shadow_regs.append(int_status_reg)
+            poll_periods.append(0)
+        n_shadow = len(self.shadow_regs)
+
         # Inputs
         self.phy_reset = Signal()
+        self.mdio_phy_addr = Signal(5)
+        self.mdio_op = Signal(2)
+        self.mdio_reg_addr = Signal(16)
+        self.mdio_devad = Signal(5)
+        self.mdio_write_data = Signal(16)
+        self.mdio_req_valid = Signal()
+        self.shadow_sel = Signal(max=n_shadow)
+        self.poll_sel = Signal(max=n_shadow)
+        self.poll_period = Signal(16)
+        self.poll_we = Signal()
 
         # Outputs
         self.link_up = Signal()
+        self.speed_10 = Signal()
+        self.mdio_req_ready = Signal()
+        self.mdio_resp_valid = Signal()
+        self.mdio_resp_data = Signal(16)
+        self.shadow_data = Signal(16)
 
         self.clk_freq = clk_freq
         self.phy_addr = phy_addr
+        self.gigabit = gigabit
+        self.poll_periods = poll_periods
+        self.init_writes = init_writes
+        self.queue_depth = queue_depth
+        self.mdc_freq = mdc_freq
+        self.suppress_preamble = suppress_preamble
+        self.fast_link_poll = fast_link_poll
+        self.int_status_reg = int_status_reg
         self.phy_rst = phy_rst
         self.mdio = mdio
         self.mdc = mdc
+        self.phy_int = phy_int
 
     def elaborate(self, platform):
         m = Module()
 
-        # Create MDIO submodule
-        clk_div = int(self.clk_freq // 2.5e6)
+        # Create MDIO submodule and its transaction queue, rounding the
+        # MDC divider up so MDC never exceeds `mdc_freq`
+        clk_div = int(-(-self.clk_freq // self.mdc_freq))
         m.submodules.mdio = mdio = MDIO(clk_div, self.mdio, self.mdc)
         self.mdio_mod = mdio
-        mdio.phy_addr = Const(self.phy_addr)
-
-        # Latches for registers we read
-        bsr = Signal(16)
-
-        # Compute output signal from registers
-        m.d.comb += self.link_up.eq(
-            bsr[2] &        # Link must be up
-            ~bsr[4] &       # No remote fault
-            bsr[5] &        # Autonegotiation complete
-            bsr[14]         # 100Mbps full duplex
-        )
-
-        registers_to_write = [
-            # Enable 100Mbps, autonegotiation, and full-duplex
-            # ("BCR", 0x00, (1 << 13) | (1 << 12) | (1 << 8)),
+
+        # Requests are tagged with the index of the shadow register they
+        # poll, or as host or initial write requests
+        n_shadow = len(self.shadow_regs)
+        host_tag = n_shadow
+        init_tag = n_shadow + 1
+        m.submodules.queue = queue = MDIOQueue(
+            mdio, self.queue_depth, Signal(max=init_tag+1).nbits)
+
+        # Register shadow, cleared while the PHY is reset
+        shadow = [Signal(16, name=f"shadow_{addr:02x}")
+                  for addr in self.shadow_regs]
+        m.d.comb += self.shadow_data.eq(Array(shadow)[self.shadow_sel])
+
+        bsr, anar, anlpar = shadow[:3]
+
+        if self.suppress_preamble:
+            m.d.comb += mdio.suppress_preamble.eq(bsr[6])
+
+        # The negotiated mode is the highest priority mode advertised by
+        # both the PHY and its link partner
+        common = Signal(16)
+        m.d.comb += common.eq(anar & anlpar)
+        fd_100 = common[8]
+        hd_100 = common[7]
+        fd_10 = common[6]
+
+        if self.gigabit:
+            # 1000BASE-T control and status registers give gigabit modes
+            gbcr, gbsr = shadow[3:5]
+            full_duplex = gbcr[9] & gbsr[11]
+        else:
+            full_duplex = fd_100 | (fd_10 & ~hd_100)
+
+        # Set while a PHY interrupt is being handled
+        int_active = Signal()
+
+        # Compute output signals from registers
+        m.d.comb += [
+            self.link_up.eq(
+                bsr[2] &        # Link must be up
+                ~bsr[4] &       # No remote fault
+                bsr[5] &        # Autonegotiation complete
+                full_duplex &   # Full duplex at a supported speed
+                ~int_active     # No link change being handled
+            ),
+            self.speed_10.eq(~(fd_100 | hd_100)),
         ]
 
-        registers_to_read = [
-            # Basic status register contains everything we need to know
-            ("BSR", 0x01, bsr),
+        # Millisecond tick for poll timers
+        one_ms = int(self.clk_freq//1000)
+        ms_ctr = Signal(max=one_ms)
+        ms_tick = Signal()
+        m.d.comb += ms_tick.eq(ms_ctr == 0)
+        with m.If(ms_tick):
+            m.d.sync += ms_ctr.eq(one_ms - 1)
+        with m.Else():
+            m.d.sync += ms_ctr.eq(ms_ctr - 1)
+
+        # Each shadow register is polled once its timer has expired, unless
+        # its poll period has been set to 0
+        periods = [Signal(16, reset=period, name=f"poll_period_{addr:02x}")
+                   for addr, period in zip(self.shadow_regs,
+                                           self.poll_periods)]
+        timers = [Signal(16, name=f"poll_timer_{addr:02x}")
+                  for addr in self.shadow_regs]
+        timer_pending = Signal(n_shadow)
+        for idx, (period, timer) in enumerate(zip(periods, timers)):
+            m.d.comb += timer_pending[idx].eq((timer == 0) & (period != 0))
+            with m.If(ms_tick & (timer != 0)):
+                m.d.sync += timer.eq(timer - 1)
+
+        # Registers read to handle a PHY interrupt, cleared once queued
+        int_pending = Signal(n_shadow)
+        if self.phy_int is not None:
+            int_regs = [0]
+            if self.int_status_reg is not None:
+                int_regs.append(n_shadow - 1)
+            int_mask = sum(1 << idx for idx in int_regs)
+            int_n = Signal()
+            m.submodules += MultiReg(self.phy_int, int_n, reset=1)
+            with m.If(~int_n & ~int_active):
+                m.d.sync += [
+                    int_active.eq(1),
+                    int_pending.eq(int_mask),
+                ]
+            with m.If(queue.resp_valid & (queue.resp_tag == int_regs[-1])
+                      & (int_pending == 0)):
+                m.d.sync += int_active.eq(0)
+
+        # BSR is read whenever nothing else is waiting to use MDIO
+        fast_pending = Signal()
+        if self.fast_link_poll:
+            m.d.comb += fast_pending.eq(
+                ~queue.busy & ~self.mdio_req_valid & (timer_pending == 0)
+                & (int_pending == 0))
+
+        pending = Signal(n_shadow)
+        m.d.comb += pending.eq(timer_pending | int_pending | fast_pending)
+        with m.If(self.poll_we):
+            m.d.sync += Array(periods)[self.poll_sel].eq(self.poll_period)
+
+        # Store responses in the shadow or return them to the host
+        m.d.comb += [
+            self.mdio_resp_valid.eq(
+                queue.resp_valid & (queue.resp_tag == host_tag)),
+            self.mdio_resp_data.eq(queue.resp_data),
         ]
+        for idx, reg in enumerate(shadow):
+            with m.If(queue.resp_valid & (queue.resp_tag == idx)):
+                m.d.sync += reg.eq(queue.resp_data)
 
         # Controller FSM
-        one_ms = int(self.clk_freq//1000)
-        counter = Signal(max=one_ms)
+        counter = Signal(max=one_ms+1)
+        init_idx = Signal(max=len(self.init_writes)+1)
         with m.FSM():
 
             # Assert PHY_RST and begin 1ms counter
             with m.State("RESET"):
                 m.d.comb += self.phy_rst.eq(0)
                 m.d.sync += counter.eq(one_ms)
+                m.d.sync += [reg.eq(0) for reg in shadow]
+                m.d.sync += [timer.eq(0) for timer in timers]
+                m.d.sync += int_active.eq(0), int_pending.eq(0)
                 m.next = "RESET_WAIT"
 
             # Wait for reset timeout
@@ -243,102 +1131,75 @@ class PHYManager(Elaboratable):
                 with m.If(self.phy_reset):
                     m.next = "RESET"
                 with m.Elif(counter == 0):
-                    m.d.sync += counter.eq(one_ms)
-                    write = bool(registers_to_write)
-                    m.next = "WRITE_WAIT" if write else "POLL_WAIT"
-
-            # Wait 1ms before writing
-            if registers_to_write:
-                with m.State("WRITE_WAIT"):
-                    m.d.comb += self.phy_rst.eq(1),
-                    m.d.sync += counter.eq(counter - 1)
-                    with m.If(self.phy_reset):
-                        m.next = "RESET"
-                    with m.Elif(counter == 0):
-                        m.next = f"WRITE_{registers_to_write[0][0]}"
-            else:
-                m.d.comb += mdio.write_data.eq(0)
-
-            for idx, (name, addr, val) in enumerate(registers_to_write):
-                if idx == len(registers_to_write) - 1:
-                    next_state = "POLL_WAIT"
-                else:
-                    next_state = f"WRITE_{registers_to_write[idx+1][0]}"
-
-                with m.State(f"WRITE_{name}"):
-                    m.d.comb += [
-                        self.phy_rst.eq(0),
-                        mdio.reg_addr.eq(Const(addr)),
-                        mdio.rw.eq(1),
-                        mdio.write_data.eq(Const(val)),
-                        mdio.start.eq(1),
-                    ]
-
-                    with m.If(self.phy_reset):
-                        m.next = "RESET"
-                    with m.Elif(mdio.busy):
-                        m.next = f"WRITE_{name}_WAIT"
-
-                with m.State(f"WRITE_{name}_WAIT"):
-                    m.d.comb += [
-                        self.phy_rst.eq(1),
-                        mdio.reg_addr.eq(0),
-                        mdio.rw.eq(0),
-                        mdio.write_data.eq(0),
-                        mdio.start.eq(0),
+                    m.d.sync += [
+                        counter.eq(one_ms),
+                        init_idx.eq(0),
                     ]
-                    with m.If(self.phy_reset):
-                        m.next = "RESET"
-                    with m.Elif(~mdio.busy):
-                        m.d.sync += counter.eq(one_ms)
-                        m.next = next_state
+                    m.next = "INIT_WAIT"
 
-            # Wait 1ms between polls
-            with m.State("POLL_WAIT"):
+            # Wait 1ms for the PHY to start up
+            with m.State("INIT_WAIT"):
                 m.d.comb += self.phy_rst.eq(1)
                 m.d.sync += counter.eq(counter - 1)
                 with m.If(self.phy_reset):
                     m.next = "RESET"
                 with m.Elif(counter == 0):
-                    m.next = f"POLL_{registers_to_read[0][0]}"
-
-            for idx, (name, addr, latch) in enumerate(registers_to_read):
-                if idx == len(registers_to_read) - 1:
-                    next_state = "POLL_WAIT"
-                else:
-                    next_state = f"POLL_{registers_to_read[idx+1][0]}"
+                    m.next = "INIT" if self.init_writes else "RUN"
 
-                # Trigger a read of the register
-                with m.State(f"POLL_{name}"):
+            # Queue initial register writes
+            if self.init_writes:
+                with m.State("INIT"):
+                    addrs = Array(addr for addr, _ in self.init_writes)
+                    values = Array(value for _, value in self.init_writes)
                     m.d.comb += [
                         self.phy_rst.eq(1),
-                        mdio.reg_addr.eq(Const(addr)),
-                        mdio.rw.eq(0),
-                        mdio.start.eq(1),
+                        queue.phy_addr.eq(self.phy_addr),
+                        queue.op.eq(OP_WRITE),
+                        queue.reg_addr.eq(addrs[init_idx]),
+                        queue.write_data.eq(values[init_idx]),
+                        queue.tag.eq(init_tag),
+                        queue.req_valid.eq(1),
                     ]
-
                     with m.If(self.phy_reset):
+                        m.d.comb += queue.req_valid.eq(0)
                         m.next = "RESET"
-                    with m.Elif(mdio.busy):
-                        m.next = f"POLL_{name}_WAIT"
-
-                # Wait for MDIO to stop being busy
-                with m.State(f"POLL_{name}_WAIT"):
-                    m.d.comb += [
-                        self.phy_rst.eq(1),
-                        mdio.reg_addr.eq(0),
-                        mdio.rw.eq(0),
-                        mdio.start.eq(0),
-                    ]
+                    with m.Elif(queue.req_ready):
+                        m.d.sync += init_idx.eq(init_idx + 1)
+                        with m.If(init_idx == len(self.init_writes) - 1):
+                            m.next = "RUN"
 
-                    with m.If(self.phy_reset):
-                        m.next = "RESET"
-                    with m.Elif(~mdio.busy):
-                        m.d.sync += [
-                            latch.eq(mdio.read_data),
-                            counter.eq(one_ms),
+            # Queue polls as they become due, and otherwise host requests
+            with m.State("RUN"):
+                m.d.comb += self.phy_rst.eq(1)
+                m.d.comb += self.mdio_req_ready.eq(
+                    queue.req_ready & (pending == 0))
+                with m.If(self.phy_reset):
+                    m.next = "RESET"
+                with m.Elif(queue.req_ready):
+                    for idx, addr in enumerate(self.shadow_regs):
+                        cond = m.If if idx == 0 else m.Elif
+                        with cond(pending[idx]):
+                            m.d.comb += [
+                                queue.phy_addr.eq(self.phy_addr),
+                                queue.op.eq(OP_READ),
+                                queue.reg_addr.eq(addr),
+                                queue.tag.eq(idx),
+                                queue.req_valid.eq(1),
+                            ]
+                            m.d.sync += [
+                                timers[idx].eq(periods[idx]),
+                                int_pending[idx].eq(0),
+                            ]
+                    with m.Elif(self.mdio_req_valid):
+                        m.d.comb += [
+                            queue.phy_addr.eq(self.mdio_phy_addr),
+                            queue.op.eq(self.mdio_op),
+                            queue.reg_addr.eq(self.mdio_reg_addr),
+                            queue.devad.eq(self.mdio_devad),
+                            queue.write_data.eq(self.mdio_write_data),
+                            queue.tag.eq(host_tag),
+                            queue.req_valid.eq(1),
                         ]
-                        m.next = next_state
 
         return m
 
@@ -350,9 +1211,11 @@ def test_phy_manager():
     mdc = Signal()
     mdio = Pin(1, 'io')
     phy_rst = Signal()
+    phy_int = Signal(reset=1)
 
     # Specify a fake 10MHz clock frequency to reduce number of simulation steps
-    phy_manager = PHYManager(10e6, 0, phy_rst, mdio, mdc)
+    phy_manager = PHYManager(10e6, 0, phy_rst, mdio, mdc, phy_int=phy_int,
+                             int_status_reg=0x1D)
 
     def testbench():
         # 1ms is 10000 ticks, so check we're still asserting phy_rst
@@ -373,29 +1236,265 @@ def test_phy_manager():
 
         assert (yield phy_manager.link_up) == 0
 
-        # Wait for the register read to synchronise to MDIO
-        while True:
-            if (yield phy_manager.mdio_mod.mdio.o) == 1:
-                break
-            yield
+        def read_register(bits):
+            # Wait for the register read to synchronise to MDIO
+            while True:
+                if (yield phy_manager.mdio_mod.mdio.o) == 1:
+                    break
+                yield
+
+            # Clock through register read, setting requested bits
+            for clk in range(260):
+                if clk in [194 + 4*(14 - bit) for bit in bits]:
+                    yield (phy_manager.mdio_mod.mdio.i.eq(1))
+                else:
+                    yield (phy_manager.mdio_mod.mdio.i.eq(0))
+                yield
 
-        # Clock through BSR register read, setting bits 14, 5, 2
-        for clk in range(260):
-            if clk in (194, 230, 242):
-                yield (phy_manager.mdio_mod.mdio.i.eq(1))
-            else:
-                yield (phy_manager.mdio_mod.mdio.i.eq(0))
-            yield
+        # Read BSR with bits 14, 5, 2 set, then ANAR advertising 100Mbps
+        # and 10Mbps full duplex, and ANLPAR advertising 10Mbps full duplex
+        yield from read_register((14, 5, 2))
+        yield from read_register((8, 6, 0))
+        yield from read_register((6, 0))
 
         # Finish register reads
         for _ in range(100):
             yield
 
-        # Check link_up becomes 1
+        # Check link_up becomes 1 at 10Mbps
+        assert (yield phy_manager.link_up) == 1
+        assert (yield phy_manager.speed_10) == 1
+
+        # Check the polled BSR is in the register shadow
+        yield (phy_manager.shadow_sel.eq(0))
+        yield
+        yield
+        assert (yield phy_manager.shadow_data) == 0x4024
+
+        # Queue a host read, which runs before the next poll is due
+        yield (phy_manager.mdio_op.eq(OP_READ))
+        yield (phy_manager.mdio_reg_addr.eq(0x02))
+        yield (phy_manager.mdio_req_valid.eq(1))
+        yield
+        yield (phy_manager.mdio_req_valid.eq(0))
+        yield from read_register((13, 9, 1))
+        assert (yield phy_manager.mdio_resp_data) == 0x2202
+
+        # A PHY interrupt takes the link down until BSR and the interrupt
+        # status register have been read
+        yield (phy_int.eq(0))
+        for _ in range(4):
+            yield
+        assert (yield phy_manager.link_up) == 0
+        yield from read_register((14, 5, 2))
+        yield (phy_int.eq(1))
+        assert (yield phy_manager.link_up) == 0
+        yield from read_register((4,))
+        for _ in range(10):
+            yield
         assert (yield phy_manager.link_up) == 1
+        yield (phy_manager.shadow_sel.eq(3))
+        yield
+        yield
+        assert (yield phy_manager.shadow_data) == 0x0010
 
     vcdf = open("phy_manager.vcd", "w")
     with pysim.Simulator(phy_manager, vcd_file=vcdf) as sim:
         sim.add_clock(1e-6)
         sim.add_sync_process(testbench())
         sim.run()
+
+
+def test_mac_loopback():
+    import random
+    from types import SimpleNamespace
+    from nmigen.back import pysim
+    from nmigen.back.pysim import Delay, Passive
+    from nmigen.lib.io import Pin
+
+    pins = SimpleNamespace(
+        ref_clk=Signal(), crs_dv=Signal(), rxd0=Signal(), rxd1=Signal(),
+        txen=Signal(), txd0=Signal(), txd1=Signal())
+    mdio = SimpleNamespace(mdio=Pin(1, "io"), mdc=Signal())
+    mac = MAC(100e6, 0, "02:44:4E:30:76:9E", pins, mdio, Signal(), Signal(),
+              loopback=True)
+
+    # The reference clock is driven from a pin, offset from the sync clock
+    def ref_clk():
+        yield Passive()
+        yield Delay(3e-9)
+        while True:
+            yield Delay(10e-9)
+            yield pins.ref_clk.eq(~pins.ref_clk)
+
+    def testbench():
+        for mode, offset, fcs in ((LOOPBACK_PHY, 0, 4),
+                                  (LOOPBACK_DESC, 64, 0)):
+            frame = [0xFF]*6 + [random.randint(0, 255) for _ in range(54)]
+            for idx, byte in enumerate(frame):
+                yield mac.tx_mem[offset + idx].eq(byte)
+            yield mac.loopback_mode.eq(mode)
+            for _ in range(10):
+                yield
+
+            yield mac.tx_offset.eq(offset)
+            yield mac.tx_len.eq(len(frame))
+            yield mac.tx_start.eq(1)
+            yield
+            yield mac.tx_start.eq(0)
+
+            # The frame must be received without reaching the PHY
+            for _ in range(2000):
+                yield
+                assert not (yield pins.txen)
+                if (yield mac.rx_valid):
+                    break
+            assert (yield mac.rx_valid)
+            assert (yield mac.rx_len) == len(frame) + fcs
+            rx_offset = (yield mac.rx_offset)
+            for idx, byte in enumerate(frame):
+                assert (yield mac.rx_mem[rx_offset + idx]) == byte
+            yield mac.rx_ack.eq(1)
+            yield
+            yield mac.rx_ack.eq(0)
+            for _ in range(10):
+                yield
+            assert not (yield mac.rx_valid)
+            assert (yield mac.tx_fifo_level) == 0
+
+    vcdf = open("mac_loopback.vcd", "w")
+    with pysim.Simulator(mac, vcd_file=vcdf) as sim:
+        sim.add_clock(1/100e6)
+        sim.add_process(ref_clk())
+        sim.add_sync_process(testbench())
+        sim.run()
+
+
+def test_mac_rx_hold():
+    import random
+    from types import SimpleNamespace
+    from nmigen.back import pysim
+    from nmigen.back.pysim import Delay, Passive
+    from nmigen.lib.io import Pin
+    from .crc import make_crc32_table
+
+    pins = SimpleNamespace(
+        rx_clk=Signal(), tx_clk=Signal(), rx_dv=Signal(), rxd=Signal(4),
+        tx_en=Signal(), txd=Signal(4))
+    mdio = SimpleNamespace(mdio=Pin(1, "io"), mdc=Signal())
+    mac = MAC(100e6, 0, "02:44:4E:30:76:9E", pins, mdio, Signal(), Signal(),
+              rx_buf_size=128, shared_buffer=True, link_down_flush=False,
+              interface="mii")
+
+    def make_frame(n):
+        data = [0xFF]*6 + [random.randint(0, 255) for _ in range(n - 10)]
+        table = make_crc32_table()
+        crc = 0xFFFFFFFF
+        for byte in data:
+            crc = table[(crc & 0xFF) ^ byte] ^ (crc >> 8)
+        crc ^= 0xFFFFFFFF
+        return data + [(crc >> (8*x)) & 0xFF for x in range(4)]
+
+    # Four frames, more than fill RX memory
+    frames = [make_frame(64) for _ in range(4)]
+    rx_done = []
+
+    # The PHY clocks are driven from pins, offset from the sync clock
+    def phy_clk():
+        yield Passive()
+        yield Delay(3e-9)
+        while True:
+            yield Delay(20e-9)
+            yield pins.rx_clk.eq(~pins.rx_clk)
+            yield pins.tx_clk.eq(~pins.tx_clk)
+
+    def rx_testbench():
+        for frame in frames:
+            yield pins.rx_dv.eq(1)
+            for byte in [0x55]*7 + [0xD5] + frame:
+                for shift in (0, 4):
+                    yield pins.rxd.eq(byte >> shift)
+                    yield
+            yield pins.rx_dv.eq(0)
+            for _ in range(50):
+                yield
+        rx_done.append(True)
+
+    def testbench():
+        # Reply in place to the first frame. The link is down and packets
+        # are held, so the reply is not transmitted, and the frame is not
+        # acknowledged.
+        for _ in range(2000):
+            if (yield mac.rx_valid):
+                break
+            yield
+        assert (yield mac.rx_valid)
+        rx_offset = (yield mac.rx_offset)
+        yield mac.tx_offset.eq(0)
+        yield mac.tx_len.eq(64)
+        yield mac.tx_split.eq(8)
+        yield mac.tx_rx_offset.eq(rx_offset)
+        yield mac.tx_start.eq(1)
+        yield
+        yield mac.tx_start.eq(0)
+
+        # Later frames fill the rest of RX memory, and are then dropped
+        # rather than overwrite the first frame.
+        for _ in range(10000):
+            if rx_done:
+                break
+            assert not (yield mac.tx_done)
+            yield
+        assert rx_done
+        for _ in range(10):
+            yield
+        assert (yield mac.tx_fifo_level) == 1
+        assert (yield mac.rx_fifo_level) == 2
+        assert (yield mac.rx_dropped) == 2
+        for idx, byte in enumerate(frames[0]):
+            assert (yield mac.rx_mem[(rx_offset + idx) % 128]) == byte
+
+    vcdf = open("mac_rx_hold.vcd", "w")
+    with pysim.Simulator(mac, vcd_file=vcdf) as sim:
+        sim.add_clock(1/100e6)
+        sim.add_process(phy_clk())
+        sim.add_sync_process(rx_testbench(), domain="phy_rx")
+        sim.add_sync_process(testbench())
+        sim.run()
+
+
+def test_counter_sync():
+    from nmigen.back import pysim
+
+    assert _fifo_depth(2048) == 32
+    assert _fifo_depth(2000) == 32
+    assert _fifo_depth(64) == 2
+
+    counter = _CounterSync(4, "rmii")
+
+    def rmii_testbench():
+        # Count past the width of the counter to check it wraps
+        for _ in range(21):
+            yield counter.inc.eq(1)
+            yield
+            yield counter.inc.eq(0)
+            yield
+            yield
+
+    def sync_testbench():
+        last = 0
+        for _ in range(200):
+            # The count must only ever step forwards by at most one
+            count = (yield counter.count)
+            assert (count - last) % 16 in (0, 1)
+            last = count
+            yield
+        assert (yield counter.count) == 21 % 16
+
+    vcdf = open("counter_sync.vcd", "w")
+    with pysim.Simulator(counter, vcd_file=vcdf) as sim:
+        sim.add_clock(1/100e6)
+        sim.add_clock(1/50e6, phase=3e-9, domain="rmii")
+        sim.add_sync_process(rmii_testbench(), domain="rmii")
+        sim.add_sync_process(sync_testbench())
+        sim.run()
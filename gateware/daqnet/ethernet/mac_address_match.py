@@ -8,49 +8,95 @@ Released under the MIT license; see LICENSE for details.
 import operator
 from functools import reduce
 
-from nmigen import Elaboratable, Module, Signal
+from nmigen import Elaboratable, Module, Signal, Cat
+from .crc import make_crc32_table
 
 
 class MACAddressMatch(Elaboratable):
     """
     MAC Address Matcher
 
+    Accepts frames sent to our own MAC address, the broadcast address, any
+    address in a table of `table_size` addresses, or any multicast address
+    whose hash is enabled in `hash_filter`.
+
+    The hash of an address is the top six bits of its Ethernet CRC, without
+    the final complement, as computed by `multicast_hash()`. As the CRC of
+    the destination address is the start of the frame check sequence, it
+    is taken from the receiver's CRC32 module rather than recomputed.
+
     Parameters:
         * `mac_addr`: 6-byte MAC address (list of ints)
+        * `table_size`: Number of addresses in the exact-match table
+        * `crc_latency`: Number of clocks after `data_valid` before `crc`
+                         includes that byte, see `CRC32.latency`
 
     Inputs:
         * `reset`: Restart address matching
         * `data`: 8-bit input data
         * `data_valid`: Pulsed high when new data is ready at `data`.
+        * `crc`: `crc_out` of a CRC32 module reset and fed with the same
+                 data as this module
+        * `hash_filter`: 64-bit mask of multicast address hashes to accept
+        * `table`: List of `table_size` 48-bit addresses to accept, with
+                   the first byte transmitted in the most significant bits
+        * `table_valid`: `table_size`-bit mask of valid `table` entries
 
     Outputs:
         * `mac_match`: High if destination MAC address matches or is broadcast.
                        Remains high until `reset` is asserted.
+        * `done`: High once all six address bytes have been received and
+                  `mac_match` is valid. Remains high until `reset` is
+                  asserted.
     """
-    def __init__(self, mac_addr):
+    def __init__(self, mac_addr, table_size=0, crc_latency=2):
         # Inputs
         self.reset = Signal()
         self.data = Signal(8)
         self.data_valid = Signal()
+        self.crc = Signal(32)
+        self.hash_filter = Signal(64)
+        self.table = [Signal(48, name=f"table{idx}")
+                      for idx in range(table_size)]
+        self.table_valid = Signal(table_size)
 
         # Outputs
         self.mac_match = Signal()
+        self.done = Signal()
 
         # Parameters
         self.mac_addr = mac_addr
+        self.table_size = table_size
+        self.crc_latency = crc_latency
 
     def elaborate(self, platform):
         m = Module()
         mac = [Signal(8) for _ in range(6)]
+        mac_cat = Cat(*mac[::-1])
+
+        # Address hash, latched once the CRC has processed the last byte
+        hash_match = Signal()
+        hash_ctr = Signal(2)
+        multicast = mac[0][0]
+        hash_idx = (~self.crc)[26:32]
 
-        m.d.sync += self.mac_match.eq(
-            reduce(operator.and_,
-                   [(mac[idx] == self.mac_addr[idx]) | (mac[idx] == 0xFF)
-                    for idx in range(6)]))
+        match = reduce(operator.and_,
+                       [(mac[idx] == self.mac_addr[idx]) | (mac[idx] == 0xFF)
+                        for idx in range(6)])
+        for idx in range(self.table_size):
+            match |= self.table_valid[idx] & (mac_cat == self.table[idx])
+        match |= hash_match
+
+        m.d.sync += self.mac_match.eq(match)
+
+        with m.FSM() as fsm:
+            m.d.sync += self.done.eq(
+                fsm.ongoing("DONE") & (hash_ctr == self.crc_latency) &
+                ~self.reset)
 
-        with m.FSM():
             with m.State("RESET"):
                 m.d.sync += [mac[idx].eq(0) for idx in range(6)]
+                m.d.sync += hash_match.eq(0), hash_ctr.eq(0)
                 with m.If(~self.reset):
                     m.next = "BYTE0"
 
@@ -64,13 +110,31 @@ class MACAddressMatch(Elaboratable):
                     with m.Elif(self.data_valid):
                         m.next = next_state
 
+            # Wait for the CRC to process the last address byte
             with m.State("DONE"):
+                with m.If(hash_ctr != self.crc_latency):
+                    m.d.sync += hash_ctr.eq(hash_ctr + 1)
+                with m.If(hash_ctr == self.crc_latency - 1):
+                    m.d.sync += hash_match.eq(
+                        multicast & (self.hash_filter >> hash_idx)[0])
                 with m.If(self.reset):
                     m.next = "RESET"
 
         return m
 
 
+def multicast_hash(mac_addr):
+    """
+    Returns the index of the bit in `hash_filter` which accepts `mac_addr`,
+    given in standard XX:XX:XX:XX:XX:XX format.
+    """
+    table = make_crc32_table()
+    crc = 0xFFFFFFFF
+    for byte in [int(x, 16) for x in mac_addr.split(":")]:
+        crc = table[(crc & 0xFF) ^ byte] ^ (crc >> 8)
+    return crc >> 26
+
+
 def test_mac_address_match():
     import random
     from nmigen.back import pysim
@@ -150,6 +214,7 @@ def test_mac_address_match():
             yield
 
         assert (yield mac_matcher.mac_match) == 0
+        assert (yield mac_matcher.done) == 1
 
         yield (reset.eq(1))
         yield
@@ -161,3 +226,60 @@ def test_mac_address_match():
         sim.add_clock(1e-6)
         sim.add_sync_process(testbench())
         sim.run()
+
+
+def test_mac_address_match_multicast():
+    from nmigen.back import pysim
+    from .crc import CRC32
+
+    mac_address = [0x01, 0x23, 0x45, 0x67, 0x89, 0xAB]
+    mac_matcher = MACAddressMatch(mac_address, table_size=2)
+    crc = CRC32()
+
+    m = Module()
+    m.submodules += mac_matcher, crc
+    m.d.comb += [
+        crc.data.eq(mac_matcher.data),
+        crc.data_valid.eq(mac_matcher.data_valid),
+        crc.reset.eq(mac_matcher.reset),
+        mac_matcher.crc.eq(crc.crc_out),
+    ]
+
+    mdns = "01:00:5E:00:00:FB"
+    other = "01:00:5E:00:00:01"
+    assert multicast_hash(mdns) != multicast_hash(other)
+
+    def testbench():
+        yield (mac_matcher.hash_filter.eq(1 << multicast_hash(mdns)))
+        yield (mac_matcher.table[0].eq(0x020000000007))
+        yield (mac_matcher.table[1].eq(0x01005E000001))
+        yield (mac_matcher.table_valid.eq(0b01))
+
+        for addr, match in (
+            (mdns, 1),
+            (other, 0),
+            ("02:00:00:00:00:07", 1),
+            ("02:00:00:00:00:08", 0),
+        ):
+            yield (mac_matcher.reset.eq(1))
+            for _ in range(4):
+                yield
+            yield (mac_matcher.reset.eq(0))
+            yield
+
+            for byte in [int(x, 16) for x in addr.split(":")] + [0]*10:
+                yield (mac_matcher.data.eq(byte))
+                yield (mac_matcher.data_valid.eq(1))
+                yield
+                yield (mac_matcher.data_valid.eq(0))
+                for _ in range(3):
+                    yield
+
+            assert (yield mac_matcher.done) == 1
+            assert (yield mac_matcher.mac_match) == match
+
+    vcdf = open("mac_matcher_multicast.vcd", "w")
+    with pysim.Simulator(m, vcd_file=vcdf) as sim:
+        sim.add_clock(1e-6)
+        sim.add_sync_process(testbench())
+        sim.run()
@@ -5,7 +5,19 @@ Copyright 2018-2019 Adam Greig
 Released under the MIT license; see LICENSE for details.
 """
 
-from nmigen import Elaboratable, Module, Signal, Array
+from nmigen import Elaboratable, Module, Signal, Array, Mux, Cat
+from nmigen.lib.fifo import SyncFIFO
+
+
+# MDIOQueue operations
+OP_READ = 0
+OP_WRITE = 1
+OP_MMD_READ = 2
+OP_MMD_WRITE = 3
+
+# Clause 22 registers used for indirect access to clause 45 MMD registers
+MMD_CTRL = 0x0D
+MMD_DATA = 0x0E
 
 
 class MDIO(Elaboratable):
@@ -15,7 +27,9 @@ class MDIO(Elaboratable):
     Reads/writes MDIO registers on an attached PHY.
 
     Parameters:
-        * `clk_div`: divider from controller clock to MDC (aim for ~2.5MHz)
+        * `clk_div`: divider from controller clock to MDC, at least 2. The
+                     standard MDC limit is 2.5MHz, but many PHYs accept
+                     faster clocks.
 
     Pins:
         * `mdio`: MDIO pin (data in/out)
@@ -27,6 +41,9 @@ class MDIO(Elaboratable):
         * `rw`: select read (0) or write (1) operation
         * `write_data`: 16-bit data to write
         * `start`: operation begins on rising edge of `start`
+        * `suppress_preamble`: send a single preamble bit instead of 32,
+                               only for PHYs which accept suppressed
+                               preambles (BSR bit 6)
 
     Outputs:
         * `read_data`: 16-bit data read from register, valid once busy is 0
@@ -39,12 +56,15 @@ class MDIO(Elaboratable):
         self.rw = Signal()
         self.write_data = Signal(16)
         self.start = Signal()
+        self.suppress_preamble = Signal()
 
         # Outputs
         self.read_data = Signal(16)
         self.busy = Signal()
 
         # Parameters
+        if clk_div < 2:
+            raise ValueError("MDIO clk_div must be at least 2")
         self.clk_div = clk_div
 
         # Pins
@@ -123,11 +143,15 @@ class MDIO(Elaboratable):
                 ]
 
                 with m.If(mdc_fall):
-                    m.d.sync += bit_counter.eq(32)
+                    with m.If(self.suppress_preamble):
+                        m.d.sync += bit_counter.eq(1)
+                    with m.Else():
+                        m.d.sync += bit_counter.eq(32)
                     m.next = "PRE_32"
 
             # PRE_32
-            # Preamble field: 32 bits of 1
+            # Preamble field: 32 bits of 1, or a single idle bit of 1 when
+            # the preamble is suppressed
             with m.State("PRE_32"):
                 m.d.comb += [
                     self.mdc.eq(mdc_int),
@@ -294,6 +318,134 @@ class MDIO(Elaboratable):
         return m
 
 
+class MDIOQueue(Elaboratable):
+    """
+    MDIO transaction queue.
+
+    Queues register reads and writes for an `MDIO` controller and runs them
+    in order. Operations are either direct clause 22 register accesses, or
+    indirect accesses to clause 45 MMD registers through the clause 22 MMD
+    access control and data registers.
+
+    Each request carries a tag which is returned with its response, so that
+    several requesters may share the queue.
+
+    Parameters:
+        * `mdio`: `MDIO` controller to run transactions on
+        * `depth`: Number of requests which may be queued
+        * `tag_bits`: Width of request tags
+
+    Inputs:
+        * `phy_addr`: 5-bit PHY address
+        * `op`: 2-bit operation: OP_READ, OP_WRITE, OP_MMD_READ, or
+                OP_MMD_WRITE
+        * `reg_addr`: 16-bit register address, of which only the bottom five
+                      bits are used for clause 22 operations
+        * `devad`: 5-bit MMD device address, for clause 45 operations
+        * `write_data`: 16-bit data to write
+        * `tag`: `tag_bits`-bit tag returned with the response
+        * `req_valid`: Assert to queue a request when `req_ready` is high
+
+    Outputs:
+        * `req_ready`: High while a request may be queued
+        * `resp_valid`: Pulsed high when a request has completed
+        * `resp_data`: 16-bit data read by a completed read request
+        * `resp_tag`: Tag of the completed request
+        * `busy`: High while any request is queued or running
+    """
+    def __init__(self, mdio, depth=4, tag_bits=4):
+        # Inputs
+        self.phy_addr = Signal(5)
+        self.op = Signal(2)
+        self.reg_addr = Signal(16)
+        self.devad = Signal(5)
+        self.write_data = Signal(16)
+        self.tag = Signal(tag_bits)
+        self.req_valid = Signal()
+
+        # Outputs
+        self.req_ready = Signal()
+        self.resp_valid = Signal()
+        self.resp_data = Signal(16)
+        self.resp_tag = Signal(tag_bits)
+        self.busy = Signal()
+
+        self.mdio = mdio
+        self.depth = depth
+
+    def elaborate(self, platform):
+        m = Module()
+        mdio = self.mdio
+
+        request = Cat(self.phy_addr, self.op, self.reg_addr, self.devad,
+                      self.write_data, self.tag)
+        m.submodules.fifo = fifo = SyncFIFO(width=len(request),
+                                            depth=self.depth)
+
+        # Current request
+        phy_addr = Signal.like(self.phy_addr)
+        op = Signal.like(self.op)
+        reg_addr = Signal.like(self.reg_addr)
+        devad = Signal.like(self.devad)
+        write_data = Signal.like(self.write_data)
+        tag = Signal.like(self.tag)
+        mmd = op[1]
+
+        # Clause 45 operations take four clause 22 transactions: select the
+        # MMD, write its register address, select the MMD's data without
+        # post-increment, and then read or write the data. Clause 22
+        # operations only run the final step.
+        step = Signal(2)
+        last_step = Signal()
+        m.d.comb += last_step.eq(step == 3)
+        setup_reg = Mux(step == 1, MMD_DATA, MMD_CTRL)
+        setup_data = Array([devad, reg_addr, devad | 0x4000])
+
+        m.d.comb += [
+            fifo.din.eq(request),
+            fifo.we.eq(self.req_valid),
+            self.req_ready.eq(fifo.writable),
+            self.resp_data.eq(mdio.read_data),
+            self.resp_tag.eq(tag),
+            mdio.phy_addr.eq(phy_addr),
+            mdio.reg_addr.eq(Mux(last_step,
+                                 Mux(mmd, MMD_DATA, reg_addr[:5]),
+                                 setup_reg)),
+            mdio.rw.eq(Mux(last_step, op[0], 1)),
+            mdio.write_data.eq(Mux(last_step, write_data, setup_data[step])),
+        ]
+
+        with m.FSM() as fsm:
+            m.d.comb += self.busy.eq(fifo.readable | ~fsm.ongoing("IDLE"))
+
+            with m.State("IDLE"):
+                with m.If(fifo.readable):
+                    m.d.comb += fifo.re.eq(1)
+                    m.d.sync += Cat(phy_addr, op, reg_addr, devad,
+                                    write_data, tag).eq(fifo.dout)
+                    m.next = "SETUP"
+
+            with m.State("SETUP"):
+                m.d.sync += step.eq(Mux(mmd, 0, 3))
+                m.next = "START"
+
+            with m.State("START"):
+                m.d.comb += mdio.start.eq(1)
+                with m.If(mdio.busy):
+                    m.next = "WAIT"
+
+            with m.State("WAIT"):
+                with m.If(~mdio.busy):
+                    with m.If(last_step):
+                        m.d.comb += self.resp_valid.eq(1)
+                        m.next = "IDLE"
+                    with m.Else():
+                        m.d.sync += step.eq(step + 1)
+                        m.next = "START"
+
+        return m
+
+
 def test_mdio_read():
     import random
     from nmigen.lib.io import Pin
@@ -456,3 +608,125 @@ def test_mdio_write():
         sim.add_clock(1e-6)
         sim.add_sync_process(testbench())
         sim.run()
+
+
+def test_mdio_queue():
+    from nmigen.lib.io import Pin
+    from nmigen.back import pysim
+
+    mdc = Signal()
+    mdio_pin = Pin(1, 'io')
+    mdio = MDIO(4, mdio_pin, mdc)
+    queue = MDIOQueue(mdio)
+
+    read_value = 0xBEEF
+
+    def testbench():
+        for _ in range(10):
+            yield
+
+        # Queue a clause 22 read and a clause 45 write
+        for op, reg_addr, devad, data, tag in (
+            (OP_READ, 0x02, 0, 0, 1),
+            (OP_MMD_WRITE, 0x3C, 0x07, 0x1234, 2),
+        ):
+            yield (queue.phy_addr.eq(3))
+            yield (queue.op.eq(op))
+            yield (queue.reg_addr.eq(reg_addr))
+            yield (queue.devad.eq(devad))
+            yield (queue.write_data.eq(data))
+            yield (queue.tag.eq(tag))
+            yield (queue.req_valid.eq(1))
+            yield
+        yield (queue.req_valid.eq(0))
+
+        # Clock through all transactions, recording each frame's bits
+        frames = []
+        responses = []
+        last_busy = 0
+        last_mdc = (yield mdc)
+        while len(responses) < 2:
+            yield
+            if (yield queue.resp_valid):
+                responses.append(((yield queue.resp_tag),
+                                  (yield queue.resp_data)))
+            new_busy = (yield mdio.busy)
+            if new_busy and not last_busy:
+                frames.append([])
+            last_busy = new_busy
+            new_mdc = (yield mdc)
+            if new_mdc and last_mdc == 0:
+                frames[-1].append((yield mdio.mdio.o))
+                bit = len(frames[-1]) - 48
+                if len(frames) == 1 and 0 <= bit < 16:
+                    yield (mdio.mdio.i.eq((read_value >> (15 - bit)) & 1))
+            last_mdc = new_mdc
+
+        def bits(x, n):
+            return [int(b) for b in f"{x:0{n}b}"]
+
+        def frame(op, reg_addr, data):
+            return ([1]*32 + [0, 1] + op + bits(3, 5) + bits(reg_addr, 5)
+                    + [1, 0] + bits(data, 16))
+
+        assert len(frames) == 5
+        assert frames[0][:46] == frame([1, 0], 0x02, 0)[:46]
+        assert frames[1][:64] == frame([0, 1], MMD_CTRL, 0x0007)
+        assert frames[2][:64] == frame([0, 1], MMD_DATA, 0x003C)
+        assert frames[3][:64] == frame([0, 1], MMD_CTRL, 0x4007)
+        assert frames[4][:64] == frame([0, 1], MMD_DATA, 0x1234)
+        assert responses[0] == (1, read_value)
+        assert responses[1][0] == 2
+        yield
+        assert not (yield queue.busy)
+
+    mod = Module()
+    mod.submodules += mdio, queue
+    vcdf = open("mdio_queue.vcd", "w")
+    with pysim.Simulator(mod, vcd_file=vcdf) as sim:
+        sim.add_clock(1e-6)
+        sim.add_sync_process(testbench())
+        sim.run()
+
+
+def test_mdio_suppress_preamble():
+    from nmigen.lib.io import Pin
+    from nmigen.back import pysim
+
+    mdc = Signal()
+    mdio_pin = Pin(1, 'io')
+    mdio = MDIO(2, mdio_pin, mdc)
+
+    def testbench():
+        for _ in range(10):
+            yield
+
+        # Write with a suppressed preamble at the fastest MDC
+        yield (mdio.phy_addr.eq(1))
+        yield (mdio.reg_addr.eq(0x1F))
+        yield (mdio.write_data.eq(0xA5C3))
+        yield (mdio.rw.eq(1))
+        yield (mdio.suppress_preamble.eq(1))
+        yield (mdio.start.eq(1))
+        yield
+        yield (mdio.start.eq(0))
+
+        obits = []
+        last_mdc = (yield mdc)
+        while len(obits) < 33:
+            yield
+            new_mdc = (yield mdc)
+            if new_mdc and last_mdc == 0:
+                obits.append((yield mdio.mdio.o))
+            last_mdc = new_mdc
+
+        expected = ([1] + [0, 1] + [0, 1] + [0, 0, 0, 0, 1]
+                    + [1, 1, 1, 1, 1] + [1, 0]
+                    + [int(x) for x in f"{0xA5C3:016b}"])
+        assert obits == expected
+
+    vcdf = open("mdio_suppress_preamble.vcd", "w")
+    with pysim.Simulator(mdio, vcd_file=vcdf) as sim:
+        sim.add_clock(1e-6)
+        sim.add_sync_process(testbench())
+        sim.run()
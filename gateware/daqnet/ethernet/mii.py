@@ -0,0 +1,362 @@
+"""
+Ethernet MII and GMII Interface
+
+Copyright 2018-2019 Adam Greig
+Released under the MIT license; see LICENSE for details.
+"""
+
+from nmigen import Elaboratable, Module, Signal, Cat
+from .rmii import RMIIRx, RMIITx
+
+
+class MIIRx(RMIIRx):
+    """
+    MII/GMII receive module
+
+    As `RMIIRx`, but receives from an MII PHY four bits at a time or a GMII
+    PHY eight bits at a time, set by the width of `rxd`.
+
+    This module must be run in the PHY's receive clock domain, and the
+    memory port and inputs and outputs must also be in that clock domain.
+
+    Pins:
+        * `rx_dv`: MII/GMII receive data valid
+        * `rxd`: MII/GMII receive data, 4 or 8 bits wide
+
+    See `RMIIRx` for the parameters, ports, inputs and outputs.
+    """
+    def __init__(self, mac_addr, write_port, rx_dv, rxd, *args, **kwargs):
+        super().__init__(mac_addr, write_port, None, None, None,
+                         *args, **kwargs)
+        self.rx_dv = rx_dv
+        self.rxd = rxd
+
+        # GMII receives a byte every cycle, too fast for a lookup table CRC
+        self.crc_table = len(rxd) < 8
+
+    def _rx_byte(self, m):
+        return MIIRxByte(self.rx_dv, self.rxd)
+
+
+class MIITx(RMIITx):
+    """
+    MII/GMII transmit module
+
+    As `RMIITx`, but transmits to an MII PHY four bits at a time or a GMII
+    PHY eight bits at a time, set by the width of `txd`.
+
+    This module must be run in the PHY's transmit clock domain, and the
+    memory port and inputs and outputs must also be in that clock domain.
+
+    Pins:
+        * `tx_en`: MII/GMII transmit enable
+        * `txd`: MII/GMII transmit data, 4 or 8 bits wide
+
+    See `RMIITx` for the parameters, ports, inputs and outputs.
+    """
+    def __init__(self, read_port, tx_en, txd, *args, **kwargs):
+        super().__init__(read_port, None, None, None, *args, **kwargs)
+        self.tx_en = tx_en
+        self.txd = txd
+        self.ipg_cycles = 96 // len(txd)
+
+        # GMII transmits a byte every cycle, too fast for a lookup table CRC
+        self.crc_table = len(txd) < 8
+
+    def _tx_byte(self, m):
+        return MIITxByte(self.tx_en, self.txd)
+
+
+class MIIRxByte(Elaboratable):
+    """
+    MII/GMII Receive Byte De-muxer
+
+    Handles receiving a byte nibble-by-nibble from MII, or byte-by-byte
+    from GMII.
+
+    This submodule must be in the PHY's receive clock domain,
+    and its outputs are likewise in that domain.
+
+    Pins:
+        * `rx_dv`: Receive data valid, input
+        * `rxd`: Receive data, 4 or 8 bits wide, input
+
+    Outputs:
+        * `data`: 8-bit wide output data
+        * `data_valid`: Asserted for one cycle when `data` is valid
+        * `dv`: Data valid, asserted from the preamble to the end of frame
+        * `align_error`: Asserted for one cycle when data valid ended
+                         partway through a byte
+    """
+    def __init__(self, rx_dv, rxd):
+        # Outputs
+        self.data = Signal(8)
+        self.data_valid = Signal()
+        self.dv = Signal()
+        self.align_error = Signal()
+
+        self.rx_dv = rx_dv
+        self.rxd = rxd
+
+    def elaborate(self, platform):
+        m = Module()
+
+        width = len(self.rxd)
+        units = 8 // width
+        preamble = 0x55 >> (8 - width)
+        sfd = 0xD5 >> (8 - width)
+
+        # Sample MII signals on rising edge of receive clock
+        rx_dv_reg = Signal()
+        rxd_reg = Signal(width)
+        m.d.sync += [
+            rx_dv_reg.eq(self.rx_dv),
+            rxd_reg.eq(self.rxd),
+        ]
+
+        # Index of the next nibble in the current byte
+        unit = Signal(max=units)
+        m.d.sync += self.data_valid.eq(0)
+
+        with m.FSM() as fsm:
+            m.d.comb += self.align_error.eq(
+                fsm.ongoing("DATA") & ~rx_dv_reg & (unit != 0))
+
+            with m.State("IDLE"):
+                m.d.sync += self.dv.eq(0)
+                with m.If(rx_dv_reg & (rxd_reg == preamble)):
+                    m.d.sync += self.dv.eq(1)
+                    m.next = "PREAMBLE_SFD"
+
+            with m.State("PREAMBLE_SFD"):
+                m.d.sync += unit.eq(0)
+                with m.If(~rx_dv_reg):
+                    m.d.sync += self.dv.eq(0)
+                    m.next = "IDLE"
+                with m.Elif(rxd_reg == sfd):
+                    m.next = "DATA"
+                with m.Elif(rxd_reg != preamble):
+                    m.d.sync += self.dv.eq(0)
+                    m.next = "IDLE"
+
+            with m.State("DATA"):
+                with m.If(rx_dv_reg):
+                    m.d.sync += self.data.eq(Cat(self.data[width:], rxd_reg))
+                    with m.If(unit == units - 1):
+                        m.d.sync += [
+                            unit.eq(0),
+                            self.data_valid.eq(1),
+                        ]
+                    with m.Else():
+                        m.d.sync += unit.eq(unit + 1)
+                with m.Else():
+                    m.d.sync += self.dv.eq(0)
+                    m.next = "IDLE"
+
+        return m
+
+
+class MIITxByte(Elaboratable):
+    """
+    MII/GMII Transmit Byte Muxer
+
+    Handles transmitting a byte nibble-by-nibble to MII, or byte-by-byte
+    to GMII.
+
+    This submodule must be in the PHY's transmit clock domain,
+    and its inputs and outputs are likewise in that domain.
+
+    Pins:
+        * `tx_en`: Transmit enable
+        * `txd`: Transmit data, 4 or 8 bits wide
+
+    Inputs:
+        * `data`: 8-bit wide data to transmit. Latched internally so you may
+          update it to the next word after asserting `data_valid`.
+        * `data_valid`: Assert while valid data is present at `data`.
+
+    Outputs:
+        * `ready`: Asserted when ready to receive new data. This is asserted
+                   while the final nibble is being transmitted so that new
+                   data can be produced on the next clock cycle.
+    """
+    def __init__(self, tx_en, txd):
+        # Inputs
+        self.data = Signal(8)
+        self.data_valid = Signal()
+
+        # Outputs
+        self.ready = Signal()
+
+        self.tx_en = tx_en
+        self.txd = txd
+
+    def elaborate(self, platform):
+        m = Module()
+
+        width = len(self.txd)
+        units = 8 // width
+
+        # Register input data on the data_valid signal, shifting it out
+        # one nibble at a time
+        data_reg = Signal(8)
+        unit = Signal(max=units)
+
+        with m.FSM() as fsm:
+            m.d.comb += [
+                self.ready.eq(fsm.ongoing("IDLE") |
+                              (fsm.ongoing("DATA") & (unit == units - 1))),
+                self.tx_en.eq(fsm.ongoing("DATA")),
+            ]
+
+            with m.State("IDLE"):
+                m.d.comb += self.txd.eq(0)
+                m.d.sync += [
+                    data_reg.eq(self.data),
+                    unit.eq(0),
+                ]
+                with m.If(self.data_valid):
+                    m.next = "DATA"
+
+            with m.State("DATA"):
+                m.d.comb += self.txd.eq(data_reg[:width])
+                with m.If(unit == units - 1):
+                    m.d.sync += [
+                        data_reg.eq(self.data),
+                        unit.eq(0),
+                    ]
+                    with m.If(~self.data_valid):
+                        m.next = "IDLE"
+                with m.Else():
+                    m.d.sync += [
+                        data_reg.eq(data_reg[width:]),
+                        unit.eq(unit + 1),
+                    ]
+
+        return m
+
+
+def test_mii_rx():
+    import random
+    from nmigen.back import pysim
+    from nmigen import Memory
+    from .crc import make_crc32_table
+
+    def make_frame(n):
+        data = [0xFF]*6 + [random.randint(0, 255) for _ in range(n - 10)]
+        table = make_crc32_table()
+        crc = 0xFFFFFFFF
+        for byte in data:
+            crc = table[(crc & 0xFF) ^ byte] ^ (crc >> 8)
+        crc ^= 0xFFFFFFFF
+        return data + [(crc >> (8*x)) & 0xFF for x in range(4)]
+
+    for width in (4, 8):
+        rx_dv = Signal()
+        rxd = Signal(width)
+
+        mem = Memory(8, 128)
+        mem_port = mem.write_port()
+        mac_addr = [random.randint(0, 255) for _ in range(6)]
+
+        mii_rx = MIIRx(mac_addr, mem_port, rx_dv, rxd)
+
+        def testbench():
+            for _ in range(10):
+                yield
+
+            txbytes = make_frame(random.randint(64, 100))
+            frame = [0x55]*7 + [0xD5] + txbytes
+            rx_valid = False
+
+            yield (rx_dv.eq(1))
+            for byte in frame:
+                for shift in range(0, 8, width):
+                    yield (rxd.eq(byte >> shift))
+                    yield
+            yield (rx_dv.eq(0))
+
+            for _ in range(10):
+                yield
+                if (yield mii_rx.rx_valid):
+                    rx_valid = True
+                    assert (yield mii_rx.rx_len) == len(txbytes)
+                    assert (yield mii_rx.rx_offset) == 0
+
+            assert rx_valid
+            for idx, byte in enumerate(txbytes):
+                assert (yield mem[idx]) == byte
+
+        mod = Module()
+        mod.submodules += mii_rx, mem_port
+        vcdf = open(f"mii_rx_{width}.vcd", "w")
+        with pysim.Simulator(mod, vcd_file=vcdf) as sim:
+            sim.add_clock(1/125e6)
+            sim.add_sync_process(testbench())
+            sim.run()
+
+
+def test_mii_tx():
+    import random
+    from nmigen.back import pysim
+    from nmigen import Memory
+    from .crc import make_crc32_table
+
+    for width in (4, 8):
+        tx_en = Signal()
+        txd = Signal(width)
+
+        txbytes = [random.randint(0, 255) for _ in range(64)]
+        mem = Memory(8, 128, txbytes)
+        mem_port = mem.read_port()
+
+        mii_tx = MIITx(mem_port, tx_en, txd)
+
+        def testbench():
+            for _ in range(10):
+                yield
+
+            # Transmit the packet repeatedly
+            yield (mii_tx.tx_start.eq(1))
+            yield (mii_tx.tx_offset.eq(0))
+            yield (mii_tx.tx_len.eq(len(txbytes)))
+
+            while not (yield tx_en):
+                yield
+
+            units = []
+            while (yield tx_en):
+                units.append((yield txd))
+                yield
+
+            per_byte = 8 // width
+            rxbytes = []
+            for idx in range(0, len(units), per_byte):
+                byte = 0
+                for unit in range(per_byte):
+                    byte |= units[idx + unit] << (width * unit)
+                rxbytes.append(byte)
+
+            table = make_crc32_table()
+            crc = 0xFFFFFFFF
+            for byte in txbytes:
+                crc = table[(crc & 0xFF) ^ byte] ^ (crc >> 8)
+            crc ^= 0xFFFFFFFF
+            fcs = [(crc >> (8*x)) & 0xFF for x in range(4)]
+
+            assert rxbytes == [0x55]*7 + [0xD5] + txbytes + fcs
+
+            # Check the interpacket gap is 96 bit times
+            ipg = 0
+            while not (yield tx_en):
+                ipg += 1
+                yield
+            assert ipg * width == 96
+
+        mod = Module()
+        mod.submodules += mii_tx, mem_port
+        vcdf = open(f"mii_tx_{width}.vcd", "w")
+        with pysim.Simulator(mod, vcd_file=vcdf) as sim:
+            sim.add_clock(1/125e6)
+            sim.add_sync_process(testbench())
+            sim.run()
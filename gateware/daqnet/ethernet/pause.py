@@ -0,0 +1,140 @@
+"""
+Ethernet PAUSE Frame Detector
+
+Copyright 2018-2019 Adam Greig
+Released under the MIT license; see LICENSE for details.
+"""
+
+from nmigen import Elaboratable, Module, Signal
+
+
+# Reserved multicast destination address for PAUSE frames
+PAUSE_ADDR = [0x01, 0x80, 0xC2, 0x00, 0x00, 0x01]
+
+# Ethertype and opcode of MAC control frames and PAUSE frames
+MAC_CONTROL_ETHERTYPE = 0x8808
+PAUSE_OPCODE = 0x0001
+
+# Length of a PAUSE frame before padding and FCS
+PAUSE_LEN = 18
+
+
+class PauseDetect(Elaboratable):
+    """
+    PAUSE Frame Detector
+
+    Inspects incoming frames for 802.3x MAC control frames, which should be
+    consumed by the MAC rather than received, and extracts the requested
+    pause time from PAUSE frames.
+
+    Inputs:
+        * `reset`: Restart detection at the start of a new frame
+        * `data`: 8-bit input data
+        * `data_valid`: Pulsed high when new data is ready at `data`.
+
+    Outputs:
+        * `mac_control`: High once the frame has been identified as a MAC
+                         control frame. Remains high until `reset` is
+                         asserted.
+        * `pause`: High once the frame has been identified as a PAUSE frame.
+                   Remains high until `reset` is asserted.
+        * `pause_quanta`: 16-bit requested pause time, in units of 512 bit
+                          times, valid while `pause` is high.
+    """
+    def __init__(self):
+        # Inputs
+        self.reset = Signal()
+        self.data = Signal(8)
+        self.data_valid = Signal()
+
+        # Outputs
+        self.mac_control = Signal()
+        self.pause = Signal()
+        self.pause_quanta = Signal(16)
+
+    def elaborate(self, platform):
+        m = Module()
+
+        # Offsets of the ethertype, opcode and pause time fields in the frame
+        etype_idx = 12
+        opcode_idx = 14
+        quanta_idx = 16
+
+        idx = Signal(max=PAUSE_LEN+1)
+        etype_hi = Signal()
+        opcode_hi = Signal()
+
+        with m.If(self.reset):
+            m.d.sync += [
+                idx.eq(0),
+                self.mac_control.eq(0),
+                self.pause.eq(0),
+            ]
+        with m.Elif(self.data_valid & (idx != PAUSE_LEN)):
+            m.d.sync += idx.eq(idx + 1)
+
+            with m.If(idx == etype_idx):
+                m.d.sync += etype_hi.eq(
+                    self.data == MAC_CONTROL_ETHERTYPE >> 8)
+            with m.If(idx == etype_idx + 1):
+                m.d.sync += self.mac_control.eq(
+                    etype_hi & (self.data == MAC_CONTROL_ETHERTYPE & 0xFF))
+
+            with m.If(idx == opcode_idx):
+                m.d.sync += opcode_hi.eq(self.data == PAUSE_OPCODE >> 8)
+            with m.If(idx == opcode_idx + 1):
+                m.d.sync += self.pause.eq(
+                    self.mac_control & opcode_hi &
+                    (self.data == PAUSE_OPCODE & 0xFF))
+
+            with m.If(idx == quanta_idx):
+                m.d.sync += self.pause_quanta[8:16].eq(self.data)
+            with m.If(idx == quanta_idx + 1):
+                m.d.sync += self.pause_quanta[0:8].eq(self.data)
+
+        return m
+
+
+def test_pause_detect():
+    from nmigen.back import pysim
+
+    pause_detect = PauseDetect()
+
+    data = pause_detect.data
+    data_valid = pause_detect.data_valid
+    reset = pause_detect.reset
+
+    def frame(ethertype, opcode, quanta):
+        return (PAUSE_ADDR + [0x02]*6 + [ethertype >> 8, ethertype & 0xFF]
+                + [opcode >> 8, opcode & 0xFF, quanta >> 8, quanta & 0xFF]
+                + [0]*42)
+
+    def testbench():
+        for ethertype, opcode, quanta, mac_control, pause in (
+            (0x8808, 0x0001, 0x1234, 1, 1),
+            (0x8808, 0x0101, 0x1234, 1, 0),
+            (0x0800, 0x0001, 0x1234, 0, 0),
+            (0x8808, 0x0001, 0xFFFF, 1, 1),
+        ):
+            yield (reset.eq(1))
+            yield
+            yield (reset.eq(0))
+            yield
+
+            for byte in frame(ethertype, opcode, quanta):
+                yield (data.eq(byte))
+                yield (data_valid.eq(1))
+                yield
+                yield (data_valid.eq(0))
+                yield
+
+            assert (yield pause_detect.mac_control) == mac_control
+            assert (yield pause_detect.pause) == pause
+            if pause:
+                assert (yield pause_detect.pause_quanta) == quanta
+
+    vcdf = open("pause_detect.vcd", "w")
+    with pysim.Simulator(pause_detect, vcd_file=vcdf) as sim:
+        sim.add_clock(1e-6)
+        sim.add_sync_process(testbench())
+        sim.run()
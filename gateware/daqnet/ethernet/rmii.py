@@ -5,9 +5,17 @@ Copyright 2018-2019 Adam Greig
 Released under the MIT license; see LICENSE for details.
 """
 
-from nmigen import Elaboratable, Module, Signal, Cat
+from nmigen import Elaboratable, Module, Signal, Cat, Mux, Array
 from .crc import CRC32
 from .mac_address_match import MACAddressMatch
+from .rx_filter import RxFilter
+from .pause import (PauseDetect, PAUSE_ADDR, MAC_CONTROL_ETHERTYPE,
+                    PAUSE_OPCODE, PAUSE_LEN)
+
+
+# Maximum number of leading bytes of an in-place packet which may be patched
+# from the transmit memory; the patch mask is stored as this many bits.
+TX_PATCH_LEN = 64
 
 
 class RMIIRx(Elaboratable):
@@ -18,11 +26,37 @@ class RMIIRx(Elaboratable):
     frame check sequence and only asserts `rx_valid` when an entire valid
     packet has been saved to the port.
 
+    Frames shorter than `min_len`, which do not end on a byte boundary, or
+    which fail the frame check sequence are discarded once received, and
+    frames longer than `max_len` are discarded as soon as they exceed it.
+    The write address is rolled back over discarded frames so their memory
+    is reused by the next frame.
+
+    Frames are also discarded as soon as their destination MAC address does
+    not match, or they fail the optional ethertype and IPv4 protocol
+    filters, so that only frames which will be handled use buffer space.
+
+    While `rx_hold` is high, frames are discarded as soon as they would
+    overwrite memory at `rx_hold_offset`, so that a packet still in use
+    is not overwritten by later frames.
+
+    If `flow_control` is set, MAC control frames are also accepted, but are
+    consumed rather than saved, and each valid PAUSE frame pulses
+    `rx_pause`.
+
     This module must be run in the RMII ref_clk domain, and the memory port
     and inputs and outputs must also be in that clock domain.
 
     Parameters:
         * `mac_addr`: 6-byte MAC address (list of ints)
+        * `min_len`: Minimum frame length in bytes, including the FCS
+        * `max_len`: Maximum frame length in bytes, including the FCS,
+                     at most 2047
+        * `ethertypes`: List of ethertypes to accept, or None to accept all
+        * `ip_protocols`: List of IPv4 protocols to accept, or None to accept
+                          all
+        * `mac_table_size`: Number of additional MAC addresses to accept
+        * `flow_control`: If True, receive PAUSE frames
 
     Ports:
         * `write_port`: a write-capable memory port, 8 bits wide by 2048,
@@ -33,18 +67,73 @@ class RMIIRx(Elaboratable):
         * `rxd0`: RMII receive data 0
         * `rxd1`: RMII receive data 1
 
+    Inputs:
+        * `speed_10`: Assert while the link is running at 10Mbps
+        * `multicast_hash`: 64-bit mask of multicast address hashes to
+                            accept, see `MACAddressMatch`
+        * `mac_table`: List of `mac_table_size` 48-bit MAC addresses to
+                       accept, see `MACAddressMatch`
+        * `mac_table_valid`: Mask of valid `mac_table` entries
+        * `rx_hold`: Assert while memory from `rx_hold_offset` must not be
+                     overwritten
+        * `rx_hold_offset`: n-bit start address of the oldest packet still
+                            in use
+
     Outputs:
         * `rx_valid`: pulsed when a valid packet is in memory
         * `rx_offset`: n-bit start address of received packet
         * `rx_len`: 11-bit length of received packet
+        * `rx_runt`: pulsed when a frame shorter than `min_len` is discarded
+        * `rx_oversize`: pulsed when a frame longer than `max_len` is
+                         discarded
+        * `rx_align_error`: pulsed when a frame which does not end on a byte
+                            boundary is discarded
+        * `rx_crc_error`: pulsed when a frame with an invalid FCS is
+                          discarded
+        * `rx_filtered`: pulsed when a frame is discarded because of its
+                         destination MAC address, ethertype, or protocol,
+                         or is a MAC control frame other than PAUSE
+        * `rx_overflow`: pulsed when a frame is discarded because it would
+                         overwrite memory held by `rx_hold`
+        * `rx_pause`: pulsed when a valid PAUSE frame is received
+        * `rx_pause_quanta`: 16-bit pause time of the last PAUSE frame, in
+                             units of 512 bit times
     """
-    def __init__(self, mac_addr, write_port, crs_dv, rxd0, rxd1):
+    # Use a lookup table CRC, which processes a byte every two cycles
+    crc_table = True
+
+    def __init__(self, mac_addr, write_port, crs_dv, rxd0, rxd1,
+                 min_len=64, max_len=1522, ethertypes=None, ip_protocols=None,
+                 mac_table_size=0, flow_control=False):
+        # Inputs
+        self.speed_10 = Signal()
+        self.multicast_hash = Signal(64)
+        self.mac_table = [Signal(48, name=f"mac_table{idx}")
+                          for idx in range(mac_table_size)]
+        self.mac_table_valid = Signal(mac_table_size)
+        self.rx_hold = Signal()
+        self.rx_hold_offset = Signal(write_port.addr.nbits)
+
         # Outputs
         self.rx_valid = Signal()
         self.rx_offset = Signal(write_port.addr.nbits)
         self.rx_len = Signal(11)
+        self.rx_runt = Signal()
+        self.rx_oversize = Signal()
+        self.rx_align_error = Signal()
+        self.rx_crc_error = Signal()
+        self.rx_filtered = Signal()
+        self.rx_overflow = Signal()
+        self.rx_pause = Signal()
+        self.rx_pause_quanta = Signal(16)
 
         # Store arguments
+        self.min_len = min_len
+        self.max_len = max_len
+        self.ethertypes = ethertypes
+        self.ip_protocols = ip_protocols
+        self.mac_table_size = mac_table_size
+        self.flow_control = flow_control
         self.mac_addr = mac_addr
         self.write_port = write_port
         self.crs_dv = crs_dv
@@ -55,49 +144,159 @@ class RMIIRx(Elaboratable):
 
         m = Module()
 
-        m.submodules.crc = crc = CRC32()
-        m.submodules.mac_match = mac_match = MACAddressMatch(self.mac_addr)
-        m.submodules.rxbyte = rxbyte = RMIIRxByte(
-            self.crs_dv, self.rxd0, self.rxd1)
+        # With flow control, PAUSE frames are accepted by an extra entry
+        # in the address table and an extra ethertype in the filter
+        table_size = self.mac_table_size
+        ethertypes = self.ethertypes
+        if self.flow_control:
+            table_size += 1
+            if ethertypes is not None:
+                ethertypes = ethertypes + [MAC_CONTROL_ETHERTYPE]
+
+        m.submodules.crc = crc = CRC32(self.crc_table)
+        m.submodules.mac_match = mac_match = MACAddressMatch(
+            self.mac_addr, table_size, crc.latency)
+        m.submodules.rx_filter = rx_filter = RxFilter(
+            ethertypes, self.ip_protocols)
+        m.submodules.rxbyte = rxbyte = self._rx_byte(m)
 
         adr = Signal(self.write_port.addr.nbits)
+        align_error = Signal()
+
+        # Writing the next byte would overwrite the held packet
+        overflow = Signal()
+        m.d.comb += overflow.eq(self.rx_hold & (adr == self.rx_hold_offset))
+
+        m.d.sync += [
+            self.rx_runt.eq(0),
+            self.rx_oversize.eq(0),
+            self.rx_align_error.eq(0),
+            self.rx_crc_error.eq(0),
+            self.rx_filtered.eq(0),
+            self.rx_overflow.eq(0),
+            self.rx_pause.eq(0),
+        ]
+
+        if self.flow_control:
+            m.submodules.pause_detect = pause_detect = PauseDetect()
 
         with m.FSM() as fsm:
             m.d.comb += [
                 self.write_port.addr.eq(adr),
                 self.write_port.data.eq(rxbyte.data),
-                self.write_port.en.eq(rxbyte.data_valid),
+                self.write_port.en.eq(
+                    fsm.ongoing("DATA") & rxbyte.data_valid &
+                    (self.rx_len != self.max_len) & ~overflow),
                 crc.data.eq(rxbyte.data),
                 crc.data_valid.eq(rxbyte.data_valid),
                 crc.reset.eq(fsm.ongoing("IDLE")),
                 mac_match.data.eq(rxbyte.data),
                 mac_match.data_valid.eq(rxbyte.data_valid),
                 mac_match.reset.eq(fsm.ongoing("IDLE")),
+                mac_match.crc.eq(crc.crc_out),
+                mac_match.hash_filter.eq(self.multicast_hash),
+                rx_filter.data.eq(rxbyte.data),
+                rx_filter.data_valid.eq(rxbyte.data_valid),
+                rx_filter.reset.eq(fsm.ongoing("IDLE")),
             ]
+            m.d.comb += [mac_match.table[idx].eq(self.mac_table[idx])
+                         for idx in range(self.mac_table_size)]
+            if self.flow_control:
+                m.d.comb += [
+                    pause_detect.data.eq(rxbyte.data),
+                    pause_detect.data_valid.eq(rxbyte.data_valid),
+                    pause_detect.reset.eq(fsm.ongoing("IDLE")),
+                    mac_match.table[-1].eq(
+                        int.from_bytes(bytes(PAUSE_ADDR), "big")),
+                    mac_match.table_valid.eq(Cat(self.mac_table_valid, 1)),
+                ]
+            else:
+                m.d.comb += mac_match.table_valid.eq(self.mac_table_valid)
 
             # Idle until we see data valid
             with m.State("IDLE"):
                 m.d.sync += self.rx_len.eq(0)
                 m.d.sync += self.rx_valid.eq(0)
+                m.d.sync += align_error.eq(0)
                 with m.If(rxbyte.dv):
                     m.d.sync += self.rx_offset.eq(adr)
                     m.next = "DATA"
 
             # Save incoming data to memory
             with m.State("DATA"):
-                with m.If(rxbyte.data_valid):
-                    m.d.sync += adr.eq(adr + 1)
-                    m.d.sync += self.rx_len.eq(self.rx_len + 1)
+                with m.If(rxbyte.align_error):
+                    m.d.sync += align_error.eq(1)
+                with m.If((mac_match.done & ~mac_match.mac_match) |
+                          rx_filter.reject):
+                    m.d.sync += [
+                        adr.eq(self.rx_offset),
+                        self.rx_filtered.eq(1),
+                    ]
+                    m.next = "DISCARD"
+                with m.Elif(rxbyte.data_valid):
+                    with m.If(self.rx_len == self.max_len):
+                        m.d.sync += [
+                            adr.eq(self.rx_offset),
+                            self.rx_oversize.eq(1),
+                        ]
+                        m.next = "DISCARD"
+                    with m.Elif(overflow):
+                        m.d.sync += [
+                            adr.eq(self.rx_offset),
+                            self.rx_overflow.eq(1),
+                        ]
+                        m.next = "DISCARD"
+                    with m.Else():
+                        m.d.sync += adr.eq(adr + 1)
+                        m.d.sync += self.rx_len.eq(self.rx_len + 1)
                 with m.Elif(~rxbyte.dv):
                     m.next = "EOF"
 
+            # Wait for the end of a discarded frame without saving it
+            with m.State("DISCARD"):
+                with m.If(~rxbyte.dv):
+                    m.next = "IDLE"
+
             with m.State("EOF"):
-                with m.If(crc.crc_match & mac_match.mac_match):
+                with m.If(align_error):
+                    m.d.sync += self.rx_align_error.eq(1)
+                with m.Elif(self.rx_len < self.min_len):
+                    m.d.sync += self.rx_runt.eq(1)
+                with m.Elif(~crc.crc_match):
+                    m.d.sync += self.rx_crc_error.eq(1)
+                with m.If(crc.crc_match & mac_match.mac_match & ~align_error
+                          & (self.rx_len >= self.min_len)):
                     m.d.sync += self.rx_valid.eq(1)
+                    if self.flow_control:
+                        # MAC control frames are consumed rather than saved
+                        with m.If(pause_detect.mac_control):
+                            m.d.sync += [
+                                self.rx_valid.eq(0),
+                                adr.eq(self.rx_offset),
+                            ]
+                            with m.If(pause_detect.pause):
+                                m.d.sync += [
+                                    self.rx_pause.eq(1),
+                                    self.rx_pause_quanta.eq(
+                                        pause_detect.pause_quanta),
+                                ]
+                            with m.Else():
+                                m.d.sync += self.rx_filtered.eq(1)
+                with m.Else():
+                    m.d.sync += adr.eq(self.rx_offset)
                 m.next = "IDLE"
 
         return m
 
+    def _rx_byte(self, m):
+        """
+        Returns the byte de-muxer for this PHY interface, which must have
+        the same outputs as `RMIIRxByte`.
+        """
+        rxbyte = RMIIRxByte(self.crs_dv, self.rxd0, self.rxd1)
+        m.d.comb += rxbyte.speed_10.eq(self.speed_10)
+        return rxbyte
+
 
 class RMIIRxByte(Elaboratable):
     """
@@ -105,6 +304,9 @@ class RMIIRxByte(Elaboratable):
 
     Handles receiving a byte dibit-by-dibit.
 
+    At 10Mbps each dibit is repeated for ten ref_clk cycles, and is sampled
+    in the middle of its repeats, timed from the start of the preamble.
+
     This submodule must be in the RMII ref_clk clock domain,
     and its outputs are likewise in that domain.
 
@@ -113,18 +315,27 @@ class RMIIRxByte(Elaboratable):
         * `rxd0`: RX data 0, input
         * `rxd1`: RX data 1, input
 
+    Inputs:
+        * `speed_10`: Assert while the link is running at 10Mbps
+
     Outputs:
         * `data`: 8-bit wide output data
         * `data_valid`: Asserted for one cycle when `data` is valid
         * `dv`: RMII Data valid recovered signal
         * `crs`: RMII Carrier sense recovered signal
+        * `align_error`: Asserted for one cycle when data valid ended
+                         partway through the most recently output byte
     """
     def __init__(self, crs_dv, rxd0, rxd1):
+        # Inputs
+        self.speed_10 = Signal()
+
         # Outputs
         self.data = Signal(8)
         self.data_valid = Signal()
         self.dv = Signal()
         self.crs = Signal()
+        self.align_error = Signal()
 
         self.crs_dv = crs_dv
         self.rxd0 = rxd0
@@ -141,7 +352,16 @@ class RMIIRxByte(Elaboratable):
             rxd_reg.eq(Cat(self.rxd0, self.rxd1)),
         ]
 
-        with m.FSM():
+        # Only advance on each sampled dibit. At 10Mbps, wait half a dibit
+        # after the preamble starts and then sample every ten cycles.
+        sample = Signal()
+        sample_ctr = Signal(max=10)
+        m.d.sync += self.data_valid.eq(0)
+
+        with m.If(sample), m.FSM() as fsm:
+            m.d.comb += self.align_error.eq(
+                fsm.ongoing("NIBBLE1") & ~self.dv & sample)
+
             with m.State("IDLE"):
                 m.d.sync += [
                     self.crs.eq(0),
@@ -210,6 +430,15 @@ class RMIIRxByte(Elaboratable):
                     m.d.sync += self.data_valid.eq(1),
                     m.next = "IDLE"
 
+        m.d.comb += sample.eq(
+            ~self.speed_10 | fsm.ongoing("IDLE") | (sample_ctr == 0))
+        with m.If(fsm.ongoing("IDLE")):
+            m.d.sync += sample_ctr.eq(4)
+        with m.Elif(sample_ctr == 0):
+            m.d.sync += sample_ctr.eq(9)
+        with m.Else():
+            m.d.sync += sample_ctr.eq(sample_ctr - 1)
+
         return m
 
 
@@ -220,12 +449,38 @@ class RMIITx(Elaboratable):
     Transmits outgoing packets from a memory. Adds preamble, start of frame
     delimiter, and frame check sequence (CRC32) automatically.
 
+    If `mac_addr` is given, 802.3x flow control is enabled. Transmission of
+    new packets is paused for the time requested by `pause_rx`, and PAUSE
+    frames are sent when `xoff` changes and refreshed while it is held high.
+    PAUSE frames are sent ahead of any waiting packets, even while paused.
+
+    The start of new packets may be delayed by a token bucket rate shaper,
+    which accumulates one token per byte time at `rate` times the line rate,
+    up to `burst` tokens. Each packet uses one token per byte time it
+    occupies the link, including its preamble, FCS, and interpacket gap,
+    and may start once the bucket is not empty. PAUSE frames do not use
+    any tokens.
+
+    While `link_up` is low, no packets or PAUSE frames are transmitted, and
+    new packets are either held until the link returns or, if `flush` is
+    set, discarded without being transmitted.
+
     This module must be run in the RMII ref_clk domain, and the memory port
     and inputs and outputs must also be in that clock domain.
 
+    Parameters:
+        * `mac_addr`: 6-byte MAC address (list of ints) used as the source
+                      of PAUSE frames, or None to disable flow control
+        * `pause_quanta`: Pause time requested when `xoff` is asserted, in
+                          units of 512 bit times
+        * `burst`: Capacity of the rate shaper's token bucket in bytes
+
     Ports:
         * `read_port`: a read memory port, 8 bits wide by 2048,
           running in the RMII ref_clk domain
+        * `rx_read_port`: optional read port into the receive memory,
+          running in the RMII ref_clk domain, used to transmit packets
+          in place from a received packet
 
     Pins:
         * `txen`: RMII transmit enable
@@ -233,23 +488,77 @@ class RMIITx(Elaboratable):
         * `txd1`: RMII transmit data 1
 
     Inputs:
+        * `speed_10`: Assert while the link is running at 10Mbps
         * `tx_start`: Pulse high to begin transmission of a packet
         * `tx_offset`: n-bit address offset of packet to transmit
         * `tx_len`: 11-bit length of packet to transmit
+        * `tx_split`: 11-bit length of the patch region at the start of
+                      the packet, or 0 to transmit the whole packet from
+                      `read_port`. Only used if `rx_read_port` is given.
+                      Bytes in the patch region whose bit is set in the
+                      patch mask are transmitted from `read_port`, and all
+                      other bytes are transmitted from the same offset in
+                      the received packet at `tx_rx_offset`. The patch mask
+                      is stored LSb first in the TX_PATCH_LEN/8 bytes
+                      following the patch region in the transmit memory,
+                      and bytes beyond TX_PATCH_LEN are always patched.
+        * `tx_rx_offset`: m-bit address offset of received packet
+        * `pause_rx`: Pulse high to pause transmission for `pause_rx_quanta`
+        * `pause_rx_quanta`: 16-bit pause time in units of 512 bit times,
+                             where 0 resumes transmission immediately
+        * `xoff`: Assert to request the link partner stops transmitting
+        * `ipg`: 8-bit interpacket gap in byte times, default 12. Values
+                 below 12 are treated as 12.
+        * `rate`: 16-bit maximum rate as a fraction of the line rate in
+                  units of 1/65536, or 0 to disable the rate shaper
+        * `link_up`: Deassert while the link is down to stop transmitting
+        * `flush`: Assert to discard packets while `link_up` is low
 
     Outputs:
         * `tx_ready`: Asserted while ready to transmit a new packet
+        * `tx_done`: Pulsed high once the packet being transmitted has been
+                     read from memory, after which it may be overwritten,
+                     or once a packet has been discarded
+        * `tx_flushed`: Pulsed high when a packet is discarded
+        * `tx_pause`: Pulsed high when a PAUSE frame is sent
+        * `paused`: High while transmission is paused
     """
-    def __init__(self, read_port, txen, txd0, txd1):
+    # Cycles in the 96 bit time interpacket gap at 100Mbps
+    ipg_cycles = 48
+
+    # Use a lookup table CRC, which processes a byte every two cycles
+    crc_table = True
+
+    def __init__(self, read_port, txen, txd0, txd1, rx_read_port=None,
+                 mac_addr=None, pause_quanta=0xFFFF, burst=4096):
         # Inputs
+        self.speed_10 = Signal()
         self.tx_start = Signal()
         self.tx_offset = Signal(read_port.addr.nbits)
         self.tx_len = Signal(11)
+        self.tx_split = Signal(11)
+        if rx_read_port is not None:
+            self.tx_rx_offset = Signal(rx_read_port.addr.nbits)
+        self.pause_rx = Signal()
+        self.pause_rx_quanta = Signal(16)
+        self.xoff = Signal()
+        self.ipg = Signal(8, reset=12)
+        self.rate = Signal(16)
+        self.link_up = Signal(reset=1)
+        self.flush = Signal()
 
         # Outputs
         self.tx_ready = Signal()
+        self.tx_done = Signal()
+        self.tx_flushed = Signal()
+        self.tx_pause = Signal()
+        self.paused = Signal()
 
+        self.mac_addr = mac_addr
+        self.pause_quanta = pause_quanta
+        self.burst = burst
         self.read_port = read_port
+        self.rx_read_port = rx_read_port
         self.txen = txen
         self.txd0 = txd0
         self.txd1 = txd1
@@ -257,28 +566,155 @@ class RMIITx(Elaboratable):
     def elaborate(self, platform):
         m = Module()
 
-        # Transmit byte counter
-        tx_idx = Signal(self.read_port.addr.nbits)
+        # Cycles per byte time, ten times as many at 10Mbps
+        byte_cycles = self.ipg_cycles // 12
+        byte_ctr = Signal(max=10*byte_cycles)
+        byte_tick = Signal()
+        m.d.comb += byte_tick.eq(byte_ctr == 0)
+        with m.If(byte_tick):
+            m.d.sync += byte_ctr.eq(Mux(
+                self.speed_10, 10*byte_cycles - 1, byte_cycles - 1))
+        with m.Else():
+            m.d.sync += byte_ctr.eq(byte_ctr - 1)
+
+        # Transmit byte counter, also used to time the interpacket gap
+        tx_idx = Signal(max=max(2**self.read_port.addr.nbits,
+                                10*byte_cycles*255 + 1))
         # Transmit length latch
         tx_len = Signal(11)
         # Transmit offset latch
         tx_offset = Signal(self.read_port.addr.nbits)
-
-        m.submodules.crc = crc = CRC32()
-        m.submodules.txbyte = txbyte = RMIITxByte(
-            self.txen, self.txd0, self.txd1)
+        # Transmit split latch
+        tx_split = Signal(11)
+
+        # Patch mask, shifted right as each byte is transmitted
+        patch_mask = Signal(TX_PATCH_LEN)
+        patch_mask_ctr = Signal(max=TX_PATCH_LEN//8 + 2)
+
+        # When transmitting a byte every clock, the preamble is extended
+        # until the patch mask has been read
+        mask_loaded = Signal()
+        if self.rx_read_port is not None:
+            m.d.comb += mask_loaded.eq(patch_mask_ctr == TX_PATCH_LEN//8 + 1)
+        else:
+            m.d.comb += mask_loaded.eq(1)
+
+        # Memory read index, which is the next byte to transmit once the
+        # current byte has been taken so that the memory read latency is
+        # hidden even when a byte is taken every cycle
+        rd_idx = Signal.like(tx_idx)
+
+        # Select whether data comes from the transmit or receive memory
+        tx_data = Signal(8)
+        if self.rx_read_port is not None:
+            tx_rx_offset = Signal(self.rx_read_port.addr.nbits)
+            m.d.comb += self.rx_read_port.addr.eq(rd_idx + tx_rx_offset)
+            with m.If((tx_split == 0) |
+                      ((tx_idx < tx_split) & patch_mask[0])):
+                m.d.comb += tx_data.eq(self.read_port.data)
+            with m.Else():
+                m.d.comb += tx_data.eq(self.rx_read_port.data)
+        else:
+            m.d.comb += tx_data.eq(self.read_port.data)
+
+        # Flow control
+        sending_pause = Signal()
+        pause_pending = Signal()
+        if self.mac_addr is not None:
+            # Quanta of 512 bit times, ten times as many cycles at 10Mbps
+            quantum_cycles = self.ipg_cycles * 512 // 96
+            quantum_ctr = Signal(max=10*quantum_cycles)
+            quantum = Signal()
+            m.d.comb += quantum.eq(quantum_ctr == 0)
+            with m.If(quantum):
+                m.d.sync += quantum_ctr.eq(Mux(
+                    self.speed_10, 10*quantum_cycles - 1, quantum_cycles - 1))
+            with m.Else():
+                m.d.sync += quantum_ctr.eq(quantum_ctr - 1)
+
+            # Pause for the requested number of quanta
+            pause_ctr = Signal(16)
+            with m.If(self.pause_rx):
+                m.d.sync += pause_ctr.eq(self.pause_rx_quanta)
+            with m.Elif(quantum & (pause_ctr != 0)):
+                m.d.sync += pause_ctr.eq(pause_ctr - 1)
+            m.d.comb += self.paused.eq(pause_ctr != 0)
+
+            # Send a PAUSE frame when xoff changes, and repeat it after half
+            # of the requested pause time while xoff remains asserted
+            xoff_sent = Signal()
+            refresh_ctr = Signal(16)
+            with m.If(quantum & (refresh_ctr != 0)):
+                m.d.sync += refresh_ctr.eq(refresh_ctr - 1)
+            m.d.comb += pause_pending.eq(
+                (self.xoff != xoff_sent) | (self.xoff & (refresh_ctr == 0)))
+
+            # PAUSE frame contents, with the pause time latched when sent
+            pause_tx_quanta = Signal(16)
+            pause_frame = Array(
+                PAUSE_ADDR + self.mac_addr + [
+                    MAC_CONTROL_ETHERTYPE >> 8, MAC_CONTROL_ETHERTYPE & 0xFF,
+                    PAUSE_OPCODE >> 8, PAUSE_OPCODE & 0xFF,
+                    pause_tx_quanta[8:16], pause_tx_quanta[0:8]])
+            with m.If(sending_pause):
+                m.d.comb += tx_data.eq(pause_frame[tx_idx])
+
+        # Interpacket gap in byte times, at least the standard 96 bit times
+        ipg = Signal(8)
+        m.d.comb += ipg.eq(Mux(self.ipg < 12, 12, self.ipg))
+
+        # Rate shaper token bucket, which may go negative after a packet
+        # is started and refills by `rate`/65536 tokens per byte time
+        max_cost = 2**11 - 1 + 12 + 255
+        tokens = Signal(min=-max_cost, max=self.burst+1, reset=self.burst)
+        token_frac = Signal(16)
+        token_carry = Signal()
+        tx_cost = Signal(max=max_cost+1)
+        shaped = Signal()
+        m.d.comb += [
+            tx_cost.eq(Mux(self.tx_len < 60, 60, self.tx_len) + 12 + ipg),
+            shaped.eq((self.rate != 0) & (tokens < 0)),
+        ]
+        with m.If(byte_tick):
+            m.d.sync += Cat(token_frac, token_carry).eq(
+                token_frac + self.rate)
+        with m.Else():
+            m.d.sync += token_carry.eq(0)
+
+        m.submodules.crc = crc = CRC32(self.crc_table)
+        m.submodules.txbyte = txbyte = self._tx_byte(m)
+
+        tx_start = Signal()
+        m.d.comb += tx_start.eq(self.tx_ready & self.tx_start)
+        with m.If(self.rate == 0):
+            m.d.sync += tokens.eq(self.burst)
+        with m.Else():
+            m.d.sync += tokens.eq(
+                tokens + (token_carry & (tokens < self.burst))
+                - Mux(tx_start & self.link_up, tx_cost, 0))
 
         with m.FSM() as fsm:
             m.d.comb += [
-                self.read_port.addr.eq(tx_idx + tx_offset),
+                rd_idx.eq(tx_idx + (fsm.ongoing("DATA") & txbyte.ready)),
+                self.read_port.addr.eq(rd_idx + tx_offset),
                 crc.data.eq(txbyte.data),
                 crc.reset.eq(fsm.ongoing("IDLE")),
                 crc.data_valid.eq(
                     (fsm.ongoing("DATA") | fsm.ongoing("PAD"))
                     & txbyte.ready),
-                self.tx_ready.eq(fsm.ongoing("IDLE")),
+                self.tx_ready.eq(fsm.ongoing("IDLE") & Mux(
+                    self.link_up,
+                    ~pause_pending & ~self.paused & ~shaped,
+                    self.flush)),
+                self.tx_done.eq(
+                    (fsm.ongoing("FCS4") & txbyte.ready & ~sending_pause)
+                    | fsm.ongoing("FLUSH")),
+                self.tx_flushed.eq(fsm.ongoing("FLUSH")),
+                self.tx_pause.eq(
+                    fsm.ongoing("IDLE") & pause_pending & self.link_up),
                 txbyte.data_valid.eq(
-                    ~(fsm.ongoing("IDLE") | fsm.ongoing("IPG"))),
+                    ~(fsm.ongoing("IDLE") | fsm.ongoing("IPG")
+                      | fsm.ongoing("FLUSH"))),
             ]
 
             with m.State("IDLE"):
@@ -287,14 +723,52 @@ class RMIITx(Elaboratable):
                     tx_idx.eq(0),
                     tx_offset.eq(self.tx_offset),
                     tx_len.eq(self.tx_len),
+                    tx_split.eq(self.tx_split),
+                    patch_mask_ctr.eq(0),
                 ]
-                with m.If(self.tx_start):
+                if self.rx_read_port is not None:
+                    m.d.sync += tx_rx_offset.eq(self.tx_rx_offset)
+                m.d.sync += sending_pause.eq(pause_pending & self.link_up)
+                with m.If(~self.link_up):
+                    with m.If(tx_start):
+                        m.next = "FLUSH"
+                with m.Elif(pause_pending):
+                    m.d.sync += [
+                        tx_len.eq(PAUSE_LEN),
+                        tx_split.eq(0),
+                    ]
+                    if self.mac_addr is not None:
+                        m.d.sync += [
+                            xoff_sent.eq(self.xoff),
+                            pause_tx_quanta.eq(
+                                Mux(self.xoff, self.pause_quanta, 0)),
+                            refresh_ctr.eq(self.pause_quanta // 2),
+                        ]
+                    m.next = "PREAMBLE"
+                with m.Elif(tx_start):
                     m.next = "PREAMBLE"
 
+            # Discard a packet while the link is down, signalling it is
+            # done once the MAC has latched its length. Waiting for an
+            # interpacket gap limits how quickly packets are discarded.
+            with m.State("FLUSH"):
+                m.d.comb += txbyte.data.eq(0)
+                m.next = "IPG"
+
             with m.State("PREAMBLE"):
                 m.d.comb += txbyte.data.eq(0x55)
+                if self.rx_read_port is not None:
+                    # Read the patch mask while sending the preamble,
+                    # shifting in one byte per clock.
+                    with m.If(patch_mask_ctr != TX_PATCH_LEN//8 + 1):
+                        m.d.sync += patch_mask_ctr.eq(patch_mask_ctr + 1)
+                        m.d.comb += self.read_port.addr.eq(
+                            tx_offset + tx_split + patch_mask_ctr)
+                        with m.If(patch_mask_ctr != 0):
+                            m.d.sync += patch_mask.eq(
+                                Cat(patch_mask[8:], self.read_port.data))
                 with m.If(txbyte.ready):
-                    with m.If(tx_idx == 6):
+                    with m.If((tx_idx >= 6) & mask_loaded):
                         m.d.sync += tx_idx.eq(0)
                         m.next = "SFD"
                     with m.Else():
@@ -306,9 +780,12 @@ class RMIITx(Elaboratable):
                     m.next = "DATA"
 
             with m.State("DATA"):
-                m.d.comb += txbyte.data.eq(self.read_port.data)
+                m.d.comb += txbyte.data.eq(tx_data)
                 with m.If(txbyte.ready):
-                    m.d.sync += tx_idx.eq(tx_idx + 1)
+                    m.d.sync += [
+                        tx_idx.eq(tx_idx + 1),
+                        patch_mask.eq(Cat(patch_mask[1:], 1)),
+                    ]
                     with m.If(tx_idx == tx_len - 1):
                         with m.If(tx_len < 60):
                             m.next = "PAD"
@@ -343,13 +820,29 @@ class RMIITx(Elaboratable):
                     m.d.sync += tx_idx.eq(0)
                     m.next = "IPG"
 
+            # Wait for the final byte to be transmitted and then for the
+            # rest of the interpacket gap, which takes ten times as many
+            # cycles at 10Mbps. The next packet starts two cycles after
+            # returning to IDLE.
             with m.State("IPG"):
-                m.d.sync += tx_idx.eq(tx_idx + 1)
-                with m.If(tx_idx == 48):
+                with m.If(txbyte.ready):
+                    m.d.sync += tx_idx.eq(tx_idx + 1)
+                with m.If(tx_idx == Mux(self.speed_10,
+                                        ipg * (10*byte_cycles) - 2,
+                                        ipg * byte_cycles - 2)):
                     m.next = "IDLE"
 
         return m
 
+    def _tx_byte(self, m):
+        """
+        Returns the byte muxer for this PHY interface, which must have the
+        same inputs and outputs as `RMIITxByte`.
+        """
+        txbyte = RMIITxByte(self.txen, self.txd0, self.txd1)
+        m.d.comb += txbyte.speed_10.eq(self.speed_10)
+        return txbyte
+
 
 class RMIITxByte(Elaboratable):
     """
@@ -357,6 +850,8 @@ class RMIITxByte(Elaboratable):
 
     Handles transmitting a byte dibit-by-dibit.
 
+    At 10Mbps each dibit is repeated for ten ref_clk cycles.
+
     This submodule must be in the RMII ref_clk clock domain,
     and its inputs and outputs are likewise in that domain.
 
@@ -366,6 +861,7 @@ class RMIITxByte(Elaboratable):
         * `txd1`: TMII Transmit data 1
 
     Inputs:
+        * `speed_10`: Assert while the link is running at 10Mbps
         * `data`: 8-bit wide data to transmit. Latched internally so you may
           update it to the next word after asserting `data_valid`.
         * `data_valid`: Assert while valid data is present at `data`.
@@ -377,6 +873,7 @@ class RMIITxByte(Elaboratable):
     """
     def __init__(self, txen, txd0, txd1):
         # Inputs
+        self.speed_10 = Signal()
         self.data = Signal(8)
         self.data_valid = Signal()
 
@@ -393,9 +890,15 @@ class RMIITxByte(Elaboratable):
         # Register input data on the data_valid signal
         data_reg = Signal(8)
 
+        # Only advance after the final repeat of each dibit at 10Mbps
+        advance = Signal()
+        repeat_ctr = Signal(max=10)
+        m.d.comb += advance.eq(~self.speed_10 | (repeat_ctr == 0))
+
         with m.FSM() as fsm:
             m.d.comb += [
-                self.ready.eq(fsm.ongoing("IDLE") | fsm.ongoing("NIBBLE4")),
+                self.ready.eq(fsm.ongoing("IDLE") |
+                              (fsm.ongoing("NIBBLE4") & advance)),
                 self.txen.eq(~fsm.ongoing("IDLE")),
             ]
 
@@ -413,32 +916,41 @@ class RMIITxByte(Elaboratable):
                     self.txd0.eq(data_reg[0]),
                     self.txd1.eq(data_reg[1]),
                 ]
-                m.next = "NIBBLE2"
+                with m.If(advance):
+                    m.next = "NIBBLE2"
 
             with m.State("NIBBLE2"):
                 m.d.comb += [
                     self.txd0.eq(data_reg[2]),
                     self.txd1.eq(data_reg[3]),
                 ]
-                m.next = "NIBBLE3"
+                with m.If(advance):
+                    m.next = "NIBBLE3"
 
             with m.State("NIBBLE3"):
                 m.d.comb += [
                     self.txd0.eq(data_reg[4]),
                     self.txd1.eq(data_reg[5]),
                 ]
-                m.next = "NIBBLE4"
+                with m.If(advance):
+                    m.next = "NIBBLE4"
 
             with m.State("NIBBLE4"):
                 m.d.comb += [
                     self.txd0.eq(data_reg[6]),
                     self.txd1.eq(data_reg[7]),
                 ]
-                m.d.sync += data_reg.eq(self.data)
-                with m.If(self.data_valid):
-                    m.next = "NIBBLE1"
-                with m.Else():
-                    m.next = "IDLE"
+                with m.If(advance):
+                    m.d.sync += data_reg.eq(self.data)
+                    with m.If(self.data_valid):
+                        m.next = "NIBBLE1"
+                    with m.Else():
+                        m.next = "IDLE"
+
+        with m.If(fsm.ongoing("IDLE") | (repeat_ctr == 0)):
+            m.d.sync += repeat_ctr.eq(9)
+        with m.Else():
+            m.d.sync += repeat_ctr.eq(repeat_ctr - 1)
 
         return m
 
@@ -539,6 +1051,213 @@ def test_rmii_rx():
         sim.run()
 
 
+def test_rmii_rx_errors():
+    import random
+    from nmigen.back import pysim
+    from nmigen import Memory
+    from .crc import make_crc32_table
+
+    crs_dv = Signal()
+    rxd0 = Signal()
+    rxd1 = Signal()
+
+    mem = Memory(8, 256)
+    mem_port = mem.write_port()
+    mac_addr = [random.randint(0, 255) for _ in range(6)]
+
+    rmii_rx = RMIIRx(mac_addr, mem_port, crs_dv, rxd0, rxd1,
+                     min_len=64, max_len=110)
+
+    def make_frame(n, dst=[0xFF]*6):
+        data = dst + [random.randint(0, 255) for _ in range(n - 10)]
+        table = make_crc32_table()
+        crc = 0xFFFFFFFF
+        for byte in data:
+            crc = table[(crc & 0xFF) ^ byte] ^ (crc >> 8)
+        crc ^= 0xFFFFFFFF
+        return data + [(crc >> (8*x)) & 0xFF for x in range(4)]
+
+    def testbench():
+        strobes = []
+        rx_lens = []
+
+        def clock():
+            yield
+            if (yield rmii_rx.rx_valid):
+                rx_lens.append((yield rmii_rx.rx_len))
+            for strobe in ("rx_valid", "rx_runt", "rx_oversize",
+                           "rx_align_error", "rx_crc_error", "rx_filtered",
+                           "rx_overflow"):
+                if (yield getattr(rmii_rx, strobe)):
+                    strobes.append(strobe)
+
+        def tx_packet(txbytes, extra_dibits=0):
+            dibits = []
+            for txbyte in txbytes:
+                dibits += [(txbyte >> shift) & 0b11 for shift in (0, 2, 4, 6)]
+            dibits += [0b10] * extra_dibits
+            yield (crs_dv.eq(1))
+            for _ in range(20):
+                yield (rxd0.eq(1))
+                yield (rxd1.eq(0))
+                yield from clock()
+            yield (rxd0.eq(1))
+            yield (rxd1.eq(1))
+            yield from clock()
+            for dibit in dibits:
+                yield (rxd0.eq(dibit & 1))
+                yield (rxd1.eq(dibit >> 1))
+                yield from clock()
+            yield (crs_dv.eq(0))
+            for _ in range(20):
+                yield from clock()
+
+        for _ in range(10):
+            yield
+
+        # Runt frame
+        yield from tx_packet(make_frame(40))
+        assert strobes == ["rx_runt"]
+
+        # Oversize frame
+        strobes.clear()
+        yield from tx_packet(make_frame(150))
+        assert strobes == ["rx_oversize"]
+
+        # Frame ending partway through a byte
+        strobes.clear()
+        yield from tx_packet(make_frame(80), extra_dibits=2)
+        assert strobes == ["rx_align_error"]
+
+        # Frame with a corrupt FCS
+        strobes.clear()
+        frame = make_frame(80)
+        frame[-1] ^= 0x01
+        yield from tx_packet(frame)
+        assert strobes == ["rx_crc_error"]
+
+        # Frame for another MAC address is discarded once the address is in
+        strobes.clear()
+        yield from tx_packet(make_frame(80, dst=[0x02]*6))
+        assert strobes == ["rx_filtered"]
+
+        # Valid frame is saved where the discarded frames started
+        strobes.clear()
+        frame = make_frame(110)
+        yield from tx_packet(frame)
+        assert strobes == ["rx_valid"]
+        assert (yield rmii_rx.rx_offset) == 0
+        assert rx_lens == [110]
+        for idx in range(110):
+            assert (yield mem[idx]) == frame[idx]
+
+        # Frame which would overwrite a held packet is discarded before
+        # reaching it
+        strobes.clear()
+        yield rmii_rx.rx_hold.eq(1)
+        yield rmii_rx.rx_hold_offset.eq(150)
+        yield from tx_packet(make_frame(80))
+        assert strobes == ["rx_overflow"]
+        for idx in range(150, 256):
+            assert (yield mem[idx]) == 0
+
+        # Once released, the frame is saved after the previous one
+        strobes.clear()
+        yield rmii_rx.rx_hold.eq(0)
+        frame = make_frame(80)
+        yield from tx_packet(frame)
+        assert strobes == ["rx_valid"]
+        assert (yield rmii_rx.rx_offset) == 110
+        for idx in range(80):
+            assert (yield mem[110 + idx]) == frame[idx]
+
+    mod = Module()
+    mod.submodules += rmii_rx, mem_port
+    vcdf = open("rmii_rx_errors.vcd", "w")
+    with pysim.Simulator(mod, vcd_file=vcdf) as sim:
+        sim.add_clock(1/50e6)
+        sim.add_sync_process(testbench())
+        sim.run()
+
+
+def test_rmii_rx_pause():
+    import random
+    from nmigen.back import pysim
+    from nmigen import Memory
+    from .crc import make_crc32_table
+
+    crs_dv = Signal()
+    rxd0 = Signal()
+    rxd1 = Signal()
+
+    mem = Memory(8, 256)
+    mem_port = mem.write_port()
+    mac_addr = [random.randint(0, 255) for _ in range(6)]
+
+    rmii_rx = RMIIRx(mac_addr, mem_port, crs_dv, rxd0, rxd1,
+                     ethertypes=[0x0800], flow_control=True)
+
+    def make_frame(opcode, quanta):
+        data = (PAUSE_ADDR + [0x02]*6 + [0x88, 0x08]
+                + [opcode >> 8, opcode & 0xFF, quanta >> 8, quanta & 0xFF])
+        data += [0] * (60 - len(data))
+        table = make_crc32_table()
+        crc = 0xFFFFFFFF
+        for byte in data:
+            crc = table[(crc & 0xFF) ^ byte] ^ (crc >> 8)
+        crc ^= 0xFFFFFFFF
+        return data + [(crc >> (8*x)) & 0xFF for x in range(4)]
+
+    def testbench():
+        strobes = []
+
+        def clock():
+            yield
+            for strobe in ("rx_valid", "rx_filtered", "rx_pause"):
+                if (yield getattr(rmii_rx, strobe)):
+                    strobes.append(strobe)
+
+        def tx_packet(txbytes):
+            yield (crs_dv.eq(1))
+            for _ in range(20):
+                yield (rxd0.eq(1))
+                yield (rxd1.eq(0))
+                yield from clock()
+            yield (rxd0.eq(1))
+            yield (rxd1.eq(1))
+            yield from clock()
+            for txbyte in txbytes:
+                for shift in (0, 2, 4, 6):
+                    yield (rxd0.eq((txbyte >> shift) & 1))
+                    yield (rxd1.eq((txbyte >> (shift + 1)) & 1))
+                    yield from clock()
+            yield (crs_dv.eq(0))
+            for _ in range(20):
+                yield from clock()
+
+        for _ in range(10):
+            yield
+
+        # PAUSE frame is consumed and reports its pause time
+        yield from tx_packet(make_frame(0x0001, 0x1234))
+        assert strobes == ["rx_pause"]
+        assert (yield rmii_rx.rx_pause_quanta) == 0x1234
+
+        # Other MAC control frames are discarded
+        strobes.clear()
+        yield from tx_packet(make_frame(0x0101, 0x5678))
+        assert strobes == ["rx_filtered"]
+        assert (yield rmii_rx.rx_pause_quanta) == 0x1234
+
+    mod = Module()
+    mod.submodules += rmii_rx, mem_port
+    vcdf = open("rmii_rx_pause.vcd", "w")
+    with pysim.Simulator(mod, vcd_file=vcdf) as sim:
+        sim.add_clock(1/50e6)
+        sim.add_sync_process(testbench())
+        sim.run()
+
+
 def test_rmii_rx_byte():
     import random
     from nmigen.back import pysim
@@ -609,6 +1328,54 @@ def test_rmii_rx_byte():
         sim.run()
 
 
+def test_rmii_rx_byte_10mbps():
+    import random
+    from nmigen.back import pysim
+
+    crs_dv = Signal()
+    rxd0 = Signal()
+    rxd1 = Signal()
+
+    rmii_rx_byte = RMIIRxByte(crs_dv, rxd0, rxd1)
+
+    def testbench():
+        yield (rmii_rx_byte.speed_10.eq(1))
+        for _ in range(random.randint(10, 20)):
+            yield
+
+        txbytes = [random.randint(0, 255) for _ in range(8)]
+        rxbytes = []
+
+        # Preamble and SFD, then data, each dibit repeated ten times
+        dibits = [0b01]*random.randint(10, 40) + [0b11]
+        for txbyte in txbytes:
+            dibits += [(txbyte >> dibit) & 0b11 for dibit in range(0, 8, 2)]
+
+        yield (crs_dv.eq(1))
+        for dibit in dibits:
+            for _ in range(10):
+                yield (rxd0.eq(dibit & 1))
+                yield (rxd1.eq(dibit >> 1))
+                yield
+                if (yield rmii_rx_byte.data_valid):
+                    rxbytes.append((yield rmii_rx_byte.data))
+
+        yield (crs_dv.eq(0))
+
+        for _ in range(40):
+            yield
+            if (yield rmii_rx_byte.data_valid):
+                rxbytes.append((yield rmii_rx_byte.data))
+
+        assert rxbytes == txbytes
+
+    vcdf = open("rmii_rx_byte_10mbps.vcd", "w")
+    with pysim.Simulator(rmii_rx_byte, vcd_file=vcdf) as sim:
+        sim.add_clock(1/50e6)
+        sim.add_sync_process(testbench())
+        sim.run()
+
+
 def test_rmii_tx():
     from nmigen.back import pysim
     from nmigen import Memory
@@ -683,6 +1450,278 @@ def test_rmii_tx():
         sim.run()
 
 
+def test_rmii_tx_split():
+    import random
+    from nmigen.back import pysim
+    from nmigen import Memory
+    from .crc import make_crc32_table
+
+    txen = Signal()
+    txd0 = Signal()
+    txd1 = Signal()
+
+    rng = random.Random(0)
+    rxbytes = [rng.randint(0, 255) for _ in range(80)]
+    hdrbytes = [rng.randint(0, 255) for _ in range(20)]
+    mask = rng.getrandbits(TX_PATCH_LEN)
+    maskbytes = [(mask >> (8*x)) & 0xFF for x in range(TX_PATCH_LEN//8)]
+    txbytes = [hdrbytes[x] if (mask >> x) & 1 else rxbytes[x]
+               for x in range(20)] + rxbytes[20:]
+
+    # Put the patch bytes and mask into the transmit memory and the received
+    # packet into the receive memory, at different offsets.
+    txoffset = 10
+    rxoffset = 30
+    tx_mem = Memory(8, 128, [0xFF]*txoffset + hdrbytes + maskbytes)
+    tx_mem_port = tx_mem.read_port()
+    rx_mem = Memory(8, 128, [0xFF]*rxoffset + rxbytes)
+    rx_mem_port = rx_mem.read_port()
+
+    table = make_crc32_table()
+    crc = 0xFFFFFFFF
+    for byte in txbytes:
+        crc = table[(crc & 0xFF) ^ byte] ^ (crc >> 8)
+    crc ^= 0xFFFFFFFF
+    crcbytes = [(crc >> (8*x)) & 0xFF for x in range(4)]
+
+    preamblebytes = [0x55, 0x55, 0x55, 0x55, 0x55, 0x55, 0x55, 0xD5]
+    txnibbles = []
+    rxnibbles = []
+    for txbyte in preamblebytes + txbytes + crcbytes:
+        txnibbles += [(txbyte >> shift) & 0b11 for shift in (0, 2, 4, 6)]
+
+    rmii_tx = RMIITx(tx_mem_port, txen, txd0, txd1, rx_mem_port)
+
+    def testbench():
+        for _ in range(10):
+            yield
+
+        yield (rmii_tx.tx_start.eq(1))
+        yield (rmii_tx.tx_offset.eq(txoffset))
+        yield (rmii_tx.tx_len.eq(len(txbytes)))
+        yield (rmii_tx.tx_split.eq(len(hdrbytes)))
+        yield (rmii_tx.tx_rx_offset.eq(rxoffset))
+
+        yield
+
+        yield (rmii_tx.tx_start.eq(0))
+
+        for _ in range((len(txbytes) + 12) * 4 + 120):
+            if (yield txen):
+                rxnibbles.append((yield txd0) | ((yield txd1) << 1))
+            yield
+
+        assert txnibbles == rxnibbles
+
+    mod = Module()
+    mod.submodules += rmii_tx, tx_mem_port, rx_mem_port
+
+    vcdf = open("rmii_tx_split.vcd", "w")
+    with pysim.Simulator(mod, vcd_file=vcdf) as sim:
+        sim.add_clock(1/50e6)
+        sim.add_sync_process(testbench())
+        sim.run()
+
+
+def test_rmii_tx_pause():
+    from nmigen.back import pysim
+    from nmigen import Memory
+    from .crc import make_crc32_table
+
+    txen = Signal()
+    txd0 = Signal()
+    txd1 = Signal()
+
+    mac_addr = [0x02, 0x44, 0x4E, 0x30, 0x76, 0x9E]
+    txbytes = [0xFF]*6 + mac_addr + [0x08, 0x00] + list(range(50))
+    mem = Memory(8, 128, txbytes)
+    mem_port = mem.read_port()
+
+    rmii_tx = RMIITx(mem_port, txen, txd0, txd1, mac_addr=mac_addr,
+                     pause_quanta=0x0100)
+
+    def pause_frame(quanta):
+        data = (PAUSE_ADDR + mac_addr + [0x88, 0x08, 0x00, 0x01,
+                                         quanta >> 8, quanta & 0xFF])
+        data += [0x00] * (60 - len(data))
+        table = make_crc32_table()
+        crc = 0xFFFFFFFF
+        for byte in data:
+            crc = table[(crc & 0xFF) ^ byte] ^ (crc >> 8)
+        crc ^= 0xFFFFFFFF
+        fcs = [(crc >> (8*x)) & 0xFF for x in range(4)]
+        return [0x55]*7 + [0xD5] + data + fcs
+
+    def rx_frame():
+        while not (yield txen):
+            yield
+        dibits = []
+        while (yield txen):
+            dibits.append((yield txd0) | ((yield txd1) << 1))
+            yield
+        return [sum(dibits[idx+n] << (2*n) for n in range(4))
+                for idx in range(0, len(dibits), 4)]
+
+    def testbench():
+        for _ in range(10):
+            yield
+
+        # Asserting xoff sends a PAUSE frame requesting pause_quanta
+        yield (rmii_tx.xoff.eq(1))
+        assert (yield from rx_frame()) == pause_frame(0x0100)
+
+        # Releasing xoff sends a PAUSE frame requesting zero pause time
+        yield (rmii_tx.xoff.eq(0))
+        assert (yield from rx_frame()) == pause_frame(0x0000)
+
+        for _ in range(100):
+            yield
+
+        # Receiving a PAUSE stops new packets for the requested quanta,
+        # where each quanta is 256 cycles at 100Mbps
+        yield (rmii_tx.pause_rx_quanta.eq(4))
+        yield (rmii_tx.pause_rx.eq(1))
+        yield
+        yield (rmii_tx.pause_rx.eq(0))
+        yield (rmii_tx.tx_start.eq(1))
+        yield (rmii_tx.tx_offset.eq(0))
+        yield (rmii_tx.tx_len.eq(len(txbytes)))
+        delay = 0
+        while not (yield txen):
+            if delay == 100:
+                assert (yield rmii_tx.paused)
+                assert not (yield rmii_tx.tx_ready)
+            delay += 1
+            yield
+        yield (rmii_tx.tx_start.eq(0))
+        assert 3*256 < delay <= 4*256 + 10
+        assert (yield rmii_tx.paused) == 0
+
+    mod = Module()
+    mod.submodules += rmii_tx, mem_port
+
+    vcdf = open("rmii_tx_pause.vcd", "w")
+    with pysim.Simulator(mod, vcd_file=vcdf) as sim:
+        sim.add_clock(1/50e6)
+        sim.add_sync_process(testbench())
+        sim.run()
+
+
+def test_rmii_tx_shaper():
+    import random
+    from nmigen.back import pysim
+    from nmigen import Memory
+
+    txen = Signal()
+    txd0 = Signal()
+    txd1 = Signal()
+
+    txbytes = [random.randint(0, 255) for _ in range(64)]
+    mem = Memory(8, 128, txbytes)
+    mem_port = mem.read_port()
+
+    rmii_tx = RMIITx(mem_port, txen, txd0, txd1, burst=0)
+
+    def testbench():
+        for _ in range(10):
+            yield
+
+        # Transmit the packet repeatedly with a 20 byte interpacket gap
+        yield (rmii_tx.ipg.eq(20))
+        yield (rmii_tx.tx_start.eq(1))
+        yield (rmii_tx.tx_offset.eq(0))
+        yield (rmii_tx.tx_len.eq(len(txbytes)))
+
+        def next_start():
+            cycles = 0
+            while (yield txen):
+                cycles += 1
+                yield
+            while not (yield txen):
+                cycles += 1
+                yield
+            return cycles
+
+        while not (yield txen):
+            yield
+        for _ in range(2):
+            gap = 0
+            while (yield txen):
+                yield
+            while not (yield txen):
+                gap += 1
+                yield
+            assert gap == 20 * 4
+
+        # Limit the rate to a quarter of the line rate, where each packet
+        # occupies 96 byte times including preamble, FCS, and gap
+        yield (rmii_tx.rate.eq(0x4000))
+        yield from next_start()
+        yield from next_start()
+        for _ in range(3):
+            cycles = yield from next_start()
+            assert abs(cycles - 4 * 96 * 4) <= 4
+
+    mod = Module()
+    mod.submodules += rmii_tx, mem_port
+    vcdf = open("rmii_tx_shaper.vcd", "w")
+    with pysim.Simulator(mod, vcd_file=vcdf) as sim:
+        sim.add_clock(1/50e6)
+        sim.add_sync_process(testbench())
+        sim.run()
+
+
+def test_rmii_tx_link():
+    from nmigen.back import pysim
+    from nmigen import Memory
+
+    txen = Signal()
+    txd0 = Signal()
+    txd1 = Signal()
+
+    mem = Memory(8, 128, [0xFF]*128)
+    mem_port = mem.read_port()
+
+    rmii_tx = RMIITx(mem_port, txen, txd0, txd1)
+
+    def testbench():
+        # Packets are held while the link is down
+        yield (rmii_tx.link_up.eq(0))
+        yield (rmii_tx.tx_start.eq(1))
+        yield (rmii_tx.tx_len.eq(64))
+        for _ in range(100):
+            yield
+            assert not (yield txen)
+            assert not (yield rmii_tx.tx_ready)
+            assert not (yield rmii_tx.tx_done)
+
+        # Packets are discarded while the link is down and flushing
+        yield (rmii_tx.flush.eq(1))
+        flushed = 0
+        for _ in range(100):
+            yield
+            assert not (yield txen)
+            if (yield rmii_tx.tx_flushed):
+                assert (yield rmii_tx.tx_done)
+                flushed += 1
+        assert flushed >= 2
+
+        # Packets are transmitted once the link is back up
+        yield (rmii_tx.link_up.eq(1))
+        for _ in range(100):
+            yield
+            assert not (yield rmii_tx.tx_flushed)
+        assert (yield txen)
+
+    mod = Module()
+    mod.submodules += rmii_tx, mem_port
+    vcdf = open("rmii_tx_link.vcd", "w")
+    with pysim.Simulator(mod, vcd_file=vcdf) as sim:
+        sim.add_clock(1/50e6)
+        sim.add_sync_process(testbench())
+        sim.run()
+
+
 def test_rmii_tx_byte():
     import random
     from nmigen.back import pysim
@@ -736,3 +1775,52 @@ def test_rmii_tx_byte():
         sim.add_clock(1/50e6)
         sim.add_sync_process(testbench())
         sim.run()
+
+
+def test_rmii_tx_byte_10mbps():
+    import random
+    from nmigen.back import pysim
+
+    txen = Signal()
+    txd0 = Signal()
+    txd1 = Signal()
+
+    rmii_tx_byte = RMIITxByte(txen, txd0, txd1)
+    data = rmii_tx_byte.data
+    data_valid = rmii_tx_byte.data_valid
+
+    def testbench():
+        yield (rmii_tx_byte.speed_10.eq(1))
+        for _ in range(10):
+            yield
+
+        txbytes = [random.randint(0, 255) for _ in range(8)]
+        txdibits = []
+        for txbyte in txbytes:
+            for dibit in range(0, 8, 2):
+                txdibits += [(txbyte >> dibit) & 0b11] * 10
+        rxdibits = []
+
+        # Each byte is latched as the previous one finishes, so update the
+        # data once each byte has started
+        yield (data.eq(txbytes[0]))
+        yield (data_valid.eq(1))
+        while not (yield txen):
+            yield
+        for txbyte in txbytes[1:] + [None]:
+            if txbyte is None:
+                yield (data_valid.eq(0))
+            else:
+                yield (data.eq(txbyte))
+            for _ in range(40):
+                rxdibits.append((yield txd0) | ((yield txd1) << 1))
+                yield
+
+        assert (yield txen) == 0
+        assert txdibits == rxdibits
+
+    vcdf = open("rmii_tx_byte_10mbps.vcd", "w")
+    with pysim.Simulator(rmii_tx_byte, vcd_file=vcdf) as sim:
+        sim.add_clock(1/50e6)
+        sim.add_sync_process(testbench())
+        sim.run()
@@ -0,0 +1,127 @@
+"""
+Ethernet Receive Filter
+
+Copyright 2018-2019 Adam Greig
+Released under the MIT license; see LICENSE for details.
+"""
+
+import operator
+from functools import reduce
+
+from nmigen import Elaboratable, Module, Signal, Cat
+
+
+class RxFilter(Elaboratable):
+    """
+    Receive Filter
+
+    Inspects the ethertype and IPv4 protocol of incoming frames so that
+    frames which will not be handled can be discarded before they are
+    entirely received.
+
+    Parameters:
+        * `ethertypes`: List of ethertypes to accept, or None to accept all
+        * `ip_protocols`: List of IPv4 protocols to accept, or None to accept
+                          all. Only applies to frames with ethertype 0x0800.
+
+    Inputs:
+        * `reset`: Restart filtering at the start of a new frame
+        * `data`: 8-bit input data
+        * `data_valid`: Pulsed high when new data is ready at `data`.
+
+    Outputs:
+        * `reject`: High once the frame has failed a filter rule.
+                    Remains high until `reset` is asserted.
+    """
+    def __init__(self, ethertypes=None, ip_protocols=None):
+        # Inputs
+        self.reset = Signal()
+        self.data = Signal(8)
+        self.data_valid = Signal()
+
+        # Outputs
+        self.reject = Signal()
+
+        # Parameters
+        self.ethertypes = ethertypes
+        self.ip_protocols = ip_protocols
+
+    def elaborate(self, platform):
+        m = Module()
+
+        # Offsets of the ethertype and IPv4 protocol fields in the frame
+        etype_idx = 12
+        proto_idx = 14 + 9
+
+        idx = Signal(max=proto_idx+2)
+        ethertype = Signal(16)
+        new_ethertype = Cat(self.data, ethertype[8:16])
+
+        with m.If(self.reset):
+            m.d.sync += [
+                idx.eq(0),
+                self.reject.eq(0),
+            ]
+        with m.Elif(self.data_valid & (idx != proto_idx + 1)):
+            m.d.sync += idx.eq(idx + 1)
+
+            with m.If(idx == etype_idx):
+                m.d.sync += ethertype[8:16].eq(self.data)
+
+            with m.If(idx == etype_idx + 1):
+                m.d.sync += ethertype[0:8].eq(self.data)
+                if self.ethertypes is not None:
+                    m.d.sync += self.reject.eq(~reduce(operator.or_, [
+                        new_ethertype == etype for etype in self.ethertypes
+                    ], 0))
+
+            with m.If(idx == proto_idx):
+                if self.ip_protocols is not None:
+                    with m.If(ethertype == 0x0800):
+                        m.d.sync += self.reject.eq(~reduce(operator.or_, [
+                            self.data == proto for proto in self.ip_protocols
+                        ], 0))
+
+        return m
+
+
+def test_rx_filter():
+    from nmigen.back import pysim
+
+    rx_filter = RxFilter(ethertypes=[0x0806, 0x0800], ip_protocols=[1, 17])
+
+    data = rx_filter.data
+    data_valid = rx_filter.data_valid
+    reset = rx_filter.reset
+
+    def frame(ethertype, protocol):
+        return ([0xFF]*12 + [ethertype >> 8, ethertype & 0xFF]
+                + [0x45] + [0]*8 + [protocol] + [0]*20)
+
+    def testbench():
+        for ethertype, protocol, reject in (
+            (0x0800, 17, 0),
+            (0x0800, 1, 0),
+            (0x0800, 6, 1),
+            (0x0806, 6, 0),
+            (0x86DD, 17, 1),
+        ):
+            yield (reset.eq(1))
+            yield
+            yield (reset.eq(0))
+            yield
+
+            for byte in frame(ethertype, protocol):
+                yield (data.eq(byte))
+                yield (data_valid.eq(1))
+                yield
+                yield (data_valid.eq(0))
+                yield
+
+            assert (yield rx_filter.reject) == reject
+
+    vcdf = open("rx_filter.vcd", "w")
+    with pysim.Simulator(rx_filter, vcd_file=vcdf) as sim:
+        sim.add_clock(1e-6)
+        sim.add_sync_process(testbench())
+        sim.run()
@@ -3,12 +3,145 @@ Copyright 2018-2019 Adam Greig
 Released under the MIT license; see LICENSE for details.
 """
 
-from nmigen import Elaboratable, Signal, Module, ClockDomain
+from nmigen import Elaboratable, Signal, Module, ClockDomain, Mux, Cat
 from .platform import SB_PLL40_PAD
 
-from .ethernet.mac import MAC
+from .ethernet.mac import MAC, LOOPBACK_OFF
 from .ethernet.ip import IPStack
+from .csr import CSR, CSRBank
 from .user import User
+from .capture import (SawtoothSource, Trigger, TriggeredCapture,
+                      SampleSerialiser, BurstBuffer)
+from .dsp import Decimator, RiceEncoder
+
+
+# Length of user UDP packets on the switch
+SWITCH_UDP_LEN = 64
+
+# Depth of the switch MAC's RX FIFO, and the RX FIFO level at which the link
+# partner is asked to pause, leaving room for frames already in flight
+SWITCH_RX_FIFO_DEPTH = 32
+SWITCH_PAUSE_THRESHOLD = SWITCH_RX_FIFO_DEPTH // 2
+
+# Number of fragmented datagrams the switch may reassemble at once, and the
+# size of each reassembly buffer, a power of two holding a user datagram
+SWITCH_REASM_CONTEXTS = 2
+SWITCH_REASM_SIZE = 128
+
+# Number of additional MAC addresses the switch may receive
+SWITCH_MAC_TABLE_SIZE = 2
+
+# Width of captured samples, and depth of the capture buffer in samples
+CAPTURE_WIDTH = 16
+CAPTURE_DEPTH = 1024
+
+# Largest log2 of the sample decimation ratio, and three-tap compensation
+# of the CIC passband droop after decimation, with unity gain at DC
+DECIM_MAX_LOG2_RATIO = 8
+DECIM_FIR_TAPS = [-2, 20, -2]
+DECIM_FIR_SHIFT = 4
+
+# Depth of the buffer gathering Rice encoded bytes into packets, and the
+# space kept free in it for the longest code and its padding
+RICE_BUFFER_DEPTH = 512
+RICE_BUFFER_RESERVE = 8
+
+# Control and status registers on the switch, in address order
+SWITCH_CSRS = [
+    CSR("tx_ipg", 8, reset=12,
+        desc="Interpacket gap in byte times, at least 12"),
+    CSR("tx_rate", 16,
+        desc="Maximum transmit rate in units of 1/65536 of the line rate, "
+             "or 0 for no limit"),
+    CSR("multicast_hash_lo", 32,
+        desc="Bits 31:0 of the mask of multicast address hashes to receive"),
+    CSR("multicast_hash_hi", 32,
+        desc="Bits 63:32 of the mask of multicast address hashes to "
+             "receive"),
+    *[csr for idx in range(SWITCH_MAC_TABLE_SIZE) for csr in (
+        CSR(f"mac_table{idx}_hi", 16,
+            desc=f"First two bytes of additional MAC address {idx}"),
+        CSR(f"mac_table{idx}_lo", 32,
+            desc=f"Last four bytes of additional MAC address {idx}"))],
+    CSR("mac_table_valid", SWITCH_MAC_TABLE_SIZE,
+        desc="Mask of additional MAC addresses to receive"),
+    CSR("link_status", 2, "ro",
+        desc="Bit 0 set while the link is up, bit 1 set at 10Mbps"),
+    CSR("rx_fifo_hwm", 8, "ro",
+        desc="Most received packets waiting at once"),
+    CSR("tx_fifo_hwm", 8, "ro",
+        desc="Most packets waiting at once to be transmitted"),
+    CSR("rx_dropped", 32, "ro",
+        desc="Received packets dropped as the RX FIFO was full"),
+    CSR("tx_dropped", 32, "ro",
+        desc="Packets dropped as the TX FIFO was full"),
+    CSR("rx_runt_errors", 32, "ro", desc="Runt frames received"),
+    CSR("rx_oversize_errors", 32, "ro", desc="Oversize frames received"),
+    CSR("rx_align_errors", 32, "ro",
+        desc="Frames received not ending on a byte boundary"),
+    CSR("rx_crc_errors", 32, "ro", desc="Frames received with a bad FCS"),
+    CSR("rx_filtered_frames", 32, "ro",
+        desc="Frames discarded by destination, ethertype or protocol"),
+    CSR("link_down_events", 32, "ro", desc="Times the link has gone down"),
+    CSR("tx_flushed_frames", 32, "ro",
+        desc="Packets discarded as the link was down"),
+    CSR("tx_paused", 1, "ro",
+        desc="Set while transmission is paused by the link partner"),
+    CSR("rx_pause_frames", 32, "ro", desc="PAUSE frames received"),
+    CSR("tx_pause_frames", 32, "ro", desc="PAUSE frames transmitted"),
+    CSR("tx_free", 12, "ro",
+        desc="Bytes of TX memory not used by packets waiting to be sent"),
+    CSR("tx_full_events", 32, "ro",
+        desc="Times processing stalled waiting for free TX memory"),
+    CSR("prbs_tx_enable", 1, desc="Set to send PRBS link test packets"),
+    CSR("prbs_tx_len", 11, reset=1472, max=1472,
+        desc="UDP payload length of PRBS packets, from 5 to 1472"),
+    CSR("prbs_rx_clear", 1, desc="Write to clear the PRBS receive counters"),
+    CSR("prbs_tx_frames", 32, "ro", desc="PRBS packets sent"),
+    CSR("prbs_rx_frames", 32, "ro", desc="PRBS packets received"),
+    CSR("prbs_rx_lost", 32, "ro", desc="PRBS packets lost"),
+    CSR("prbs_rx_bit_errors", 32, "ro", desc="PRBS bit errors"),
+    CSR("source_period", 16, reset=99,
+        desc="Clocks between test source samples, less one"),
+    CSR("source_step", CAPTURE_WIDTH, reset=1,
+        desc="Increment of the test source sawtooth per sample"),
+    CSR("decim_log2_ratio", 4, max=DECIM_MAX_LOG2_RATIO,
+        desc=f"log2 of the sample decimation ratio, at most "
+             f"{DECIM_MAX_LOG2_RATIO}"),
+    CSR("decim_fir_en", 1,
+        desc="Set to filter decimated samples, which then drops samples "
+             "arriving within 5 clocks of the previous one"),
+    CSR("trigger_mode", 3, max=4,
+        desc="Trigger mode: 0 off, 1 above, 2 at or below, 3 rising "
+             "through or 4 falling through trigger_level"),
+    CSR("trigger_level", CAPTURE_WIDTH,
+        desc="Trigger threshold, two's complement"),
+    CSR("capture_pre_len", 11, max=CAPTURE_DEPTH-1,
+        desc=f"Samples captured before the trigger, at most "
+             f"{CAPTURE_DEPTH-1}"),
+    CSR("capture_post_len", 11, reset=1, max=CAPTURE_DEPTH,
+        desc=f"Samples captured from the trigger, at least 1, and reduced "
+             f"to fit {CAPTURE_DEPTH} samples with capture_pre_len"),
+    CSR("capture_arm", 1, desc="Write to arm the capture"),
+    CSR("capture_rearm", 1,
+        desc="Set to arm the capture again after each is sent"),
+    CSR("capture_status", 2, "ro",
+        desc="Bit 0 set while armed, bit 1 set from the trigger until "
+             "the capture has been read out for sending"),
+    CSR("capture_tx_len", 11, reset=1024, max=1468,
+        desc="Most capture bytes in each packet, or 0 to pause sending"),
+    CSR("capture_tx_frames", 32, "ro", desc="Capture packets sent"),
+    CSR("capture_rice", 1,
+        desc="Set to send captures Rice encoded instead of as raw samples, "
+             "changing only once a capture has been sent"),
+    CSR("rice_k", 4, reset=4, max=CAPTURE_WIDTH-1,
+        desc=f"Rice parameter for encoded captures, at most "
+             f"{CAPTURE_WIDTH-1}"),
+    CSR("rice_samples_in", 32, "ro", desc="Samples Rice encoded"),
+    CSR("rice_bytes_out", 32, "ro",
+        desc="Bytes produced by the Rice encoder, which with "
+             "rice_samples_in gives the compression ratio"),
+]
 
 
 class LEDBlinker(Elaboratable):
@@ -73,7 +206,16 @@ class SwitchTop(Top):
         rmii = platform.request("rmii")
         mdio = platform.request("mdio")
         mac_addr = "02:44:4E:30:76:9E"
-        mac = MAC(100e6, 0, mac_addr, rmii, mdio, phy.rst, phy.led)
+        # Only receive the ARP and IPv4 ICMP/UDP frames IPStack handles,
+        # ask the link partner to pause while the RX FIFO fills up, and
+        # watch the link status continuously to see changes quickly
+        mac = MAC(100e6, 0, mac_addr, rmii, mdio, phy.rst, phy.led,
+                  ethertypes=[0x0806, 0x0800], ip_protocols=[0x01, 0x11],
+                  mac_table_size=SWITCH_MAC_TABLE_SIZE,
+                  rx_fifo_depth=SWITCH_RX_FIFO_DEPTH, flow_control=True,
+                  pause_threshold=SWITCH_PAUSE_THRESHOLD,
+                  phy_suppress_preamble=True, phy_fast_link_poll=True,
+                  loopback=True)
         m.submodules.mac = mac
 
         # Explicitly zero unused inputs in MAC
@@ -81,19 +223,31 @@ class SwitchTop(Top):
             mac.phy_reset.eq(0),
         ]
 
+        # Control and status registers
+        m.submodules.csr_bank = csr_bank = CSRBank(SWITCH_CSRS)
+
         # User data stuff
-        user = User()
+        user = User(100e6, SWITCH_UDP_LEN, csr_bank,
+                    len(mac.phy_manager.shadow_regs))
         m.submodules.user = user
 
-        # IP stack
+        # IP stack. Replies are not sent in place with shared_buffer, as
+        # the MAC's descriptor loopback, used for the PRBS link test, cannot
+        # carry packets sent in place from RX memory.
         ip4_addr = "10.1.1.5"
         m.submodules.ipstack = ipstack = IPStack(
-            mac_addr, ip4_addr, 16, 1735, mac.rx_port, mac.tx_port,
-            user.mem_r_port, user.mem_w_port)
+            mac_addr, ip4_addr, SWITCH_UDP_LEN, 1735, mac.rx_port,
+            mac.tx_port, user.mem_r_port, user.mem_w_port,
+            reasm_contexts=SWITCH_REASM_CONTEXTS,
+            reasm_size=SWITCH_REASM_SIZE, prbs_port=1736, capture_port=1737)
         m.d.comb += [
             mac.tx_start.eq(ipstack.tx_start),
             mac.tx_len.eq(ipstack.tx_len),
             mac.tx_offset.eq(ipstack.tx_offset),
+            mac.tx_split.eq(ipstack.tx_split),
+            mac.tx_rx_offset.eq(ipstack.tx_rx_offset),
+            ipstack.tx_free.eq(mac.tx_free),
+            ipstack.tx_done.eq(mac.tx_done),
             ipstack.rx_valid.eq(mac.rx_valid),
             ipstack.rx_len.eq(mac.rx_len),
             ipstack.rx_offset.eq(mac.rx_offset),
@@ -103,4 +257,141 @@ class SwitchTop(Top):
             user.packet_received.eq(ipstack.user_rx),
         ]
 
+        # Send PRBS link test packets to whoever last sent us user data,
+        # or to ourselves in MAC loopback, under control of the CSRs
+        looped = Signal()
+        dst_mac = Signal(48)
+        dst_ip4 = Signal(32)
+        m.d.comb += [
+            looped.eq(user.loopback_mode != LOOPBACK_OFF),
+            dst_mac.eq(Mux(looped, ipstack.mac_addr, ipstack.user_last_mac)),
+            dst_ip4.eq(Mux(looped, ipstack.ip4_addr, ipstack.user_last_ip4)),
+            mac.loopback_mode.eq(user.loopback_mode),
+            ipstack.udp_echo.eq(user.udp_echo),
+            ipstack.prbs_tx_enable.eq(csr_bank["prbs_tx_enable"]),
+            ipstack.prbs_tx_len.eq(csr_bank["prbs_tx_len"]),
+            ipstack.prbs_dst_mac.eq(dst_mac),
+            ipstack.prbs_dst_ip4.eq(dst_ip4),
+            ipstack.prbs_rx_clear.eq(csr_bank.strobe("prbs_rx_clear")),
+        ]
+
+        # Capture decimated samples from the test source on a trigger, and
+        # send them to the same destination as PRBS packets
+        m.submodules.source = source = SawtoothSource(CAPTURE_WIDTH)
+        m.submodules.decimator = decimator = Decimator(
+            CAPTURE_WIDTH, 3, DECIM_MAX_LOG2_RATIO, pipeline=2,
+            fir_taps=DECIM_FIR_TAPS, fir_shift=DECIM_FIR_SHIFT)
+        m.submodules.trigger = trigger = Trigger(CAPTURE_WIDTH)
+        m.submodules.capture = capture = TriggeredCapture(
+            CAPTURE_WIDTH, CAPTURE_DEPTH)
+        m.submodules.serialiser = serialiser = SampleSerialiser(CAPTURE_WIDTH)
+        pre_len = csr_bank["capture_pre_len"]
+        post_len = csr_bank["capture_post_len"]
+        post_room = Signal(max=CAPTURE_DEPTH+1)
+        m.d.comb += [
+            source.period.eq(csr_bank["source_period"]),
+            source.step.eq(csr_bank["source_step"]),
+            decimator.in_data.eq(source.out_data),
+            decimator.in_valid.eq(source.out_valid),
+            decimator.log2_ratio.eq(csr_bank["decim_log2_ratio"]),
+            decimator.fir_en.eq(csr_bank["decim_fir_en"]),
+            trigger.in_data.eq(decimator.out_data),
+            trigger.in_valid.eq(decimator.out_valid),
+            trigger.mode.eq(csr_bank["trigger_mode"]),
+            trigger.level.eq(csr_bank["trigger_level"]),
+            capture.in_data.eq(decimator.out_data),
+            capture.in_valid.eq(decimator.out_valid),
+            capture.trigger.eq(trigger.trigger),
+            capture.arm.eq(csr_bank.strobe("capture_arm")),
+            capture.rearm.eq(csr_bank["capture_rearm"]),
+            capture.pre_len.eq(pre_len),
+            post_room.eq(CAPTURE_DEPTH - pre_len),
+            capture.post_len.eq(
+                Mux(post_len == 0, 1,
+                    Mux(post_len > post_room, post_room, post_len))),
+            csr_bank["capture_status"].eq(Cat(capture.armed, capture.busy)),
+            ipstack.capture_tx_len.eq(csr_bank["capture_tx_len"]),
+            ipstack.capture_dst_mac.eq(dst_mac),
+            ipstack.capture_dst_ip4.eq(dst_ip4),
+        ]
+
+        # Send captures as raw samples, or Rice encoded with each capture
+        # one block. The encoder produces at most one byte per 8 clocks, so
+        # its bytes are gathered into bursts before being sent.
+        m.submodules.rice = rice = RiceEncoder(CAPTURE_WIDTH)
+        m.submodules.rice_buffer = rice_buffer = BurstBuffer(
+            RICE_BUFFER_DEPTH, RICE_BUFFER_RESERVE)
+        rice_en = csr_bank["capture_rice"]
+        m.d.comb += [
+            serialiser.in_data.eq(capture.out_data),
+            serialiser.in_valid.eq(capture.out_valid & ~rice_en),
+            serialiser.in_last.eq(capture.out_last),
+            serialiser.out_ready.eq(ipstack.capture_ready & ~rice_en),
+            rice.in_data.eq(capture.out_data),
+            rice.in_valid.eq(
+                capture.out_valid & rice_en & rice_buffer.in_room),
+            rice.in_last.eq(capture.out_last),
+            rice.k.eq(csr_bank["rice_k"]),
+            rice.flush.eq(0),
+            rice_buffer.in_data.eq(rice.out_data),
+            rice_buffer.in_valid.eq(rice.out_valid),
+            rice_buffer.in_last.eq(rice.out_last),
+            rice_buffer.burst_len.eq(csr_bank["capture_tx_len"]),
+            rice_buffer.out_ready.eq(ipstack.capture_ready & rice_en),
+            csr_bank["rice_samples_in"].eq(rice.samples_in),
+            csr_bank["rice_bytes_out"].eq(rice.bytes_out),
+        ]
+        with m.If(rice_en):
+            m.d.comb += [
+                capture.out_ready.eq(rice.in_ready & rice_buffer.in_room),
+                ipstack.capture_data.eq(rice_buffer.out_data),
+                ipstack.capture_valid.eq(rice_buffer.out_valid),
+                ipstack.capture_last.eq(rice_buffer.out_last),
+            ]
+        with m.Else():
+            m.d.comb += [
+                capture.out_ready.eq(serialiser.in_ready),
+                ipstack.capture_data.eq(serialiser.out_data),
+                ipstack.capture_valid.eq(serialiser.out_valid),
+                ipstack.capture_last.eq(serialiser.out_last),
+            ]
+
+        # Expose MAC tuning and statistics through the CSRs
+        m.d.comb += [
+            mac.tx_ipg.eq(csr_bank["tx_ipg"]),
+            mac.tx_rate.eq(csr_bank["tx_rate"]),
+            mac.multicast_hash.eq(Cat(csr_bank["multicast_hash_lo"],
+                                      csr_bank["multicast_hash_hi"])),
+            mac.mac_table_valid.eq(csr_bank["mac_table_valid"]),
+            csr_bank["link_status"].eq(Cat(mac.link_up, mac.speed_10)),
+        ]
+        for idx, entry in enumerate(mac.mac_table):
+            m.d.comb += entry.eq(Cat(csr_bank[f"mac_table{idx}_lo"],
+                                     csr_bank[f"mac_table{idx}_hi"]))
+        for csr in SWITCH_CSRS:
+            for block in (mac, ipstack):
+                if csr.access == "ro" and hasattr(block, csr.name):
+                    m.d.comb += csr_bank[csr.name].eq(
+                        getattr(block, csr.name))
+                    break
+
+        # Give the user application access to the PHY
+        phy_manager = mac.phy_manager
+        m.d.comb += [
+            phy_manager.mdio_phy_addr.eq(user.mdio_phy_addr),
+            phy_manager.mdio_op.eq(user.mdio_op),
+            phy_manager.mdio_reg_addr.eq(user.mdio_reg_addr),
+            phy_manager.mdio_devad.eq(user.mdio_devad),
+            phy_manager.mdio_write_data.eq(user.mdio_write_data),
+            phy_manager.mdio_req_valid.eq(user.mdio_req_valid),
+            phy_manager.shadow_sel.eq(user.shadow_sel),
+            phy_manager.poll_sel.eq(user.poll_sel),
+            phy_manager.poll_period.eq(user.poll_period),
+            phy_manager.poll_we.eq(user.poll_we),
+            user.mdio_req_ready.eq(phy_manager.mdio_req_ready),
+            user.mdio_resp_valid.eq(phy_manager.mdio_resp_valid),
+            user.mdio_resp_data.eq(phy_manager.mdio_resp_data),
+            user.shadow_data.eq(phy_manager.shadow_data),
+        ]
+
         return m
@@ -1,10 +1,77 @@
-from nmigen import Elaboratable, Module, Signal, Memory
+from nmigen import Elaboratable, Module, Signal, Memory, Array, Cat
+from .csr import CSRHandler, CSR_HEADER_LEN, CSR_OP_LEN
+
+
+# Commands in the first byte of received user packets
+CMD_MDIO = ord("M")
+CMD_SHADOW = ord("S")
+CMD_POLL = ord("P")
+CMD_LOOPBACK = ord("L")
+CMD_CSR = ord("R")
+
+# Replaces the command byte in replies to rejected commands
+CMD_NAK = ord("N")
+
+# Flag in the second byte of `CMD_LOOPBACK` packets, whose lowest two bits
+# are the MAC loopback mode
+LOOPBACK_UDP_ECHO = 0x04
 
 
 class User(Elaboratable):
-    def __init__(self):
-        self.user_rx_mem = Memory(8, 32)
-        self.user_tx_mem = Memory(8, 32,
+    """
+    User application.
+
+    Replies to each received user packet. Packets starting with a command
+    byte give access to the PHY through a `PHYManager`, control loopback,
+    or access control and status registers, and are replied to with the
+    result. Other packets set the user LEDs from their first byte and are
+    replied to with a greeting.
+
+    Command packets are 8 bytes, except for `CMD_CSR` batches, which are
+    variable length, set by their count of ops as described by
+    `CSRHandler`:
+        * 0: `CMD_MDIO`, `CMD_SHADOW`, `CMD_POLL`, `CMD_LOOPBACK`, or
+             `CMD_CSR`
+        * 1: MDIO operation for `CMD_MDIO`, register shadow index, or
+             loopback mode and flags
+        * 2: PHY address
+        * 3: MMD device address
+        * 4-5: Register address, big-endian
+        * 6-7: Data to write, poll period in ms, or loopback duration in
+               ms, big-endian
+
+    `CMD_MDIO` queues an MDIO request, `CMD_SHADOW` reads the register
+    shadow, and `CMD_POLL` sets a register's poll period. The reply is the
+    command with bytes 6-7 replaced by the data read, or unchanged for
+    writes. `CMD_SHADOW` and `CMD_POLL` commands with a register shadow
+    index of `n_shadow` or more are not carried out, and are replied to
+    with their command byte replaced by `CMD_NAK`.
+
+    `CMD_LOOPBACK` sets the MAC loopback mode, which returns to
+    `LOOPBACK_OFF` after the given duration as the board cannot be reached
+    over the network until then, and echoes user packets instead of
+    receiving them while `LOOPBACK_UDP_ECHO` is set.
+
+    `CMD_CSR` packets instead contain a batch of register operations, which
+    are carried out by a `CSRHandler` and replied to as it describes.
+
+    Replies are written over the start of the greeting.
+
+    Parameters:
+        * `clk_freq`: Clock frequency, used to time loopback
+        * `udp_len`: Length of user packets, at least 16
+        * `csr_bank`: `CSRBank` to access with `CMD_CSR`, or None
+        * `n_shadow`: Number of register shadows in the `PHYManager`
+
+    Outputs/Inputs:
+        PHY access ports named as in `PHYManager`, to be connected to it
+        * `loopback_mode`: Output, MAC loopback mode
+        * `udp_echo`: Output, IPStack UDP echo enable
+    """
+    def __init__(self, clk_freq=100e6, udp_len=32, csr_bank=None,
+                 n_shadow=256):
+        self.user_rx_mem = Memory(8, udp_len)
+        self.user_tx_mem = Memory(8, udp_len,
                                   [ord(x) for x in "Hello, World!!\r\n"])
         self.mem_r_port = self.user_tx_mem.read_port()
         self.mem_w_port = self.user_rx_mem.write_port()
@@ -12,6 +79,33 @@ class User(Elaboratable):
         self.transmit_ready = Signal()
         self.transmit_packet = Signal()
 
+        # PHY access outputs
+        self.mdio_phy_addr = Signal(5)
+        self.mdio_op = Signal(2)
+        self.mdio_reg_addr = Signal(16)
+        self.mdio_devad = Signal(5)
+        self.mdio_write_data = Signal(16)
+        self.mdio_req_valid = Signal()
+        self.shadow_sel = Signal(max=n_shadow)
+        self.poll_sel = Signal(max=n_shadow)
+        self.poll_period = Signal(16)
+        self.poll_we = Signal()
+
+        # Loopback outputs
+        self.loopback_mode = Signal(2)
+        self.udp_echo = Signal()
+
+        # PHY access inputs
+        self.mdio_req_ready = Signal()
+        self.mdio_resp_valid = Signal()
+        self.mdio_resp_data = Signal(16)
+        self.shadow_data = Signal(16)
+
+        self.clk_freq = clk_freq
+        self.udp_len = udp_len
+        self.csr_bank = csr_bank
+        self.n_shadow = n_shadow
+
     def elaborate(self, platform):
         m = Module()
         rx_port = self.user_rx_mem.read_port()
@@ -22,24 +116,138 @@ class User(Elaboratable):
         led1 = platform.request("user_led", 0)
         led2 = platform.request("user_led", 1)
 
+        # Received command, and the data to reply with
+        cmd = [Signal(8, name=f"cmd_{idx}") for idx in range(8)]
+        cmd_idx = Signal(max=9)
+        reply_data = Signal(32)
+        reply = Array(cmd[:4] + [reply_data[24:32], reply_data[16:24],
+                                 reply_data[8:16], reply_data[0:8]])
+
+        # Shadow indices past the PHYManager's register shadows are rejected
+        shadow_bad = Signal()
+        m.d.comb += shadow_bad.eq(cmd[1] >= self.n_shadow)
+
         m.d.comb += [
-            tx_port.addr.eq(0),
+            tx_port.addr.eq(cmd_idx),
             tx_port.en.eq(0),
-            tx_port.data.eq(0),
-            rx_port.addr.eq(0),
+            tx_port.data.eq(reply[cmd_idx]),
+            rx_port.addr.eq(cmd_idx),
+            self.mdio_op.eq(cmd[1]),
+            self.mdio_phy_addr.eq(cmd[2]),
+            self.mdio_devad.eq(cmd[3]),
+            self.mdio_reg_addr.eq(Cat(cmd[5], cmd[4])),
+            self.mdio_write_data.eq(Cat(cmd[7], cmd[6])),
+            self.shadow_sel.eq(cmd[1]),
+            self.poll_sel.eq(cmd[1]),
+            self.poll_period.eq(Cat(cmd[7], cmd[6])),
         ]
 
-        m.d.sync += [
-            led1.eq(rx_port.data & 1),
-            led2.eq((rx_port.data & 2) >> 1),
-        ]
+        if self.csr_bank is not None:
+            max_ops = (self.udp_len - CSR_HEADER_LEN) // CSR_OP_LEN
+            csr_handler = CSRHandler(self.csr_bank, max_ops)
+            m.submodules.csr_handler = csr_handler
+            m.d.comb += csr_handler.rx_data.eq(rx_port.data)
+
+        # Count down the MAC loopback duration in ms
+        ms_ticks = int(self.clk_freq // 1000)
+        ms_ctr = Signal(max=ms_ticks)
+        loopback_ms = Signal(16)
+        with m.If(ms_ctr == ms_ticks - 1):
+            m.d.sync += ms_ctr.eq(0)
+            with m.If(loopback_ms != 0):
+                m.d.sync += loopback_ms.eq(loopback_ms - 1)
+            with m.Else():
+                m.d.sync += self.loopback_mode.eq(0)
+        with m.Else():
+            m.d.sync += ms_ctr.eq(ms_ctr + 1)
 
         with m.FSM():
             with m.State("IDLE"):
-                m.d.sync += self.transmit_packet.eq(0)
+                m.d.sync += [
+                    self.transmit_packet.eq(0),
+                    cmd_idx.eq(0),
+                ]
                 with m.If(self.packet_received):
-                    m.next = "RX"
-            with m.State("RX"):
+                    m.next = "READ"
+
+            # Read the command, shifting in one byte per clock
+            with m.State("READ"):
+                m.d.sync += cmd_idx.eq(cmd_idx + 1)
+                with m.If(cmd_idx != 0):
+                    m.d.sync += [dst.eq(src) for dst, src
+                                 in zip(cmd, list(cmd[1:]) + [rx_port.data])]
+                with m.If(cmd_idx == 8):
+                    m.d.sync += [
+                        cmd_idx.eq(0),
+                        reply_data.eq(
+                            Cat(rx_port.data, cmd[7], cmd[6], cmd[5])),
+                    ]
+                    m.next = "DISPATCH"
+
+            with m.State("DISPATCH"):
+                with m.Switch(cmd[0]):
+                    with m.Case(CMD_MDIO):
+                        m.d.comb += self.mdio_req_valid.eq(1)
+                        with m.If(self.mdio_req_ready):
+                            m.next = "MDIO_WAIT"
+                    with m.Case(CMD_SHADOW):
+                        with m.If(shadow_bad):
+                            m.d.sync += cmd[0].eq(CMD_NAK)
+                        with m.Else():
+                            m.d.sync += reply_data[:16].eq(self.shadow_data)
+                        m.next = "REPLY"
+                    with m.Case(CMD_POLL):
+                        with m.If(shadow_bad):
+                            m.d.sync += cmd[0].eq(CMD_NAK)
+                        with m.Else():
+                            m.d.comb += self.poll_we.eq(1)
+                        m.next = "REPLY"
+                    with m.Case(CMD_LOOPBACK):
+                        m.d.sync += [
+                            self.loopback_mode.eq(cmd[1][:2]),
+                            self.udp_echo.eq(
+                                (cmd[1] & LOOPBACK_UDP_ECHO) != 0),
+                            loopback_ms.eq(Cat(cmd[7], cmd[6])),
+                            ms_ctr.eq(0),
+                        ]
+                        m.next = "REPLY"
+                    if self.csr_bank is not None:
+                        with m.Case(CMD_CSR):
+                            m.d.comb += csr_handler.start.eq(1)
+                            m.next = "CSR"
+                    with m.Case():
+                        m.d.sync += [
+                            led1.eq(cmd[0][0]),
+                            led2.eq(cmd[0][1]),
+                        ]
+                        m.next = "SEND"
+
+            # Let the CSR handler write its reply over the transmit data
+            if self.csr_bank is not None:
+                with m.State("CSR"):
+                    m.d.comb += [
+                        rx_port.addr.eq(csr_handler.rx_addr),
+                        tx_port.addr.eq(csr_handler.tx_addr),
+                        tx_port.data.eq(csr_handler.tx_data),
+                        tx_port.en.eq(csr_handler.tx_en),
+                    ]
+                    with m.If(csr_handler.done):
+                        m.next = "SEND"
+
+            with m.State("MDIO_WAIT"):
+                with m.If(self.mdio_resp_valid):
+                    with m.If(~self.mdio_op[0]):
+                        m.d.sync += reply_data[:16].eq(self.mdio_resp_data)
+                    m.next = "REPLY"
+
+            # Write the reply over the start of the transmit data
+            with m.State("REPLY"):
+                m.d.comb += tx_port.en.eq(1)
+                m.d.sync += cmd_idx.eq(cmd_idx + 1)
+                with m.If(cmd_idx == 7):
+                    m.next = "SEND"
+
+            with m.State("SEND"):
                 with m.If(self.transmit_ready):
                     m.d.sync += self.transmit_packet.eq(1)
                     m.next = "IDLE"
@@ -9,26 +9,55 @@ from nmigen import Module, Signal, Cat, Elaboratable
 
 
 class LFSR(Elaboratable):
+    """
+    Maximal length Fibonacci linear feedback shift register.
+
+    Parameters:
+        * `k`: Register length, one of the keys of `TAPS`
+        * `n`: Number of bits shifted in per clock
+
+    Inputs:
+        * `reset`: Load `seed` into the register
+        * `seed`: k-bit non-zero initial state, 1 by default
+        * `en`: Shift the register while high, high by default
+
+    Outputs:
+        * `state`: k-bit register state
+        * `next`: k-bit state after the next shift, whose lowest `n` bits
+                  are the newly generated bits, the newest in bit 0
+    """
     TAPS = {7: 6, 9: 5, 11: 9, 15: 14, 20: 3, 23: 18, 31: 28}
 
-    def __init__(self, k):
+    def __init__(self, k, n=1):
         self.reset = Signal()
+        self.seed = Signal(k, reset=1)
+        self.en = Signal(reset=1)
         self.state = Signal(k, reset=1)
+        self.next = Signal(k)
 
         if k not in LFSR.TAPS.keys():
             raise ValueError(f"k={k} invalid for LFSR")
+        if not 1 <= n <= k:
+            raise ValueError(f"n={n} invalid for LFSR with k={k}")
 
         self.k = k
+        self.n = n
 
     def elaborate(self, platform):
         m = Module()
-        x = Signal()
         tap = LFSR.TAPS[self.k]
-        m.d.comb += x.eq(self.state[self.k-1] ^ self.state[tap-1])
+
+        # Unroll n shifts, each feeding back into bit 0
+        bits = [self.state[i] for i in range(self.k)]
+        for _ in range(self.n):
+            x = bits[self.k-1] ^ bits[tap-1]
+            bits = [x] + bits[:-1]
+        m.d.comb += self.next.eq(Cat(*bits))
+
         with m.If(self.reset):
-            m.d.sync += self.state.eq(1)
-        with m.Else():
-            m.d.sync += Cat(self.state).eq(Cat(x, self.state))
+            m.d.sync += self.state.eq(self.seed)
+        with m.Elif(self.en):
+            m.d.sync += self.state.eq(self.next)
 
         return m
 
@@ -64,61 +93,409 @@ class PulseStretch(Elaboratable):
         return m
 
 
+def _chunks(n, m):
+    """Returns the (start, stop) bit indices of m near-equal chunks of n."""
+    bounds = [(idx*n)//m for idx in range(m+1)]
+    return list(zip(bounds[:-1], bounds[1:]))
+
+
+def _delay(m, sig, cycles, name):
+    """Returns `sig` delayed by `cycles` registers added to module `m`."""
+    for idx in range(cycles):
+        reg = Signal(len(sig), name=f"{name}_d{idx}")
+        m.d.sync += reg.eq(sig)
+        sig = reg
+    return sig
+
+
 class PipelinedAdder(Elaboratable):
     """
-    Implements an n-wide adder using m pipelined sub-adders.
+    Implements an n-wide adder or subtractor using m pipelined sub-adders.
+
+    The carry between sub-adders is registered, with the inputs to each
+    sub-adder delayed to meet it and the outputs delayed to line back up,
+    so a new addition may start every clock. See `PipelinedAccumulator`
+    for why this is used rather than carry-save form.
+
+    Parameters:
+        * `n`: Width of inputs and output
+        * `m`: Number of sub-adders and pipeline stages, at most `n`
+        * `subtract`: If True, compute `a - b` instead of `a + b`
+
+    Inputs:
+        * `a`, `b`: n-bit unsigned operands
+
+    Outputs:
+        * `c`: n-bit result, `latency` clocks after the inputs
+        * `co`: Carry out of the addition, or high if `a >= b` when
+                subtracting, valid with `c`
     """
-    def __init__(self, n, m):
+    def __init__(self, n, m, subtract=False):
+        if not 1 <= m <= n:
+            raise ValueError(f"m={m} invalid for {n}-bit PipelinedAdder")
+
         self.a = Signal(n)
         self.b = Signal(n)
         self.c = Signal(n)
+        self.co = Signal()
 
         self.n = n
         self.m = m
+        self.subtract = subtract
+        self.latency = m
 
     def elaborate(self, platform):
         m = Module()
 
-        bits_per_sub = self.n//self.m
-        ci = 0
-        for idx in range(self.m):
-            sub_adder = Signal(bits_per_sub+1, name=f"sub{idx}")
-            i0 = idx*bits_per_sub
-            i1 = (idx+1)*bits_per_sub
-            m.d.sync += sub_adder.eq(self.a[i0:i1] + self.b[i0:i1] + ci)
-            m.d.comb += self.c[i0:i1].eq(sub_adder[:bits_per_sub])
+        b = ~self.b if self.subtract else self.b
+        ci = int(self.subtract)
+        for idx, (i0, i1) in enumerate(_chunks(self.n, self.m)):
+            a_sub = _delay(m, self.a[i0:i1], idx, f"a{idx}")
+            b_sub = _delay(m, b[i0:i1], idx, f"b{idx}")
+            sub_adder = Signal(i1-i0+1, name=f"sub{idx}")
+            m.d.sync += sub_adder.eq(a_sub + b_sub + ci)
+            c_sub = _delay(m, sub_adder[:-1], self.m-1-idx, f"c{idx}")
+            m.d.comb += self.c[i0:i1].eq(c_sub)
             ci = sub_adder[-1]
+        m.d.comb += self.co.eq(ci)
 
         return m
 
 
-def test_pipelined_adder():
+class PipelinedComparator(Elaboratable):
+    """
+    Compares two n-wide unsigned values using m pipelined sub-comparators.
+
+    Each stage compares one chunk of the inputs, starting from the least
+    significant, and combines the result with that of the stage before.
+
+    Parameters:
+        * `n`: Width of inputs
+        * `m`: Number of sub-comparators and pipeline stages, at most `n`
+
+    Inputs:
+        * `a`, `b`: n-bit unsigned operands
+
+    Outputs:
+        * `lt`: High if `a < b`, `latency` clocks after the inputs
+        * `eq`: High if `a == b`, valid with `lt`
+    """
+    def __init__(self, n, m):
+        if not 1 <= m <= n:
+            raise ValueError(f"m={m} invalid for {n}-bit PipelinedComparator")
+
+        self.a = Signal(n)
+        self.b = Signal(n)
+        self.lt = Signal()
+        self.eq = Signal()
+
+        self.n = n
+        self.m = m
+        self.latency = m
+
+    def elaborate(self, platform):
+        m = Module()
+
+        lt = 0
+        eq = 1
+        for idx, (i0, i1) in enumerate(_chunks(self.n, self.m)):
+            a_sub = _delay(m, self.a[i0:i1], idx, f"a{idx}")
+            b_sub = _delay(m, self.b[i0:i1], idx, f"b{idx}")
+            lt_sub = Signal(name=f"lt{idx}")
+            eq_sub = Signal(name=f"eq{idx}")
+            m.d.sync += [
+                lt_sub.eq((a_sub < b_sub) | ((a_sub == b_sub) & lt)),
+                eq_sub.eq((a_sub == b_sub) & eq),
+            ]
+            lt, eq = lt_sub, eq_sub
+        m.d.comb += [
+            self.lt.eq(lt),
+            self.eq.eq(eq),
+        ]
+
+        return m
+
+
+class PipelinedAccumulator(Elaboratable):
+    """
+    Implements an n-wide accumulator using m pipelined sub-accumulators.
+
+    Each sub-accumulator adds its chunk of the input and the registered
+    carry from the chunk below, so a new input may be added every clock.
+    The sum wraps modulo 2**n.
+
+    A carry-save accumulator would avoid carry propagation in the loop,
+    but the iCE40 already has a dedicated fast carry chain in each logic
+    cell, so each chunk's adder is about as fast as a carry-save stage.
+    Carry-save would also double the accumulator registers, and its sum
+    and carry vectors would still need a full carry-propagate add to
+    produce `acc` for every input, as the CIC decimator reads it each
+    sample.
+
+    Parameters:
+        * `n`: Width of input and accumulator
+        * `m`: Number of sub-accumulators and pipeline stages, at most `n`
+
+    Inputs:
+        * `x`: n-bit unsigned value to add
+        * `en`: Add `x` to the accumulator while high, high by default
+        * `clear`: Reset the accumulator to zero, ignoring `x`
+
+    Outputs:
+        * `acc`: n-bit accumulated sum, including inputs up to `latency`
+                 clocks ago
+    """
+    def __init__(self, n, m):
+        if not 1 <= m <= n:
+            raise ValueError(
+                f"m={m} invalid for {n}-bit PipelinedAccumulator")
+
+        self.x = Signal(n)
+        self.en = Signal(reset=1)
+        self.clear = Signal()
+        self.acc = Signal(n)
+
+        self.n = n
+        self.m = m
+        self.latency = m
+
+    def elaborate(self, platform):
+        m = Module()
+
+        ci = 0
+        for idx, (i0, i1) in enumerate(_chunks(self.n, self.m)):
+            x_sub = _delay(m, self.x[i0:i1], idx, f"x{idx}")
+            en_sub = _delay(m, self.en, idx, f"en{idx}")
+            clear_sub = _delay(m, self.clear, idx, f"clear{idx}")
+            acc_sub = Signal(i1-i0, name=f"acc{idx}")
+            co = Signal(name=f"co{idx}")
+            with m.If(clear_sub):
+                m.d.sync += [acc_sub.eq(0), co.eq(0)]
+            with m.Elif(en_sub):
+                m.d.sync += Cat(acc_sub, co).eq(acc_sub + x_sub + ci)
+            with m.Else():
+                m.d.sync += co.eq(0)
+            acc_out = _delay(m, acc_sub, self.m-1-idx, f"acc{idx}")
+            m.d.comb += self.acc[i0:i1].eq(acc_out)
+            ci = co
+
+        return m
+
+
+class PipelinedOnesComplementAdder(Elaboratable):
+    """
+    Implements an n-wide one's complement adder, as used by the internet
+    checksum, from two m-stage `PipelinedAdder`s.
+
+    The first adder forms the two's complement sum and the second adds its
+    carry back in, which cannot carry again.
+
+    Parameters:
+        * `n`: Width of inputs and output
+        * `m`: Number of pipeline stages in each adder, at most `n`
+
+    Inputs:
+        * `a`, `b`: n-bit one's complement operands
+
+    Outputs:
+        * `c`: n-bit one's complement sum, `latency` clocks after the inputs
+    """
+    def __init__(self, n, m):
+        self.a = Signal(n)
+        self.b = Signal(n)
+        self.c = Signal(n)
+
+        self.sum = PipelinedAdder(n, m)
+        self.wrap = PipelinedAdder(n, m)
+
+        self.n = n
+        self.m = m
+        self.latency = self.sum.latency + self.wrap.latency
+
+    def elaborate(self, platform):
+        m = Module()
+        m.submodules.sum = self.sum
+        m.submodules.wrap = self.wrap
+
+        m.d.comb += [
+            self.sum.a.eq(self.a),
+            self.sum.b.eq(self.b),
+            self.wrap.a.eq(self.sum.c),
+            self.wrap.b.eq(self.sum.co),
+            self.c.eq(self.wrap.c),
+        ]
+
+        return m
+
+
+def test_lfsr():
     from nmigen.back import pysim
-    import random
 
-    n = 64
-    m = 4
-    adder = PipelinedAdder(n, m)
+    k = 15
+    lfsr1 = LFSR(k)
+    lfsr8 = LFSR(k, n=8)
+
+    def model(state, n):
+        for _ in range(n):
+            x = ((state >> (k-1)) ^ (state >> (LFSR.TAPS[k]-1))) & 1
+            state = ((state << 1) | x) & (2**k - 1)
+        return state
 
     def testbench():
+        # Each register steps by its own number of bits per clock
+        last1 = last8 = None
         for _ in range(100):
-            a = random.randrange(2**n)
-            b = random.randrange(2**n)
             yield
-            yield adder.a.eq(a)
-            yield adder.b.eq(b)
-            for _ in range(m+1):
-                yield
-            assert (yield adder.c) == (a+b) % (2**n)
-
-        yield adder.a.eq(2**n-1)
-        yield adder.b.eq(1)
-        for _ in range(m+1):
+            state1 = (yield lfsr1.state)
+            state8 = (yield lfsr8.state)
+            if last1 is not None:
+                assert state1 == model(last1, 1)
+                assert state8 == model(last8, 8)
+            last1, last8 = state1, state8
+
+        # Loading a seed and holding the register
+        yield lfsr8.seed.eq(0x1234)
+        yield lfsr8.reset.eq(1)
+        yield
+        yield lfsr8.reset.eq(0)
+        yield lfsr8.en.eq(0)
+        yield
+        yield
+        assert (yield lfsr8.state) == 0x1234
+        yield lfsr8.en.eq(1)
+        yield
+        yield
+        assert (yield lfsr8.state) == model(0x1234, 8)
+
+    m = Module()
+    m.submodules += lfsr1, lfsr8
+    vcdf = open("lfsr.vcd", "w")
+    with pysim.Simulator(m, vcd_file=vcdf) as sim:
+        sim.add_clock(1e-6)
+        sim.add_sync_process(testbench())
+        sim.run()
+
+
+def _test_pipeline(dut, vcd, inputs, outputs, model, n=200):
+    """
+    Streams random input values through `dut`, one set per clock, and
+    checks its outputs against `model` after `dut.latency` clocks.
+
+    `inputs` maps input names to functions generating random values,
+    `outputs` lists the output names, and `model` maps the list of all
+    input value dicts so far to a tuple of expected output values.
+    """
+    from nmigen.back import pysim
+
+    def testbench():
+        history = []
+        for cycle in range(n + dut.latency + 1):
+            if cycle < n:
+                values = {name: gen() for name, gen in inputs.items()}
+                for name, value in values.items():
+                    yield getattr(dut, name).eq(value)
+                history.append(values)
             yield
-        assert (yield adder.c) == 0
+            # Outputs seen now follow the inputs set latency+1 clocks ago
+            done = cycle - dut.latency
+            if 0 <= done < n:
+                got = []
+                for name in outputs:
+                    got.append((yield getattr(dut, name)))
+                assert tuple(got) == model(history[:done+1]), \
+                    f"{vcd} mismatch at input {done}"
 
-    vcdf = open("adder.vcd", "w")
-    with pysim.Simulator(adder, vcd_file=vcdf) as sim:
+    vcdf = open(f"{vcd}.vcd", "w")
+    with pysim.Simulator(dut, vcd_file=vcdf) as sim:
         sim.add_clock(1e-6)
         sim.add_sync_process(testbench())
         sim.run()
+
+
+def test_pipelined_adder():
+    import random
+
+    n = 64
+    m = 4
+    adder = PipelinedAdder(n, m)
+
+    # Bias towards values which carry through every sub-adder
+    def operand():
+        return random.choice([random.randrange(2**n), 2**n-1, 1, 0])
+
+    def model(history):
+        a, b = history[-1]["a"], history[-1]["b"]
+        return ((a + b) % 2**n, int(a + b >= 2**n))
+
+    _test_pipeline(adder, "adder", {"a": operand, "b": operand},
+                   ["c", "co"], model)
+
+    # Widths not a multiple of the number of stages
+    n = 30
+    sub = PipelinedAdder(n, 4, subtract=True)
+
+    def model(history):
+        a, b = history[-1]["a"], history[-1]["b"]
+        return ((a - b) % 2**n, int(a >= b))
+
+    _test_pipeline(sub, "subtractor",
+                   {"a": lambda: random.randrange(2**n),
+                    "b": lambda: random.randrange(2**n)},
+                   ["c", "co"], model)
+
+
+def test_pipelined_comparator():
+    import random
+
+    n = 32
+    cmp = PipelinedComparator(n, 3)
+
+    # Pick values which often share their upper bits
+    def operand():
+        return 0x12345600 | random.choice([0x00, 0xFF, random.randrange(256)])
+
+    def model(history):
+        a, b = history[-1]["a"], history[-1]["b"]
+        return (int(a < b), int(a == b))
+
+    _test_pipeline(cmp, "comparator", {"a": operand, "b": operand},
+                   ["lt", "eq"], model)
+
+
+def test_pipelined_accumulator():
+    import random
+
+    n = 24
+    acc = PipelinedAccumulator(n, 4)
+
+    def model(history):
+        total = 0
+        for values in history:
+            if values["clear"]:
+                total = 0
+            elif values["en"]:
+                total = (total + values["x"]) % 2**n
+        return (total,)
+
+    _test_pipeline(acc, "accumulator",
+                   {"x": lambda: random.randrange(2**n),
+                    "en": lambda: int(random.random() < 0.8),
+                    "clear": lambda: int(random.random() < 0.05)},
+                   ["acc"], model)
+
+
+def test_pipelined_ones_complement_adder():
+    import random
+
+    n = 16
+    adder = PipelinedOnesComplementAdder(n, 2)
+
+    def operand():
+        return random.choice([random.randrange(2**n), 0xFFFF, 0x0001])
+
+    def model(history):
+        c = history[-1]["a"] + history[-1]["b"]
+        return ((c & 0xFFFF) + (c >> 16),)
+
+    _test_pipeline(adder, "ones_complement_adder",
+                   {"a": operand, "b": operand}, ["c"], model)
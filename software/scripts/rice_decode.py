@@ -0,0 +1,85 @@
+import argparse
+import numpy as np
+
+
+def get_args():
+    parser = argparse.ArgumentParser(
+        description="Decode a block of samples from the gateware's "
+                    "RiceEncoder")
+    parser.add_argument("filename")
+    parser.add_argument("count", type=int, help="number of samples")
+    parser.add_argument("width", type=int, help="sample width in bits")
+    parser.add_argument("k", type=int, help="Rice parameter")
+    return parser.parse_args()
+
+
+def windows(bits, starts, length):
+    """
+    Returns the `length`-bit big-endian integers starting at each of
+    `starts` in `bits`, which must be padded by at least `length` bits.
+    """
+    values = np.zeros(len(starts), dtype=np.int64)
+    for idx in range(length):
+        values = (values << 1) | bits[starts + idx]
+    return values
+
+
+def decode(data, count, width, k):
+    """
+    Decodes `count` signed samples of `width` bits from the bytes `data`,
+    a block flushed from a RiceEncoder using Rice parameter `k`.
+
+    Each code is a run of one bits, a zero, and `k` bits, or `width` one
+    bits and `width` bits for escaped codes. The code starting at every bit
+    position is found at once, then the codes actually present are picked
+    out by following each code to the next, doubling the number of codes
+    found on each pass.
+    """
+    bits = np.unpackbits(np.frombuffer(data, dtype=np.uint8))
+    bits = bits.astype(np.int64)
+    n = len(bits)
+    positions = np.arange(n)
+
+    # Find the first zero bit at or after every position
+    zeros = np.where(bits == 0, positions, n)
+    first_zero = np.minimum.accumulate(zeros[::-1])[::-1]
+    run = first_zero - positions
+    escape = run >= width
+    code_len = np.where(escape, 2 * width, run + 1 + k)
+
+    # Position of the next code after one starting at each position, with
+    # position `n` standing for the end of the data
+    jump = np.append(np.minimum(positions + code_len, n), n)
+    starts = np.zeros(1, dtype=np.int64)
+    while len(starts) < count:
+        starts = np.concatenate([starts, jump[starts]])
+        jump = jump[jump]
+    starts = starts[:count]
+    if count and starts[-1] >= n:
+        raise ValueError("Not enough data for sample count")
+
+    padded = np.concatenate([bits, np.zeros(2 * width + k, dtype=np.int64)])
+    esc = escape[starts]
+    u = np.where(esc,
+                 windows(padded, starts + width, width),
+                 (run[starts] << k) |
+                 windows(padded, first_zero[starts] + 1, k))
+
+    # Undo the zigzag mapping and the delta coding
+    delta = (u >> 1) ^ -(u & 1)
+    samples = np.cumsum(delta) % 2**width
+    return np.where(samples >= 2**(width - 1), samples - 2**width, samples)
+
+
+def main():
+    args = get_args()
+    with open(args.filename, "rb") as f:
+        data = f.read()
+    samples = decode(data, args.count, args.width, args.k)
+    ratio = args.count * args.width / (8 * len(data))
+    print(f"Decoded {len(samples)} samples, compression ratio {ratio:.2f}")
+    print(samples)
+
+
+if __name__ == "__main__":
+    main()
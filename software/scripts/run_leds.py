@@ -13,7 +13,7 @@ def get_args():
 
 def set_leds(s, led1, led2):
     data = int(led1) | (int(led2) << 1)
-    s.send(struct.pack("B", data) + b"\x00"*15)
+    s.send(struct.pack("B", data) + b"\x00"*63)
 
 
 def main():
@@ -0,0 +1,645 @@
+"""
+DAQnet CSR host bindings.
+
+Generated by daqnet.csr.generate_bindings, do not edit.
+"""
+
+import socket
+import struct
+
+
+COMMAND = 0x52
+WRITE = 0x80
+PACKET_LEN = 64
+MAX_OPS = 12
+
+# Register name: (address, width, access)
+REGISTERS = {
+    # Interpacket gap in byte times, at least 12
+    "tx_ipg": (0, 8, "rw"),
+    # Maximum transmit rate in units of 1/65536 of the line rate, or 0
+    # for no limit
+    "tx_rate": (1, 16, "rw"),
+    # Bits 31:0 of the mask of multicast address hashes to receive
+    "multicast_hash_lo": (2, 32, "rw"),
+    # Bits 63:32 of the mask of multicast address hashes to receive
+    "multicast_hash_hi": (3, 32, "rw"),
+    # First two bytes of additional MAC address 0
+    "mac_table0_hi": (4, 16, "rw"),
+    # Last four bytes of additional MAC address 0
+    "mac_table0_lo": (5, 32, "rw"),
+    # First two bytes of additional MAC address 1
+    "mac_table1_hi": (6, 16, "rw"),
+    # Last four bytes of additional MAC address 1
+    "mac_table1_lo": (7, 32, "rw"),
+    # Mask of additional MAC addresses to receive
+    "mac_table_valid": (8, 2, "rw"),
+    # Bit 0 set while the link is up, bit 1 set at 10Mbps
+    "link_status": (9, 2, "ro"),
+    # Most received packets waiting at once
+    "rx_fifo_hwm": (10, 8, "ro"),
+    # Most packets waiting at once to be transmitted
+    "tx_fifo_hwm": (11, 8, "ro"),
+    # Received packets dropped as the RX FIFO was full
+    "rx_dropped": (12, 32, "ro"),
+    # Packets dropped as the TX FIFO was full
+    "tx_dropped": (13, 32, "ro"),
+    # Runt frames received
+    "rx_runt_errors": (14, 32, "ro"),
+    # Oversize frames received
+    "rx_oversize_errors": (15, 32, "ro"),
+    # Frames received not ending on a byte boundary
+    "rx_align_errors": (16, 32, "ro"),
+    # Frames received with a bad FCS
+    "rx_crc_errors": (17, 32, "ro"),
+    # Frames discarded by destination, ethertype or protocol
+    "rx_filtered_frames": (18, 32, "ro"),
+    # Times the link has gone down
+    "link_down_events": (19, 32, "ro"),
+    # Packets discarded as the link was down
+    "tx_flushed_frames": (20, 32, "ro"),
+    # Set while transmission is paused by the link partner
+    "tx_paused": (21, 1, "ro"),
+    # PAUSE frames received
+    "rx_pause_frames": (22, 32, "ro"),
+    # PAUSE frames transmitted
+    "tx_pause_frames": (23, 32, "ro"),
+    # Bytes of TX memory not used by packets waiting to be sent
+    "tx_free": (24, 12, "ro"),
+    # Times processing stalled waiting for free TX memory
+    "tx_full_events": (25, 32, "ro"),
+    # Set to send PRBS link test packets
+    "prbs_tx_enable": (26, 1, "rw"),
+    # UDP payload length of PRBS packets, from 5 to 1472
+    "prbs_tx_len": (27, 11, "rw"),
+    # Write to clear the PRBS receive counters
+    "prbs_rx_clear": (28, 1, "rw"),
+    # PRBS packets sent
+    "prbs_tx_frames": (29, 32, "ro"),
+    # PRBS packets received
+    "prbs_rx_frames": (30, 32, "ro"),
+    # PRBS packets lost
+    "prbs_rx_lost": (31, 32, "ro"),
+    # PRBS bit errors
+    "prbs_rx_bit_errors": (32, 32, "ro"),
+    # Clocks between test source samples, less one
+    "source_period": (33, 16, "rw"),
+    # Increment of the test source sawtooth per sample
+    "source_step": (34, 16, "rw"),
+    # log2 of the sample decimation ratio, at most 8
+    "decim_log2_ratio": (35, 4, "rw"),
+    # Set to filter decimated samples, which then drops samples arriving
+    # within 5 clocks of the previous one
+    "decim_fir_en": (36, 1, "rw"),
+    # Trigger mode: 0 off, 1 above, 2 at or below, 3 rising through or 4
+    # falling through trigger_level
+    "trigger_mode": (37, 3, "rw"),
+    # Trigger threshold, two's complement
+    "trigger_level": (38, 16, "rw"),
+    # Samples captured before the trigger, at most 1023
+    "capture_pre_len": (39, 11, "rw"),
+    # Samples captured from the trigger, at least 1, and reduced to fit
+    # 1024 samples with capture_pre_len
+    "capture_post_len": (40, 11, "rw"),
+    # Write to arm the capture
+    "capture_arm": (41, 1, "rw"),
+    # Set to arm the capture again after each is sent
+    "capture_rearm": (42, 1, "rw"),
+    # Bit 0 set while armed, bit 1 set from the trigger until the
+    # capture has been read out for sending
+    "capture_status": (43, 2, "ro"),
+    # Most capture bytes in each packet, or 0 to pause sending
+    "capture_tx_len": (44, 11, "rw"),
+    # Capture packets sent
+    "capture_tx_frames": (45, 32, "ro"),
+    # Set to send captures Rice encoded instead of as raw samples,
+    # changing only once a capture has been sent
+    "capture_rice": (46, 1, "rw"),
+    # Rice parameter for encoded captures, at most 15
+    "rice_k": (47, 4, "rw"),
+    # Samples Rice encoded
+    "rice_samples_in": (48, 32, "ro"),
+    # Bytes produced by the Rice encoder, which with rice_samples_in
+    # gives the compression ratio
+    "rice_bytes_out": (49, 32, "ro"),
+}
+
+
+def encode_request(ops):
+    """
+    Returns a request packet for a list of (name, value) ops, which
+    read the register if value is None and write it otherwise.
+    """
+    if len(ops) > MAX_OPS:
+        raise ValueError(f"At most {MAX_OPS} ops per packet")
+    packet = struct.pack("BB", COMMAND, len(ops))
+    for name, value in ops:
+        addr, width, access = REGISTERS[name]
+        if value is None:
+            packet += struct.pack(">BI", addr, 0)
+        elif access != "rw":
+            raise ValueError(f"{name} is read-only")
+        else:
+            packet += struct.pack(">BI", addr | WRITE,
+                                  value & (2**width - 1))
+    return packet + bytes(PACKET_LEN - len(packet))
+
+
+def decode_reply(packet, ops):
+    """
+    Returns the register values after each op in a reply packet.
+    """
+    if packet[0] != COMMAND or packet[1] != len(ops):
+        raise ValueError("Reply does not match request")
+    values = []
+    for idx in range(len(ops)):
+        offset = 2 + 5 * idx
+        values.append(struct.unpack(">I",
+                                    packet[offset+1:offset+5])[0])
+    return values
+
+
+class CSRClient:
+    """
+    Accesses the registers over UDP, with a property per register.
+    """
+    def __init__(self, address, port, timeout=1.0):
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.settimeout(timeout)
+        self.sock.connect((address, port))
+
+    def batch(self, ops):
+        """
+        Carries out a list of (name, value) ops in one round trip,
+        returning the register values after each op.
+        """
+        values = []
+        for idx in range(0, len(ops), MAX_OPS):
+            chunk = ops[idx:idx+MAX_OPS]
+            self.sock.send(encode_request(chunk))
+            reply = self.sock.recv(PACKET_LEN)
+            values += decode_reply(reply, chunk)
+        return values
+
+    def read(self, name):
+        return self.batch([(name, None)])[0]
+
+    def write(self, name, value):
+        return self.batch([(name, value)])[0]
+
+    @property
+    def tx_ipg(self):
+        """
+        Interpacket gap in byte times, at least 12
+        """
+        return self.read("tx_ipg")
+
+    @tx_ipg.setter
+    def tx_ipg(self, value):
+        self.write("tx_ipg", value)
+
+    @property
+    def tx_rate(self):
+        """
+        Maximum transmit rate in units of 1/65536 of the line rate, or 0
+        for no limit
+        """
+        return self.read("tx_rate")
+
+    @tx_rate.setter
+    def tx_rate(self, value):
+        self.write("tx_rate", value)
+
+    @property
+    def multicast_hash_lo(self):
+        """
+        Bits 31:0 of the mask of multicast address hashes to receive
+        """
+        return self.read("multicast_hash_lo")
+
+    @multicast_hash_lo.setter
+    def multicast_hash_lo(self, value):
+        self.write("multicast_hash_lo", value)
+
+    @property
+    def multicast_hash_hi(self):
+        """
+        Bits 63:32 of the mask of multicast address hashes to receive
+        """
+        return self.read("multicast_hash_hi")
+
+    @multicast_hash_hi.setter
+    def multicast_hash_hi(self, value):
+        self.write("multicast_hash_hi", value)
+
+    @property
+    def mac_table0_hi(self):
+        """
+        First two bytes of additional MAC address 0
+        """
+        return self.read("mac_table0_hi")
+
+    @mac_table0_hi.setter
+    def mac_table0_hi(self, value):
+        self.write("mac_table0_hi", value)
+
+    @property
+    def mac_table0_lo(self):
+        """
+        Last four bytes of additional MAC address 0
+        """
+        return self.read("mac_table0_lo")
+
+    @mac_table0_lo.setter
+    def mac_table0_lo(self, value):
+        self.write("mac_table0_lo", value)
+
+    @property
+    def mac_table1_hi(self):
+        """
+        First two bytes of additional MAC address 1
+        """
+        return self.read("mac_table1_hi")
+
+    @mac_table1_hi.setter
+    def mac_table1_hi(self, value):
+        self.write("mac_table1_hi", value)
+
+    @property
+    def mac_table1_lo(self):
+        """
+        Last four bytes of additional MAC address 1
+        """
+        return self.read("mac_table1_lo")
+
+    @mac_table1_lo.setter
+    def mac_table1_lo(self, value):
+        self.write("mac_table1_lo", value)
+
+    @property
+    def mac_table_valid(self):
+        """
+        Mask of additional MAC addresses to receive
+        """
+        return self.read("mac_table_valid")
+
+    @mac_table_valid.setter
+    def mac_table_valid(self, value):
+        self.write("mac_table_valid", value)
+
+    @property
+    def link_status(self):
+        """
+        Bit 0 set while the link is up, bit 1 set at 10Mbps
+        """
+        return self.read("link_status")
+
+    @property
+    def rx_fifo_hwm(self):
+        """
+        Most received packets waiting at once
+        """
+        return self.read("rx_fifo_hwm")
+
+    @property
+    def tx_fifo_hwm(self):
+        """
+        Most packets waiting at once to be transmitted
+        """
+        return self.read("tx_fifo_hwm")
+
+    @property
+    def rx_dropped(self):
+        """
+        Received packets dropped as the RX FIFO was full
+        """
+        return self.read("rx_dropped")
+
+    @property
+    def tx_dropped(self):
+        """
+        Packets dropped as the TX FIFO was full
+        """
+        return self.read("tx_dropped")
+
+    @property
+    def rx_runt_errors(self):
+        """
+        Runt frames received
+        """
+        return self.read("rx_runt_errors")
+
+    @property
+    def rx_oversize_errors(self):
+        """
+        Oversize frames received
+        """
+        return self.read("rx_oversize_errors")
+
+    @property
+    def rx_align_errors(self):
+        """
+        Frames received not ending on a byte boundary
+        """
+        return self.read("rx_align_errors")
+
+    @property
+    def rx_crc_errors(self):
+        """
+        Frames received with a bad FCS
+        """
+        return self.read("rx_crc_errors")
+
+    @property
+    def rx_filtered_frames(self):
+        """
+        Frames discarded by destination, ethertype or protocol
+        """
+        return self.read("rx_filtered_frames")
+
+    @property
+    def link_down_events(self):
+        """
+        Times the link has gone down
+        """
+        return self.read("link_down_events")
+
+    @property
+    def tx_flushed_frames(self):
+        """
+        Packets discarded as the link was down
+        """
+        return self.read("tx_flushed_frames")
+
+    @property
+    def tx_paused(self):
+        """
+        Set while transmission is paused by the link partner
+        """
+        return self.read("tx_paused")
+
+    @property
+    def rx_pause_frames(self):
+        """
+        PAUSE frames received
+        """
+        return self.read("rx_pause_frames")
+
+    @property
+    def tx_pause_frames(self):
+        """
+        PAUSE frames transmitted
+        """
+        return self.read("tx_pause_frames")
+
+    @property
+    def tx_free(self):
+        """
+        Bytes of TX memory not used by packets waiting to be sent
+        """
+        return self.read("tx_free")
+
+    @property
+    def tx_full_events(self):
+        """
+        Times processing stalled waiting for free TX memory
+        """
+        return self.read("tx_full_events")
+
+    @property
+    def prbs_tx_enable(self):
+        """
+        Set to send PRBS link test packets
+        """
+        return self.read("prbs_tx_enable")
+
+    @prbs_tx_enable.setter
+    def prbs_tx_enable(self, value):
+        self.write("prbs_tx_enable", value)
+
+    @property
+    def prbs_tx_len(self):
+        """
+        UDP payload length of PRBS packets, from 5 to 1472
+        """
+        return self.read("prbs_tx_len")
+
+    @prbs_tx_len.setter
+    def prbs_tx_len(self, value):
+        self.write("prbs_tx_len", value)
+
+    @property
+    def prbs_rx_clear(self):
+        """
+        Write to clear the PRBS receive counters
+        """
+        return self.read("prbs_rx_clear")
+
+    @prbs_rx_clear.setter
+    def prbs_rx_clear(self, value):
+        self.write("prbs_rx_clear", value)
+
+    @property
+    def prbs_tx_frames(self):
+        """
+        PRBS packets sent
+        """
+        return self.read("prbs_tx_frames")
+
+    @property
+    def prbs_rx_frames(self):
+        """
+        PRBS packets received
+        """
+        return self.read("prbs_rx_frames")
+
+    @property
+    def prbs_rx_lost(self):
+        """
+        PRBS packets lost
+        """
+        return self.read("prbs_rx_lost")
+
+    @property
+    def prbs_rx_bit_errors(self):
+        """
+        PRBS bit errors
+        """
+        return self.read("prbs_rx_bit_errors")
+
+    @property
+    def source_period(self):
+        """
+        Clocks between test source samples, less one
+        """
+        return self.read("source_period")
+
+    @source_period.setter
+    def source_period(self, value):
+        self.write("source_period", value)
+
+    @property
+    def source_step(self):
+        """
+        Increment of the test source sawtooth per sample
+        """
+        return self.read("source_step")
+
+    @source_step.setter
+    def source_step(self, value):
+        self.write("source_step", value)
+
+    @property
+    def decim_log2_ratio(self):
+        """
+        log2 of the sample decimation ratio, at most 8
+        """
+        return self.read("decim_log2_ratio")
+
+    @decim_log2_ratio.setter
+    def decim_log2_ratio(self, value):
+        self.write("decim_log2_ratio", value)
+
+    @property
+    def decim_fir_en(self):
+        """
+        Set to filter decimated samples, which then drops samples
+        arriving within 5 clocks of the previous one
+        """
+        return self.read("decim_fir_en")
+
+    @decim_fir_en.setter
+    def decim_fir_en(self, value):
+        self.write("decim_fir_en", value)
+
+    @property
+    def trigger_mode(self):
+        """
+        Trigger mode: 0 off, 1 above, 2 at or below, 3 rising through or
+        4 falling through trigger_level
+        """
+        return self.read("trigger_mode")
+
+    @trigger_mode.setter
+    def trigger_mode(self, value):
+        self.write("trigger_mode", value)
+
+    @property
+    def trigger_level(self):
+        """
+        Trigger threshold, two's complement
+        """
+        return self.read("trigger_level")
+
+    @trigger_level.setter
+    def trigger_level(self, value):
+        self.write("trigger_level", value)
+
+    @property
+    def capture_pre_len(self):
+        """
+        Samples captured before the trigger, at most 1023
+        """
+        return self.read("capture_pre_len")
+
+    @capture_pre_len.setter
+    def capture_pre_len(self, value):
+        self.write("capture_pre_len", value)
+
+    @property
+    def capture_post_len(self):
+        """
+        Samples captured from the trigger, at least 1, and reduced to
+        fit 1024 samples with capture_pre_len
+        """
+        return self.read("capture_post_len")
+
+    @capture_post_len.setter
+    def capture_post_len(self, value):
+        self.write("capture_post_len", value)
+
+    @property
+    def capture_arm(self):
+        """
+        Write to arm the capture
+        """
+        return self.read("capture_arm")
+
+    @capture_arm.setter
+    def capture_arm(self, value):
+        self.write("capture_arm", value)
+
+    @property
+    def capture_rearm(self):
+        """
+        Set to arm the capture again after each is sent
+        """
+        return self.read("capture_rearm")
+
+    @capture_rearm.setter
+    def capture_rearm(self, value):
+        self.write("capture_rearm", value)
+
+    @property
+    def capture_status(self):
+        """
+        Bit 0 set while armed, bit 1 set from the trigger until the
+        capture has been read out for sending
+        """
+        return self.read("capture_status")
+
+    @property
+    def capture_tx_len(self):
+        """
+        Most capture bytes in each packet, or 0 to pause sending
+        """
+        return self.read("capture_tx_len")
+
+    @capture_tx_len.setter
+    def capture_tx_len(self, value):
+        self.write("capture_tx_len", value)
+
+    @property
+    def capture_tx_frames(self):
+        """
+        Capture packets sent
+        """
+        return self.read("capture_tx_frames")
+
+    @property
+    def capture_rice(self):
+        """
+        Set to send captures Rice encoded instead of as raw samples,
+        changing only once a capture has been sent
+        """
+        return self.read("capture_rice")
+
+    @capture_rice.setter
+    def capture_rice(self, value):
+        self.write("capture_rice", value)
+
+    @property
+    def rice_k(self):
+        """
+        Rice parameter for encoded captures, at most 15
+        """
+        return self.read("rice_k")
+
+    @rice_k.setter
+    def rice_k(self, value):
+        self.write("rice_k", value)
+
+    @property
+    def rice_samples_in(self):
+        """
+        Samples Rice encoded
+        """
+        return self.read("rice_samples_in")
+
+    @property
+    def rice_bytes_out(self):
+        """
+        Bytes produced by the Rice encoder, which with rice_samples_in
+        gives the compression ratio
+        """
+        return self.read("rice_bytes_out")
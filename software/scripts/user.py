@@ -15,7 +15,7 @@ def main():
     args = get_args()
     s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM, 0)
     s.connect((args.address, int(args.port)))
-    s.send(struct.pack("B", int(args.data, 0)) + b"\x00"*15)
+    s.send(struct.pack("B", int(args.data, 0)) + b"\x00"*63)
     s.close()
 
 